@@ -0,0 +1,298 @@
+"""In-memory authorization cache for Authorize / StartTransaction.
+
+A card tap used to open a connection per lookup: ``id_tags``, then
+``resolve_account_by_card`` / ``ensure_legacy_account_for_card``, then the
+``account_cards``/``household_accounts``/``card_whitelist`` join again in
+StartTransaction.  ``AuthorizationCache`` keeps one ``Authorization`` per
+id_tag, loaded on a cold miss by a single joined query
+(``load_authorization``), so a warm tap makes no SQLite call at all.
+
+Freshness rules:
+
+- writers invalidate explicitly after commit: ``invalidate_card`` for
+  id_tag / card / whitelist / reservation changes, ``invalidate_account`` for
+  household status and balance changes (top-up, settlement debit);
+- entries also expire after ``ttl_s`` as a backstop for writes made outside
+  this process (e.g. ``migrate_household_accounts.py``);
+- every invalidation bumps a generation counter and a load that raced an
+  invalidation is returned but not stored;
+- unknown id_tags are never cached: every unknown tap still goes through the
+  enrollment capture / audit path.
+
+This module intentionally has no FastAPI or OCPP dependency.
+"""
+
+from __future__ import annotations
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable
+
+
+BALANCE_POSITIVE = "positive"
+BALANCE_EMPTY = "empty"
+
+AUTHORIZATION_SQL = """
+    SELECT it.id_tag, it.status, it.valid_until,
+           ac.account_id, ac.status AS card_status,
+           ha.status AS account_status, ha.balance,
+           ha.floor_no, ha.parking_space_no,
+           (
+               SELECT GROUP_CONCAT(cw.charge_point_id, char(31))
+               FROM card_whitelist cw
+               WHERE cw.card_id = it.id_tag
+           ) AS allowed_charge_points,
+           EXISTS(
+               SELECT 1 FROM reservations r
+               WHERE r.id_tag = it.id_tag AND r.status = 'active'
+           ) AS has_active_reservation,
+           EXISTS(SELECT 1 FROM cards c WHERE c.card_id = it.id_tag) AS legacy_card
+    FROM id_tags it
+    LEFT JOIN account_cards ac ON ac.card_id = it.id_tag
+    LEFT JOIN household_accounts ha ON ha.account_id = ac.account_id
+    WHERE it.id_tag = ?
+"""
+
+
+def balance_class(balance: Any) -> str:
+    """StartTransaction 只需要知道餘額是否 > 0。"""
+    try:
+        return BALANCE_POSITIVE if float(balance or 0) > 0 else BALANCE_EMPTY
+    except (TypeError, ValueError):
+        return BALANCE_EMPTY
+
+
+@dataclass(frozen=True)
+class Authorization:
+    id_tag: str
+    status: str | None
+    valid_until: str | None
+    account_id: int | None
+    card_status: str | None
+    account_status: str | None
+    balance_class: str
+    floor_no: str | None
+    parking_space_no: str | None
+    allowed_charge_points: frozenset[str]
+    has_active_reservation: bool
+    legacy_card: bool
+
+    @property
+    def has_account(self) -> bool:
+        return self.account_id is not None
+
+    @property
+    def account_active(self) -> bool:
+        return self.card_status == "active" and self.account_status == "active"
+
+    def authorize_status(self) -> str:
+        """Authorize 回覆：id_tag Accepted 且卡片、戶號皆 active。"""
+        if self.status == "Accepted" and self.has_account and self.account_active:
+            return "Accepted"
+        return "Blocked"
+
+    def allows_charge_point(self, charge_point_id: str) -> bool:
+        return charge_point_id in self.allowed_charge_points
+
+
+def load_authorization(conn: sqlite3.Connection, id_tag: str) -> Authorization | None:
+    """Cold-miss path: one joined query; None when the id_tag is unknown."""
+    row = conn.execute(AUTHORIZATION_SQL, (id_tag,)).fetchone()
+    if row is None:
+        return None
+    (
+        tag,
+        status,
+        valid_until,
+        account_id,
+        card_status,
+        account_status,
+        balance,
+        floor_no,
+        parking_space_no,
+        allowed,
+        has_reservation,
+        legacy_card,
+    ) = tuple(row)
+    return Authorization(
+        id_tag=tag,
+        status=status,
+        valid_until=valid_until,
+        account_id=int(account_id) if account_id is not None else None,
+        card_status=card_status,
+        account_status=account_status,
+        balance_class=balance_class(balance),
+        floor_no=floor_no,
+        parking_space_no=parking_space_no,
+        allowed_charge_points=frozenset(allowed.split("\x1f")) if allowed else frozenset(),
+        has_active_reservation=bool(has_reservation),
+        legacy_card=bool(legacy_card),
+    )
+
+
+@dataclass
+class AuthorizationCacheStats:
+    hits: int = 0
+    misses: int = 0
+    unknown: int = 0
+    stale_loads: int = 0
+    invalidations: int = 0
+    evictions: int = 0
+
+
+class AuthorizationCache:
+    """
+    Thread-safe LRU + TTL cache of ``Authorization`` keyed by id_tag.
+
+    ``scope`` is the database path: switching databases drops every entry,
+    so an entry can never answer for another database file.
+    """
+
+    def __init__(
+        self,
+        ttl_s: float = 60.0,
+        max_entries: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ttl_s = float(ttl_s)
+        self.max_entries = max(1, int(max_entries))
+        self.clock = clock
+        self.stats = AuthorizationCacheStats()
+        self._entries: OrderedDict[str, tuple[Authorization, float]] = OrderedDict()
+        self._scope: str | None = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def configure(self, *, ttl_s: float | None = None, max_entries: int | None = None) -> None:
+        with self._lock:
+            if ttl_s is not None:
+                self.ttl_s = float(ttl_s)
+            if max_entries is not None:
+                self.max_entries = max(1, int(max_entries))
+            self._drop_all()
+
+    def _drop_all(self) -> None:
+        self._entries.clear()
+        self._generation += 1
+
+    def get(
+        self,
+        scope: str,
+        id_tag: str,
+        loader: Callable[[str], Authorization | None],
+    ) -> Authorization | None:
+        """Return the cached entry, or call ``loader(id_tag)`` on a miss."""
+        with self._lock:
+            if scope != self._scope:
+                self._drop_all()
+                self._scope = scope
+            cached = self._entries.get(id_tag)
+            if cached is not None and cached[1] > self.clock():
+                self._entries.move_to_end(id_tag)
+                self.stats.hits += 1
+                return cached[0]
+            self._entries.pop(id_tag, None)
+            generation = self._generation
+
+        entry = loader(id_tag)
+
+        with self._lock:
+            self.stats.misses += 1
+            if entry is None:
+                self.stats.unknown += 1
+            elif generation != self._generation or scope != self._scope:
+                # 載入期間有寫入：回傳本次結果但不寫入快取
+                self.stats.stale_loads += 1
+            elif self.ttl_s > 0:
+                self._entries[id_tag] = (entry, self.clock() + self.ttl_s)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.stats.evictions += 1
+        return entry
+
+    def invalidate_card(self, id_tag: str | None) -> None:
+        if not id_tag:
+            return
+        with self._lock:
+            self._generation += 1
+            self.stats.invalidations += 1
+            self._entries.pop(str(id_tag), None)
+            self._entries.pop(str(id_tag).strip(), None)
+
+    def invalidate_account(self, account_id: int | None) -> None:
+        if account_id is None:
+            return
+        with self._lock:
+            self._generation += 1
+            self.stats.invalidations += 1
+            for key in [
+                key
+                for key, (entry, _) in self._entries.items()
+                if entry.account_id == int(account_id)
+            ]:
+                self._entries.pop(key, None)
+
+    def invalidate_many(self, id_tags=(), account_ids=()) -> None:
+        """Bulk admin writes: one generation bump for the whole batch."""
+        cards = {str(id_tag).strip() for id_tag in id_tags if id_tag}
+        accounts = {int(account_id) for account_id in account_ids if account_id is not None}
+        if not cards and not accounts:
+            return
+        with self._lock:
+            self._generation += 1
+            self.stats.invalidations += 1
+            for key in [
+                key
+                for key, (entry, _) in self._entries.items()
+                if key.strip() in cards or entry.account_id in accounts
+            ]:
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.stats.invalidations += 1
+            self._drop_all()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def snapshot(self) -> dict[str, Any]:
+        stats = self.stats
+        lookups = stats.hits + stats.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl_s,
+            "generation": self._generation,
+            "hits": stats.hits,
+            "misses": stats.misses,
+            "hit_ratio": round(stats.hits / lookups, 4) if lookups else None,
+            "unknown": stats.unknown,
+            "stale_loads": stats.stale_loads,
+            "invalidations": stats.invalidations,
+            "evictions": stats.evictions,
+        }
+
+
+# Process-wide instance shared by main.py (readers) and
+# household_account_service.py (writers).
+authorization_cache = AuthorizationCache()
+
+
+def invalidate_card(id_tag: str | None) -> None:
+    authorization_cache.invalidate_card(id_tag)
+
+
+def invalidate_account(account_id: int | None) -> None:
+    authorization_cache.invalidate_account(account_id)
+
+
+def invalidate_many(id_tags=(), account_ids=()) -> None:
+    authorization_cache.invalidate_many(id_tags, account_ids)
+
+
+def clear() -> None:
+    authorization_cache.clear()
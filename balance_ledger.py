@@ -0,0 +1,443 @@
+"""Append-only household balance ledger.
+
+Every change to a household balance is one ``household_balance_ledger`` row
+(``opening`` / ``topup`` / ``debit`` / ``refund`` / ``adjustment``) carrying
+the signed amount and the balance before and after it.  Rows are write-once:
+triggers reject UPDATE and DELETE.
+
+``household_accounts.balance`` stays as the cached, materialized balance that
+authorization, the balance monitor and the admin UI already read.  It is only
+written by the ledger's AFTER INSERT trigger, so a top-up or a StopTransaction
+debit is a single ``INSERT ... SELECT`` statement: the write lock is held for
+one statement instead of a read / compute / update round trip.
+
+- ``idempotency_key`` is UNIQUE; StopTransaction uses
+  ``settlement:<tx_id>:<account_id>:<start_timestamp>`` so a replayed
+  settlement can never debit twice;
+- debits are clamped at zero (the amount recorded is what was actually
+  taken), matching the previous ``max(0, before - charge)`` rule;
+- ``rollup`` recomputes every account from the ledger and reports (or, with
+  ``repair=True``, records an ``adjustment`` for) any drift of the cache.
+
+This module intentionally has no FastAPI or OCPP dependency.
+"""
+
+from __future__ import annotations
+
+import sqlite3
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Any
+
+
+LEDGER_TABLE = "household_balance_ledger"
+ENTRY_TYPES = ("opening", "topup", "debit", "refund", "adjustment")
+MONEY_QUANT = Decimal("0.01")
+# REAL 金額比對容許的誤差（小於 1 分）
+DRIFT_TOLERANCE = 0.005
+
+LEDGER_SCHEMA = (
+    f"""
+    CREATE TABLE IF NOT EXISTS {LEDGER_TABLE} (
+        entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        account_id INTEGER NOT NULL,
+        entry_type TEXT NOT NULL,
+        amount REAL NOT NULL,
+        balance_before REAL NOT NULL,
+        balance_after REAL NOT NULL,
+        idempotency_key TEXT UNIQUE,
+        transaction_id INTEGER,
+        note TEXT,
+        created_at TEXT NOT NULL,
+        FOREIGN KEY (account_id) REFERENCES household_accounts(account_id),
+        CHECK (entry_type IN ('opening','topup','debit','refund','adjustment')),
+        CHECK (balance_after >= 0)
+    )
+    """,
+    f"""
+    CREATE INDEX IF NOT EXISTS idx_household_balance_ledger_account
+    ON {LEDGER_TABLE}(account_id, entry_id)
+    """,
+    f"""
+    CREATE INDEX IF NOT EXISTS idx_household_balance_ledger_tx
+    ON {LEDGER_TABLE}(transaction_id)
+    WHERE transaction_id IS NOT NULL
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_household_balance_ledger_no_update
+    BEFORE UPDATE ON {LEDGER_TABLE}
+    BEGIN
+        SELECT RAISE(ABORT, '{LEDGER_TABLE} is append-only');
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_household_balance_ledger_no_delete
+    BEFORE DELETE ON {LEDGER_TABLE}
+    BEGIN
+        SELECT RAISE(ABORT, '{LEDGER_TABLE} is append-only');
+    END
+    """,
+    # 快取餘額只由帳本維護；opening 列是既有餘額的起點，不需回寫
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_household_balance_ledger_cache
+    AFTER INSERT ON {LEDGER_TABLE}
+    WHEN NEW.entry_type != 'opening'
+    BEGIN
+        UPDATE household_accounts
+        SET balance = NEW.balance_after, updated_at = NEW.created_at
+        WHERE account_id = NEW.account_id;
+    END
+    """,
+)
+
+
+class LedgerError(ValueError):
+    """A ledger write was rejected (unknown account, negative balance, ...)."""
+
+
+@dataclass(frozen=True)
+class LedgerEntry:
+    entry_id: int
+    account_id: int
+    entry_type: str
+    amount: float
+    balance_before: float
+    balance_after: float
+    idempotency_key: str | None
+    transaction_id: int | None
+    note: str | None
+    created_at: str
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+ENTRY_COLUMNS = ", ".join(LedgerEntry.__dataclass_fields__)
+
+
+def utc_iso() -> str:
+    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+
+
+def money(value: Any) -> Decimal:
+    try:
+        return Decimal(str(value or 0)).quantize(MONEY_QUANT, rounding=ROUND_HALF_UP)
+    except Exception as exc:
+        raise LedgerError("invalid amount") from exc
+
+
+def settlement_idempotency_key(
+    transaction_id: int,
+    account_id: int | None = None,
+    start_timestamp: str | None = None,
+) -> str:
+    """
+    ``transactions.transaction_id`` is not AUTOINCREMENT, so an id can come
+    back after rows are deleted; the account and start time pin the key to
+    one charging session.
+    """
+    parts = [str(int(transaction_id))]
+    if account_id is not None:
+        parts.append(str(int(account_id)))
+    if start_timestamp:
+        parts.append(str(start_timestamp))
+    return "settlement:" + ":".join(parts)
+
+
+def settlement_key_for_transaction(conn, transaction_id: int, account_id: int | None = None) -> str:
+    """
+    ``settlement_idempotency_key`` with the start time read from
+    ``transactions``.  Every settlement debit (StopTransaction,
+    ``debit_household_account_atomic``) builds its key here, so one session
+    has one key whichever path posts it.
+    """
+    row = conn.execute(
+        "SELECT start_timestamp FROM transactions WHERE transaction_id = ?",
+        (int(transaction_id),),
+    ).fetchone()
+    return settlement_idempotency_key(transaction_id, account_id, row[0] if row else None)
+
+
+def _entry(row) -> LedgerEntry | None:
+    return LedgerEntry(*tuple(row)) if row is not None else None
+
+
+def get_entry_by_key(conn, idempotency_key: str) -> LedgerEntry | None:
+    return _entry(
+        conn.execute(
+            f"SELECT {ENTRY_COLUMNS} FROM {LEDGER_TABLE} WHERE idempotency_key = ?",
+            (idempotency_key,),
+        ).fetchone()
+    )
+
+
+def ensure_schema(conn: sqlite3.Connection) -> list[str]:
+    """Idempotently create the ledger and give every account an opening entry."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for sql in LEDGER_SCHEMA:
+            conn.execute(sql)
+        opened = backfill_openings(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return [f"{LEDGER_TABLE}.opening x{opened}"] if opened else []
+
+
+_OPENING_SQL = f"""
+    INSERT OR IGNORE INTO {LEDGER_TABLE} (
+        account_id, entry_type, amount, balance_before, balance_after,
+        idempotency_key, transaction_id, note, created_at
+    )
+    SELECT account_id, 'opening', ROUND(balance, 2), 0, ROUND(balance, 2),
+           'opening:' || account_id, NULL, NULL, ?
+    FROM household_accounts
+    WHERE account_id = ?
+"""
+
+
+def record_opening(conn, account_id: int, now: str | None = None) -> bool:
+    """
+    Anchor an account's existing cached balance as its first ledger entry.
+    Does not commit; a no-op if the account already has an opening entry.
+    """
+    cur = conn.execute(_OPENING_SQL, (now or utc_iso(), int(account_id)))
+    return cur.rowcount == 1
+
+
+def record_openings(conn, account_ids, now: str | None = None) -> int:
+    """``record_opening`` for many new accounts in one ``executemany`` (caller commits)."""
+    now = now or utc_iso()
+    cur = conn.executemany(_OPENING_SQL, [(now, int(account_id)) for account_id in account_ids])
+    return max(cur.rowcount, 0)
+
+
+def backfill_openings(conn) -> int:
+    """Opening entries for accounts created before the ledger (caller commits)."""
+    cur = conn.execute(
+        f"""
+        INSERT OR IGNORE INTO {LEDGER_TABLE} (
+            account_id, entry_type, amount, balance_before, balance_after,
+            idempotency_key, transaction_id, note, created_at
+        )
+        SELECT ha.account_id, 'opening', ROUND(ha.balance, 2), 0, ROUND(ha.balance, 2),
+               'opening:' || ha.account_id, NULL, NULL, ?
+        FROM household_accounts ha
+        WHERE NOT EXISTS (
+            SELECT 1 FROM {LEDGER_TABLE} l WHERE l.account_id = ha.account_id
+        )
+        """,
+        (utc_iso(),),
+    )
+    return max(cur.rowcount, 0)
+
+
+_POST_ENTRY_SQL = f"""
+    INSERT INTO {LEDGER_TABLE} (
+        account_id, entry_type, amount, balance_before, balance_after,
+        idempotency_key, transaction_id, note, created_at
+    )
+    SELECT account_id, :entry_type,
+           ROUND(applied, 2), ROUND(balance, 2), ROUND(balance + applied, 2),
+           :key, :transaction_id, :note, :now
+    FROM (
+        SELECT account_id, balance,
+               CASE WHEN :clamp AND balance + :delta < 0
+                    THEN -balance ELSE :delta END AS applied
+        FROM household_accounts
+        WHERE account_id = :account_id
+    )
+"""
+
+
+def post_entry(
+    conn,
+    account_id: int,
+    entry_type: str,
+    amount: Any,
+    *,
+    idempotency_key: str | None = None,
+    transaction_id: int | None = None,
+    note: str | None = None,
+    clamp: bool = False,
+    now: str | None = None,
+) -> tuple[LedgerEntry, bool]:
+    """
+    Append one signed entry in a single ``INSERT ... SELECT`` (caller commits).
+
+    ``clamp=True`` caps a negative amount at the current balance (debits).
+    Returns ``(entry, created)``; when ``idempotency_key`` was already used the
+    original entry is returned with ``created=False`` and nothing changes.
+    """
+    if entry_type not in ENTRY_TYPES or entry_type == "opening":
+        raise LedgerError(f"invalid entry_type: {entry_type}")
+    delta = float(money(amount))
+    try:
+        cur = conn.execute(
+            _POST_ENTRY_SQL,
+            {
+                "entry_type": entry_type,
+                "key": idempotency_key,
+                "transaction_id": transaction_id,
+                "note": note,
+                "now": now or utc_iso(),
+                "clamp": int(bool(clamp)),
+                "delta": delta,
+                "account_id": int(account_id),
+            },
+        )
+    except sqlite3.IntegrityError as exc:
+        # UNIQUE(idempotency_key)：同一筆結算 / 儲值已入帳，回傳原本那筆
+        existing = get_entry_by_key(conn, idempotency_key) if idempotency_key else None
+        if existing is None:
+            raise LedgerError("balance cannot be negative") from exc
+        if existing.account_id != int(account_id):
+            raise LedgerError("idempotency_key already used by another account") from exc
+        return existing, False
+
+    if cur.rowcount != 1:
+        raise LedgerError("account not found")
+    entry = _entry(
+        conn.execute(
+            f"SELECT {ENTRY_COLUMNS} FROM {LEDGER_TABLE} WHERE entry_id = ?",
+            (cur.lastrowid,),
+        ).fetchone()
+    )
+    return entry, True
+
+
+def post_entries(conn, entries, *, now: str | None = None) -> int:
+    """
+    Many non-clamped entries in one ``executemany`` (caller commits).
+
+    ``entries`` are ``(account_id, entry_type, amount, idempotency_key, note)``.
+    Callers validate accounts and idempotency keys up front: a duplicate key or
+    a negative balance aborts the whole batch with ``LedgerError``.
+    """
+    now = now or utc_iso()
+    params = []
+    for account_id, entry_type, amount, idempotency_key, note in entries:
+        if entry_type not in ENTRY_TYPES or entry_type == "opening":
+            raise LedgerError(f"invalid entry_type: {entry_type}")
+        params.append(
+            {
+                "entry_type": entry_type,
+                "key": idempotency_key,
+                "transaction_id": None,
+                "note": note,
+                "now": now,
+                "clamp": 0,
+                "delta": float(money(amount)),
+                "account_id": int(account_id),
+            }
+        )
+    try:
+        cur = conn.executemany(_POST_ENTRY_SQL, params)
+    except sqlite3.IntegrityError as exc:
+        raise LedgerError(f"ledger batch rejected: {exc}") from exc
+    if cur.rowcount != len(params):
+        raise LedgerError("account not found")
+    return cur.rowcount
+
+
+def account_history(
+    conn,
+    account_id: int,
+    limit: int = 100,
+    before_entry_id: int | None = None,
+) -> list[dict[str, Any]]:
+    """Newest first; page with ``before_entry_id``."""
+    params: list[Any] = [int(account_id)]
+    where = "account_id = ?"
+    if before_entry_id is not None:
+        where += " AND entry_id < ?"
+        params.append(int(before_entry_id))
+    params.append(max(1, int(limit)))
+    rows = conn.execute(
+        f"""
+        SELECT {ENTRY_COLUMNS} FROM {LEDGER_TABLE}
+        WHERE {where}
+        ORDER BY entry_id DESC
+        LIMIT ?
+        """,
+        params,
+    ).fetchall()
+    return [_entry(row).to_dict() for row in rows]
+
+
+def rollup(conn, *, repair: bool = False) -> dict[str, Any]:
+    """
+    Recompute every account from the ledger and compare with the cache.
+
+    ``repair=True`` records the drift as an ``adjustment`` entry (so the audit
+    trail explains the cached balance) and anchors accounts that have no
+    ledger history yet.  Commits only when it repairs something.
+    """
+    rows = conn.execute(
+        f"""
+        SELECT ha.account_id,
+               ROUND(ha.balance, 2),
+               ROUND(COALESCE(SUM(l.amount), 0), 2),
+               COUNT(l.entry_id)
+        FROM household_accounts ha
+        LEFT JOIN {LEDGER_TABLE} l ON l.account_id = ha.account_id
+        GROUP BY ha.account_id
+        ORDER BY ha.account_id
+        """
+    ).fetchall()
+
+    drifted: list[dict[str, Any]] = []
+    unledgered: list[int] = []
+    for account_id, cached, ledger_sum, entries in rows:
+        if not entries:
+            unledgered.append(int(account_id))
+        elif abs(float(cached) - float(ledger_sum)) > DRIFT_TOLERANCE:
+            drifted.append(
+                {
+                    "account_id": int(account_id),
+                    "cached_balance": float(cached),
+                    "ledger_balance": float(ledger_sum),
+                    "drift": round(float(cached) - float(ledger_sum), 2),
+                }
+            )
+
+    repaired = 0
+    if repair and (drifted or unledgered):
+        now = utc_iso()
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            for item in drifted:
+                conn.execute(
+                    f"""
+                    INSERT INTO {LEDGER_TABLE} (
+                        account_id, entry_type, amount, balance_before, balance_after,
+                        idempotency_key, transaction_id, note, created_at
+                    ) VALUES (?, 'adjustment', ?, ?, ?, NULL, NULL, ?, ?)
+                    """,
+                    (
+                        item["account_id"],
+                        item["drift"],
+                        item["ledger_balance"],
+                        item["cached_balance"],
+                        "rollup: cached balance changed outside the ledger",
+                        now,
+                    ),
+                )
+                repaired += 1
+            for account_id in unledgered:
+                repaired += int(record_opening(conn, account_id, now))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    return {
+        "accounts": len(rows),
+        "drifted": drifted,
+        "unledgered": unledgered,
+        "repaired": repaired,
+        "ok": not drifted and not unledgered,
+    }
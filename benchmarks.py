@@ -0,0 +1,422 @@
+# benchmarks.py
+# ============================================================
+# Micro-benchmarks for the pricing / cost / allocation hot paths
+#
+#   python benchmarks.py                        # full suite, print JSON
+#   python benchmarks.py --quick                # small data sets (CI / tests)
+#   python benchmarks.py --output bench.json --baseline benchmark_baseline.json
+#   python benchmarks.py --update-baseline      # rewrite benchmark_baseline.json
+#
+# Every run migrates and seeds a throw-away SQLite database (DATABASE_PATH is
+# pointed at a temp file *before* main.py is imported):
+#   - sessions with 1k / 10k / 100k Energy.Active.Import.Register samples
+#   - daily_pricing_rules for 2026-2035 built from holidays/*.json
+#   - hundreds of household accounts
+# and times the functions called on every MeterValues / StopTransaction /
+# LINE notification. Results are compared against a stored baseline by median;
+# the exit code is 1 when any case is slower than --max-regression allows.
+#
+# Baseline numbers are machine specific: regenerate them on the machine that
+# runs the comparison (--update-baseline) before trusting a regression report.
+# ============================================================
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from schema_migrations import migrate as migrate_schema
+
+
+ROOT = Path(__file__).resolve().parent
+DEFAULT_BASELINE = ROOT / "benchmark_baseline.json"
+HOLIDAYS_DIR = ROOT / "holidays"
+
+FULL_METER_SIZES = (1_000, 10_000, 100_000)
+QUICK_METER_SIZES = (200, 1_000)
+
+# 台電時間電價風格的模板（金額為合成資料，只求時段結構接近實際）
+SYNTHETIC_TEMPLATES = {
+    "summer": {
+        "weekday": [("00:00", "09:00", 2.18), ("09:00", "16:00", 4.61),
+                    ("16:00", "22:00", 9.39), ("22:00", "24:00", 4.61)],
+        "saturday": [("00:00", "09:00", 2.18), ("09:00", "24:00", 2.53)],
+        "sunday": [("00:00", "24:00", 2.18)],
+    },
+    "non_summer": {
+        "weekday": [("00:00", "09:00", 2.03), ("09:00", "16:00", 4.48),
+                    ("16:00", "22:00", 8.99), ("22:00", "24:00", 4.48)],
+        "saturday": [("00:00", "09:00", 2.03), ("09:00", "24:00", 2.36)],
+        "sunday": [("00:00", "24:00", 2.03)],
+    },
+}
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    runs: int
+    number: int
+    median_ms: float
+    mean_ms: float
+    min_ms: float
+    max_ms: float
+    ops_per_s: float
+
+
+def time_callable(
+    name: str,
+    fn: Callable[[], Any],
+    repeat: int = 5,
+    number: int = 1,
+    warmup: int = 1,
+) -> BenchmarkResult:
+    """每次量測 = 呼叫 fn() number 次；回傳單次呼叫的平均耗時統計。"""
+    for _ in range(max(0, warmup)):
+        fn()
+    per_call: List[float] = []
+    for _ in range(max(1, repeat)):
+        t0 = time.perf_counter()
+        for _ in range(max(1, number)):
+            fn()
+        per_call.append((time.perf_counter() - t0) / max(1, number))
+    median = statistics.median(per_call)
+    return BenchmarkResult(
+        name=name,
+        runs=len(per_call),
+        number=max(1, number),
+        median_ms=round(median * 1000.0, 4),
+        mean_ms=round(statistics.fmean(per_call) * 1000.0, 4),
+        min_ms=round(min(per_call) * 1000.0, 4),
+        max_ms=round(max(per_call) * 1000.0, 4),
+        ops_per_s=round(1.0 / median, 2) if median > 0 else 0.0,
+    )
+
+
+# -----------------------------
+# Synthetic data
+# -----------------------------
+def _load_holiday_day_types(years) -> Dict[str, str]:
+    day_types: Dict[str, str] = {}
+    for year in years:
+        path = HOLIDAYS_DIR / f"{year}.json"
+        if not path.exists():
+            continue
+        for day, value in json.loads(path.read_text(encoding="utf-8")).items():
+            if isinstance(value, dict):
+                value = value.get("type")
+            value = str(value or "").strip().lower()
+            if value in ("holiday", "workday"):
+                day_types[day] = value
+    return day_types
+
+
+def build_pricing_rows(first_year: int = 2026, last_year: int = 2035) -> List[tuple]:
+    """(date, start_time, end_time, price, label) for every day, like the calendar import."""
+    day_types = _load_holiday_day_types(range(first_year, last_year + 1))
+    rows: List[tuple] = []
+    current = date(first_year, 1, 1)
+    end = date(last_year, 12, 31)
+    while current <= end:
+        day_str = current.isoformat()
+        season = "summer" if (6, 1) <= (current.month, current.day) <= (9, 30) else "non_summer"
+        day_type = day_types.get(day_str)
+        if day_type == "holiday":
+            template = "sunday"
+        elif day_type == "workday":
+            template = "weekday"
+        else:
+            template = ("weekday",) * 5 + ("saturday", "sunday")
+            template = template[current.weekday()]
+        for start, stop, price in SYNTHETIC_TEMPLATES[season][template]:
+            rows.append((day_str, start, stop, price, f"{season}:{template}"))
+        current += timedelta(days=1)
+    return rows
+
+
+def seed_pricing(conn, first_year: int = 2026, last_year: int = 2035) -> int:
+    rows = build_pricing_rows(first_year, last_year)
+    conn.execute("DELETE FROM daily_pricing_rules")
+    conn.executemany(
+        """
+        INSERT INTO daily_pricing_rules (date, start_time, end_time, price, label)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        rows,
+    )
+    conn.commit()
+    return len(rows)
+
+
+def seed_meter_session(
+    conn,
+    transaction_id: int,
+    samples: int,
+    start: datetime,
+    interval_s: int = 10,
+    cp_id: str = "BENCH*CP*0001",
+) -> None:
+    """One transaction with `samples` energy register readings (7kW, monotonic Wh)."""
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO transactions
+            (transaction_id, charge_point_id, connector_id, id_tag,
+             meter_start, start_timestamp)
+        VALUES (?, ?, 1, ?, 0, ?)
+        """,
+        (transaction_id, cp_id, f"BENCH-{transaction_id}", start.isoformat()),
+    )
+    wh_per_sample = 7000.0 * interval_s / 3600.0
+    conn.executemany(
+        """
+        INSERT INTO meter_values
+            (transaction_id, charge_point_id, connector_id, timestamp,
+             value, measurand, unit)
+        VALUES (?, ?, 1, ?, ?, 'Energy.Active.Import.Register', 'Wh')
+        """,
+        (
+            (
+                transaction_id,
+                cp_id,
+                (start + timedelta(seconds=i * interval_s)).isoformat(),
+                round(i * wh_per_sample, 3),
+            )
+            for i in range(samples)
+        ),
+    )
+    conn.commit()
+
+
+def seed_households(db_file: str, count: int) -> List[int]:
+    from household_account_service import connect, create_household_account
+
+    conn = connect(db_file)
+    try:
+        return [
+            int(
+                create_household_account(
+                    conn, f"B{index // 100 + 1}", f"P{index:04d}", balance=1_000_000
+                )["account_id"]
+            )
+            for index in range(count)
+        ]
+    finally:
+        conn.close()
+
+
+# -----------------------------
+# Suite
+# -----------------------------
+def _import_main_for(db_file: str):
+    os.environ["DATABASE_PATH"] = db_file
+    if "main" in sys.modules:
+        main = sys.modules["main"]
+        if str(getattr(main, "DB_FILE", "")) != db_file:
+            raise RuntimeError(
+                "main.py is already imported with another DATABASE_PATH; "
+                "run benchmarks.py in a fresh process"
+            )
+        return main
+    import main  # noqa: E402  (DATABASE_PATH must be set first)
+
+    return main
+
+
+def run_suite(quick: bool = False, only: Optional[List[str]] = None) -> Dict[str, Any]:
+    meter_sizes = QUICK_METER_SIZES if quick else FULL_METER_SIZES
+    household_count = 50 if quick else 500
+    repeat = 3 if quick else 5
+
+    with tempfile.TemporaryDirectory(prefix="bench_") as directory:
+        db_file = str(Path(directory) / "bench.sqlite3")
+        migrate_schema(db_file)
+        main = _import_main_for(db_file)
+
+        t_seed = time.perf_counter()
+        with main.get_conn() as conn:
+            pricing_rows = seed_pricing(conn)
+            # 下午 14:00（台北）開始 → 會跨越尖峰/離峰時段
+            start = datetime(2026, 7, 15, 6, 0, tzinfo=timezone.utc)
+            for tx_id, samples in enumerate(meter_sizes, start=900_001):
+                seed_meter_session(conn, tx_id, samples, start)
+            conn.execute("UPDATE community_settings SET contract_kw = 70, enabled = 1 WHERE id = 1")
+            conn.commit()
+        account_ids = seed_households(db_file, household_count)
+        seed_s = time.perf_counter() - t_seed
+
+        cases: List[tuple] = []
+        for tx_id, samples in enumerate(meter_sizes, start=900_001):
+            cases.append((
+                f"calculate_multi_period_cost_detailed[samples={samples}]",
+                lambda tx_id=tx_id: main._calculate_multi_period_cost_detailed(tx_id),
+                repeat,
+                1,
+            ))
+
+        timestamps = [
+            (datetime(2026, 1, 1, tzinfo=timezone.utc) + timedelta(hours=7 * i)).isoformat()
+            for i in range(200)
+        ]
+        cases.append((
+            "price_for_timestamp[200_lookups]",
+            lambda: [main._price_for_timestamp(ts) for ts in timestamps],
+            repeat,
+            1,
+        ))
+
+        for active in (1, 10, 100):
+            cp_ids = [f"BENCH*CP*{i:04d}" for i in range(active)]
+            cases.append((
+                f"calculate_allocated_power_kw_by_cp_ids[active={active}]",
+                lambda cp_ids=cp_ids: main.calculate_allocated_power_kw_by_cp_ids(cp_ids),
+                repeat,
+                50,
+            ))
+
+        longest_tx_id = 900_000 + len(meter_sizes)
+        breakdown = main._calculate_multi_period_cost_detailed(longest_tx_id)
+        details = [
+            {
+                "from": seg.get("start"),
+                "to": seg.get("end"),
+                "kWh": seg.get("kwh"),
+                "price": seg.get("price"),
+                "cost": seg.get("subtotal"),
+            }
+            for seg in breakdown.get("segments") or []
+        ]
+        tx_start = start.isoformat()
+        tx_stop = (start + timedelta(seconds=10 * meter_sizes[-1])).isoformat()
+        cases.append((
+            f"build_line_price_summary_lines[segments={len(details)}]",
+            lambda: main._build_line_price_summary_lines(
+                details, tx_start=tx_start, tx_stop=tx_stop
+            ),
+            repeat,
+            50,
+        ))
+
+        from household_account_service import connect, debit_household_account_atomic
+
+        debit_conn = connect(db_file)
+        position = {"i": 0}
+
+        def _debit_next():
+            account_id = account_ids[position["i"] % len(account_ids)]
+            position["i"] += 1
+            debit_household_account_atomic(debit_conn, account_id, 1.23)
+
+        cases.append((
+            f"debit_household_account_atomic[households={household_count}]",
+            _debit_next,
+            repeat,
+            50,
+        ))
+
+        results: Dict[str, Any] = {}
+        try:
+            for name, fn, case_repeat, number in cases:
+                if only and not any(token in name for token in only):
+                    continue
+                results[name] = asdict(time_callable(name, fn, case_repeat, number))
+        finally:
+            debit_conn.close()
+
+    return {
+        "meta": {
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "quick": quick,
+            "seed_seconds": round(seed_s, 3),
+            "pricing_rows": pricing_rows,
+            "meter_sizes": list(meter_sizes),
+            "households": household_count,
+        },
+        "results": results,
+    }
+
+
+def compare_to_baseline(
+    report: Dict[str, Any],
+    baseline: Dict[str, Any],
+    max_regression: float = 0.25,
+) -> Dict[str, Any]:
+    """
+    以 median 比較；ratio = current / baseline。
+    ratio > 1 + max_regression → regression。
+    """
+    rows = {}
+    regressions = []
+    base_results = baseline.get("results") or {}
+    for name, current in (report.get("results") or {}).items():
+        base = base_results.get(name)
+        if not base or not base.get("median_ms"):
+            rows[name] = {"status": "new", "median_ms": current["median_ms"]}
+            continue
+        ratio = float(current["median_ms"]) / float(base["median_ms"])
+        status = "regression" if ratio > 1.0 + max_regression else "ok"
+        if ratio < 1.0 - max_regression:
+            status = "improved"
+        rows[name] = {
+            "status": status,
+            "median_ms": current["median_ms"],
+            "baseline_median_ms": base["median_ms"],
+            "ratio": round(ratio, 3),
+        }
+        if status == "regression":
+            regressions.append(name)
+    return {
+        "max_regression": max_regression,
+        "regressions": regressions,
+        "cases": rows,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pricing / cost / allocation micro-benchmarks")
+    parser.add_argument("--quick", action="store_true", help="Small data sets")
+    parser.add_argument("--filter", action="append", default=None,
+                        help="Only run cases whose name contains this text; repeatable")
+    parser.add_argument("--output", default=None, help="Write JSON report to this file")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE))
+    parser.add_argument("--max-regression", type=float, default=0.25)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args()
+
+    # main.py prints/logs on import and in hot paths → keep stdout for the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run_suite(quick=args.quick, only=args.filter)
+
+    baseline_path = Path(args.baseline)
+    if args.update_baseline:
+        baseline_path.write_text(
+            json.dumps(report, ensure_ascii=False, indent=2) + "\n", encoding="utf-8"
+        )
+    elif baseline_path.exists():
+        baseline = json.loads(baseline_path.read_text(encoding="utf-8"))
+        if bool(baseline.get("meta", {}).get("quick")) == bool(args.quick):
+            report["comparison"] = compare_to_baseline(report, baseline, args.max_regression)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    print(text)
+
+    if report.get("comparison", {}).get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
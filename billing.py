@@ -0,0 +1,201 @@
+"""Multi-period cost engine shared by live settlement and payment recalculation.
+
+``multi_period_breakdown`` is the pure core of
+``main._calculate_multi_period_cost_detailed``: consecutive
+``Energy.Active.Import`` readings are priced by the tariff period
+(Asia/Taipei wall clock) the later reading falls in, grouped into
+segments, and the total is the sum of the rounded segment subtotals so the
+LINE price summary always adds up to the debited amount.
+
+``settlement_amount`` applies the StopTransaction rule: the multi-period
+total when it is positive, otherwise ``used kWh × price at stop``.
+
+Callers load the meter readings and the rules, resolved by ``tariff_engine``
+(per-date overrides, else the year's calendar): ``tariff_engine.load_rules_by_date``
+or main's per-date ``TariffRulesCache`` for ``rule_dates``.  The pricing itself
+never touches SQLite, so the recalculation worker pool can reuse one
+in-memory rule set across thousands of transactions.
+
+This module intentionally has no FastAPI or OCPP dependency.
+"""
+
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from decimal import ROUND_HALF_UP, Decimal
+from typing import Any
+
+
+TZ_TAIPEI = timezone(timedelta(hours=8))
+DEFAULT_PRICE = 6.0
+MONEY_ZERO = Decimal("0.00")
+MONEY_QUANT = Decimal("0.01")
+
+RulesByDate = dict[str, list[tuple[str, str, float]]]
+
+
+def to_decimal(value, default="0") -> Decimal:
+    try:
+        if value is None:
+            return Decimal(str(default))
+        return Decimal(str(value))
+    except Exception:
+        return Decimal(str(default))
+
+
+def money_dec(value) -> Decimal:
+    return to_decimal(value).quantize(MONEY_QUANT, rounding=ROUND_HALF_UP)
+
+
+def to_local(ts: Any) -> datetime:
+    """UTC ISO（無時區視為 UTC）→ 台北時間。"""
+    parsed = datetime.fromisoformat(str(ts).replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(TZ_TAIPEI)
+
+
+def rule_dates(meter_rows: list[tuple]) -> list[str]:
+    """分段計價會用到的日期：第一筆讀值前一天（跨午夜時段）到最後一筆讀值當天。"""
+    if not meter_rows:
+        return []
+    first = to_local(meter_rows[0][0]).date() - timedelta(days=1)
+    last = to_local(meter_rows[-1][0]).date()
+    return [
+        (first + timedelta(days=n)).strftime("%Y-%m-%d")
+        for n in range((last - first).days + 1)
+    ]
+
+
+def _period_for(rules_by_date: RulesByDate, dt_local: datetime) -> tuple[str, str, Any]:
+    date_key = dt_local.strftime("%Y-%m-%d")
+    time_str = dt_local.strftime("%H:%M")
+    for r_start, r_end, r_price in rules_by_date.get(date_key, []):
+        if r_start <= time_str < r_end:
+            return r_start, r_end, r_price
+    # 若當天找不到，往前一天找
+    prev_date = (dt_local - timedelta(days=1)).strftime("%Y-%m-%d")
+    for r_start, r_end, r_price in rules_by_date.get(prev_date, []):
+        if r_start <= time_str < r_end:
+            return r_start, r_end, r_price
+    return "00:00", "23:59", DEFAULT_PRICE
+
+
+def multi_period_breakdown(
+    meter_rows: list[tuple],
+    rules_by_date: RulesByDate,
+    surcharge_per_kwh: Any = 0,
+) -> dict[str, Any]:
+    """
+    ``meter_rows``: ``(timestamp, value_wh)`` 依時間排序。
+
+    Returns ``{"total": float, "segments": [...]}``（與
+    ``_calculate_multi_period_cost_detailed`` 相同格式）。
+    """
+    if len(meter_rows) < 2:
+        return {"total": 0.0, "segments": []}
+
+    surcharge_dec = to_decimal(surcharge_per_kwh)
+    segments_map: dict[tuple, dict[str, Any]] = {}
+
+    for i in range(1, len(meter_rows)):
+        _, val_prev = meter_rows[i - 1]
+        ts_curr, val_curr = meter_rows[i]
+
+        diff_wh_dec = to_decimal(val_curr) - to_decimal(val_prev)
+        if diff_wh_dec < 0:
+            diff_wh_dec = Decimal("0")
+        diff_kwh_dec = diff_wh_dec / Decimal("1000")
+
+        dt_local = to_local(ts_curr)
+        date_key = dt_local.strftime("%Y-%m-%d")
+        start_t, end_t, base_price = _period_for(rules_by_date, dt_local)
+
+        base_price_dec = to_decimal(base_price)
+        final_price_dec = base_price_dec + surcharge_dec
+
+        # 用字串當 key，避免 Decimal / float 混用造成 key 不穩定
+        key = (date_key, start_t, end_t, str(final_price_dec))
+        if key not in segments_map:
+            segments_map[key] = {
+                "start": f"{date_key}T{start_t}:00",
+                "end": f"{date_key}T{end_t}:00",
+                "kwh_dec": Decimal("0"),
+                "price_dec": final_price_dec,
+                "base_price_dec": base_price_dec,
+                "subtotal_raw_dec": Decimal("0"),
+            }
+        seg = segments_map[key]
+        seg["kwh_dec"] += diff_kwh_dec
+        seg["subtotal_raw_dec"] += diff_kwh_dec * final_price_dec
+
+    segments = []
+    total_dec = MONEY_ZERO
+    for seg in sorted(segments_map.values(), key=lambda s: s["start"]):
+        subtotal_dec = money_dec(seg["subtotal_raw_dec"])
+        total_dec += subtotal_dec
+        kwh_dec = seg["kwh_dec"].quantize(Decimal("0.000001"), rounding=ROUND_HALF_UP)
+        segments.append(
+            {
+                "start": seg["start"],
+                "end": seg["end"],
+                "kwh": float(kwh_dec),
+                "price": float(seg["price_dec"]),
+                "base_price": float(seg["base_price_dec"]),
+                "surcharge": float(surcharge_dec),
+                "subtotal": float(subtotal_dec),
+            }
+        )
+
+    # total 必須等於「各分段已顯示金額」加總
+    return {
+        "total": float(total_dec.quantize(MONEY_QUANT, rounding=ROUND_HALF_UP)),
+        "segments": segments,
+    }
+
+
+def _in_range(now_hm: str, start: str, end: str) -> bool:
+    """HH:MM；處理跨日，且 start==end 視為全天（同 main._price_time_in_range）。"""
+    if start == end:
+        return True
+    if start < end:
+        return start <= now_hm < end
+    return now_hm >= start or now_hm < end
+
+
+def price_at(rules_by_date: RulesByDate, ts: Any) -> float:
+    """單一時間點電價（同 main._price_for_timestamp：重疊取最高價，找不到回預設）。"""
+    try:
+        dt_local = to_local(ts)
+    except (TypeError, ValueError):
+        return DEFAULT_PRICE
+    t = dt_local.strftime("%H:%M")
+    hits = [
+        float(p)
+        for s, e, p in rules_by_date.get(dt_local.strftime("%Y-%m-%d"), [])
+        if _in_range(t, s, e)
+    ]
+    return max(hits) if hits else DEFAULT_PRICE
+
+
+def settlement_amount(
+    meter_start: Any,
+    meter_stop: Any,
+    stop_timestamp: Any,
+    meter_rows: list[tuple],
+    rules_by_date: RulesByDate,
+    surcharge_per_kwh: Any = 0,
+) -> tuple[float, dict[str, Any]]:
+    """StopTransaction 扣款金額：多時段總額 > 0 時採用，否則 used kWh × 結束時電價。"""
+    breakdown = multi_period_breakdown(meter_rows, rules_by_date, surcharge_per_kwh)
+    total = float(money_dec(breakdown["total"]))
+    if total > 0:
+        return total, breakdown
+    try:
+        used_kwh = max(0.0, (float(meter_stop or 0) - float(meter_start or 0)) / 1000.0)
+    except (TypeError, ValueError):
+        used_kwh = 0.0
+    flat = money_dec(
+        to_decimal(used_kwh) * to_decimal(price_at(rules_by_date, stop_timestamp))
+    )
+    return float(flat), breakdown
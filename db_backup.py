@@ -0,0 +1,432 @@
+"""Online hot backups of the SQLite database, with rotation and restore.
+
+``migrate_household_accounts.backup_database`` only copies the file once
+per migration; otherwise the Render persistent disk was the only copy.
+``DatabaseBackup.run`` takes a point-in-time copy while the server keeps
+writing:
+
+- the copy uses SQLite's online backup API in steps of ``step_pages``
+  pages with ``step_sleep_s`` between steps, so a step only holds the
+  source read lock for a few milliseconds (``max_step_ms`` in the stats);
+- a commit from another connection restarts the copy; after
+  ``max_restarts`` restarts the rest is copied in one step, which in WAL
+  mode is a single read transaction and still does not block writers;
+- the copy is switched to ``journal_mode=DELETE`` (a standalone file),
+  checked with ``PRAGMA integrity_check`` and only then gzip-compressed
+  into ``backup_dir``; the newest ``keep`` snapshots are kept.
+
+``restore_backup`` is offline only (the CLI takes the migration lock):
+it verifies the snapshot, keeps a ``.pre-restore`` copy of the current
+database and replaces the file.
+
+    python db_backup.py backup
+    python db_backup.py list
+    python db_backup.py verify <snapshot.gz>
+    python db_backup.py restore <snapshot.gz>
+
+This module intentionally has no FastAPI or OCPP dependency.
+"""
+
+from __future__ import annotations
+
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+
+SNAPSHOT_SUFFIX = ".sqlite3.gz"
+
+
+class BackupError(RuntimeError):
+    """The copy could not be taken or did not pass ``integrity_check``."""
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def _stamp(now: datetime | None = None) -> str:
+    now = now or datetime.now(timezone.utc)
+    return now.strftime("%Y%m%dT%H%M%S%fZ")
+
+
+def _ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000.0, 2)
+
+
+def snapshot_prefix(db_file: str) -> str:
+    return f"{Path(db_file).name}."
+
+
+def list_backups(backup_dir: str, db_file: str) -> list[Path]:
+    """Snapshots of ``db_file`` in ``backup_dir``, oldest first (the stamp sorts by time)."""
+    directory = Path(backup_dir)
+    if not directory.is_dir():
+        return []
+    prefix = snapshot_prefix(db_file)
+    return sorted(
+        p for p in directory.iterdir()
+        if p.is_file() and p.name.startswith(prefix) and p.name.endswith(SNAPSHOT_SUFFIX)
+    )
+
+
+def integrity_check(db_file: str) -> list[str]:
+    """``PRAGMA integrity_check`` rows; ``["ok"]`` for a healthy file."""
+    conn = sqlite3.connect(db_file)
+    try:
+        return [row[0] for row in conn.execute("PRAGMA integrity_check").fetchall()]
+    finally:
+        conn.close()
+
+
+def copy_database(
+    source_file: str,
+    target_file: str,
+    *,
+    step_pages: int = 256,
+    step_sleep_s: float = 0.005,
+    max_restarts: int = 3,
+    busy_timeout_s: float = 5.0,
+    standalone: bool = True,
+) -> dict[str, Any]:
+    """
+    Online backup of ``source_file`` into ``target_file``.  With
+    ``standalone`` the copy is switched to ``journal_mode=DELETE``;
+    reporting_replica keeps it in WAL mode for concurrent readers.
+
+    Returns copy metrics: ``steps``, ``restarts``, ``max_step_ms``,
+    ``pages`` and ``single_step_fallback``.
+    """
+    progress: dict[str, Any] = {
+        "steps": 0,
+        "restarts": 0,
+        "max_step_ms": 0.0,
+        "pages": 0,
+        "single_step_fallback": False,
+    }
+    last = {"remaining": None, "at": 0.0}
+
+    def on_progress(status: int, remaining: int, total: int) -> None:
+        # 上一次回呼結束到這次回呼開始 = 這一步 backup_step 的耗時
+        step_ms = round((time.perf_counter() - last["at"]) * 1000.0, 2)
+        progress["max_step_ms"] = max(progress["max_step_ms"], step_ms)
+        progress["steps"] += 1
+        progress["pages"] = total
+        if last["remaining"] is not None and remaining >= last["remaining"]:
+            # 每步至少複製一頁；剩餘頁數沒有減少代表來源被其他連線寫入、SQLite 從頭重新複製
+            progress["restarts"] += 1
+            if progress["restarts"] > max_restarts:
+                raise _TooManyRestarts()
+        last["remaining"] = remaining
+        if remaining and step_sleep_s > 0:
+            # Connection.backup 的 sleep 參數只在 BUSY / LOCKED 時生效；
+            # 步與步之間的讓步要自己做（time.sleep 會釋放 GIL 給 OCPP 寫入）
+            time.sleep(step_sleep_s)
+        last["at"] = time.perf_counter()
+
+    source = sqlite3.connect(source_file, timeout=busy_timeout_s)
+    try:
+        target = sqlite3.connect(target_file)
+        try:
+            last["at"] = time.perf_counter()
+            try:
+                source.backup(target, pages=int(step_pages), progress=on_progress)
+            except _TooManyRestarts:
+                progress["single_step_fallback"] = True
+                started = time.perf_counter()
+                source.backup(target, pages=-1)
+                progress["max_step_ms"] = max(progress["max_step_ms"], _ms(started))
+                progress["steps"] += 1
+            if standalone:
+                # 複本改成單一檔案（不帶 -wal / -shm），壓縮與還原都只需處理一個檔
+                target.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            target.close()
+    finally:
+        source.close()
+    return progress
+
+
+def _compress(source: Path, target: Path) -> None:
+    partial = target.with_name(f"{target.name}.partial")
+    with open(source, "rb") as src, gzip.open(partial, "wb", compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, length=1024 * 1024)
+    os.replace(partial, target)
+
+
+def _decompress(source: Path, target: Path) -> None:
+    with gzip.open(source, "rb") as src, open(target, "wb") as dst:
+        shutil.copyfileobj(src, dst, length=1024 * 1024)
+
+
+def verify_backup(snapshot: str, *, scratch_dir: str | None = None) -> list[str]:
+    """Decompress ``snapshot`` to a scratch file and run ``integrity_check`` on it."""
+    snapshot_path = Path(snapshot)
+    scratch = Path(scratch_dir or snapshot_path.parent) / f".{snapshot_path.name}.verify"
+    try:
+        _decompress(snapshot_path, scratch)
+        return integrity_check(str(scratch))
+    except (OSError, EOFError, sqlite3.DatabaseError) as e:
+        return [f"unreadable: {e}"]
+    finally:
+        scratch.unlink(missing_ok=True)
+
+
+def restore_backup(snapshot: str, db_file: str) -> dict[str, Any]:
+    """
+    Replace ``db_file`` with ``snapshot``.  The server must be stopped; the
+    current database (including committed WAL pages) is kept as
+    ``<db>.pre-restore.<stamp>`` first.
+    """
+    db_path = Path(db_file)
+    incoming = db_path.with_name(f"{db_path.name}.restore.partial")
+    try:
+        _decompress(Path(snapshot), incoming)
+        result = integrity_check(str(incoming))
+    except (OSError, EOFError, sqlite3.DatabaseError) as e:
+        incoming.unlink(missing_ok=True)
+        raise BackupError(f"unreadable snapshot {snapshot}: {e}") from e
+    if result != ["ok"]:
+        incoming.unlink(missing_ok=True)
+        raise BackupError(f"integrity_check failed for {snapshot}: {result[:5]}")
+
+    previous = None
+    if db_path.exists():
+        previous = db_path.with_name(f"{db_path.name}.pre-restore.{_stamp()}")
+        copy_database(str(db_path), str(previous), step_pages=-1)
+    for suffix in ("-wal", "-shm"):
+        Path(f"{db_file}{suffix}").unlink(missing_ok=True)
+    os.replace(incoming, db_path)
+    return {"restored": str(db_path), "snapshot": str(snapshot), "previous": str(previous) if previous else None}
+
+
+@dataclass
+class BackupStats:
+    runs: int = 0
+    failures: int = 0
+    skipped_busy: int = 0
+    last_error: str | None = None
+    last_snapshot: str | None = None
+    last_finished_at: float | None = None
+    last_total_ms: float = 0.0
+    last_copy_ms: float = 0.0
+    last_verify_ms: float = 0.0
+    last_compress_ms: float = 0.0
+    last_steps: int = 0
+    last_restarts: int = 0
+    last_single_step_fallback: bool = False
+    last_max_step_ms: float = 0.0
+    max_step_ms: float = 0.0
+    last_raw_bytes: int = 0
+    last_compressed_bytes: int = 0
+    rotated: int = 0
+
+
+class DatabaseBackup:
+    """
+    Periodic snapshot writer; ``run`` is synchronous (main.py calls it via
+    ``asyncio.to_thread``) and returns None when a run is already in progress.
+    """
+
+    def __init__(
+        self,
+        db_file: str,
+        backup_dir: str,
+        *,
+        keep: int = 7,
+        interval_s: float = 6 * 3600.0,
+        step_pages: int = 256,
+        step_sleep_s: float = 0.005,
+        max_restarts: int = 3,
+    ):
+        self.db_file = db_file
+        self.backup_dir = backup_dir
+        self.keep = max(1, int(keep))
+        self.interval_s = float(interval_s)
+        self.step_pages = int(step_pages)
+        self.step_sleep_s = float(step_sleep_s)
+        self.max_restarts = int(max_restarts)
+        self.stats = BackupStats()
+        self._lock = threading.Lock()
+
+    def _rotate(self) -> list[Path]:
+        removed = []
+        snapshots = list_backups(self.backup_dir, self.db_file)
+        for old in snapshots[: max(0, len(snapshots) - self.keep)]:
+            old.unlink(missing_ok=True)
+            removed.append(old)
+        self.stats.rotated += len(removed)
+        return removed
+
+    def run(self) -> dict[str, Any] | None:
+        if not self._lock.acquire(blocking=False):
+            self.stats.skipped_busy += 1
+            return None
+        try:
+            return self._run()
+        finally:
+            self._lock.release()
+
+    def _run(self) -> dict[str, Any]:
+        stats = self.stats
+        started = time.perf_counter()
+        directory = Path(self.backup_dir)
+        directory.mkdir(parents=True, exist_ok=True)
+        snapshot = directory / f"{snapshot_prefix(self.db_file)}{_stamp()}{SNAPSHOT_SUFFIX}"
+        raw = directory / f".{snapshot.name}.raw"
+        stats.runs += 1
+        try:
+            copy_started = time.perf_counter()
+            progress = copy_database(
+                self.db_file,
+                str(raw),
+                step_pages=self.step_pages,
+                step_sleep_s=self.step_sleep_s,
+                max_restarts=self.max_restarts,
+            )
+            copy_ms = _ms(copy_started)
+
+            verify_started = time.perf_counter()
+            result = integrity_check(str(raw))
+            verify_ms = _ms(verify_started)
+            if result != ["ok"]:
+                raise BackupError(f"integrity_check failed: {result[:5]}")
+
+            raw_bytes = raw.stat().st_size
+            compress_started = time.perf_counter()
+            _compress(raw, snapshot)
+            compress_ms = _ms(compress_started)
+        except (OSError, sqlite3.Error, BackupError) as e:
+            stats.failures += 1
+            stats.last_error = str(e)
+            raise
+        finally:
+            raw.unlink(missing_ok=True)
+
+        removed = self._rotate()
+        stats.last_snapshot = str(snapshot)
+        stats.last_finished_at = time.time()
+        stats.last_total_ms = _ms(started)
+        stats.last_copy_ms = copy_ms
+        stats.last_verify_ms = verify_ms
+        stats.last_compress_ms = compress_ms
+        stats.last_steps = progress["steps"]
+        stats.last_restarts = progress["restarts"]
+        stats.last_single_step_fallback = progress["single_step_fallback"]
+        stats.last_max_step_ms = progress["max_step_ms"]
+        stats.max_step_ms = max(stats.max_step_ms, progress["max_step_ms"])
+        stats.last_raw_bytes = raw_bytes
+        stats.last_compressed_bytes = snapshot.stat().st_size
+        stats.last_error = None
+        return {
+            "snapshot": str(snapshot),
+            "raw_bytes": raw_bytes,
+            "compressed_bytes": stats.last_compressed_bytes,
+            "total_ms": stats.last_total_ms,
+            "copy_ms": copy_ms,
+            "verify_ms": verify_ms,
+            "compress_ms": compress_ms,
+            "rotated": [p.name for p in removed],
+            **progress,
+        }
+
+    def snapshot(self) -> dict[str, Any]:
+        stats = self.stats
+        return {
+            "backup_dir": self.backup_dir,
+            "keep": self.keep,
+            "interval_s": self.interval_s,
+            "step_pages": self.step_pages,
+            "step_sleep_ms": round(self.step_sleep_s * 1000.0, 2),
+            "running": self._lock.locked(),
+            "runs": stats.runs,
+            "failures": stats.failures,
+            "skipped_busy": stats.skipped_busy,
+            "last_error": stats.last_error,
+            "last_snapshot": stats.last_snapshot,
+            "last_finished_at": (
+                datetime.fromtimestamp(stats.last_finished_at, timezone.utc).replace(microsecond=0).isoformat()
+                if stats.last_finished_at
+                else None
+            ),
+            "last_total_ms": stats.last_total_ms,
+            "last_copy_ms": stats.last_copy_ms,
+            "last_verify_ms": stats.last_verify_ms,
+            "last_compress_ms": stats.last_compress_ms,
+            "last_steps": stats.last_steps,
+            "last_restarts": stats.last_restarts,
+            "last_single_step_fallback": stats.last_single_step_fallback,
+            "last_max_step_ms": stats.last_max_step_ms,
+            "max_step_ms": stats.max_step_ms,
+            "last_raw_bytes": stats.last_raw_bytes,
+            "last_compressed_bytes": stats.last_compressed_bytes,
+            "rotated": stats.rotated,
+            "snapshots": [
+                {"name": p.name, "bytes": p.stat().st_size}
+                for p in list_backups(self.backup_dir, self.db_file)
+            ],
+        }
+
+
+def default_backup_dir(db_file: str) -> str:
+    return os.getenv("DB_BACKUP_DIR") or str(Path(db_file).parent / "backups")
+
+
+def main(argv: list[str] | None = None) -> int:
+    from db_config import get_database_path
+
+    parser = argparse.ArgumentParser(description="SQLite hot backup / restore")
+    parser.add_argument("command", choices=("backup", "list", "verify", "restore"))
+    parser.add_argument("snapshot", nargs="?", help="snapshot file for verify / restore")
+    parser.add_argument("--database", help="defaults to DATABASE_PATH")
+    parser.add_argument("--backup-dir", help="defaults to DB_BACKUP_DIR or <database dir>/backups")
+    parser.add_argument("--keep", type=int, default=int(os.getenv("DB_BACKUP_KEEP", "7")))
+    args = parser.parse_args(argv)
+
+    db_file = args.database or get_database_path()
+    backup_dir = args.backup_dir or default_backup_dir(db_file)
+
+    if args.command == "backup":
+        report = DatabaseBackup(db_file, backup_dir, keep=args.keep).run()
+    elif args.command == "list":
+        report = {
+            "backup_dir": backup_dir,
+            "snapshots": [
+                {"path": str(p), "bytes": p.stat().st_size} for p in list_backups(backup_dir, db_file)
+            ],
+        }
+    else:
+        if not args.snapshot:
+            parser.error(f"{args.command} needs a snapshot file")
+        if args.command == "verify":
+            result = verify_backup(args.snapshot)
+            report = {"snapshot": args.snapshot, "integrity_check": result, "ok": result == ["ok"]}
+        else:
+            from run_startup_migrations import migration_file_lock
+
+            # 與啟動遷移互斥；仍須先停止 uvicorn，否則連線會繼續寫舊檔
+            with migration_file_lock(db_file):
+                try:
+                    report = restore_backup(args.snapshot, db_file)
+                except BackupError as e:
+                    print(f"[DB][BACKUP][RESTORE_FAILED] {e}", file=sys.stderr)
+                    return 1
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.command == "verify" and not report["ok"]:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,327 @@
+"""SQLite WAL checkpoint and maintenance scheduler.
+
+Every ``get_conn()`` runs in WAL mode, but nothing managed checkpoints: the
+WAL grew under continuous MeterValues ingestion until SQLite's automatic
+checkpoint (``wal_autocheckpoint``, 1000 pages) ran inside whichever writer
+committed next and stalled it.  ``DatabaseMaintenance.tick`` is called
+every few seconds from a worker thread and, on its own connection:
+
+- tracks write activity with ``PRAGMA data_version`` (it changes whenever
+  another connection commits); maintenance that takes the write lock only
+  runs after ``quiet_s`` without commits;
+- runs a ``PASSIVE`` checkpoint (never waits for readers or writers) every
+  ``passive_interval_s`` whether or not writes are happening: continuous
+  ingestion never leaves a quiet window, and a checkpointed WAL is reused
+  from the start, so its size stays bounded by one interval of writes;
+- runs a ``TRUNCATE`` checkpoint when the WAL file exceeds
+  ``truncate_wal_bytes``, with ``busy_timeout`` set to ``truncate_budget_ms``
+  so a busy database costs at most that budget (retried on a later tick);
+- runs ``PRAGMA optimize`` every ``optimize_interval_s`` and a full
+  ``ANALYZE`` when ``request_analyze`` was called;
+- runs ``PRAGMA incremental_vacuum`` in steps of ``vacuum_max_pages`` after
+  bulk deletes (``request_vacuum``) or when the freelist exceeds
+  ``vacuum_freelist_pages``; this needs ``auto_vacuum=INCREMENTAL``, which
+  ``enable_incremental_vacuum`` converts to offline (it rewrites the file).
+
+``connection_pragmas`` builds the per-connection ``cache_size`` /
+``mmap_size`` / ``wal_autocheckpoint`` settings applied by ``get_conn()``.
+
+This module intentionally has no FastAPI or OCPP dependency.
+"""
+
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable
+
+
+AUTO_VACUUM_MODES = {0: "none", 1: "full", 2: "incremental"}
+
+
+def connection_pragmas(
+    *, cache_size_kib: int = 0, mmap_size: int = 0, wal_autocheckpoint: int = 0
+) -> tuple[str, ...]:
+    """``PRAGMA`` statements for new connections; 0 keeps SQLite's default."""
+    pragmas = []
+    if cache_size_kib > 0:
+        # 負值代表 KiB（正值是頁數，會隨 page_size 改變）
+        pragmas.append(f"PRAGMA cache_size=-{int(cache_size_kib)}")
+    if mmap_size > 0:
+        pragmas.append(f"PRAGMA mmap_size={int(mmap_size)}")
+    if wal_autocheckpoint > 0:
+        pragmas.append(f"PRAGMA wal_autocheckpoint={int(wal_autocheckpoint)}")
+    return tuple(pragmas)
+
+
+def wal_size(db_file: str) -> int:
+    try:
+        return os.path.getsize(f"{db_file}-wal")
+    except OSError:
+        return 0
+
+
+def checkpoint(conn: sqlite3.Connection, mode: str = "PASSIVE") -> tuple[int, int, int]:
+    """``(busy, wal_frames, checkpointed_frames)`` of ``PRAGMA wal_checkpoint(mode)``."""
+    if mode not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+        raise ValueError(f"unknown checkpoint mode: {mode}")
+    busy, frames, checkpointed = conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+    return int(busy), int(frames), int(checkpointed)
+
+
+def page_stats(conn: sqlite3.Connection) -> dict[str, Any]:
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    return {
+        "page_size": page_size,
+        "page_count": page_count,
+        "freelist_pages": freelist,
+        "freelist_bytes": freelist * page_size,
+        "auto_vacuum": AUTO_VACUUM_MODES.get(auto_vacuum, str(auto_vacuum)),
+    }
+
+
+def enable_incremental_vacuum(db_file: str) -> bool:
+    """
+    Switch the file to ``auto_vacuum=INCREMENTAL`` (a full ``VACUUM``, which
+    rewrites the database).  Run offline, under the migration lock; returns
+    False when it already was.
+    """
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+    finally:
+        conn.close()
+
+
+@dataclass
+class MaintenanceStats:
+    ticks: int = 0
+    quiet_ticks: int = 0
+    passive_checkpoints: int = 0
+    truncate_checkpoints: int = 0
+    checkpoint_busy: int = 0
+    last_checkpoint_mode: str | None = None
+    last_checkpoint_ms: float = 0.0
+    max_checkpoint_ms: float = 0.0
+    last_wal_frames: int = 0
+    last_checkpointed_frames: int = 0
+    last_wal_bytes_before: int = 0
+    optimize_runs: int = 0
+    analyze_runs: int = 0
+    last_optimize_ms: float = 0.0
+    vacuum_runs: int = 0
+    vacuum_pages: int = 0
+    errors: int = 0
+    last_error: str | None = None
+
+
+class DatabaseMaintenance:
+    """
+    Maintenance scheduler; ``tick`` is synchronous and must not run
+    concurrently with itself (main.py calls it from one loop).
+    """
+
+    def __init__(
+        self,
+        db_file: str,
+        *,
+        quiet_s: float = 5.0,
+        passive_interval_s: float = 10.0,
+        truncate_wal_bytes: int = 64 * 1024 * 1024,
+        truncate_budget_ms: int = 200,
+        truncate_min_interval_s: float = 300.0,
+        optimize_interval_s: float = 6 * 3600.0,
+        vacuum_freelist_pages: int = 2000,
+        vacuum_max_pages: int = 1000,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.db_file = db_file
+        self.quiet_s = float(quiet_s)
+        self.passive_interval_s = float(passive_interval_s)
+        self.truncate_wal_bytes = int(truncate_wal_bytes)
+        self.truncate_budget_ms = int(truncate_budget_ms)
+        self.truncate_min_interval_s = float(truncate_min_interval_s)
+        self.optimize_interval_s = float(optimize_interval_s)
+        self.vacuum_freelist_pages = int(vacuum_freelist_pages)
+        self.vacuum_max_pages = max(1, int(vacuum_max_pages))
+        self.clock = clock
+        self.stats = MaintenanceStats()
+        self._conn: sqlite3.Connection | None = None
+        self._data_version: int | None = None
+        self._last_write_at = clock()
+        self._last_passive_at: float | None = None
+        self._last_truncate_at: float | None = None
+        # 啟動後先等一輪 optimize_interval_s，不在重啟風暴中跑
+        self._last_optimize_at = clock()
+        self._analyze_requested = False
+        self._vacuum_requested = False
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(
+                self.db_file, isolation_level=None, check_same_thread=False
+            )
+            self._conn.execute(f"PRAGMA busy_timeout={self.truncate_budget_ms}")
+        return self._conn
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def request_analyze(self) -> None:
+        self._analyze_requested = True
+
+    def request_vacuum(self) -> None:
+        """大量刪除（保留期清理、電價壓縮、payments 重算 swap）之後呼叫。"""
+        self._vacuum_requested = True
+
+    def _checkpoint(self, conn: sqlite3.Connection, mode: str) -> bool:
+        wal_before = wal_size(self.db_file)
+        started = time.perf_counter()
+        busy, frames, checkpointed = checkpoint(conn, mode)
+        elapsed_ms = round((time.perf_counter() - started) * 1000.0, 2)
+        stats = self.stats
+        stats.last_checkpoint_mode = mode
+        stats.last_checkpoint_ms = elapsed_ms
+        stats.max_checkpoint_ms = max(stats.max_checkpoint_ms, elapsed_ms)
+        stats.last_wal_frames = frames
+        stats.last_checkpointed_frames = checkpointed
+        stats.last_wal_bytes_before = wal_before
+        if busy:
+            stats.checkpoint_busy += 1
+            return False
+        if mode == "TRUNCATE":
+            stats.truncate_checkpoints += 1
+        else:
+            stats.passive_checkpoints += 1
+        return True
+
+    def _optimize(self, conn: sqlite3.Connection, full: bool) -> None:
+        started = time.perf_counter()
+        conn.execute("ANALYZE" if full else "PRAGMA optimize")
+        self.stats.last_optimize_ms = round((time.perf_counter() - started) * 1000.0, 2)
+        if full:
+            self.stats.analyze_runs += 1
+        else:
+            self.stats.optimize_runs += 1
+
+    def _incremental_vacuum(self, conn: sqlite3.Connection) -> int:
+        before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        # sqlite3 的 execute 對不回傳列的 PRAGMA 只 step 一次（只釋放一頁）；
+        # executescript 會執行到完成
+        conn.executescript(f"PRAGMA incremental_vacuum({self.vacuum_max_pages});")
+        freed = before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+        self.stats.vacuum_runs += 1
+        self.stats.vacuum_pages += freed
+        return freed
+
+    def tick(self) -> list[str]:
+        """Run whatever is due; returns the actions taken (for logs / tests)."""
+        with self._lock:
+            actions: list[str] = []
+            now = self.clock()
+            self.stats.ticks += 1
+            try:
+                conn = self._connection()
+                data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+                if data_version != self._data_version:
+                    self._data_version = data_version
+                    self._last_write_at = now
+                quiet = now - self._last_write_at >= self.quiet_s
+                if quiet:
+                    self.stats.quiet_ticks += 1
+
+                wal_bytes = wal_size(self.db_file)
+                if wal_bytes >= self.truncate_wal_bytes and (
+                    self._last_truncate_at is None
+                    or now - self._last_truncate_at >= self.truncate_min_interval_s
+                ):
+                    # 不等 quiet：WAL 已過大，以 busy_timeout 預算嘗試，失敗下個 tick 再試
+                    if self._checkpoint(conn, "TRUNCATE"):
+                        self._last_truncate_at = now
+                        actions.append("truncate_checkpoint")
+                    else:
+                        actions.append("truncate_busy")
+                elif wal_bytes > 0 and (
+                    self._last_passive_at is None
+                    or now - self._last_passive_at >= self.passive_interval_s
+                ):
+                    self._checkpoint(conn, "PASSIVE")
+                    self._last_passive_at = now
+                    actions.append("passive_checkpoint")
+
+                if not quiet:
+                    return actions
+
+                if self._analyze_requested or now - self._last_optimize_at >= self.optimize_interval_s:
+                    self._optimize(conn, full=self._analyze_requested)
+                    actions.append("analyze" if self._analyze_requested else "optimize")
+                    self._analyze_requested = False
+                    self._last_optimize_at = now
+
+                if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                    freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                    if freelist and (
+                        self._vacuum_requested or freelist >= self.vacuum_freelist_pages
+                    ):
+                        self._incremental_vacuum(conn)
+                        actions.append("incremental_vacuum")
+                        # 一次只清 vacuum_max_pages 頁；還有剩就下個 quiet tick 繼續
+                        if conn.execute("PRAGMA freelist_count").fetchone()[0] == 0:
+                            self._vacuum_requested = False
+                else:
+                    self._vacuum_requested = False
+            except sqlite3.Error as e:
+                # database is locked 等：本輪放棄，下個 tick 重試
+                self.stats.errors += 1
+                self.stats.last_error = str(e)
+                actions.append("error")
+            return actions
+
+    def metrics(self) -> dict[str, Any]:
+        with self._lock:
+            metrics: dict[str, Any] = {"wal_bytes": wal_size(self.db_file)}
+            try:
+                metrics.update(page_stats(self._connection()))
+            except sqlite3.Error as e:
+                metrics["error"] = str(e)
+            return metrics
+
+    def snapshot(self) -> dict[str, Any]:
+        stats = self.stats
+        return {
+            **self.metrics(),
+            "quiet": self.clock() - self._last_write_at >= self.quiet_s,
+            "ticks": stats.ticks,
+            "quiet_ticks": stats.quiet_ticks,
+            "passive_checkpoints": stats.passive_checkpoints,
+            "truncate_checkpoints": stats.truncate_checkpoints,
+            "checkpoint_busy": stats.checkpoint_busy,
+            "last_checkpoint_mode": stats.last_checkpoint_mode,
+            "last_checkpoint_ms": stats.last_checkpoint_ms,
+            "max_checkpoint_ms": stats.max_checkpoint_ms,
+            "last_wal_frames": stats.last_wal_frames,
+            "last_checkpointed_frames": stats.last_checkpointed_frames,
+            "last_wal_bytes_before": stats.last_wal_bytes_before,
+            "optimize_runs": stats.optimize_runs,
+            "analyze_runs": stats.analyze_runs,
+            "last_optimize_ms": stats.last_optimize_ms,
+            "vacuum_runs": stats.vacuum_runs,
+            "vacuum_pages": stats.vacuum_pages,
+            "vacuum_requested": self._vacuum_requested,
+            "errors": stats.errors,
+            "last_error": stats.last_error,
+        }
@@ -8,12 +8,15 @@ be tested independently.
 from __future__ import annotations
 
 import sqlite3
-import time
 import unicodedata
 import uuid
 from datetime import datetime, timedelta, timezone
 from decimal import Decimal, ROUND_HALF_UP
-from typing import Any
+from typing import Any, Sequence
+
+import auth_cache
+import balance_ledger
+from balance_ledger import LedgerError
 
 
 MONEY_QUANT = Decimal("0.01")
@@ -44,9 +47,24 @@ def normalize_household_identity(value: Any, field: str) -> str:
     return normalized
 
 
+def household_identity_key(floor_no: Any, parking_space_no: Any) -> tuple[str, str]:
+    """Comparison key of the floor/parking identity (mirrors the UPPER(TRIM()) unique index)."""
+    return (
+        unicodedata.normalize("NFKC", str(floor_no)).strip().upper(),
+        unicodedata.normalize("NFKC", str(parking_space_no)).strip().upper(),
+    )
+
+
 def _find_household_identity_conflicts(
     conn: sqlite3.Connection,
+    candidates: Sequence[tuple[int, str, str]] = (),
 ) -> list[dict[str, Any]]:
+    """
+    Floor/parking keys used more than once.  ``candidates`` are
+    ``(row, floor_no, parking_space_no)`` of a bulk batch about to be
+    inserted; they are grouped with the stored accounts in the same pass,
+    so one scan finds clashes with the database and inside the batch.
+    """
     if not {"floor_no", "parking_space_no"} <= _columns(conn, "household_accounts"):
         return []
     groups: dict[tuple[str, str], list[int]] = {}
@@ -59,18 +77,24 @@ def _find_household_identity_conflicts(
         """
     ).fetchall()
     for row in rows:
-        floor = unicodedata.normalize("NFKC", str(row[1])).strip().upper()
-        parking = unicodedata.normalize("NFKC", str(row[2])).strip().upper()
-        groups.setdefault((floor, parking), []).append(int(row[0]))
-    return [
-        {
-            "floor_no": key[0],
-            "parking_space_no": key[1],
-            "account_ids": account_ids,
-        }
-        for key, account_ids in groups.items()
-        if len(account_ids) > 1
-    ]
+        groups.setdefault(household_identity_key(row[1], row[2]), []).append(int(row[0]))
+    batch: dict[tuple[str, str], list[int]] = {}
+    for index, floor, parking in candidates:
+        batch.setdefault(household_identity_key(floor, parking), []).append(int(index))
+    conflicts = []
+    for key in list(groups) + [key for key in batch if key not in groups]:
+        account_ids = groups.get(key, [])
+        batch_rows = batch.get(key, [])
+        if len(account_ids) + len(batch_rows) > 1:
+            conflict = {
+                "floor_no": key[0],
+                "parking_space_no": key[1],
+                "account_ids": account_ids,
+            }
+            if candidates:
+                conflict["rows"] = batch_rows
+            conflicts.append(conflict)
+    return conflicts
 
 
 def utc_now() -> datetime:
@@ -243,6 +267,7 @@ def ensure_schema(conn: sqlite3.Connection) -> list[str]:
             "ON transactions(account_id)"
         )
     conn.commit()
+    changes.extend(balance_ledger.ensure_schema(conn))
     return changes
 
 
@@ -276,10 +301,12 @@ def list_household_accounts(conn: sqlite3.Connection) -> list[dict[str, Any]]:
     rows = conn.execute(
         """
         SELECT ha.*,
-               COUNT(ac.card_id) AS card_count
+               (
+                   SELECT COUNT(*) FROM account_cards ac
+                   WHERE ac.account_id = ha.account_id
+               ) AS card_count
         FROM household_accounts ha
-        LEFT JOIN account_cards ac ON ac.account_id = ha.account_id
-        GROUP BY ha.account_id
+        -- 與 idx_household_accounts_sort_key 相同的運算式：依索引順序掃描，不另建暫存排序
         ORDER BY
             CASE WHEN NULLIF(TRIM(ha.floor_no), '') IS NULL THEN 1 ELSE 0 END,
             UPPER(TRIM(ha.floor_no)),
@@ -360,6 +387,7 @@ def ensure_legacy_account_for_card(
             """,
             (card_id, cur.lastrowid, legacy["name"], now, now),
         )
+        balance_ledger.record_opening(conn, cur.lastrowid, now)
         if commit:
             conn.commit()
     except sqlite3.IntegrityError:
@@ -397,6 +425,7 @@ def create_household_account(
             """,
             (internal_code, floor, parking, float(opening), status, now, now),
         )
+        balance_ledger.record_opening(conn, cur.lastrowid, now)
         conn.commit()
     except sqlite3.IntegrityError as exc:
         raise HouseholdAccountConflictError(
@@ -436,6 +465,7 @@ def update_household_account(
             (*values.values(), account_id),
         )
         conn.commit()
+        auth_cache.invalidate_account(account_id)
     except sqlite3.IntegrityError as exc:
         raise HouseholdAccountConflictError(
             "floor_no and parking_space_no already exist"
@@ -445,27 +475,32 @@ def update_household_account(
     return get_account_by_id(conn, account_id) or {}
 
 
-def topup_household_account(conn: sqlite3.Connection, account_id: int, amount: Any) -> dict[str, Any]:
+def topup_household_account(
+    conn: sqlite3.Connection,
+    account_id: int,
+    amount: Any,
+    idempotency_key: str | None = None,
+) -> dict[str, Any]:
     increment = money(amount)
     if increment <= 0:
         raise HouseholdAccountError("amount must be greater than zero")
     conn.execute("BEGIN IMMEDIATE")
     try:
-        now = utc_iso()
-        cur = conn.execute(
-            """
-            UPDATE household_accounts
-            SET balance = ROUND(balance + ?, 2), updated_at = ?
-            WHERE account_id = ?
-            """,
-            (float(increment), now, account_id),
-        )
-        if cur.rowcount != 1:
-            raise HouseholdAccountError("account not found")
+        try:
+            balance_ledger.post_entry(
+                conn,
+                account_id,
+                "topup",
+                increment,
+                idempotency_key=f"topup:{idempotency_key}" if idempotency_key else None,
+            )
+        except LedgerError as exc:
+            raise HouseholdAccountError(str(exc)) from exc
         row = conn.execute(
             "SELECT * FROM household_accounts WHERE account_id = ?", (account_id,)
         ).fetchone()
         conn.commit()
+        auth_cache.invalidate_account(account_id)
         return dict(row)
     except Exception:
         conn.rollback()
@@ -507,6 +542,7 @@ def bind_card_to_account(
             (card_id, account_id, status, now, now),
         )
         conn.commit()
+        auth_cache.invalidate_card(card_id)
     except sqlite3.IntegrityError as exc:
         conn.rollback()
         raise HouseholdAccountError("card is already bound to an account") from exc
@@ -542,6 +578,7 @@ def update_account_card(conn: sqlite3.Connection, card_id: str, **fields: Any) -
                 ("Accepted" if values["status"] == "active" else "Blocked", card_id),
             )
         conn.commit()
+        auth_cache.invalidate_card(card_id)
     except Exception:
         conn.rollback()
         raise
@@ -742,6 +779,7 @@ def confirm_enrollment(conn: sqlite3.Connection, enrollment_id: str) -> dict[str
             (created, enrollment_id),
         )
         conn.commit()
+        auth_cache.invalidate_card(card_id)
         return resolve_account_by_card(conn, card_id) or {}
     except Exception:
         conn.rollback()
@@ -765,35 +803,43 @@ def cancel_enrollment(conn: sqlite3.Connection, enrollment_id: str) -> dict[str,
 
 
 def debit_household_account_atomic(
-    conn: sqlite3.Connection, account_id: int, amount: Any
+    conn: sqlite3.Connection,
+    account_id: int,
+    amount: Any,
+    *,
+    transaction_id: int | None = None,
 ) -> tuple[float, float]:
+    """
+    Append a clamped debit to the balance ledger; returns (before, after).
+
+    One ``INSERT ... SELECT`` under ``busy_timeout`` replaces the old
+    read-modify-write with sleep-retry.  With ``transaction_id`` the debit is
+    keyed by the settlement, so a replay returns the original result.
+    """
     charge = money(amount)
     if charge < 0:
         raise HouseholdAccountError("amount cannot be negative")
-    for attempt in range(3):
-        try:
-            conn.execute("BEGIN IMMEDIATE")
-            row = conn.execute(
-                "SELECT balance FROM household_accounts WHERE account_id=?", (account_id,)
-            ).fetchone()
-            if not row:
-                raise HouseholdAccountError("account not found")
-            before = money(row["balance"])
-            after = max(Decimal("0.00"), before - charge).quantize(
-                MONEY_QUANT, rounding=ROUND_HALF_UP
-            )
-            conn.execute(
-                "UPDATE household_accounts SET balance=?,updated_at=? WHERE account_id=?",
-                (float(after), utc_iso(), account_id),
-            )
-            conn.commit()
-            return float(before), float(after)
-        except sqlite3.OperationalError as exc:
-            conn.rollback()
-            if "locked" not in str(exc).lower() or attempt == 2:
-                raise
-            time.sleep(0.05 * (attempt + 1))
-        except Exception:
-            conn.rollback()
-            raise
-    raise RuntimeError("unreachable")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        entry, _ = balance_ledger.post_entry(
+            conn,
+            account_id,
+            "debit",
+            -charge,
+            idempotency_key=(
+                balance_ledger.settlement_key_for_transaction(conn, transaction_id, account_id)
+                if transaction_id is not None
+                else None
+            ),
+            transaction_id=transaction_id,
+            clamp=True,
+        )
+        conn.commit()
+        auth_cache.invalidate_account(account_id)
+    except LedgerError as exc:
+        conn.rollback()
+        raise HouseholdAccountError(str(exc)) from exc
+    except Exception:
+        conn.rollback()
+        raise
+    return entry.balance_before, entry.balance_after
@@ -0,0 +1,544 @@
+"""Bulk household, card, top-up and id_tag administration.
+
+Onboarding a building used to take one HTTP call per household, card and
+top-up, each with its own connection, lookups and commit.  The functions
+here take a whole CSV or JSON batch (``parse_rows``) and:
+
+- validate every row first: field rules are the single-record ones
+  (``normalize_household_identity``, ``money``, statuses), and conflicts
+  are found set-based, with the stored data and inside the batch
+  (``_find_household_identity_conflicts`` with candidates, chunked ``IN``
+  lookups for cards, id_tags and idempotency keys);
+- apply nothing when any row fails (or with ``dry_run``); otherwise apply
+  the batch in one ``BEGIN IMMEDIATE`` transaction with ``executemany``;
+- invalidate the authorization cache once per batch
+  (``auth_cache.invalidate_many``).
+
+Every function returns a ``BulkReport`` with one result per input row.
+
+This module intentionally has no FastAPI or OCPP dependency.
+"""
+
+from __future__ import annotations
+
+import csv
+import io
+import json
+import sqlite3
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Callable, Iterable
+
+import auth_cache
+import balance_ledger
+from balance_ledger import LedgerError
+from household_account_service import (
+    HouseholdAccountConflictError,
+    HouseholdAccountError,
+    _find_household_identity_conflicts,
+    household_identity_key,
+    money,
+    normalize_household_identity,
+    utc_iso,
+)
+
+
+BULK_MAX_ROWS = 5000
+LOOKUP_CHUNK = 500
+DEFAULT_VALID_UNTIL = "2099-12-31T23:59:59"
+
+
+@dataclass
+class BulkRowResult:
+    row: int
+    status: str = "ok"
+    error: str | None = None
+    data: dict[str, Any] = field(default_factory=dict)
+
+    def fail(self, message: str) -> None:
+        # 同一列只回報第一個錯誤
+        if self.status != "error":
+            self.status = "error"
+            self.error = message
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"row": self.row, "status": self.status, "error": self.error, **self.data}
+
+
+@dataclass
+class BulkReport:
+    operation: str
+    dry_run: bool
+    results: list[BulkRowResult]
+    applied: bool = False
+
+    @property
+    def errors(self) -> int:
+        return sum(1 for result in self.results if result.status == "error")
+
+    def to_dict(self) -> dict[str, Any]:
+        statuses = [result.status for result in self.results]
+        return {
+            "operation": self.operation,
+            "dryRun": self.dry_run,
+            "applied": self.applied,
+            "total": len(statuses),
+            "ok": statuses.count("ok"),
+            "errors": statuses.count("error"),
+            "skipped": statuses.count("skipped"),
+            "rows": [result.to_dict() for result in self.results],
+        }
+
+
+# ------------------------------------------------------------
+# input
+# ------------------------------------------------------------
+def parse_rows(body: bytes | str, content_type: str | None = None) -> list[dict[str, Any]]:
+    """CSV (header row) or JSON (a list, or ``{"rows": [...]}``) into row dicts."""
+    text = body.decode("utf-8-sig") if isinstance(body, bytes) else body.lstrip("﻿")
+    if not text.strip():
+        raise HouseholdAccountError("empty batch")
+    if "csv" in (content_type or "").lower():
+        reader = csv.DictReader(io.StringIO(text))
+        rows = [
+            {
+                (key or "").strip(): value.strip() if isinstance(value, str) else value
+                for key, value in row.items()
+                if key
+            }
+            for row in reader
+        ]
+        rows = [row for row in rows if any(value not in (None, "") for value in row.values())]
+    else:
+        try:
+            payload = json.loads(text)
+        except ValueError as exc:
+            raise HouseholdAccountError(f"invalid JSON: {exc}") from exc
+        rows = payload.get("rows") if isinstance(payload, dict) else payload
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise HouseholdAccountError("JSON batch must be a list of objects or {\"rows\": [...]}")
+    if not rows:
+        raise HouseholdAccountError("empty batch")
+    if len(rows) > BULK_MAX_ROWS:
+        raise HouseholdAccountError(f"batch exceeds {BULK_MAX_ROWS} rows")
+    return rows
+
+
+def _field(row: dict[str, Any], snake_key: str, camel_key: str | None = None, default: Any = None) -> Any:
+    """snake_case / camelCase 任一皆可；CSV 空白欄位視為未填。"""
+    values = [
+        row[key]
+        for key in (snake_key, camel_key)
+        if key and key in row and row[key] not in (None, "")
+    ]
+    if len(values) == 2 and values[0] != values[1]:
+        raise HouseholdAccountError(f"conflicting values for {snake_key} and {camel_key}")
+    return values[0] if values else default
+
+
+def _list_field(row: dict[str, Any], snake_key: str, camel_key: str) -> list[str]:
+    value = _field(row, snake_key, camel_key, [])
+    if isinstance(value, str):
+        # CSV 一格多值：以 ; 或 | 分隔
+        value = value.replace("|", ";").split(";")
+    if not isinstance(value, list):
+        raise HouseholdAccountError(f"{snake_key} must be a list")
+    items = [str(item).strip() for item in value if str(item).strip()]
+    if len(set(items)) != len(items):
+        raise HouseholdAccountError(f"{snake_key} contains duplicates")
+    return items
+
+
+def _status(row: dict[str, Any], message: str) -> str:
+    status = _field(row, "status", None, "active")
+    if status not in ("active", "disabled"):
+        raise HouseholdAccountError(message)
+    return status
+
+
+def _chunks(values: list[Any]) -> Iterable[list[Any]]:
+    for start in range(0, len(values), LOOKUP_CHUNK):
+        yield values[start : start + LOOKUP_CHUNK]
+
+
+def _existing(conn: sqlite3.Connection, sql: str, values: Iterable[Any]) -> dict[Any, Any]:
+    """``sql`` has one ``{placeholders}``; returns ``{first column: second column}``."""
+    found: dict[Any, Any] = {}
+    for chunk in _chunks(sorted(set(values))):
+        placeholders = ",".join("?" for _ in chunk)
+        for row in conn.execute(sql.format(placeholders=placeholders), chunk).fetchall():
+            found[row[0]] = row[1] if len(row) > 1 else True
+    return found
+
+
+def _account_index(conn: sqlite3.Connection) -> tuple[set[int], dict[tuple[str, str], int]]:
+    ids: set[int] = set()
+    by_identity: dict[tuple[str, str], int] = {}
+    for account_id, floor, parking in conn.execute(
+        "SELECT account_id, floor_no, parking_space_no FROM household_accounts"
+    ).fetchall():
+        ids.add(int(account_id))
+        if floor and parking and str(floor).strip() and str(parking).strip():
+            by_identity[household_identity_key(floor, parking)] = int(account_id)
+    return ids, by_identity
+
+
+def _resolve_account(
+    row: dict[str, Any], ids: set[int], by_identity: dict[tuple[str, str], int]
+) -> int:
+    account_id = _field(row, "account_id", "accountId")
+    if account_id is not None:
+        try:
+            account_id = int(account_id)
+        except (TypeError, ValueError) as exc:
+            raise HouseholdAccountError("account_id must be an integer") from exc
+        if account_id not in ids:
+            raise HouseholdAccountError("account not found")
+        return account_id
+    floor = _field(row, "floor_no", "floorNo")
+    parking = _field(row, "parking_space_no", "parkingSpaceNo")
+    if floor is None or parking is None:
+        raise HouseholdAccountError("account_id or floor_no + parking_space_no is required")
+    key = household_identity_key(
+        normalize_household_identity(floor, "floor_no"),
+        normalize_household_identity(parking, "parking_space_no"),
+    )
+    if key not in by_identity:
+        raise HouseholdAccountError("account not found")
+    return by_identity[key]
+
+
+def _check_cards(
+    conn: sqlite3.Connection, results: list[BulkRowResult], cards_by_row: dict[int, list[str]]
+) -> None:
+    """卡號在批次內重複、或已綁定其他戶號 → 該列錯誤。"""
+    seen: dict[str, int] = {}
+    for index, cards in cards_by_row.items():
+        for card_id in cards:
+            if card_id in seen:
+                results[index].fail(f"card {card_id} repeated in batch (row {seen[card_id] + 1})")
+            else:
+                seen[card_id] = index
+    bound = _existing(
+        conn, "SELECT card_id, account_id FROM account_cards WHERE card_id IN ({placeholders})", seen
+    )
+    for card_id, account_id in bound.items():
+        results[seen[card_id]].fail(f"card {card_id} is already bound to account {account_id}")
+
+
+def _begin(conn: sqlite3.Connection) -> None:
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute("BEGIN IMMEDIATE")
+
+
+def _insert_cards(conn: sqlite3.Connection, cards: list[tuple[str, int, str, str | None]], now: str) -> None:
+    """``(card_id, account_id, status, valid_until)``；與 bind_card_to_account 寫入相同的三張表。"""
+    conn.executemany(
+        "INSERT OR IGNORE INTO cards(card_id, balance) VALUES (?, 0)",
+        [(card_id,) for card_id, _, _, _ in cards],
+    )
+    conn.executemany(
+        "INSERT OR REPLACE INTO id_tags(id_tag, status, valid_until) VALUES (?, ?, ?)",
+        [
+            (card_id, "Accepted" if status == "active" else "Blocked", valid_until)
+            for card_id, _, status, valid_until in cards
+        ],
+    )
+    conn.executemany(
+        """
+        INSERT INTO account_cards
+            (card_id, account_id, status, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        [(card_id, account_id, status, now, now) for card_id, account_id, status, _ in cards],
+    )
+
+
+# ------------------------------------------------------------
+# operations
+# ------------------------------------------------------------
+def bulk_create_accounts(
+    conn: sqlite3.Connection, rows: list[dict[str, Any]], *, dry_run: bool = False
+) -> BulkReport:
+    """Rows: ``floor_no``, ``parking_space_no``, ``balance``, ``status``, ``card_ids``."""
+    results = [BulkRowResult(index + 1) for index in range(len(rows))]
+    parsed: dict[int, tuple[str, str, float, str]] = {}
+    cards_by_row: dict[int, list[str]] = {}
+    for index, row in enumerate(rows):
+        try:
+            floor = normalize_household_identity(_field(row, "floor_no", "floorNo", ""), "floor_no")
+            parking = normalize_household_identity(
+                _field(row, "parking_space_no", "parkingSpaceNo", ""), "parking_space_no"
+            )
+            status = _status(row, "invalid account status")
+            opening = money(_field(row, "balance", None, 0))
+            if opening < 0:
+                raise HouseholdAccountError("balance cannot be negative")
+            cards_by_row[index] = _list_field(row, "card_ids", "cardIds")
+        except HouseholdAccountError as exc:
+            results[index].fail(str(exc))
+            continue
+        parsed[index] = (floor, parking, float(opening), status)
+        results[index].data = {"floorNo": floor, "parkingSpaceNo": parking}
+
+    for conflict in _find_household_identity_conflicts(
+        conn, [(index, floor, parking) for index, (floor, parking, _, _) in parsed.items()]
+    ):
+        for index in conflict["rows"]:
+            detail = (
+                f"account_ids={conflict['account_ids']}"
+                if conflict["account_ids"]
+                else f"rows={[i + 1 for i in conflict['rows']]}"
+            )
+            results[index].fail(f"floor_no and parking_space_no already exist ({detail})")
+    _check_cards(conn, results, cards_by_row)
+
+    report = BulkReport("create_accounts", dry_run, results)
+    if report.errors or dry_run:
+        return report
+
+    now = utc_iso()
+    codes = {index: f"ACCOUNT-{uuid.uuid4().hex}" for index in parsed}
+    _begin(conn)
+    try:
+        conn.executemany(
+            """
+            INSERT INTO household_accounts
+                (account_code, account_name, floor_no, parking_space_no,
+                 balance, status, created_at, updated_at)
+            VALUES (?, '', ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (codes[index], floor, parking, balance, status, now, now)
+                for index, (floor, parking, balance, status) in parsed.items()
+            ],
+        )
+        account_ids = _existing(
+            conn,
+            "SELECT account_code, account_id FROM household_accounts WHERE account_code IN ({placeholders})",
+            codes.values(),
+        )
+        balance_ledger.record_openings(conn, account_ids.values(), now)
+        _insert_cards(
+            conn,
+            [
+                (card_id, account_ids[codes[index]], "active", None)
+                for index, cards in cards_by_row.items()
+                for card_id in cards
+            ],
+            now,
+        )
+        conn.commit()
+    except sqlite3.IntegrityError as exc:
+        conn.rollback()
+        raise HouseholdAccountConflictError(f"batch conflicts with concurrent changes: {exc}") from exc
+    except Exception:
+        conn.rollback()
+        raise
+    for index in parsed:
+        results[index].data.update(
+            {"accountId": account_ids[codes[index]], "cardIds": cards_by_row[index]}
+        )
+    auth_cache.invalidate_many(
+        [card_id for cards in cards_by_row.values() for card_id in cards], account_ids.values()
+    )
+    report.applied = True
+    return report
+
+
+def bulk_bind_cards(
+    conn: sqlite3.Connection, rows: list[dict[str, Any]], *, dry_run: bool = False
+) -> BulkReport:
+    """Rows: ``account_id`` or ``floor_no`` + ``parking_space_no``, ``card_id``, ``status``,
+    ``valid_until``, ``charge_point_ids``."""
+    results = [BulkRowResult(index + 1) for index in range(len(rows))]
+    ids, by_identity = _account_index(conn)
+    parsed: dict[int, tuple[str, int, str, str | None, list[str]]] = {}
+    for index, row in enumerate(rows):
+        try:
+            card_id = str(_field(row, "card_id", "cardId", "") or _field(row, "idTag", None, "")).strip()
+            if not card_id:
+                raise HouseholdAccountError("card_id is required")
+            account_id = _resolve_account(row, ids, by_identity)
+            status = _status(row, "invalid card status")
+            valid_until = _field(row, "valid_until", "validUntil")
+            charge_points = _list_field(row, "charge_point_ids", "chargePointIds")
+        except HouseholdAccountError as exc:
+            results[index].fail(str(exc))
+            continue
+        parsed[index] = (card_id, account_id, status, valid_until, charge_points)
+        results[index].data = {"cardId": card_id, "accountId": account_id}
+    _check_cards(conn, results, {index: [item[0]] for index, item in parsed.items()})
+
+    report = BulkReport("bind_cards", dry_run, results)
+    if report.errors or dry_run:
+        return report
+
+    whitelist = sorted(
+        {(card_id, cp_id) for card_id, _, _, _, cps in parsed.values() for cp_id in cps}
+    )
+    _begin(conn)
+    try:
+        _insert_cards(
+            conn,
+            [(card_id, account_id, status, valid_until) for card_id, account_id, status, valid_until, _ in parsed.values()],
+            utc_iso(),
+        )
+        conn.executemany(
+            """
+            INSERT INTO card_whitelist(card_id, charge_point_id)
+            SELECT ?, ? WHERE NOT EXISTS (
+                SELECT 1 FROM card_whitelist WHERE card_id = ? AND charge_point_id = ?
+            )
+            """,
+            [(card_id, cp_id, card_id, cp_id) for card_id, cp_id in whitelist],
+        )
+        conn.commit()
+    except sqlite3.IntegrityError as exc:
+        conn.rollback()
+        raise HouseholdAccountConflictError(f"batch conflicts with concurrent changes: {exc}") from exc
+    except Exception:
+        conn.rollback()
+        raise
+    auth_cache.invalidate_many([item[0] for item in parsed.values()])
+    report.applied = True
+    return report
+
+
+def bulk_topup(
+    conn: sqlite3.Connection, rows: list[dict[str, Any]], *, dry_run: bool = False
+) -> BulkReport:
+    """Rows: account reference, ``amount``, ``idempotency_key``.  Keys already
+    in the ledger are reported as ``skipped`` (the single top-up returns the
+    original entry for them)."""
+    results = [BulkRowResult(index + 1) for index in range(len(rows))]
+    ids, by_identity = _account_index(conn)
+    parsed: dict[int, tuple[int, float, str | None]] = {}
+    keys: dict[str, int] = {}
+    for index, row in enumerate(rows):
+        try:
+            account_id = _resolve_account(row, ids, by_identity)
+            amount = money(_field(row, "amount", None, 0))
+            if amount <= 0:
+                raise HouseholdAccountError("amount must be greater than zero")
+            key = _field(row, "idempotency_key", "idempotencyKey")
+            key = f"topup:{key}" if key is not None else None
+            if key is not None and key in keys:
+                raise HouseholdAccountError(f"idempotency_key repeated in batch (row {keys[key] + 1})")
+        except HouseholdAccountError as exc:
+            results[index].fail(str(exc))
+            continue
+        if key is not None:
+            keys[key] = index
+        parsed[index] = (account_id, float(amount), key)
+        results[index].data = {"accountId": account_id, "amount": float(amount)}
+
+    used = _existing(
+        conn,
+        f"SELECT idempotency_key, account_id FROM {balance_ledger.LEDGER_TABLE} "
+        "WHERE idempotency_key IN ({placeholders})",
+        keys,
+    )
+    for key, account_id in used.items():
+        index = keys[key]
+        if index not in parsed:
+            continue
+        if int(account_id) != parsed[index][0]:
+            results[index].fail("idempotency_key already used by another account")
+        else:
+            results[index].status = "skipped"
+            results[index].data["reason"] = "idempotency_key already applied"
+            del parsed[index]
+
+    report = BulkReport("topup", dry_run, results)
+    if report.errors or dry_run:
+        return report
+
+    if parsed:
+        _begin(conn)
+        try:
+            balance_ledger.post_entries(
+                conn,
+                [(account_id, "topup", amount, key, None) for account_id, amount, key in parsed.values()],
+            )
+            balances = _existing(
+                conn,
+                "SELECT account_id, balance FROM household_accounts WHERE account_id IN ({placeholders})",
+                [account_id for account_id, _, _ in parsed.values()],
+            )
+            conn.commit()
+        except LedgerError as exc:
+            conn.rollback()
+            raise HouseholdAccountError(str(exc)) from exc
+        except Exception:
+            conn.rollback()
+            raise
+        for index, (account_id, _, _) in parsed.items():
+            results[index].data["balance"] = balances.get(account_id)
+        auth_cache.invalidate_many(account_ids=[item[0] for item in parsed.values()])
+    report.applied = True
+    return report
+
+
+def _iso_datetime(value: str) -> datetime:
+    return datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+
+
+def bulk_add_id_tags(
+    conn: sqlite3.Connection,
+    rows: list[dict[str, Any]],
+    *,
+    dry_run: bool = False,
+    parse_datetime: Callable[[str], datetime] = _iso_datetime,
+) -> BulkReport:
+    """Rows: ``idTag``, ``status`` (default Accepted), ``validUntil`` — same rules as ``POST /api/id_tags``."""
+    results = [BulkRowResult(index + 1) for index in range(len(rows))]
+    parsed: dict[int, tuple[str, str, str]] = {}
+    seen: dict[str, int] = {}
+    for index, row in enumerate(rows):
+        try:
+            id_tag = str(_field(row, "id_tag", "idTag", "")).strip()
+            if not id_tag:
+                raise HouseholdAccountError("idTag is required")
+            if id_tag in seen:
+                raise HouseholdAccountError(f"idTag repeated in batch (row {seen[id_tag] + 1})")
+            status = str(_field(row, "status", None, "Accepted"))
+            valid_until = _field(row, "valid_until", "validUntil", DEFAULT_VALID_UNTIL)
+            try:
+                valid_str = parse_datetime(valid_until).strftime("%Y-%m-%dT%H:%M:%S")
+            except (TypeError, ValueError, OverflowError) as exc:
+                raise HouseholdAccountError("Invalid validUntil format") from exc
+        except HouseholdAccountError as exc:
+            results[index].fail(str(exc))
+            continue
+        seen[id_tag] = index
+        parsed[index] = (id_tag, status, valid_str)
+        results[index].data = {"idTag": id_tag}
+    for id_tag in _existing(conn, "SELECT id_tag FROM id_tags WHERE id_tag IN ({placeholders})", seen):
+        results[seen[id_tag]].fail("idTag already exists")
+
+    report = BulkReport("add_id_tags", dry_run, results)
+    if report.errors or dry_run:
+        return report
+
+    _begin(conn)
+    try:
+        conn.executemany(
+            "INSERT INTO id_tags (id_tag, status, valid_until) VALUES (?, ?, ?)", list(parsed.values())
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO cards (card_id, balance) VALUES (?, 0)",
+            [(id_tag,) for id_tag, _, _ in parsed.values()],
+        )
+        conn.commit()
+    except sqlite3.IntegrityError as exc:
+        conn.rollback()
+        raise HouseholdAccountConflictError(f"batch conflicts with concurrent changes: {exc}") from exc
+    except Exception:
+        conn.rollback()
+        raise
+    auth_cache.invalidate_many(seen)
+    report.applied = True
+    return report
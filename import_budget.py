@@ -0,0 +1,206 @@
+# import_budget.py
+# ============================================================
+# Import-time audit / startup budget for main.py
+#
+#   python import_budget.py                         # breakdown + budget check, JSON on stdout
+#   python import_budget.py --runs 5 --top 20
+#   python import_budget.py --output importtime.json --budget-ms 1500
+#
+# Each run imports main in a fresh interpreter with `python -X importtime`
+# against a throw-away, already-migrated database (what start.sh gives the
+# app), parses the per-module self / cumulative microseconds and reports the
+# median run. The check fails (exit 1) when:
+#   - main's cumulative import time exceeds --budget-ms, or
+#   - any LAZY_MODULES entry is imported eagerly. Those belong to optional
+#     subsystems (PDF report, LINE HTTP client, legacy date parsing, the
+#     uvicorn CLI) and must only be loaded on first use.
+#
+# Every restart is followed by all chargers reconnecting at once, so import
+# time is on the critical path of that reconnect storm.
+# ============================================================
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+
+ROOT = Path(__file__).resolve().parent
+
+# 這些模組只允許在第一次使用時載入（見 main.py 內的 function-local import）
+LAZY_MODULES = (
+    "reportlab",
+    "dateutil",
+    "uvicorn",
+    "urllib.request",
+    "requests",
+)
+
+DEFAULT_BUDGET_MS = float(os.getenv("IMPORT_BUDGET_MS", "2000"))
+
+_IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( +)(\S+)\s*$")
+
+
+@dataclass
+class ImportRecord:
+    module: str
+    self_us: int
+    cumulative_us: int
+    depth: int
+
+
+def parse_importtime(text: str) -> List[ImportRecord]:
+    """Parse `-X importtime` stderr; the header and unrelated lines are skipped."""
+    records = []
+    for line in text.splitlines():
+        match = _IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, module = match.groups()
+        records.append(
+            ImportRecord(
+                module=module,
+                self_us=int(self_us),
+                cumulative_us=int(cumulative_us),
+                depth=(len(indent) - 1) // 2,
+            )
+        )
+    return records
+
+
+def _is_lazy(module: str, lazy_modules=LAZY_MODULES) -> Optional[str]:
+    for name in lazy_modules:
+        if module == name or module.startswith(name + "."):
+            return name
+    return None
+
+
+def measure_once(module: str = "main", database_path: Optional[str] = None) -> Dict[str, Any]:
+    env = os.environ.copy()
+    if database_path:
+        env["DATABASE_PATH"] = database_path
+    started = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=300,
+    )
+    wall_ms = (time.perf_counter() - started) * 1000.0
+    if process.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{process.stderr[-4000:]}")
+    records = parse_importtime(process.stderr)
+    target = next((r for r in reversed(records) if r.module == module and r.depth == 0), None)
+    if target is None:
+        raise RuntimeError(f"no importtime record for {module}")
+    return {"wall_ms": wall_ms, "records": records, "target": target}
+
+
+def audit(
+    records: List[ImportRecord],
+    module: str = "main",
+    budget_ms: float = DEFAULT_BUDGET_MS,
+    top: int = 15,
+    lazy_modules=LAZY_MODULES,
+) -> Dict[str, Any]:
+    target = next(r for r in reversed(records) if r.module == module and r.depth == 0)
+    # importtime 是後序輸出：main 之前、縮排較深的連續紀錄才是 main 造成的載入
+    # （interpreter / site 啟動時的載入不算）
+    start = len(records) - 1 - records[::-1].index(target)
+    first_own = start
+    while first_own > 0 and records[first_own - 1].depth > 0:
+        first_own -= 1
+    own = records[first_own : start + 1]
+
+    direct = [r for r in own if r.depth == 1]
+    lazy_violations = sorted(
+        {r.module for r in own if _is_lazy(r.module, lazy_modules)}
+    )
+    total_ms = target.cumulative_us / 1000.0
+    return {
+        "module": module,
+        "total_ms": round(total_ms, 3),
+        "self_ms": round(target.self_us / 1000.0, 3),
+        "module_count": len(own),
+        "budget_ms": budget_ms,
+        "within_budget": total_ms <= budget_ms,
+        "lazy_modules": list(lazy_modules),
+        "lazy_violations": lazy_violations,
+        "direct_imports": [
+            {"module": r.module, "cumulative_ms": round(r.cumulative_us / 1000.0, 3)}
+            for r in sorted(direct, key=lambda r: r.cumulative_us, reverse=True)[:top]
+        ],
+        "top_self": [
+            {"module": r.module, "self_ms": round(r.self_us / 1000.0, 3)}
+            for r in sorted(own, key=lambda r: r.self_us, reverse=True)[:top]
+        ],
+    }
+
+
+def run_audit(
+    runs: int = 3,
+    module: str = "main",
+    budget_ms: float = DEFAULT_BUDGET_MS,
+    top: int = 15,
+) -> Dict[str, Any]:
+    from schema_migrations import migrate as migrate_schema
+
+    with tempfile.TemporaryDirectory(prefix="importtime_") as directory:
+        database_path = str(Path(directory) / "importtime.sqlite3")
+        migrate_schema(database_path)
+        samples = [measure_once(module, database_path) for _ in range(max(1, runs))]
+
+    samples.sort(key=lambda s: s["target"].cumulative_us)
+    median = samples[len(samples) // 2]
+    report = audit(median["records"], module=module, budget_ms=budget_ms, top=top)
+    report["runs"] = len(samples)
+    report["run_total_ms"] = [round(s["target"].cumulative_us / 1000.0, 3) for s in samples]
+    report["process_wall_ms"] = round(statistics.median(s["wall_ms"] for s in samples), 3)
+    report["python"] = sys.version.split()[0]
+    report["breakdown"] = [asdict(r) for r in median["records"]]
+    report["ok"] = report["within_budget"] and not report["lazy_violations"]
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="main.py import-time audit")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--output", help="write the full report (with breakdown) as JSON")
+    args = parser.parse_args(argv)
+
+    report = run_audit(args.runs, args.module, args.budget_ms, args.top)
+    if args.output:
+        Path(args.output).write_text(
+            json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8"
+        )
+
+    summary = {k: v for k, v in report.items() if k != "breakdown"}
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if report["lazy_violations"]:
+        print(f"[IMPORT_BUDGET][LAZY_VIOLATION] {report['lazy_violations']}", file=sys.stderr)
+    if not report["within_budget"]:
+        print(
+            f"[IMPORT_BUDGET][OVER_BUDGET] total_ms={report['total_ms']} "
+            f"budget_ms={report['budget_ms']}",
+            file=sys.stderr,
+        )
+    return 0 if report["ok"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,430 @@
+# line_emulator.py
+# ============================================================
+# In-process LINE Messaging API emulator for integration / load tests
+#
+#   python line_emulator.py --port 8089 --latency-ms 80 --rate-429 0.05 --rate-5xx 0.02
+#   LINE_API_BASE_URL=http://127.0.0.1:8089 \
+#   LINE_CHANNEL_ACCESS_TOKEN=emulator-token uvicorn main:app
+#
+# Serves the endpoints main.py calls (push / multicast / reply) on a local
+# ThreadingHTTPServer and:
+#   - checks the Bearer channel access token (401) and payload limits (400),
+#   - records every request and every delivered message per LINE userId,
+#   - injects latency, 429 (with Retry-After) and 5xx errors, either at a
+#     seeded random rate or as a scripted sequence (queue_statuses),
+#   - rejects pushes to configured userIds (fail_users) with 400,
+#   - answers 409 to a reused X-Line-Retry-Key that was already accepted,
+#     and can deliver a request but lose its response (lose_responses),
+#   - signs webhook deliveries with the channel secret (X-Line-Signature),
+#     the same HMAC-SHA256 LINE uses, so /webhook can be driven offline.
+#
+# In tests:
+#   with LineApiEmulator() as line_api:
+#       patch.multiple(main, **line_api.main_overrides())
+# ============================================================
+
+from __future__ import annotations
+
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter, defaultdict, deque
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+
+log = logging.getLogger("line_emulator")
+
+DEFAULT_CHANNEL_ACCESS_TOKEN = "emulator-token"
+DEFAULT_CHANNEL_SECRET = "emulator-secret"
+
+PUSH_PATH = "/v2/bot/message/push"
+MULTICAST_PATH = "/v2/bot/message/multicast"
+REPLY_PATH = "/v2/bot/message/reply"
+
+MAX_MULTICAST_RECIPIENTS = 500
+MAX_MESSAGES_PER_REQUEST = 5
+
+
+def sign_webhook_body(body: bytes, channel_secret: str) -> str:
+    """X-Line-Signature：base64(HMAC-SHA256(channel secret, raw body))。"""
+    digest = hmac.new(channel_secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("ascii")
+
+
+def verify_webhook_signature(body: bytes, signature: str, channel_secret: str) -> bool:
+    if not signature or not channel_secret:
+        return False
+    return hmac.compare_digest(sign_webhook_body(body, channel_secret), signature)
+
+
+def text_message_event(
+    user_id: str,
+    text: str,
+    reply_token: Optional[str] = None,
+    webhook_event_id: Optional[str] = None,
+    redelivery: bool = False,
+) -> Dict[str, Any]:
+    """LINE webhook 的文字訊息 event。"""
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "webhookEventId": webhook_event_id or uuid.uuid4().hex.upper(),
+        "deliveryContext": {"isRedelivery": bool(redelivery)},
+        "source": {"type": "user", "userId": user_id},
+        "replyToken": reply_token or uuid.uuid4().hex,
+        "message": {"id": uuid.uuid4().hex[:18], "type": "text", "text": text},
+    }
+
+
+@dataclass
+class FaultConfig:
+    latency_ms: float = 0.0
+    latency_jitter_ms: float = 0.0
+    rate_429: float = 0.0
+    rate_5xx: float = 0.0
+    retry_after_s: int = 1
+    seed: Optional[int] = None
+
+
+@dataclass
+class RecordedRequest:
+    path: str
+    status: int
+    body: Optional[Dict[str, Any]]
+    recipients: List[str]
+    authorized: bool
+    latency_ms: float
+    retry_key: Optional[str] = None
+    received_at: float = field(default_factory=time.time)
+
+
+class LineApiEmulator:
+    def __init__(
+        self,
+        channel_access_token: str = DEFAULT_CHANNEL_ACCESS_TOKEN,
+        channel_secret: str = DEFAULT_CHANNEL_SECRET,
+        faults: Optional[FaultConfig] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.channel_access_token = channel_access_token
+        self.channel_secret = channel_secret
+        self.faults = faults or FaultConfig()
+        self.fail_users: set = set()
+        self.requests: List[RecordedRequest] = []
+        self.delivered: Dict[str, List[str]] = defaultdict(list)
+        self._scripted: deque = deque()
+        self._lost_responses = 0
+        self.accepted_retry_keys: Dict[str, str] = {}
+        self._rng = random.Random(self.faults.seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    # ---------------- lifecycle ----------------
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    def main_overrides(self) -> Dict[str, str]:
+        """main.py 的 LINE 設定，指向這個 emulator（給 patch.multiple 用）。"""
+        return {
+            "LINE_CHANNEL_ACCESS_TOKEN": self.channel_access_token,
+            "LINE_CHANNEL_SECRET": self.channel_secret,
+            "LINE_PUSH_API_URL": self.url(PUSH_PATH),
+            "LINE_MULTICAST_API_URL": self.url(MULTICAST_PATH),
+            "LINE_REPLY_API_URL": self.url(REPLY_PATH),
+        }
+
+    def server_env(self) -> Dict[str, str]:
+        """啟動 main:app 子程序時的環境變數。"""
+        return {
+            "LINE_API_BASE_URL": self.base_url,
+            "LINE_CHANNEL_ACCESS_TOKEN": self.channel_access_token,
+            "LINE_CHANNEL_SECRET": self.channel_secret,
+        }
+
+    def start(self) -> "LineApiEmulator":
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._server.serve_forever, name="line-emulator", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join(timeout=5)
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self) -> "LineApiEmulator":
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ---------------- fault control ----------------
+    def queue_statuses(self, *statuses: int):
+        """Next requests answer with these statuses, in order (before random faults)."""
+        with self._lock:
+            self._scripted.extend(int(s) for s in statuses)
+
+    def lose_responses(self, count: int = 1):
+        """Next ``count`` accepted requests are delivered but answered 504 (response lost)."""
+        with self._lock:
+            self._lost_responses += int(count)
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.delivered.clear()
+            self._scripted.clear()
+            self._lost_responses = 0
+            self.accepted_retry_keys.clear()
+
+    def _next_fault(self) -> Optional[int]:
+        with self._lock:
+            if self._scripted:
+                return self._scripted.popleft()
+            roll = self._rng.random()
+        if roll < self.faults.rate_429:
+            return 429
+        if roll < self.faults.rate_429 + self.faults.rate_5xx:
+            return 500
+        return None
+
+    def _latency_s(self) -> float:
+        with self._lock:
+            jitter = self._rng.uniform(-1.0, 1.0) * self.faults.latency_jitter_ms
+        return max(0.0, self.faults.latency_ms + jitter) / 1000.0
+
+    # ---------------- request handling ----------------
+    def handle(self, path: str, headers, raw_body: bytes):
+        """Return (status, response dict, extra headers) and record the request."""
+        started = time.perf_counter()
+        authorized = headers.get("Authorization") == f"Bearer {self.channel_access_token}"
+        retry_key = headers.get("X-Line-Retry-Key")
+        body = None
+        recipients: List[str] = []
+        extra_headers: Dict[str, str] = {}
+
+        try:
+            body = json.loads(raw_body.decode("utf-8")) if raw_body else None
+        except ValueError:
+            body = None
+
+        if path not in (PUSH_PATH, MULTICAST_PATH, REPLY_PATH):
+            status, response = 404, {"message": "Not found"}
+        elif not authorized:
+            status, response = 401, {"message": "Authentication failed. Confirm that the access token in the authorization header is valid."}
+        elif not isinstance(body, dict):
+            status, response = 400, {"message": "The request body has 1 error(s)"}
+        else:
+            recipients, error = self._validate(path, body)
+            with self._lock:
+                accepted_request_id = self.accepted_retry_keys.get(retry_key) if retry_key else None
+            if error:
+                status, response = 400, {"message": error}
+            elif accepted_request_id:
+                status = 409
+                response = {"message": "The retry key is already accepted"}
+                extra_headers["X-Line-Accepted-Request-Id"] = accepted_request_id
+            else:
+                fault = self._next_fault()
+                if fault == 429:
+                    status = 429
+                    response = {"message": "The API rate limit has been exceeded. Try again later."}
+                    extra_headers["Retry-After"] = str(self.faults.retry_after_s)
+                elif fault is not None and fault >= 400:
+                    status, response = fault, {"message": "Internal server error"}
+                elif self.fail_users.intersection(recipients):
+                    status, response = 400, {"message": "Failed to send messages"}
+                else:
+                    status, response = 200, {}
+
+        delay = self._latency_s()
+        if delay:
+            time.sleep(delay)
+
+        request_id = uuid.uuid4().hex
+        if status == 200:
+            texts = [m.get("text", "") for m in body.get("messages", [])]
+            with self._lock:
+                for user_id in recipients:
+                    self.delivered[user_id].extend(texts)
+                if retry_key:
+                    self.accepted_retry_keys[retry_key] = request_id
+                if self._lost_responses:
+                    self._lost_responses -= 1
+                    status, response = 504, {"message": "Gateway timeout"}
+
+        extra_headers["X-Line-Request-Id"] = request_id
+        record = RecordedRequest(
+            path=path,
+            status=status,
+            body=body,
+            recipients=recipients,
+            authorized=authorized,
+            latency_ms=round((time.perf_counter() - started) * 1000.0, 3),
+            retry_key=retry_key,
+        )
+        with self._lock:
+            self.requests.append(record)
+        return status, response, extra_headers
+
+    @staticmethod
+    def _validate(path: str, body: Dict[str, Any]):
+        messages = body.get("messages")
+        if not isinstance(messages, list) or not 1 <= len(messages) <= MAX_MESSAGES_PER_REQUEST:
+            return [], f"messages must contain 1-{MAX_MESSAGES_PER_REQUEST} items"
+        if path == PUSH_PATH:
+            to = body.get("to")
+            if not isinstance(to, str) or not to:
+                return [], "The property, 'to', in the request body is invalid"
+            return [to], None
+        if path == MULTICAST_PATH:
+            to = body.get("to")
+            if not isinstance(to, list) or not 1 <= len(to) <= MAX_MULTICAST_RECIPIENTS:
+                return [], f"'to' must contain 1-{MAX_MULTICAST_RECIPIENTS} userIds"
+            return [str(u) for u in to], None
+        if not body.get("replyToken"):
+            return [], "Invalid reply token"
+        return [f"reply:{body['replyToken']}"], None
+
+    def _handler_class(self):
+        emulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive，與正式 LINE API 相同
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw_body = self.rfile.read(length) if length else b""
+                status, response, headers = emulator.handle(self.path, self.headers, raw_body)
+                payload = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, fmt, *args):
+                log.debug("[LINE_EMULATOR] " + fmt, *args)
+
+        return Handler
+
+    # ---------------- webhook delivery ----------------
+    def post_webhook(
+        self,
+        url: str,
+        events: List[Dict[str, Any]],
+        signature: Optional[str] = None,
+        timeout: float = 10.0,
+    ):
+        """POST a signed webhook to the app; returns (status, parsed body)."""
+        body = json.dumps(
+            {"destination": "Uemulator", "events": events}, ensure_ascii=False
+        ).encode("utf-8")
+        request = urllib.request.Request(
+            url,
+            data=body,
+            method="POST",
+            headers={
+                "Content-Type": "application/json",
+                "X-Line-Signature": signature or sign_webhook_body(body, self.channel_secret),
+            },
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as resp:
+                status, text = resp.status, resp.read().decode("utf-8", errors="replace")
+        except urllib.error.HTTPError as e:
+            status, text = e.code, e.read().decode("utf-8", errors="replace")
+        try:
+            return status, json.loads(text)
+        except ValueError:
+            return status, text
+
+    # ---------------- reporting ----------------
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            requests = list(self.requests)
+            delivered = {user: len(texts) for user, texts in self.delivered.items()}
+        latencies = sorted(r.latency_ms for r in requests)
+        return {
+            "requests": len(requests),
+            "by_path": dict(Counter(r.path for r in requests)),
+            "by_status": {str(k): v for k, v in Counter(r.status for r in requests).items()},
+            "delivered_messages": sum(delivered.values()),
+            "recipients": len(delivered),
+            "max_messages_per_recipient": max(delivered.values(), default=0),
+            "p50_latency_ms": latencies[len(latencies) // 2] if latencies else None,
+            "max_latency_ms": latencies[-1] if latencies else None,
+            "faults": asdict(self.faults),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local LINE Messaging API emulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--token", default=DEFAULT_CHANNEL_ACCESS_TOKEN)
+    parser.add_argument("--secret", default=DEFAULT_CHANNEL_SECRET)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--latency-jitter-ms", type=float, default=0.0)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--fail-user", action="append", default=[],
+                        help="userId that always gets 400; repeatable")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
+    emulator = LineApiEmulator(
+        channel_access_token=args.token,
+        channel_secret=args.secret,
+        faults=FaultConfig(
+            latency_ms=args.latency_ms,
+            latency_jitter_ms=args.latency_jitter_ms,
+            rate_429=args.rate_429,
+            rate_5xx=args.rate_5xx,
+            seed=args.seed,
+        ),
+        host=args.host,
+        port=args.port,
+    )
+    emulator.fail_users.update(args.fail_user)
+    emulator.start()
+    log.info(f"LINE emulator listening on {emulator.base_url} (LINE_API_BASE_URL)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
+        print(json.dumps(emulator.stats(), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
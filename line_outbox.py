@@ -0,0 +1,545 @@
+"""Durable LINE notification outbox and its async worker pool.
+
+StopTransaction settlement inserts one ``line_outbox`` row per notification
+event (``charge_completed`` / ``low_balance_after_transaction`` /
+``auto_stop_balance_insufficient``) inside the same SQLite transaction that
+debits the household account, so a restart can never lose a queued
+notification.  ``LineOutboxWorkerPool`` drains the table:
+
+- a dispatcher claims due rows (``pending`` → ``sending`` with a lease) only
+  up to the number of idle workers;
+- each job runs on the pool's own bounded thread pool, never on the default
+  executor, so a LINE outage cannot starve ``asyncio.to_thread`` users;
+- retryable failures (network errors, HTTP 429 / 5xx) are rescheduled with
+  exponential backoff and jitter; after ``max_attempts`` the row is ``dead``;
+- ``sending`` rows whose lease expired (worker crashed / process restarted)
+  are returned to ``pending`` on the next claim.
+
+This module intentionally has no FastAPI or LINE API dependency: the
+handler that builds and sends a message is injected by main.py.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable
+
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = "pending"
+STATUS_SENDING = "sending"
+STATUS_DONE = "done"
+STATUS_DEAD = "dead"
+
+RETRYABLE_HTTP_STATUS = frozenset({408, 429})
+
+# uuid5 namespace for X-Line-Retry-Key; never change it, or keys issued
+# before a deploy would no longer match their retries.
+RETRY_KEY_NAMESPACE = uuid.UUID("00db7b9b-c7bd-4569-80c8-0d8611c31d6d")
+
+
+@dataclass(frozen=True)
+class OutboxJob:
+    id: int
+    event_type: str
+    transaction_id: int
+    attempts: int
+    claim_token: str
+
+
+@dataclass
+class LineDeliveryOptions:
+    """
+    Passed from the outbox into the send_* helpers.
+
+    ``reclaim_failed`` lets a retry re-open recipient claims that previously
+    failed; ``stale_sending_before`` (ISO timestamp) re-opens ``sending``
+    recipient claims left behind by a crashed worker.
+    """
+
+    reclaim_failed: bool = False
+    stale_sending_before: str | None = None
+    rate_limiter: "RecipientRateLimiter | None" = None
+
+
+def utc_iso(epoch: float | None = None) -> str:
+    moment = datetime.fromtimestamp(time.time() if epoch is None else epoch, timezone.utc)
+    return moment.isoformat()
+
+
+def backoff_delay(
+    attempts: int,
+    base_s: float = 5.0,
+    cap_s: float = 600.0,
+    jitter: float = 0.2,
+    rng: random.Random | None = None,
+) -> float:
+    """Delay before retry #``attempts`` (1-based): base·2^(n-1), capped, ±jitter."""
+    delay = min(float(cap_s), float(base_s) * (2 ** max(0, int(attempts) - 1)))
+    if jitter:
+        delay *= 1.0 + (rng or random).uniform(-float(jitter), float(jitter))
+    return max(0.0, delay)
+
+
+def retry_key(event_type: str, transaction_id: int, line_user_ids) -> str:
+    """
+    X-Line-Retry-Key for one event sent to a fixed set of recipients.
+
+    The outbox row is unique on (event_type, transaction_id), so the key is
+    the same on every attempt of that job; LINE then answers 409 instead of
+    delivering a second copy when an earlier attempt's response was lost.
+    """
+    recipients = ",".join(sorted(str(u) for u in line_user_ids))
+    return str(uuid.uuid5(RETRY_KEY_NAMESPACE, f"{event_type}:{int(transaction_id)}:{recipients}"))
+
+
+def is_retryable_line_result(result: Any) -> bool:
+    """
+    Decide from a send_*_line_notification result whether the job is retried.
+
+    sent / skipped are final.  Per-recipient failures are retried only for
+    transient LINE errors; a failure before any recipient was attempted
+    (message build error, DB busy) is always retried.
+    """
+    if not isinstance(result, dict):
+        return True
+    status = result.get("status")
+    if status in ("sent", "skipped"):
+        return False
+    recipient_results = result.get("recipientResults")
+    if not recipient_results:
+        return status in ("failed", "partial")
+    for item in recipient_results:
+        if item.get("status") != "failed":
+            continue
+        line_result = item.get("lineResult") or {}
+        if "retryable" in line_result:
+            if line_result["retryable"]:
+                return True
+            continue
+        status_code = line_result.get("status_code")
+        if status_code is None or status_code in RETRYABLE_HTTP_STATUS or status_code >= 500:
+            return True
+    return False
+
+
+# ------------------------------------------------------------
+# SQLite 存取（呼叫端負責連線與交易邊界）
+# ------------------------------------------------------------
+def enqueue(
+    conn: sqlite3.Connection | sqlite3.Cursor,
+    event_type: str,
+    transaction_id: int,
+    now: float | None = None,
+) -> bool:
+    """
+    Idempotently queue one event; does not commit.
+
+    Call it with the settlement cursor so the row commits (or rolls back)
+    together with the debit.
+    """
+    now = time.time() if now is None else now
+    cur = conn.execute(
+        """
+        INSERT OR IGNORE INTO line_outbox (
+            event_type, transaction_id, status, attempts,
+            next_attempt_at, created_at, updated_at
+        ) VALUES (?, ?, 'pending', 0, ?, ?, ?)
+        """,
+        (str(event_type), int(transaction_id), float(now), utc_iso(now), utc_iso(now)),
+    )
+    return cur.rowcount == 1
+
+
+def recover_expired_claims(conn: sqlite3.Connection, lease_s: float, now: float | None = None) -> int:
+    now = time.time() if now is None else now
+    cur = conn.execute(
+        """
+        UPDATE line_outbox
+        SET status='pending', claim_token=NULL, updated_at=?
+        WHERE status='sending' AND claimed_at < ?
+        """,
+        (utc_iso(now), float(now) - float(lease_s)),
+    )
+    return cur.rowcount
+
+
+def claim_due(
+    conn: sqlite3.Connection,
+    limit: int,
+    lease_s: float,
+    now: float | None = None,
+) -> tuple[list[OutboxJob], int]:
+    """Recover expired leases, then claim up to ``limit`` due rows (commits)."""
+    now = time.time() if now is None else now
+    if limit <= 0:
+        return [], 0
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        recovered = recover_expired_claims(conn, lease_s, now)
+        rows = conn.execute(
+            """
+            SELECT id, event_type, transaction_id, attempts
+            FROM line_outbox
+            WHERE status='pending' AND next_attempt_at <= ?
+            ORDER BY next_attempt_at, id
+            LIMIT ?
+            """,
+            (float(now), int(limit)),
+        ).fetchall()
+        jobs = []
+        for row in rows:
+            token = uuid.uuid4().hex
+            conn.execute(
+                """
+                UPDATE line_outbox
+                SET status='sending', claim_token=?, claimed_at=?,
+                    attempts=attempts+1, updated_at=?
+                WHERE id=? AND status='pending'
+                """,
+                (token, float(now), utc_iso(now), int(row[0])),
+            )
+            jobs.append(
+                OutboxJob(
+                    id=int(row[0]),
+                    event_type=str(row[1]),
+                    transaction_id=int(row[2]),
+                    attempts=int(row[3]) + 1,
+                    claim_token=token,
+                )
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return jobs, recovered
+
+
+def complete(conn: sqlite3.Connection, job: OutboxJob, status: str, error: str | None = None) -> bool:
+    """Finish a claimed job; False when the lease was lost to recovery."""
+    cur = conn.execute(
+        """
+        UPDATE line_outbox
+        SET status=?, last_error=?, claim_token=NULL, updated_at=?
+        WHERE id=? AND claim_token=?
+        """,
+        (status, error, utc_iso(), job.id, job.claim_token),
+    )
+    conn.commit()
+    return cur.rowcount == 1
+
+
+def reschedule(
+    conn: sqlite3.Connection,
+    job: OutboxJob,
+    delay_s: float,
+    error: str | None,
+    now: float | None = None,
+) -> bool:
+    now = time.time() if now is None else now
+    cur = conn.execute(
+        """
+        UPDATE line_outbox
+        SET status='pending', next_attempt_at=?, last_error=?,
+            claim_token=NULL, updated_at=?
+        WHERE id=? AND claim_token=?
+        """,
+        (float(now) + float(delay_s), error, utc_iso(now), job.id, job.claim_token),
+    )
+    conn.commit()
+    return cur.rowcount == 1
+
+
+def outbox_summary(conn: sqlite3.Connection) -> dict[str, Any]:
+    counts = {
+        str(status): int(count)
+        for status, count in conn.execute(
+            "SELECT status, COUNT(*) FROM line_outbox GROUP BY status"
+        ).fetchall()
+    }
+    oldest = conn.execute(
+        "SELECT MIN(next_attempt_at) FROM line_outbox WHERE status='pending'"
+    ).fetchone()[0]
+    return {
+        "counts": counts,
+        "oldest_pending_due_at": utc_iso(oldest) if oldest is not None else None,
+    }
+
+
+# ------------------------------------------------------------
+# 每位收件者的發送間隔
+# ------------------------------------------------------------
+class RecipientRateLimiter:
+    """
+    Thread-safe minimum interval between two pushes to the same LINE user.
+
+    ``reserve`` books the next slot and returns how long the caller must
+    wait, so concurrent workers sending to one household are spaced out
+    instead of bursting (LINE throttles per channel and users see floods).
+    """
+
+    def __init__(self, min_interval_s: float = 1.0, clock: Callable[[], float] = time.monotonic):
+        self.min_interval_s = max(0.0, float(min_interval_s))
+        self.clock = clock
+        self._next_slot: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def reserve(self, key: str) -> float:
+        if self.min_interval_s <= 0:
+            return 0.0
+        with self._lock:
+            now = self.clock()
+            slot = max(now, self._next_slot.get(key, 0.0))
+            self._next_slot[key] = slot + self.min_interval_s
+            if len(self._next_slot) > 10_000:
+                self._next_slot = {k: v for k, v in self._next_slot.items() if v > now}
+            return slot - now
+
+    def wait(self, key: str) -> float:
+        delay = self.reserve(key)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+# ------------------------------------------------------------
+# Worker pool
+# ------------------------------------------------------------
+@dataclass
+class OutboxPoolStats:
+    claimed: int = 0
+    done: int = 0
+    retried: int = 0
+    dead: int = 0
+    recovered: int = 0
+    lost_leases: int = 0
+    errors: int = 0
+    last_error: str | None = None
+    in_flight: int = 0
+    started_at: str | None = None
+
+
+class LineOutboxWorkerPool:
+    """
+    Bounded async consumer of ``line_outbox``.
+
+    ``handler(job, options)`` is synchronous (it performs blocking SQLite and
+    HTTP work) and runs on this pool's own ``ThreadPoolExecutor``.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], sqlite3.Connection],
+        handler: Callable[[OutboxJob, LineDeliveryOptions], dict],
+        *,
+        workers: int = 4,
+        poll_interval_s: float = 5.0,
+        lease_s: float = 120.0,
+        max_attempts: int = 6,
+        backoff_base_s: float = 5.0,
+        backoff_cap_s: float = 600.0,
+        rate_limiter: RecipientRateLimiter | None = None,
+    ):
+        self.connect = connect
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.poll_interval_s = max(0.05, float(poll_interval_s))
+        self.lease_s = max(1.0, float(lease_s))
+        self.max_attempts = max(1, int(max_attempts))
+        self.backoff_base_s = float(backoff_base_s)
+        self.backoff_cap_s = float(backoff_cap_s)
+        self.rate_limiter = rate_limiter or RecipientRateLimiter(0)
+        self.stats = OutboxPoolStats()
+        self._executor: ThreadPoolExecutor | None = None
+        self._wake: asyncio.Event | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._queue: asyncio.Queue | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks) and self._loop is not None and not self._loop.is_closed()
+
+    def start(self) -> None:
+        """Start on the running event loop (idempotent)."""
+        loop = asyncio.get_running_loop()
+        if self.running and self._loop is loop:
+            return
+        self._loop = loop
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="line-outbox"
+        )
+        self._wake = asyncio.Event()
+        self._queue = asyncio.Queue(maxsize=self.workers)
+        self.stats.started_at = utc_iso()
+        self._tasks = [loop.create_task(self._dispatcher(), name="line-outbox-dispatcher")]
+        self._tasks += [
+            loop.create_task(self._worker(), name=f"line-outbox-worker-{i}")
+            for i in range(self.workers)
+        ]
+        logger.warning(
+            f"[LINE][OUTBOX][START] workers={self.workers} | poll_s={self.poll_interval_s} "
+            f"| lease_s={self.lease_s} | max_attempts={self.max_attempts}"
+        )
+
+    async def stop(self) -> None:
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._executor is not None:
+            # 進行中的工作會在 lease 到期後被下一次啟動回收
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        logger.warning("[LINE][OUTBOX][STOP]")
+
+    def wake(self) -> None:
+        """Nudge the dispatcher after an enqueue (safe from any thread)."""
+        if not self.running or self._wake is None:
+            return
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self._loop:
+            self._wake.set()
+        else:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def _claim(self, limit: int) -> list[OutboxJob]:
+        conn = self.connect()
+        try:
+            jobs, recovered = claim_due(conn, limit, self.lease_s)
+        finally:
+            conn.close()
+        if recovered:
+            self.stats.recovered += recovered
+            logger.warning(f"[LINE][OUTBOX][RECOVERED] expired_sending={recovered}")
+        self.stats.claimed += len(jobs)
+        return jobs
+
+    async def _dispatcher(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wake.clear()
+            try:
+                free = self.workers - self.stats.in_flight
+                jobs = await loop.run_in_executor(self._executor, self._claim, free) if free > 0 else []
+                for job in jobs:
+                    self.stats.in_flight += 1
+                    await self._queue.put(job)
+                if jobs and len(jobs) == free:
+                    # 還有積壓：等任一 worker 空出來再領下一批
+                    await asyncio.sleep(0)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats.errors += 1
+                self.stats.last_error = str(e)
+                logger.exception(f"[LINE][OUTBOX][DISPATCH_ERR] err={e}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval_s)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            try:
+                await loop.run_in_executor(self._executor, self.run_job, job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats.errors += 1
+                self.stats.last_error = str(e)
+                logger.exception(f"[LINE][OUTBOX][WORKER_ERR] job_id={job.id} | err={e}")
+            finally:
+                self.stats.in_flight = max(0, self.stats.in_flight - 1)
+                self._queue.task_done()
+                self._wake.set()
+
+    def delivery_options(self, job: OutboxJob) -> LineDeliveryOptions:
+        return LineDeliveryOptions(
+            reclaim_failed=job.attempts > 1,
+            stale_sending_before=utc_iso(time.time() - self.lease_s),
+            rate_limiter=self.rate_limiter,
+        )
+
+    def run_job(self, job: OutboxJob) -> str:
+        """Run one claimed job to a terminal or rescheduled state (blocking)."""
+        try:
+            result = self.handler(job, self.delivery_options(job))
+            error = None
+            retry = is_retryable_line_result(result)
+            if retry and isinstance(result, dict):
+                error = str(result.get("reason") or result.get("status") or "failed")
+        except Exception as e:
+            result, retry, error = None, True, f"{type(e).__name__}: {e}"
+            logger.exception(
+                f"[LINE][OUTBOX][HANDLER_ERR] job_id={job.id} | event={job.event_type} "
+                f"| tx_id={job.transaction_id} | err={e}"
+            )
+
+        conn = self.connect()
+        try:
+            if not retry:
+                outcome = STATUS_DONE
+                kept = complete(conn, job, STATUS_DONE)
+            elif job.attempts >= self.max_attempts:
+                outcome = STATUS_DEAD
+                kept = complete(conn, job, STATUS_DEAD, error)
+            else:
+                outcome = "retry"
+                delay = backoff_delay(job.attempts, self.backoff_base_s, self.backoff_cap_s)
+                kept = reschedule(conn, job, delay, error)
+        finally:
+            conn.close()
+
+        if not kept:
+            self.stats.lost_leases += 1
+        elif outcome == STATUS_DONE:
+            self.stats.done += 1
+        elif outcome == STATUS_DEAD:
+            self.stats.dead += 1
+        else:
+            self.stats.retried += 1
+        logger.warning(
+            f"[LINE][OUTBOX][JOB] job_id={job.id} | event={job.event_type} "
+            f"| tx_id={job.transaction_id} | attempt={job.attempts} | outcome={outcome} "
+            f"| lease_kept={kept} | error={error}"
+        )
+        return outcome
+
+    def drain_once(self, limit: int | None = None) -> list[str]:
+        """Claim and run due jobs inline (no event loop); used as a sync fallback."""
+        jobs = self._claim(self.workers if limit is None else limit)
+        return [self.run_job(job) for job in jobs]
+
+    def snapshot(self) -> dict[str, Any]:
+        stats = self.stats
+        return {
+            "running": self.running,
+            "workers": self.workers,
+            "in_flight": stats.in_flight,
+            "claimed": stats.claimed,
+            "done": stats.done,
+            "retried": stats.retried,
+            "dead": stats.dead,
+            "recovered": stats.recovered,
+            "lost_leases": stats.lost_leases,
+            "errors": stats.errors,
+            "last_error": stats.last_error,
+            "started_at": stats.started_at,
+        }
@@ -0,0 +1,270 @@
+"""LINE webhook intake: signature verification, dedup and async dispatch.
+
+``POST /webhook`` used to parse the body and run binding lookups plus the
+LINE Reply API call inline inside ``async def``; a burst of LINE events
+stalled the event loop that also serves the OCPP WebSockets.  The endpoint
+now only verifies ``X-Line-Signature`` and hands the events to
+``WebhookEventQueue``:
+
+- events are deduplicated by ``webhookEventId`` (LINE redelivers the same id
+  after a timeout or a non-2xx reply) in a bounded in-memory window;
+- a bounded ``asyncio.Queue`` feeds ``workers`` consumer tasks, and each
+  event runs on the queue's own ``ThreadPoolExecutor`` because the handler
+  does blocking SQLite and HTTP work;
+- when the queue is full the event is not marked as seen, so the endpoint
+  can answer non-2xx and LINE's redelivery brings it back.
+
+This module intentionally has no FastAPI or LINE API dependency: the event
+handler is injected by main.py.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable
+
+
+logger = logging.getLogger(__name__)
+
+
+def utc_iso() -> str:
+    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+
+
+def compute_signature(body: bytes, channel_secret: str) -> str:
+    """X-Line-Signature：base64(HMAC-SHA256(channel secret, raw body))。"""
+    digest = hmac.new(channel_secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("ascii")
+
+
+def verify_signature(body: bytes, signature: str | None, channel_secret: str) -> bool:
+    if not signature or not channel_secret:
+        return False
+    return hmac.compare_digest(compute_signature(body, channel_secret), signature)
+
+
+def event_id(event: dict) -> str | None:
+    value = event.get("webhookEventId") if isinstance(event, dict) else None
+    return str(value) if value else None
+
+
+class EventDeduplicator:
+    """
+    Remembers recently accepted ``webhookEventId`` values.
+
+    Bounded by both ``ttl_s`` and ``max_entries`` so a flood of unique ids
+    cannot grow memory without limit.  Thread-safe.
+    """
+
+    def __init__(
+        self,
+        ttl_s: float = 3600.0,
+        max_entries: int = 10000,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ttl_s = float(ttl_s)
+        self.max_entries = max(1, int(max_entries))
+        self.clock = clock
+        self._seen: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float) -> None:
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if now - seen_at < self.ttl_s and len(self._seen) <= self.max_entries:
+                break
+            self._seen.pop(key)
+
+    def add(self, key: str) -> bool:
+        """Record ``key``; False when it was already seen within the window."""
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+            if key in self._seen:
+                return False
+            self._seen[key] = now
+            self._expire(now)
+            return True
+
+    def discard(self, key: str) -> None:
+        with self._lock:
+            self._seen.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+
+@dataclass
+class WebhookQueueStats:
+    received: int = 0
+    accepted: int = 0
+    duplicates: int = 0
+    dropped: int = 0
+    processed: int = 0
+    errors: int = 0
+    last_error: str | None = None
+    in_flight: int = 0
+    started_at: str | None = None
+
+
+@dataclass(frozen=True)
+class SubmitResult:
+    accepted: int
+    duplicates: int
+    dropped: int
+
+
+class WebhookEventQueue:
+    """
+    Bounded async consumer of LINE webhook events.
+
+    ``handler(event)`` is synchronous and runs on this queue's own
+    ``ThreadPoolExecutor`` with at most ``workers`` events in flight.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[dict], Any],
+        *,
+        workers: int = 4,
+        maxsize: int = 1000,
+        dedup: EventDeduplicator | None = None,
+    ):
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.maxsize = max(1, int(maxsize))
+        self.dedup = dedup or EventDeduplicator()
+        self.stats = WebhookQueueStats()
+        self._executor: ThreadPoolExecutor | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._queue: asyncio.Queue | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks) and self._loop is not None and not self._loop.is_closed()
+
+    def start(self) -> None:
+        """Start on the running event loop (idempotent)."""
+        loop = asyncio.get_running_loop()
+        if self.running and self._loop is loop:
+            return
+        self._loop = loop
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="line-webhook"
+        )
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self.stats.started_at = utc_iso()
+        self._tasks = [
+            loop.create_task(self._worker(), name=f"line-webhook-worker-{i}")
+            for i in range(self.workers)
+        ]
+        logger.warning(
+            f"[LINE][WEBHOOK][START] workers={self.workers} | maxsize={self.maxsize}"
+        )
+
+    async def stop(self) -> None:
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        logger.warning("[LINE][WEBHOOK][STOP]")
+
+    def submit(self, events) -> SubmitResult:
+        """
+        Enqueue events without waiting for them (call from the event loop).
+
+        Starts the queue lazily, e.g. when the app runs without its startup
+        hook under a test client.
+        """
+        if not self.running:
+            self.start()
+
+        accepted = duplicates = dropped = 0
+        for event in events or []:
+            if not isinstance(event, dict):
+                continue
+            self.stats.received += 1
+            key = event_id(event)
+            if key is not None and not self.dedup.add(key):
+                duplicates += 1
+                continue
+            try:
+                self._queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # 未標記為已處理：LINE 重送時可再次接受
+                if key is not None:
+                    self.dedup.discard(key)
+                dropped += 1
+                continue
+            accepted += 1
+
+        self.stats.accepted += accepted
+        self.stats.duplicates += duplicates
+        self.stats.dropped += dropped
+        if duplicates or dropped:
+            logger.warning(
+                f"[LINE][WEBHOOK][SUBMIT] accepted={accepted} | duplicates={duplicates} "
+                f"| dropped={dropped} | queued={self._queue.qsize()}"
+            )
+        return SubmitResult(accepted, duplicates, dropped)
+
+    async def join(self) -> None:
+        """Wait until every accepted event has been handled (tests / shutdown)."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    def _run(self, event: dict) -> None:
+        self.handler(event)
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            event = await self._queue.get()
+            self.stats.in_flight += 1
+            try:
+                await loop.run_in_executor(self._executor, self._run, event)
+                self.stats.processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats.errors += 1
+                self.stats.last_error = str(e)
+                logger.exception(
+                    f"[LINE][WEBHOOK][EVENT_ERR] event_id={event_id(event)} | err={e}"
+                )
+            finally:
+                self.stats.in_flight = max(0, self.stats.in_flight - 1)
+                self._queue.task_done()
+
+    def snapshot(self) -> dict[str, Any]:
+        stats = self.stats
+        return {
+            "running": self.running,
+            "workers": self.workers,
+            "maxsize": self.maxsize,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "in_flight": stats.in_flight,
+            "received": stats.received,
+            "accepted": stats.accepted,
+            "duplicates": stats.duplicates,
+            "dropped": stats.dropped,
+            "processed": stats.processed,
+            "errors": stats.errors,
+            "last_error": stats.last_error,
+            "dedup_window": len(self.dedup),
+            "started_at": stats.started_at,
+        }
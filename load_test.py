@@ -0,0 +1,760 @@
+# load_test.py
+# ============================================================
+# Techlux OCPP 1.6 load-test harness
+#
+# Drives N simulated charge points (cp_sim5.SimChargePoint) against a locally
+# started `main:app` backed by a throw-away DATABASE_PATH, and reports
+# throughput plus p50/p95/p99 latency per OCPP action.
+#
+#   python load_test.py --chargers 200 --duration 120 --meter 5 \
+#       --charging-ratio 0.7 --storm-at 60 --remote-stops-per-min 20 \
+#       --seed 42 --output load_test_report.json
+#
+# Scenario (which chargers charge, session lengths, idle gaps, RemoteStop
+# targets, reconnect storms) is derived from --seed only, so two runs with the
+# same arguments exercise the same traffic shape.
+#
+# --line-emulator points the server at a local LINE API emulator
+# (line_emulator.py), binds --line-users-per-account LINE users to every
+# household and reports LINE fan-out / retry / outbox numbers offline:
+#
+#   python load_test.py --chargers 50 --duration 60 --line-emulator \
+#       --line-latency-ms 80 --line-rate-429 0.05 --line-rate-5xx 0.02
+# ============================================================
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import websockets
+
+import cp_sim5
+from cp_sim5 import SimChargePoint, SimConfig
+
+
+ROOT = Path(__file__).resolve().parent
+
+log = logging.getLogger("load_test")
+
+
+def _ensure_ocpp_payload_aliases():
+    """
+    cp_sim5 使用新版 python-ocpp 命名（call.BootNotification），
+    requirements.txt 鎖定的 ocpp==0.26 只有 *Payload 類別 → 補上別名。
+    """
+    from ocpp.v16 import call as ocpp_call, call_result as ocpp_call_result
+
+    for module in (ocpp_call, ocpp_call_result):
+        for name in dir(module):
+            if name.endswith("Payload") and not hasattr(module, name[: -len("Payload")]):
+                setattr(module, name[: -len("Payload")], getattr(module, name))
+
+
+_ensure_ocpp_payload_aliases()
+
+
+# -----------------------------
+# Config
+# -----------------------------
+@dataclass
+class LoadTestConfig:
+    chargers: int = 50
+    duration_s: float = 60.0
+    seed: int = 1
+
+    # Connection ramp (chargers connect spread over this window)
+    ramp_s: float = 5.0
+
+    # Traffic shape
+    meter_interval_s: float = 5.0
+    status_keepalive_s: int = 30
+    charging_ratio: float = 0.7
+    session_min_s: float = 20.0
+    session_max_s: float = 60.0
+    idle_min_s: float = 2.0
+    idle_max_s: float = 10.0
+
+    # Reconnect storms: every charger drops its socket at these offsets (s)
+    storm_at_s: List[float] = field(default_factory=list)
+    storm_reconnect_jitter_s: float = 1.0
+
+    # RemoteStop traffic through /api/charge-points/{id}/stop
+    remote_stops_per_min: float = 0.0
+
+    # Seeded data
+    cp_prefix: str = "LT*SIM*"
+    card_prefix: str = "LT-CARD-"
+    household_balance: float = 1_000_000.0
+    # None → 每支樁 7kW，避免 Smart Charging 因契約容量擋下 StartTransaction
+    contract_kw: Optional[float] = None
+
+    # LINE notifications against line_emulator.LineApiEmulator
+    line_emulator: bool = False
+    line_users_per_account: int = 1
+    line_latency_ms: float = 0.0
+    line_rate_429: float = 0.0
+    line_rate_5xx: float = 0.0
+    line_drain_s: float = 10.0
+
+    # Server
+    host: str = "127.0.0.1"
+    port: int = 0
+    server_url: Optional[str] = None
+
+
+@dataclass
+class ChargerPlan:
+    cp_id: str
+    id_tag: str
+    charges: bool
+    start_delay_s: float
+    sessions: List[tuple] = field(default_factory=list)  # (idle_s, session_s)
+
+
+@dataclass
+class ChargerState:
+    """跨重連保留的樁端狀態（交易、電表、行程進度）。"""
+
+    cursor: int = 0
+    transaction_id: Optional[int] = None
+    energy_wh: float = 0.0
+    meter_start_wh: int = 0
+    session_deadline: Optional[float] = None
+
+    def capture(self, cp: SimChargePoint):
+        self.transaction_id = cp.transaction_id
+        self.energy_wh = cp.energy_wh
+        self.meter_start_wh = cp.meter_start_wh
+
+    def restore(self, cp: SimChargePoint):
+        cp.transaction_id = self.transaction_id
+        cp.is_charging = self.transaction_id is not None
+        cp.energy_wh = self.energy_wh
+        cp.meter_start_wh = self.meter_start_wh
+
+
+def build_plans(config: LoadTestConfig) -> List[ChargerPlan]:
+    """
+    依 seed 產生每支樁的固定行程（是否充電、每段 idle/充電秒數）。
+    同一組參數 → 同一組行程，方便比較不同版本的結果。
+    """
+    rng = random.Random(config.seed)
+    plans: List[ChargerPlan] = []
+    for index in range(config.chargers):
+        plan = ChargerPlan(
+            cp_id=f"{config.cp_prefix}{index + 1:05d}",
+            id_tag=f"{config.card_prefix}{index + 1:05d}",
+            charges=rng.random() < config.charging_ratio,
+            start_delay_s=rng.uniform(0.0, max(0.0, config.ramp_s)),
+        )
+        elapsed = plan.start_delay_s
+        while plan.charges and elapsed < config.duration_s:
+            idle_s = rng.uniform(config.idle_min_s, config.idle_max_s)
+            session_s = rng.uniform(config.session_min_s, config.session_max_s)
+            plan.sessions.append((round(idle_s, 3), round(session_s, 3)))
+            elapsed += idle_s + session_s
+        plans.append(plan)
+    return plans
+
+
+def build_remote_stop_schedule(config: LoadTestConfig) -> List[tuple]:
+    """(offset_s, charger_index) pairs for RemoteStop API traffic."""
+    if config.remote_stops_per_min <= 0 or config.chargers <= 0:
+        return []
+    rng = random.Random(config.seed + 7919)
+    gap_s = 60.0 / float(config.remote_stops_per_min)
+    schedule = []
+    offset = config.ramp_s + gap_s
+    while offset < config.duration_s:
+        schedule.append((round(offset, 3), rng.randrange(config.chargers)))
+        offset += gap_s
+    return schedule
+
+
+# -----------------------------
+# Metrics
+# -----------------------------
+def percentile(sorted_values: List[float], pct: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * (float(pct) / 100.0)
+    low = int(rank)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (rank - low)
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.started_at = time.perf_counter()
+
+    def record(self, action: str, seconds: float, ok: bool = True):
+        self.samples.setdefault(action, []).append(float(seconds))
+        if not ok:
+            self.errors[action] = self.errors.get(action, 0) + 1
+
+    def summary(self, elapsed_s: Optional[float] = None) -> Dict[str, Any]:
+        elapsed_s = elapsed_s or (time.perf_counter() - self.started_at)
+        actions: Dict[str, Any] = {}
+        for action in sorted(self.samples):
+            values = sorted(self.samples[action])
+            actions[action] = {
+                "count": len(values),
+                "errors": self.errors.get(action, 0),
+                "throughput_per_s": round(len(values) / elapsed_s, 3) if elapsed_s > 0 else None,
+                "p50_ms": _ms(percentile(values, 50)),
+                "p95_ms": _ms(percentile(values, 95)),
+                "p99_ms": _ms(percentile(values, 99)),
+                "max_ms": _ms(values[-1]),
+            }
+        total = sum(len(v) for v in self.samples.values())
+        return {
+            "elapsed_s": round(elapsed_s, 3),
+            "total_calls": total,
+            "total_errors": sum(self.errors.values()),
+            "throughput_per_s": round(total / elapsed_s, 3) if elapsed_s > 0 else None,
+            "actions": actions,
+        }
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1000.0, 2)
+
+
+class LoadChargePoint(SimChargePoint):
+    """SimChargePoint 加上每個 OCPP action 的往返時間量測。"""
+
+    def __init__(self, cp_id: str, ws, config: SimConfig, recorder: LatencyRecorder):
+        super().__init__(cp_id, ws, config)
+        self.recorder = recorder
+
+    async def call(self, payload, suppress=True, unique_id=None):
+        action = type(payload).__name__
+        if action.endswith("Payload"):
+            action = action[: -len("Payload")]
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            response = await super().call(payload, suppress=suppress, unique_id=unique_id)
+            ok = response is not None
+            return response
+        finally:
+            self.recorder.record(action, time.perf_counter() - t0, ok=ok)
+
+
+# -----------------------------
+# Local server
+# -----------------------------
+def _free_port(host: str) -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return int(sock.getsockname()[1])
+
+
+class LocalServer:
+    """
+    以暫存 DATABASE_PATH 啟動 `main:app`（先跑 run_startup_migrations.py，
+    與 start.sh 相同順序），server 輸出寫入 server.log。
+    """
+
+    def __init__(self, config: LoadTestConfig, workdir: Path):
+        self.config = config
+        self.workdir = workdir
+        self.database_path = workdir / "load_test.sqlite3"
+        self.log_path = workdir / "server.log"
+        self.port = int(config.port or _free_port(config.host))
+        self.process: Optional[subprocess.Popen] = None
+        self.extra_env: Dict[str, str] = {}
+        self._log_file = None
+
+    @property
+    def http_base(self) -> str:
+        return f"http://{self.config.host}:{self.port}"
+
+    @property
+    def ws_base(self) -> str:
+        return f"ws://{self.config.host}:{self.port}"
+
+    def start(self, timeout_s: float = 60.0):
+        env = os.environ.copy()
+        env.update(self.extra_env)
+        env["DATABASE_PATH"] = str(self.database_path)
+        for suffix in ("", "-wal", "-shm"):
+            Path(f"{self.database_path}{suffix}").unlink(missing_ok=True)
+        self._log_file = open(self.log_path, "w", encoding="utf-8")
+        subprocess.run(
+            [sys.executable, "run_startup_migrations.py"],
+            cwd=ROOT,
+            env=env,
+            stdout=self._log_file,
+            stderr=subprocess.STDOUT,
+            check=True,
+        )
+        self.process = subprocess.Popen(
+            [
+                sys.executable, "-m", "uvicorn", "main:app",
+                "--host", self.config.host,
+                "--port", str(self.port),
+                "--log-level", "warning",
+            ],
+            cwd=ROOT,
+            env=env,
+            stdout=self._log_file,
+            stderr=subprocess.STDOUT,
+        )
+        deadline = time.monotonic() + timeout_s
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"server exited early, see {self.log_path}")
+            try:
+                with urllib.request.urlopen(f"{self.http_base}/api/version-check", timeout=1):
+                    return
+            except (urllib.error.URLError, ConnectionError, OSError):
+                time.sleep(0.2)
+        raise RuntimeError(f"server did not become ready in {timeout_s}s")
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+
+def _line_card_id(id_tag: str, n: int) -> str:
+    return id_tag if n == 0 else f"{id_tag}-L{n}"
+
+
+def seed_database(
+    database_path: Path,
+    plans: List[ChargerPlan],
+    balance: float,
+    contract_kw: Optional[float] = None,
+    line_users_per_account: int = 0,
+):
+    """
+    每支樁：白名單一筆、一個住戶帳戶、一張綁定卡片（card_whitelist 允許該樁）。
+    line_users_per_account > 0 時，每張卡另外綁定 LINE 使用者。
+    """
+    from household_account_service import (
+        bind_card_to_account,
+        connect,
+        create_household_account,
+        ensure_schema,
+    )
+
+    conn = connect(str(database_path))
+    try:
+        ensure_schema(conn)
+        conn.executemany(
+            """
+            INSERT OR IGNORE INTO charge_points (charge_point_id, name, status)
+            VALUES (?, ?, 'enabled')
+            """,
+            [(plan.cp_id, f"load-test {plan.cp_id}") for plan in plans],
+        )
+        conn.commit()
+        for index, plan in enumerate(plans, start=1):
+            account = create_household_account(
+                conn, "LT", f"P{index:05d}", balance=balance
+            )
+            bind_card_to_account(conn, int(account["account_id"]), plan.id_tag)
+            for n in range(1, line_users_per_account):
+                bind_card_to_account(
+                    conn, int(account["account_id"]), _line_card_id(plan.id_tag, n)
+                )
+        conn.executemany(
+            "INSERT INTO card_whitelist (card_id, charge_point_id) VALUES (?, ?)",
+            [(plan.id_tag, plan.cp_id) for plan in plans],
+        )
+        if line_users_per_account > 0:
+            # line_bindings 以 id_tag 為主鍵：同住戶的其他 LINE 使用者綁在附卡上
+            conn.executemany(
+                """
+                INSERT INTO line_bindings (
+                    id_tag, line_user_id, display_name, enabled, created_at, updated_at
+                ) VALUES (?, ?, ?, 1, datetime('now'), datetime('now'))
+                """,
+                [
+                    (_line_card_id(plan.id_tag, n), f"U-{plan.id_tag}-{n}", f"load-test {n}")
+                    for plan in plans
+                    for n in range(line_users_per_account)
+                ],
+            )
+        conn.execute(
+            "UPDATE community_settings SET enabled = 1, contract_kw = ? WHERE id = 1",
+            (float(contract_kw if contract_kw is not None else 7.0 * len(plans)),),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# -----------------------------
+# Charger runner
+# -----------------------------
+class LoadTestRun:
+    def __init__(self, config: LoadTestConfig, ws_base: str, http_base: str):
+        self.config = config
+        self.ws_base = ws_base.rstrip("/")
+        self.http_base = http_base.rstrip("/")
+        self.recorder = LatencyRecorder()
+        self.plans = build_plans(config)
+        self.remote_stops = build_remote_stop_schedule(config)
+        self.stop_all = asyncio.Event()
+        self.storm_generation = 0
+        self.storm_event = asyncio.Event()
+        self.active_cps: Dict[str, LoadChargePoint] = {}
+        self.counters: Dict[str, int] = {
+            "connects": 0,
+            "connect_failures": 0,
+            "sessions_started": 0,
+            "sessions_completed": 0,
+            "sessions_rejected": 0,
+            "remote_stops_sent": 0,
+            "remote_stops_skipped": 0,
+        }
+
+    def _sim_config(self) -> SimConfig:
+        return SimConfig(
+            ws_base=self.ws_base,
+            meter_interval_s=self.config.meter_interval_s,
+            do_authorize=False,
+            do_start_tx=False,
+            status_keepalive_s=self.config.status_keepalive_s,
+        )
+
+    async def _sleep_or_stop(self, seconds: float) -> bool:
+        """回傳 True 代表整體測試已結束。"""
+        try:
+            await asyncio.wait_for(self.stop_all.wait(), timeout=max(0.0, seconds))
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _session_loop(self, cp: LoadChargePoint, plan: ChargerPlan, state: "ChargerState"):
+        # 重連後續跑：伺服器端交易仍在（斷線 ≠ 交易結束），等原本的 deadline 到再停
+        if cp.transaction_id is not None and state.session_deadline is not None:
+            if await self._finish_session(cp, state):
+                return
+
+        while state.cursor < len(plan.sessions) and not self.stop_all.is_set():
+            idle_s, session_s = plan.sessions[state.cursor]
+            if await self._sleep_or_stop(idle_s):
+                return
+            state.cursor += 1
+            if not await cp.authorize(plan.id_tag):
+                continue
+            tx_id = await cp.start_transaction(plan.id_tag)
+            if not tx_id:
+                # 後端回 transaction_id=0（Blocked/Invalid）→ 本段不算開始充電
+                cp.transaction_id = None
+                cp.is_charging = False
+                self.counters["sessions_rejected"] += 1
+                continue
+            self.counters["sessions_started"] += 1
+            state.session_deadline = time.monotonic() + session_s
+            if await self._finish_session(cp, state):
+                return
+
+    async def _finish_session(self, cp: LoadChargePoint, state: "ChargerState") -> bool:
+        """等到 session 結束（時間到或被 RemoteStop）；回傳 True 代表整體測試已結束。"""
+        while cp.transaction_id is not None and time.monotonic() < state.session_deadline:
+            if await self._sleep_or_stop(min(1.0, state.session_deadline - time.monotonic())):
+                return True
+        if cp.transaction_id is not None:
+            await cp.stop_transaction(reason="Local")
+        state.session_deadline = None
+        self.counters["sessions_completed"] += 1
+        return False
+
+    async def _run_charger(self, plan: ChargerPlan):
+        if await self._sleep_or_stop(plan.start_delay_s):
+            return
+        sim_config = self._sim_config()
+        state = ChargerState()
+        rng = random.Random(f"{self.config.seed}:{plan.cp_id}")
+
+        while not self.stop_all.is_set():
+            generation = self.storm_generation
+            t0 = time.perf_counter()
+            try:
+                ws = await websockets.connect(
+                    f"{self.ws_base}/{plan.cp_id}",
+                    subprotocols=["ocpp1.6"],
+                    ping_interval=None,
+                    close_timeout=2,
+                    max_queue=None,
+                )
+            except Exception as e:
+                self.recorder.record("WebSocketConnect", time.perf_counter() - t0, ok=False)
+                self.counters["connect_failures"] += 1
+                log.debug(f"[{plan.cp_id}] connect failed: {e}")
+                if await self._sleep_or_stop(1.0 + rng.uniform(0, 1.0)):
+                    return
+                continue
+
+            self.recorder.record("WebSocketConnect", time.perf_counter() - t0)
+            self.counters["connects"] += 1
+            cp = LoadChargePoint(plan.cp_id, ws, sim_config, self.recorder)
+            state.restore(cp)
+            receiver = asyncio.create_task(cp.start())
+            loops: List[asyncio.Task] = []
+            try:
+                await cp.boot()
+                self.active_cps[plan.cp_id] = cp
+                loops = [
+                    asyncio.create_task(cp.meter_values_loop()),
+                    asyncio.create_task(cp.heartbeat_loop()),
+                    asyncio.create_task(cp.status_keepalive_loop()),
+                    asyncio.create_task(self._session_loop(cp, plan, state)),
+                ]
+                waiters = {
+                    receiver,
+                    asyncio.create_task(self.stop_all.wait()),
+                    asyncio.create_task(self._wait_storm(generation)),
+                }
+                _, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+                for task in pending:
+                    if task is not receiver:
+                        task.cancel()
+            except Exception as e:
+                log.warning(f"[{plan.cp_id}] session error: {e!r}")
+            finally:
+                self.active_cps.pop(plan.cp_id, None)
+                cp.stop()
+                for task in loops:
+                    task.cancel()
+                await asyncio.gather(*loops, return_exceptions=True)
+                if self.stop_all.is_set():
+                    try:
+                        await asyncio.wait_for(cp.stop_transaction(reason="Local"), timeout=10)
+                    except Exception:
+                        pass
+                state.capture(cp)
+                receiver.cancel()
+                await asyncio.gather(receiver, return_exceptions=True)
+                try:
+                    await ws.close()
+                except Exception:
+                    pass
+
+            # 重連風暴：所有樁同時斷線，短暫 jitter 後一起重連
+            if await self._sleep_or_stop(rng.uniform(0.0, self.config.storm_reconnect_jitter_s)):
+                return
+
+    async def _wait_storm(self, generation: int):
+        while self.storm_generation == generation:
+            self.storm_event.clear()
+            await self.storm_event.wait()
+
+    async def _storm_driver(self):
+        t_start = time.monotonic()
+        for offset in sorted(self.config.storm_at_s):
+            if await self._sleep_or_stop(offset - (time.monotonic() - t_start)):
+                return
+            self.storm_generation += 1
+            self.storm_event.set()
+            log.warning(f"[LOADTEST][STORM] generation={self.storm_generation} at={offset}s")
+
+    def _post(self, path: str) -> int:
+        req = urllib.request.Request(f"{self.http_base}{path}", data=b"", method="POST")
+        try:
+            with urllib.request.urlopen(req, timeout=60) as resp:
+                return int(resp.status)
+        except urllib.error.HTTPError as e:
+            return int(e.code)
+
+    async def _remote_stop_driver(self):
+        t_start = time.monotonic()
+        for offset, index in self.remote_stops:
+            if await self._sleep_or_stop(offset - (time.monotonic() - t_start)):
+                return
+            cp_id = self.plans[index].cp_id
+            cp = self.active_cps.get(cp_id)
+            if cp is None or cp.transaction_id is None:
+                self.counters["remote_stops_skipped"] += 1
+                continue
+            self.counters["remote_stops_sent"] += 1
+            asyncio.create_task(self._remote_stop(cp_id))
+
+    async def _remote_stop(self, cp_id: str):
+        t0 = time.perf_counter()
+        path = f"/api/charge-points/{urllib.parse.quote(cp_id, safe='')}/stop"
+        try:
+            status = await asyncio.to_thread(self._post, path)
+            ok = 200 <= status < 300
+        except Exception:
+            ok = False
+        self.recorder.record("RemoteStopApi", time.perf_counter() - t0, ok=ok)
+
+    async def run(self) -> Dict[str, Any]:
+        self.recorder = LatencyRecorder()
+        tasks = [asyncio.create_task(self._run_charger(plan)) for plan in self.plans]
+        drivers = [
+            asyncio.create_task(self._storm_driver()),
+            asyncio.create_task(self._remote_stop_driver()),
+        ]
+        await self._sleep_or_stop(self.config.duration_s)
+        elapsed_s = time.perf_counter() - self.recorder.started_at
+        self.stop_all.set()
+        await asyncio.gather(*drivers, return_exceptions=True)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return {
+            "config": asdict(self.config),
+            "counters": dict(self.counters),
+            "latency": self.recorder.summary(elapsed_s),
+        }
+
+
+async def run_load_test(config: LoadTestConfig, workdir: Optional[Path] = None) -> Dict[str, Any]:
+    """
+    完整流程：暫存 DB → 啟動 server → seed → 跑負載 → 關閉 server。
+    若 config.server_url 有值則直接打既有 server（不 seed、不啟動）。
+    """
+    random.seed(config.seed)  # cp_sim5 電流/meter_start 亂數
+    plans = build_plans(config)
+
+    if config.server_url:
+        parsed = urllib.parse.urlparse(config.server_url)
+        http_base = f"{'https' if parsed.scheme in ('wss', 'https') else 'http'}://{parsed.netloc}"
+        ws_base = f"{'wss' if parsed.scheme in ('wss', 'https') else 'ws'}://{parsed.netloc}"
+        return await LoadTestRun(config, ws_base, http_base).run()
+
+    with tempfile.TemporaryDirectory(prefix="load_test_") as tmp:
+        directory = Path(workdir) if workdir else Path(tmp)
+        directory.mkdir(parents=True, exist_ok=True)
+        server = LocalServer(config, directory)
+        line_api = None
+        if config.line_emulator:
+            from line_emulator import FaultConfig, LineApiEmulator
+
+            line_api = LineApiEmulator(
+                faults=FaultConfig(
+                    latency_ms=config.line_latency_ms,
+                    rate_429=config.line_rate_429,
+                    rate_5xx=config.line_rate_5xx,
+                    seed=config.seed,
+                )
+            ).start()
+            server.extra_env.update(line_api.server_env())
+        server.start()
+        try:
+            await asyncio.to_thread(
+                seed_database,
+                server.database_path,
+                plans,
+                config.household_balance,
+                config.contract_kw,
+                config.line_users_per_account if line_api else 0,
+            )
+            report = await LoadTestRun(config, server.ws_base, server.http_base).run()
+            if line_api is not None:
+                report["line"] = await _line_report(server.http_base, line_api, config.line_drain_s)
+            report["server_log"] = str(server.log_path) if workdir else None
+            return report
+        finally:
+            server.stop()
+            if line_api is not None:
+                line_api.stop()
+
+
+async def _line_report(http_base: str, line_api, drain_s: float) -> Dict[str, Any]:
+    """等 outbox 清空（或 drain_s 到期）後回報 emulator 與 outbox 統計。"""
+
+    def fetch_outbox():
+        with urllib.request.urlopen(f"{http_base}/api/line/outbox", timeout=5) as resp:
+            return json.loads(resp.read().decode("utf-8"))
+
+    outbox: Dict[str, Any] = {}
+    deadline = time.monotonic() + drain_s
+    while True:
+        try:
+            outbox = await asyncio.to_thread(fetch_outbox)
+        except Exception as e:
+            outbox = {"error": str(e)}
+        counts = outbox.get("counts") or {}
+        if not counts.get("pending") and not counts.get("sending"):
+            break
+        if time.monotonic() >= deadline:
+            break
+        await asyncio.sleep(0.5)
+    return {"emulator": line_api.stats(), "outbox": outbox}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Techlux OCPP load-test harness")
+    parser.add_argument("--chargers", type=int, default=50)
+    parser.add_argument("--duration", dest="duration_s", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--ramp", dest="ramp_s", type=float, default=5.0)
+    parser.add_argument("--meter", dest="meter_interval_s", type=float, default=5.0)
+    parser.add_argument("--status-keepalive", dest="status_keepalive_s", type=int, default=30)
+    parser.add_argument("--charging-ratio", type=float, default=0.7)
+    parser.add_argument("--session-min", dest="session_min_s", type=float, default=20.0)
+    parser.add_argument("--session-max", dest="session_max_s", type=float, default=60.0)
+    parser.add_argument("--idle-min", dest="idle_min_s", type=float, default=2.0)
+    parser.add_argument("--idle-max", dest="idle_max_s", type=float, default=10.0)
+    parser.add_argument("--storm-at", dest="storm_at_s", type=float, action="append", default=[],
+                        help="Offset (s) of a reconnect storm; repeatable")
+    parser.add_argument("--storm-jitter", dest="storm_reconnect_jitter_s", type=float, default=1.0)
+    parser.add_argument("--remote-stops-per-min", type=float, default=0.0)
+    parser.add_argument("--contract-kw", type=float, default=None)
+    parser.add_argument("--line-emulator", action="store_true",
+                        help="Send LINE notifications to a local LINE API emulator")
+    parser.add_argument("--line-users-per-account", type=int, default=1)
+    parser.add_argument("--line-latency-ms", type=float, default=0.0)
+    parser.add_argument("--line-rate-429", type=float, default=0.0)
+    parser.add_argument("--line-rate-5xx", type=float, default=0.0)
+    parser.add_argument("--line-drain", dest="line_drain_s", type=float, default=10.0)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--server-url", default=None,
+                        help="Use an already running server instead of starting one")
+    parser.add_argument("--workdir", default=None,
+                        help="Keep DB and server.log in this directory")
+    parser.add_argument("--output", default=None, help="Write JSON report to this file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
+    quiet = logging.DEBUG if args.verbose else logging.WARNING
+    for name in ("ocpp", "websockets", cp_sim5.log.name):
+        logging.getLogger(name).setLevel(quiet)
+
+    options = {k: v for k, v in vars(args).items() if k not in ("workdir", "output", "verbose")}
+    config = LoadTestConfig(**options)
+
+    report = asyncio.run(
+        run_load_test(config, workdir=Path(args.workdir) if args.workdir else None)
+    )
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+        log.info(f"report written to {args.output}")
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
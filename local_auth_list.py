@@ -0,0 +1,447 @@
+"""OCPP 1.6 Local Authorization List sync (SendLocalList).
+
+Every tap used to round-trip Authorize to the backend, and while a
+charger's WebSocket was down (``ws_disconnect_grace``) residents were
+refused.  This module computes, per charger, the list of cards the charger
+may accept on its own and keeps it in sync with SendLocalList:
+
+- the list is derived from ``card_whitelist`` (cards allowed on that
+  charger) joined with ``id_tags``, ``account_cards`` and
+  ``household_accounts``: ``Accepted`` only when the id_tag is Accepted,
+  card and household are active and the shared balance is > 0, otherwise
+  ``Blocked``.  Cards not yet adopted into a household are left out so the
+  charger still asks the backend (legacy adoption runs on Authorize);
+- ``local_auth_list_state`` stores, per charger, the list version and the
+  exact entries the charger last accepted.  With a known previous list the
+  sync sends only the differences (removed cards as entries without
+  ``idTagInfo``); an unknown / mismatched version or a diff larger than the
+  list itself sends a Full update;
+- updates are chunked to ``max_length`` entries (a large Full is sent as one
+  Full chunk followed by Differential chunks with consecutive versions);
+- ``LocalListSync`` bounds fleet-wide concurrency and spaces consecutive
+  SendLocalList calls by ``min_interval_s``.
+
+StartTransaction still checks status, whitelist and balance on the
+backend, so a list that lags behind a write can only delay a rejection
+until the charger reports the transaction.
+
+This module intentionally has no FastAPI or OCPP dependency: the calls
+that talk to the charger are injected by main.py.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable
+
+
+logger = logging.getLogger(__name__)
+
+UPDATE_FULL = "Full"
+UPDATE_DIFFERENTIAL = "Differential"
+
+STATUS_ACCEPTED = "Accepted"
+STATUS_FAILED = "Failed"
+STATUS_NOT_SUPPORTED = "NotSupported"
+STATUS_VERSION_MISMATCH = "VersionMismatch"
+
+LOCAL_LIST_SQL = """
+    SELECT it.id_tag, it.status, ac.status AS card_status,
+           ha.status AS account_status, ha.balance
+    FROM card_whitelist cw
+    JOIN id_tags it ON it.id_tag = cw.card_id
+    JOIN account_cards ac ON ac.card_id = it.id_tag
+    JOIN household_accounts ha ON ha.account_id = ac.account_id
+    WHERE cw.charge_point_id = ?
+    ORDER BY it.id_tag
+"""
+
+
+def utc_iso() -> str:
+    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+
+
+def compute_local_list(conn: sqlite3.Connection, charge_point_id: str) -> dict[str, str]:
+    """{id_tag: "Accepted" | "Blocked"} for one charger."""
+    entries: dict[str, str] = {}
+    for id_tag, status, card_status, account_status, balance in conn.execute(
+        LOCAL_LIST_SQL, (charge_point_id,)
+    ):
+        accepted = (
+            status == "Accepted"
+            and card_status == "active"
+            and account_status == "active"
+            and float(balance or 0) > 0
+        )
+        entries[str(id_tag)] = "Accepted" if accepted else "Blocked"
+    return entries
+
+
+def content_hash(entries: dict[str, str]) -> str:
+    raw = json.dumps(entries, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+@dataclass(frozen=True)
+class LocalListState:
+    charge_point_id: str
+    list_version: int
+    entries: dict[str, str] | None
+    last_status: str | None
+    last_error: str | None
+    synced_at: str | None
+
+
+@dataclass(frozen=True)
+class LocalListUpdate:
+    list_version: int
+    update_type: str
+    # id_tag -> status；None 代表自本地清單移除（僅 Differential）
+    entries: tuple[tuple[str, str | None], ...]
+
+    def authorization_list(self) -> list[dict[str, Any]]:
+        items = []
+        for id_tag, status in self.entries:
+            item: dict[str, Any] = {"id_tag": id_tag}
+            if status is not None:
+                item["id_tag_info"] = {"status": status}
+            items.append(item)
+        return items
+
+
+def load_state(conn: sqlite3.Connection, charge_point_id: str) -> LocalListState | None:
+    row = conn.execute(
+        """
+        SELECT charge_point_id, list_version, entries, last_status, last_error, synced_at
+        FROM local_auth_list_state WHERE charge_point_id = ?
+        """,
+        (charge_point_id,),
+    ).fetchone()
+    if row is None:
+        return None
+    entries = json.loads(row[2]) if row[2] is not None else None
+    return LocalListState(row[0], int(row[1] or 0), entries, row[3], row[4], row[5])
+
+
+def list_states(conn: sqlite3.Connection) -> list[dict[str, Any]]:
+    rows = conn.execute(
+        """
+        SELECT charge_point_id, list_version, content_hash, entry_count,
+               last_status, last_error, synced_at, updated_at
+        FROM local_auth_list_state ORDER BY charge_point_id
+        """
+    ).fetchall()
+    columns = (
+        "charge_point_id", "list_version", "content_hash", "entry_count",
+        "last_status", "last_error", "synced_at", "updated_at",
+    )
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def record_result(
+    conn: sqlite3.Connection,
+    charge_point_id: str,
+    *,
+    status: str,
+    list_version: int | None = None,
+    entries: dict[str, str] | None = None,
+    error: str | None = None,
+) -> None:
+    """
+    Persist the outcome of one sync.
+
+    ``Accepted`` stores the new version and entries; ``VersionMismatch``
+    forgets the stored entries so the next sync sends a Full list; any other
+    status only records the error.
+    """
+    now = utc_iso()
+    conn.execute(
+        """
+        INSERT OR IGNORE INTO local_auth_list_state
+            (charge_point_id, list_version, updated_at)
+        VALUES (?, 0, ?)
+        """,
+        (charge_point_id, now),
+    )
+    if status == STATUS_ACCEPTED:
+        conn.execute(
+            """
+            UPDATE local_auth_list_state
+            SET list_version = ?, entries = ?, content_hash = ?, entry_count = ?,
+                last_status = ?, last_error = NULL, synced_at = ?, updated_at = ?
+            WHERE charge_point_id = ?
+            """,
+            (
+                int(list_version or 0),
+                json.dumps(entries or {}, sort_keys=True),
+                content_hash(entries or {}),
+                len(entries or {}),
+                status,
+                now,
+                now,
+                charge_point_id,
+            ),
+        )
+    elif status == STATUS_VERSION_MISMATCH:
+        conn.execute(
+            """
+            UPDATE local_auth_list_state
+            SET list_version = COALESCE(?, list_version),
+                entries = NULL, content_hash = NULL, last_status = ?,
+                last_error = ?, updated_at = ?
+            WHERE charge_point_id = ?
+            """,
+            (list_version, status, error, now, charge_point_id),
+        )
+    else:
+        conn.execute(
+            """
+            UPDATE local_auth_list_state
+            SET last_status = ?, last_error = ?, updated_at = ?
+            WHERE charge_point_id = ?
+            """,
+            (status, error, now, charge_point_id),
+        )
+    conn.commit()
+
+
+def plan_updates(
+    previous: dict[str, str] | None,
+    current: dict[str, str],
+    *,
+    list_version: int,
+    max_length: int = 100,
+) -> list[LocalListUpdate]:
+    """
+    SendLocalList calls that turn ``previous`` into ``current``.
+
+    Versions start at ``list_version + 1`` and increase by one per chunk.
+    """
+    max_length = max(1, int(max_length))
+    version = int(list_version or 0)
+    if previous is not None and previous == current:
+        return []
+
+    diff: list[tuple[str, str | None]] = []
+    if previous is not None:
+        diff = [
+            (id_tag, status)
+            for id_tag, status in sorted(current.items())
+            if previous.get(id_tag) != status
+        ]
+        diff += [(id_tag, None) for id_tag in sorted(set(previous) - set(current))]
+
+    updates: list[LocalListUpdate] = []
+    if previous is not None and len(diff) < max(1, len(current)):
+        for start in range(0, len(diff), max_length):
+            version += 1
+            updates.append(
+                LocalListUpdate(
+                    version, UPDATE_DIFFERENTIAL, tuple(diff[start:start + max_length])
+                )
+            )
+        return updates
+
+    items = [(id_tag, status) for id_tag, status in sorted(current.items())]
+    version += 1
+    updates.append(LocalListUpdate(version, UPDATE_FULL, tuple(items[:max_length])))
+    for start in range(max_length, len(items), max_length):
+        version += 1
+        updates.append(
+            LocalListUpdate(
+                version, UPDATE_DIFFERENTIAL, tuple(items[start:start + max_length])
+            )
+        )
+    return updates
+
+
+@dataclass
+class LocalListSyncStats:
+    runs: int = 0
+    sent: int = 0
+    unchanged: int = 0
+    failed: int = 0
+    not_supported: int = 0
+    last_error: str | None = None
+    last_run_at: str | None = None
+
+
+class LocalListSync:
+    """
+    Fleet-wide SendLocalList scheduler.
+
+    ``send(charge_point_id, update)`` returns the charger's UpdateStatus
+    string; ``get_version(charge_point_id)`` (optional) returns the
+    charger's GetLocalListVersion, used to detect a list the charger lost.
+    Both are awaited on the event loop; SQLite work runs in threads.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], sqlite3.Connection],
+        send: Callable[[str, LocalListUpdate], Awaitable[str]],
+        *,
+        get_version: Callable[[str], Awaitable[int | None]] | None = None,
+        max_length: int = 100,
+        concurrency: int = 4,
+        min_interval_s: float = 0.5,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.connect = connect
+        self.send = send
+        self.get_version = get_version
+        self.max_length = max(1, int(max_length))
+        self.concurrency = max(1, int(concurrency))
+        self.min_interval_s = max(0.0, float(min_interval_s))
+        self.clock = clock
+        self.stats = LocalListSyncStats()
+        self._next_slot = 0.0
+        self._pace_lock: asyncio.Lock | None = None
+        self._cp_locks: dict[str, asyncio.Lock] = {}
+
+    def _run_db(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        conn = self.connect()
+        try:
+            return fn(conn)
+        finally:
+            conn.close()
+
+    async def _pace(self) -> None:
+        """全場 SendLocalList 之間至少間隔 min_interval_s。"""
+        if self.min_interval_s <= 0:
+            return
+        if self._pace_lock is None:
+            self._pace_lock = asyncio.Lock()
+        async with self._pace_lock:
+            now = self.clock()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.min_interval_s
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def sync_charge_point(self, charge_point_id: str, *, force_full: bool = False) -> dict[str, Any]:
+        lock = self._cp_locks.setdefault(charge_point_id, asyncio.Lock())
+        async with lock:
+            return await self._sync(charge_point_id, force_full=force_full)
+
+    async def _sync(self, charge_point_id: str, *, force_full: bool) -> dict[str, Any]:
+        state, current = await asyncio.to_thread(
+            self._run_db,
+            lambda conn: (
+                load_state(conn, charge_point_id),
+                compute_local_list(conn, charge_point_id),
+            ),
+        )
+        if state is not None and state.last_status == STATUS_NOT_SUPPORTED and not force_full:
+            return {"charge_point_id": charge_point_id, "result": "not_supported"}
+
+        version = state.list_version if state else 0
+        previous = None if force_full or state is None else state.entries
+        updates = plan_updates(previous, current, list_version=version, max_length=self.max_length)
+        if not updates:
+            self.stats.unchanged += 1
+            return {"charge_point_id": charge_point_id, "result": "unchanged", "list_version": version}
+
+        if self.get_version is not None and previous is not None:
+            charger_version = await self.get_version(charge_point_id)
+            if charger_version is not None and int(charger_version) != version:
+                logger.warning(
+                    f"[LOCAL_LIST][VERSION_DRIFT] cp_id={charge_point_id} "
+                    f"| stored={version} | charger={charger_version}"
+                )
+                updates = plan_updates(None, current, list_version=version, max_length=self.max_length)
+
+        status = STATUS_ACCEPTED
+        error = None
+        applied_version = version
+        for update in updates:
+            await self._pace()
+            try:
+                status = str(await self.send(charge_point_id, update))
+            except Exception as e:
+                status, error = STATUS_FAILED, str(e) or type(e).__name__
+            if status != STATUS_ACCEPTED:
+                error = error or f"{update.update_type} v{update.list_version}: {status}"
+                break
+            applied_version = update.list_version
+            self.stats.sent += 1
+
+        if status == STATUS_ACCEPTED:
+            await asyncio.to_thread(
+                self._run_db,
+                lambda conn: record_result(
+                    conn, charge_point_id, status=status,
+                    list_version=applied_version, entries=current,
+                ),
+            )
+        else:
+            if status == STATUS_NOT_SUPPORTED:
+                self.stats.not_supported += 1
+            else:
+                self.stats.failed += 1
+                self.stats.last_error = error
+            # 分段途中失敗：清單已部分套用，下次改送 Full
+            failed_status = (
+                STATUS_VERSION_MISMATCH
+                if applied_version != version and status != STATUS_NOT_SUPPORTED
+                else status
+            )
+            await asyncio.to_thread(
+                self._run_db,
+                lambda conn: record_result(
+                    conn, charge_point_id, status=failed_status,
+                    list_version=applied_version, error=error,
+                ),
+            )
+            logger.warning(
+                f"[LOCAL_LIST][SEND][FAIL] cp_id={charge_point_id} | status={status} | err={error}"
+            )
+
+        return {
+            "charge_point_id": charge_point_id,
+            "result": "synced" if status == STATUS_ACCEPTED else "failed",
+            "status": status,
+            "update_types": [update.update_type for update in updates],
+            "list_version": applied_version,
+            "entries": len(current),
+            "error": error,
+        }
+
+    async def sync_all(self, charge_point_ids) -> list[dict[str, Any]]:
+        self.stats.runs += 1
+        self.stats.last_run_at = utc_iso()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run(cp_id: str) -> dict[str, Any]:
+            async with semaphore:
+                try:
+                    return await self.sync_charge_point(cp_id)
+                except Exception as e:
+                    self.stats.failed += 1
+                    self.stats.last_error = str(e)
+                    logger.exception(f"[LOCAL_LIST][SYNC][ERR] cp_id={cp_id} | err={e}")
+                    return {"charge_point_id": cp_id, "result": "error", "error": str(e)}
+
+        return list(await asyncio.gather(*(run(cp_id) for cp_id in charge_point_ids)))
+
+    def snapshot(self) -> dict[str, Any]:
+        stats = self.stats
+        return {
+            "max_length": self.max_length,
+            "concurrency": self.concurrency,
+            "min_interval_s": self.min_interval_s,
+            "runs": stats.runs,
+            "sent": stats.sent,
+            "unchanged": stats.unchanged,
+            "failed": stats.failed,
+            "not_supported": stats.not_supported,
+            "last_error": stats.last_error,
+            "last_run_at": stats.last_run_at,
+        }
@@ -1,4 +1,4 @@
-from fastapi import Body, FastAPI, HTTPException
+from fastapi import Body, FastAPI, HTTPException, Query, Request
 
 # The household routes are declared early to keep this large legacy module's
 # additions isolated.  The main FastAPI initialization below reuses this app.
@@ -141,12 +141,42 @@ def api_topup_household_account(account_id: int, data: dict = Body(...)):
     with household_connect(DB_FILE) as account_conn:
         try:
             return _household_api_payload(
-                topup_household_account(account_conn, account_id, data.get("amount"))
+                topup_household_account(
+                    account_conn,
+                    account_id,
+                    data.get("amount"),
+                    idempotency_key=_request_alias(
+                        data, "idempotency_key", "idempotencyKey", None
+                    ),
+                )
             )
         except HouseholdAccountError as exc:
             raise _household_http_error(exc) from exc
 
 
+@app.get("/api/household-accounts/{account_id}/ledger")
+def api_household_account_ledger(
+    account_id: int,
+    limit: int = Query(default=100, ge=1, le=1000),
+    before: int | None = Query(default=None),
+):
+    with household_connect(DB_FILE) as account_conn:
+        if not get_account_by_id(account_conn, account_id):
+            raise HTTPException(status_code=404, detail="account not found")
+        return balance_ledger.account_history(
+            account_conn, account_id, limit=limit, before_entry_id=before
+        )
+
+
+@app.post("/api/balance-ledger/rollup")
+def api_balance_ledger_rollup(repair: bool = Query(default=False)):
+    with household_connect(DB_FILE) as account_conn:
+        report = balance_ledger.rollup(account_conn, repair=repair)
+    if report.get("repaired"):
+        authorization_cache.clear()
+    return report
+
+
 @app.get("/api/household-accounts/{account_id}/cards")
 def api_list_account_cards(account_id: int):
     with household_connect(DB_FILE) as account_conn:
@@ -177,6 +207,7 @@ def api_add_account_card(account_id: int, data: dict = Body(...)):
                         (card_id, cp_id),
                     )
             account_conn.commit()
+            auth_cache.invalidate_card(card_id)
             return result
         except HouseholdAccountError as exc:
             raise _household_http_error(exc) from exc
@@ -248,7 +279,65 @@ def api_cancel_card_enrollment(enrollment_id: str):
             raise _household_http_error(exc) from exc
 
 
+async def _household_bulk_response(request: Request, dry_run: bool, operation, **kwargs):
+    """
+    CSV（text/csv，第一列為欄位名）或 JSON 批次 → household_bulk 的單一交易。
+    任何一列驗證失敗則整批不寫入並回 422，逐列結果在 rows。
+    """
+    body = await request.body()
+
+    def run():
+        rows = household_bulk.parse_rows(body, request.headers.get("content-type"))
+        with household_connect(DB_FILE) as account_conn:
+            return operation(account_conn, rows, dry_run=dry_run, **kwargs)
+
+    try:
+        report = await asyncio.to_thread(run)
+    except HouseholdAccountError as exc:
+        raise _household_http_error(exc) from exc
+    return JSONResponse(
+        status_code=422 if report.errors else 200, content=report.to_dict()
+    )
+
+
+@app.post("/api/household-accounts/bulk")
+async def api_bulk_create_household_accounts(
+    request: Request, dry_run: bool = Query(default=False, alias="dryRun")
+):
+    return await _household_bulk_response(
+        request, dry_run, household_bulk.bulk_create_accounts
+    )
+
+
+@app.post("/api/household-accounts/topups/bulk")
+async def api_bulk_topup_household_accounts(
+    request: Request, dry_run: bool = Query(default=False, alias="dryRun")
+):
+    return await _household_bulk_response(
+        request, dry_run, household_bulk.bulk_topup
+    )
+
+
+@app.post("/api/account-cards/bulk")
+async def api_bulk_bind_account_cards(
+    request: Request, dry_run: bool = Query(default=False, alias="dryRun")
+):
+    return await _household_bulk_response(
+        request, dry_run, household_bulk.bulk_bind_cards
+    )
+
+
+@app.post("/api/id_tags/bulk")
+async def api_bulk_add_id_tags(
+    request: Request, dry_run: bool = Query(default=False, alias="dryRun")
+):
+    return await _household_bulk_response(
+        request, dry_run, household_bulk.bulk_add_id_tags, parse_datetime=parse_date
+    )
+
+
 import asyncio
+from contextlib import nullcontext
 
 from urllib.parse import unquote  # ← 新增
 
@@ -645,10 +734,11 @@ import csv
 import uuid
 import logging
 import sqlite3
-import uvicorn
 import asyncio
-import urllib.request
-import urllib.error
+
+# 重量級 / 非必要相依（reportlab、uvicorn、dateutil、LINE 用的 requests）
+# 改為使用時才載入，import main 只付出 OCPP / FastAPI 的必要成本；
+# 見 import_budget.py 的 LAZY_MODULES 檢查。
 
 pending_stop_transactions: dict[int, "StopContext"] = {}
 # 針對每筆交易做「已送停充」去重，避免前端/後端重複送
@@ -669,7 +759,6 @@ from fastapi import (
 )
 from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from dateutil.parser import parse as parse_date
 from websockets.exceptions import ConnectionClosedOK
 from ocpp.v16 import call, call_result, ChargePoint as OcppChargePoint
 from ocpp.v16.enums import Action, RegistrationStatus
@@ -681,8 +770,28 @@ from stop_flow import (
     sqlite_write_with_retry,
 )
 stop_registry = StopRegistry(pending_stop_transactions)
+import billing
+import pricing_calendar
+import tariff_engine
+from pricing_calendar import TariffRulesCache
+import payments_recalc
+from payments_recalc import PaymentRecalculator, RecalcJobError
+from ocpp_capture import recorder_from_env as ocpp_capture_recorder_from_env
+from ws_admission import (
+    AdmissionController,
+    AdmissionRejected,
+    ConnectionLogBatcher,
+    VersionedWhitelist,
+)
+from status_tracker import DUPLICATE as STATUS_DUPLICATE, StatusLogBatcher, StatusTracker
 from urllib.parse import urlparse, parse_qsl
-from reportlab.pdfgen import canvas
+
+
+def parse_date(timestr, *args, **kwargs):
+    # dateutil 只有報表與舊資料修正路徑會用到，延遲到第一次呼叫才載入
+    from dateutil.parser import parse as _dateutil_parse
+
+    return _dateutil_parse(timestr, *args, **kwargs)
 
 
 # ===============================
@@ -721,6 +830,39 @@ ws_disconnect_seq = {}
 # 🚀 救回藍燈閃爍：將去抖動延遲拉長至 15 秒，避免打斷充電樁繼電器閉合的機械動作
 REBALANCE_DEBOUNCE_SECONDS = float(os.getenv("REBALANCE_DEBOUNCE_SECONDS", "15.0"))
 
+# ===============================
+# 🌪️ 重連風暴：WebSocket 握手准入控制（見 ws_admission.py）
+# ===============================
+WS_ADMISSION_RATE_PER_SECOND = float(os.getenv("WS_ADMISSION_RATE_PER_SECOND", "20"))
+WS_ADMISSION_BURST = int(os.getenv("WS_ADMISSION_BURST", "20"))
+WS_ADMISSION_MAX_CONCURRENT = int(os.getenv("WS_ADMISSION_MAX_CONCURRENT", "10"))
+WS_ADMISSION_WAIT_SECONDS = float(os.getenv("WS_ADMISSION_WAIT_SECONDS", "30"))
+WS_STORM_WINDOW_SECONDS = float(os.getenv("WS_STORM_WINDOW_SECONDS", "10"))
+WS_STORM_THRESHOLD = int(os.getenv("WS_STORM_THRESHOLD", "5"))
+WS_STORM_SETTLE_SECONDS = float(os.getenv("WS_STORM_SETTLE_SECONDS", "10"))
+# 風暴期間 rebalance 最多延後多久（避免持續有樁重連時永遠不重算）
+REBALANCE_STORM_MAX_WAIT_SECONDS = float(
+    os.getenv("REBALANCE_STORM_MAX_WAIT_SECONDS", "120")
+)
+CONNECTION_LOG_FLUSH_SECONDS = float(os.getenv("CONNECTION_LOG_FLUSH_SECONDS", "1.0"))
+
+# StatusNotification / Heartbeat 寫入合併（見 status_tracker.py）
+STATUS_KEEPALIVE_TOUCH_SECONDS = float(os.getenv("STATUS_KEEPALIVE_TOUCH_SECONDS", "900"))
+STATUS_LOG_FLUSH_SECONDS = float(os.getenv("STATUS_LOG_FLUSH_SECONDS", "1.0"))
+PRESENCE_FLUSH_SECONDS = float(os.getenv("PRESENCE_FLUSH_SECONDS", "30"))
+
+status_tracker = StatusTracker(keepalive_touch_s=STATUS_KEEPALIVE_TOUCH_SECONDS)
+
+ws_admission = AdmissionController(
+    rate_per_s=WS_ADMISSION_RATE_PER_SECOND,
+    burst=WS_ADMISSION_BURST,
+    max_concurrent=WS_ADMISSION_MAX_CONCURRENT,
+    wait_timeout_s=WS_ADMISSION_WAIT_SECONDS,
+    storm_window_s=WS_STORM_WINDOW_SECONDS,
+    storm_threshold=WS_STORM_THRESHOLD,
+    settle_s=WS_STORM_SETTLE_SECONDS,
+)
+
 rebalance_lock = asyncio.Lock()
 pending_rebalance_task = None
 rebalance_requested = False
@@ -775,10 +917,14 @@ async def _debounced_rebalance_runner(expected_seq: int):
 
     try:
         while True:
+            barrier_started = time.monotonic()
             while True:
                 wait_s = REBALANCE_DEBOUNCE_SECONDS - (
                     time.time() - rebalance_last_requested_at
                 )
+                # 重連風暴屏障：等所有樁重連、Boot/Status 穩定後只重算一次
+                if time.monotonic() - barrier_started < REBALANCE_STORM_MAX_WAIT_SECONDS:
+                    wait_s = max(wait_s, ws_admission.settle_remaining_s())
                 if wait_s <= 0:
                     break
                 await asyncio.sleep(min(wait_s, 0.2))
@@ -862,6 +1008,47 @@ LOW_BALANCE_LINE_THRESHOLD = 1000.0
 # ===============================
 AUTO_STOP_REASON_BALANCE_INSUFFICIENT = "balance_insufficient"
 
+
+# ===============================
+# LINE 推播 outbox（見 line_outbox.py）
+# ===============================
+LINE_OUTBOX_WORKERS = int(os.getenv("LINE_OUTBOX_WORKERS", "4"))
+LINE_OUTBOX_POLL_SECONDS = float(os.getenv("LINE_OUTBOX_POLL_SECONDS", "5"))
+LINE_OUTBOX_LEASE_SECONDS = float(os.getenv("LINE_OUTBOX_LEASE_SECONDS", "120"))
+LINE_OUTBOX_MAX_ATTEMPTS = int(os.getenv("LINE_OUTBOX_MAX_ATTEMPTS", "6"))
+LINE_RECIPIENT_MIN_INTERVAL_SECONDS = float(
+    os.getenv("LINE_RECIPIENT_MIN_INTERVAL_SECONDS", "1.0")
+)
+
+# ===============================
+# LINE webhook 事件佇列（見 line_webhook.py）
+# ===============================
+LINE_WEBHOOK_WORKERS = int(os.getenv("LINE_WEBHOOK_WORKERS", "4"))
+LINE_WEBHOOK_QUEUE_SIZE = int(os.getenv("LINE_WEBHOOK_QUEUE_SIZE", "1000"))
+LINE_WEBHOOK_DEDUP_SECONDS = float(os.getenv("LINE_WEBHOOK_DEDUP_SECONDS", "3600"))
+
+# ===============================
+# 餘額帳本定期核對（見 balance_ledger.py）；0 = 停用
+# ===============================
+BALANCE_LEDGER_ROLLUP_SECONDS = float(os.getenv("BALANCE_LEDGER_ROLLUP_SECONDS", "3600"))
+
+# ===============================
+# Authorize / StartTransaction 授權快取（見 auth_cache.py）；TTL 0 = 不快取
+# ===============================
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "60"))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+
+# ===============================
+# OCPP Local Authorization List 同步（見 local_auth_list.py）；預設關閉
+# ===============================
+LOCAL_AUTH_LIST_ENABLED = os.getenv("LOCAL_AUTH_LIST_ENABLED", "0") == "1"
+LOCAL_AUTH_LIST_SYNC_SECONDS = float(os.getenv("LOCAL_AUTH_LIST_SYNC_SECONDS", "300"))
+LOCAL_AUTH_LIST_MAX_LENGTH = int(os.getenv("LOCAL_AUTH_LIST_MAX_LENGTH", "100"))
+LOCAL_AUTH_LIST_CONCURRENCY = int(os.getenv("LOCAL_AUTH_LIST_CONCURRENCY", "4"))
+LOCAL_AUTH_LIST_MIN_INTERVAL_SECONDS = float(
+    os.getenv("LOCAL_AUTH_LIST_MIN_INTERVAL_SECONDS", "0.5")
+)
+
 # ===============================
 # 金額計算工具：統一四捨五入策略
 # ===============================
@@ -957,7 +1144,7 @@ async def send_current_limit_profile(
     # [1.2] 先寫入狀態（保底：就算後面送失敗，前端也看的到 requested）
     # =====================================================
     now_iso = datetime.utcnow().replace(tzinfo=timezone.utc).isoformat()
-    st = current_limit_state.setdefault(cp_id, {})
+    st = clear_restored(current_limit_state.setdefault(cp_id, {}))
     st.update(
         {
             "requested_limit_a": float(limit_a),
@@ -1368,21 +1555,32 @@ app.add_middleware(
     allow_credentials=False,  # ✅ 你目前前端沒用 cookie/session，關掉最穩
     allow_methods=["*"],
     allow_headers=["*"],
+    # 報表端點的資料新鮮度（見 report_freshness_headers）
+    expose_headers=["X-Report-Source", "X-Report-Refreshed-At", "X-Report-Staleness-Seconds"],
 )
 
 
 charging_point_status = {}
 
+# OCPP frame capture（預設關閉；設定 OCPP_CAPTURE_DIR 才會寫檔）
+ocpp_frame_recorder = ocpp_capture_recorder_from_env()
+
 
 class FastAPIWebSocketAdapter:
-    def __init__(self, websocket):
+    def __init__(self, websocket, capture=None):
         self.websocket = websocket
+        # OCPP_CAPTURE_DIR 啟用時：逐 frame 寫入 ocpp_capture（供 ocpp_replay.py 重播）
+        self.capture = capture
 
     async def recv(self):
         msg = await self.websocket.receive_text()
+        if self.capture is not None:
+            self.capture.record_in(msg)
         return msg
 
     async def send(self, data):
+        if self.capture is not None:
+            self.capture.record_out(data)
         try:
             await self.websocket.send_text(data)
         except (WebSocketDisconnect, ConnectionClosedOK):
@@ -1754,6 +1952,7 @@ def _upsert_live(cp_id: str, **kv):
             skipped_keys.append(k)
 
     cur["updated_at"] = time.time()
+    clear_restored(cur)
     live_status_cache[cp_id] = cur
 
     if _is_debug_target_cp(cp_id):
@@ -1777,8 +1976,13 @@ from fastapi import WebSocket, WebSocketDisconnect
 # ======================
 # WebSocket 白名單：熱更新 / 即時重查保護
 # ======================
-charge_point_whitelist_cache = set()
-charge_point_whitelist_cache_updated_at = 0.0
+# 版本化快取：寫入 API 於 commit 後整批替換；accept 路徑只讀快取、不碰 DB
+charge_point_whitelist = VersionedWhitelist()
+whitelist_refresh_task = None
+WS_WHITELIST_MISS_REFRESH_SECONDS = float(
+    os.getenv("WS_WHITELIST_MISS_REFRESH_SECONDS", "5")
+)
+whitelist_last_miss_refresh_at = 0.0
 
 
 def _load_charge_point_whitelist_from_db():
@@ -1797,24 +2001,48 @@ def _load_charge_point_whitelist_from_db():
 
 
 def refresh_charge_point_whitelist_cache(reason: str = "manual"):
-    global charge_point_whitelist_cache
-    global charge_point_whitelist_cache_updated_at
-
     allowed_ids = _load_charge_point_whitelist_from_db()
-    charge_point_whitelist_cache = set(allowed_ids)
-    charge_point_whitelist_cache_updated_at = time.time()
+    previous_version = charge_point_whitelist.snapshot().version
+    snapshot = charge_point_whitelist.replace(allowed_ids, reason=reason)
 
     logger.warning(
         f"[WHITELIST][REFRESH] "
-        f"reason={reason} | count={len(allowed_ids)} | allowed_ids={allowed_ids}"
+        f"reason={reason} | version={snapshot.version} | "
+        f"changed={snapshot.version != previous_version} | count={len(allowed_ids)}"
     )
     return allowed_ids
 
 
 def get_charge_point_whitelist_cache():
-    if not charge_point_whitelist_cache:
+    if not charge_point_whitelist.loaded:
         return refresh_charge_point_whitelist_cache(reason="cache_empty")
-    return sorted(charge_point_whitelist_cache)
+    return sorted(charge_point_whitelist.snapshot().ids)
+
+
+async def _refresh_whitelist_after_miss(cp_id: str):
+    """
+    白名單 miss（例如由外部腳本直接寫入 DB）：同時 miss 的握手共用同一次
+    DB 重讀，且每 WS_WHITELIST_MISS_REFRESH_SECONDS 最多一次，
+    未知樁的重連風暴不會變成整表掃描風暴。
+    """
+    global whitelist_refresh_task
+    global whitelist_last_miss_refresh_at
+
+    if whitelist_refresh_task is None or whitelist_refresh_task.done():
+        now = time.monotonic()
+        if now - whitelist_last_miss_refresh_at < WS_WHITELIST_MISS_REFRESH_SECONDS:
+            return charge_point_whitelist.snapshot()
+        whitelist_last_miss_refresh_at = now
+        whitelist_refresh_task = asyncio.create_task(
+            asyncio.to_thread(
+                refresh_charge_point_whitelist_cache, reason=f"ws_miss:{cp_id}"
+            )
+        )
+    try:
+        await asyncio.shield(whitelist_refresh_task)
+    except Exception as e:
+        logger.error(f"[WS_AUTH][WHITELIST_REFRESH_ERR] cp_id={cp_id} | err={e}")
+    return charge_point_whitelist.snapshot()
 
 
 async def _accept_or_reject_ws(websocket: WebSocket, raw_cp_id: str):
@@ -1837,57 +2065,42 @@ async def _accept_or_reject_ws(websocket: WebSocket, raw_cp_id: str):
     #      await websocket.close(code=1008)
     #      return None
 
-    # 先看 cache；若 miss，不要立刻拒絕，要短暫重查 DB 幾次
-    allowed_ids = get_charge_point_whitelist_cache()
-    whitelist_source = "cache"
-
-    if cp_id not in allowed_ids:
-        whitelist_source = "db_retry_after_cache_miss"
-
-        # 關鍵：避免「白名單剛新增，但這一輪 attempt 剛好撞到舊狀態」而白白浪費整輪 retry
-        retry_plan = (0.0, 0.25, 0.5, 1.0)
-
-        for idx, sleep_s in enumerate(retry_plan, start=1):
-            if sleep_s > 0:
-                await asyncio.sleep(sleep_s)
-
-            allowed_ids = refresh_charge_point_whitelist_cache(
-                reason=f"ws_miss_retry#{idx}:{cp_id}"
-            )
-
-            if cp_id in allowed_ids:
-                logger.warning(
-                    f"[WS_AUTH][RECOVERED_AFTER_REFRESH] "
-                    f"cp_id={cp_id} | retry_index={idx} | allowed_ids={allowed_ids}"
-                )
-                break
+    # 白名單：命中時只讀版本化快取（寫入 API 已於 commit 後刷新），不碰 DB；
+    # 尚未載入或 miss 時才走共用、節流的重讀
+    whitelist = charge_point_whitelist.snapshot()
+    if not charge_point_whitelist.loaded or cp_id not in whitelist.ids:
+        whitelist = await _refresh_whitelist_after_miss(cp_id)
 
     logger.warning(
         f"[WS_AUTH][CHECK] "
-        f"cp_id={cp_id} | source={whitelist_source} | "
-        f"allowed_ids={allowed_ids} | "
-        f"cache_updated_at={charge_point_whitelist_cache_updated_at}"
+        f"cp_id={cp_id} | whitelist_version={whitelist.version} | "
+        f"allowed={cp_id in whitelist.ids} | count={len(whitelist.ids)}"
     )
 
-    print(f"📝 白名單允許={allowed_ids}, 本次連線={cp_id}")
-
-    if cp_id not in allowed_ids:
-        print(f"❌ 拒絕：{cp_id} 不在白名單 {allowed_ids}")
+    if cp_id not in whitelist.ids:
+        ws_admission.stats.rejected_whitelist += 1
+        print(f"❌ 拒絕：{cp_id} 不在白名單 (version={whitelist.version})")
         await websocket.close(code=1008)
         return None
 
-    # 接受連線（OCPP 1.6 子協定）
-    await websocket.accept(subprotocol="ocpp1.6")
-    print(f"✅ 接受 WebSocket：cp_id={cp_id} | ip={websocket.client.host}")
+    # 准入控制：token bucket + 同時握手上限；超出等待預算就請樁稍後重連
+    try:
+        await ws_admission.acquire(cp_id)
+    except AdmissionRejected as e:
+        logger.warning(f"[WS_ADMISSION][REJECT] cp_id={cp_id} | reason={e}")
+        await websocket.close(code=1013)
+        return None
 
-    now = datetime.utcnow().isoformat()
-    with get_conn() as _c:
-        cur = _c.cursor()
-        cur.execute(
-            "INSERT INTO connection_logs (charge_point_id, ip, time) VALUES (?, ?, ?)",
-            (cp_id, websocket.client.host, now),
+    try:
+        # 接受連線（OCPP 1.6 子協定）
+        await websocket.accept(subprotocol="ocpp1.6")
+        print(f"✅ 接受 WebSocket：cp_id={cp_id} | ip={websocket.client.host}")
+
+        connection_log_batcher.add(
+            cp_id, websocket.client.host, datetime.utcnow().isoformat()
         )
-        _c.commit()
+    finally:
+        ws_admission.release()
 
     return cp_id
 
@@ -1911,9 +2124,16 @@ async def websocket_endpoint(websocket: WebSocket, charge_point_id: str):
         )
 
         # 2) 啟動 OCPP handler
-        cp = ChargePoint(cp_id, FastAPIWebSocketAdapter(websocket))
+        ws_capture = (
+            ocpp_frame_recorder.for_charge_point(cp_id)
+            if ocpp_frame_recorder is not None
+            else None
+        )
+        cp = ChargePoint(cp_id, FastAPIWebSocketAdapter(websocket, capture=ws_capture))
         cp.supports_smart_charging = True
         connection_seq = int(cp_connection_seq.get(cp_id, 0) or 0) + 1
+        if ws_capture is not None:
+            ws_capture.open(connection_seq=connection_seq)
         connection_instance_id = str(uuid.uuid4())
         cp_connection_seq[cp_id] = connection_seq
         cp.connection_seq = connection_seq
@@ -1950,6 +2170,9 @@ async def websocket_endpoint(websocket: WebSocket, charge_point_id: str):
         )
         cp_norm = _normalize_cp_id(charge_point_id)
 
+        if "ws_capture" in locals() and ws_capture is not None:
+            ws_capture.close()
+
         # ==================================================
         # 3) WebSocket 斷線處理
         #    規則：
@@ -1971,6 +2194,10 @@ async def websocket_endpoint(websocket: WebSocket, charge_point_id: str):
             )
             return
 
+        # 重連後第一筆 StatusNotification 一定寫入 status_logs
+        # （放在 stale 檢查之後：舊連線的 finally 不可清掉新連線剛記錄的狀態）
+        status_tracker.forget(cp_norm)
+
         try:
             now = datetime.utcnow().replace(tzinfo=timezone.utc).isoformat()
 
@@ -2170,7 +2397,6 @@ from household_account_service import (
     create_enrollment_session,
     create_household_account,
     disable_account_card,
-    ensure_schema as ensure_household_schema,
     ensure_legacy_account_for_card,
     get_account_by_id,
     get_enrollment_session,
@@ -2181,9 +2407,104 @@ from household_account_service import (
     update_account_card,
     update_household_account,
 )
+from schema_migrations import (
+    LINE_BINDINGS_SCHEMA,
+    LINE_MESSAGE_LOGS_SCHEMA,
+    apply_statements,
+    require_current_schema,
+)
+import line_outbox
+import settlement_snapshot
+import transaction_detail
+from transaction_detail import TimelineAccumulator, TransactionDetailCache
+import balance_ledger
+import household_bulk
+from line_outbox import LineDeliveryOptions, LineOutboxWorkerPool, RecipientRateLimiter
+import line_webhook
+from line_webhook import EventDeduplicator, WebhookEventQueue
+import auth_cache
+from auth_cache import authorization_cache, load_authorization
+import local_auth_list
+from local_auth_list import LocalListSync
+from state_snapshot import StateSnapshotter, clear_restored, mark_restored, merge_missing
+import db_maintenance
+from db_maintenance import DatabaseMaintenance
+from db_backup import DatabaseBackup, default_backup_dir
+from reporting_replica import ReportingReplica, set_tracking as set_report_tracking
 
 DB_FILE = get_database_path()
 
+authorization_cache.configure(
+    ttl_s=AUTH_CACHE_TTL_SECONDS, max_entries=AUTH_CACHE_MAX_ENTRIES
+)
+
+# 交易明細：結算 commit 後寫入降採樣曲線；已結束交易的明細以 LRU 快取（見 transaction_detail.py）
+TRANSACTION_TIMELINE_MAX_POINTS = int(os.getenv("TRANSACTION_TIMELINE_MAX_POINTS", "240"))
+TRANSACTION_TIMELINE_MIN_BUCKET_SECONDS = float(
+    os.getenv("TRANSACTION_TIMELINE_MIN_BUCKET_SECONDS", "60")
+)
+TRANSACTION_DETAIL_CACHE_SIZE = int(os.getenv("TRANSACTION_DETAIL_CACHE_SIZE", "512"))
+transaction_detail_cache = TransactionDetailCache(max_entries=TRANSACTION_DETAIL_CACHE_SIZE)
+live_transaction_timelines = TimelineAccumulator(
+    max_points=TRANSACTION_TIMELINE_MAX_POINTS,
+    min_bucket_s=TRANSACTION_TIMELINE_MIN_BUCKET_SECONDS,
+)
+
+# SQLite 維護：連線層級 cache / mmap 設定 + WAL checkpoint / optimize / vacuum 排程（見 db_maintenance.py）
+DB_MAINTENANCE_ENABLED = os.getenv("DB_MAINTENANCE_ENABLED", "1") == "1"
+DB_MAINTENANCE_TICK_SECONDS = float(os.getenv("DB_MAINTENANCE_TICK_SECONDS", "5"))
+DB_CACHE_SIZE_KIB = int(os.getenv("DB_CACHE_SIZE_KIB", "0"))
+DB_MMAP_SIZE_BYTES = int(os.getenv("DB_MMAP_SIZE_BYTES", "0"))
+# 0 = 沿用 SQLite 預設（1000 頁）；排程器的 PASSIVE checkpoint 固定週期執行，
+# 正常情況下 WAL 不會長到觸發寫入端的自動 checkpoint
+DB_WAL_AUTOCHECKPOINT_PAGES = int(os.getenv("DB_WAL_AUTOCHECKPOINT_PAGES", "0"))
+DB_CONNECTION_PRAGMAS = db_maintenance.connection_pragmas(
+    cache_size_kib=DB_CACHE_SIZE_KIB,
+    mmap_size=DB_MMAP_SIZE_BYTES,
+    wal_autocheckpoint=DB_WAL_AUTOCHECKPOINT_PAGES,
+)
+database_maintenance = DatabaseMaintenance(
+    DB_FILE,
+    quiet_s=float(os.getenv("DB_MAINTENANCE_QUIET_SECONDS", "5")),
+    passive_interval_s=float(os.getenv("DB_CHECKPOINT_PASSIVE_SECONDS", "10")),
+    truncate_wal_bytes=int(os.getenv("DB_CHECKPOINT_TRUNCATE_WAL_MB", "64")) * 1024 * 1024,
+    truncate_budget_ms=int(os.getenv("DB_CHECKPOINT_TRUNCATE_BUDGET_MS", "200")),
+    optimize_interval_s=float(os.getenv("DB_OPTIMIZE_INTERVAL_SECONDS", str(6 * 3600))),
+    vacuum_max_pages=int(os.getenv("DB_INCREMENTAL_VACUUM_PAGES", "1000")),
+)
+
+# 線上熱備份：backup API 分段複製 + integrity_check + gzip 輪替（見 db_backup.py；還原用 CLI）
+DB_BACKUP_INTERVAL_SECONDS = float(os.getenv("DB_BACKUP_INTERVAL_SECONDS", str(6 * 3600)))
+database_backup = DatabaseBackup(
+    DB_FILE,
+    default_backup_dir(DB_FILE),
+    keep=int(os.getenv("DB_BACKUP_KEEP", "7")),
+    interval_s=DB_BACKUP_INTERVAL_SECONDS,
+    step_pages=int(os.getenv("DB_BACKUP_STEP_PAGES", "256")),
+    step_sleep_s=float(os.getenv("DB_BACKUP_STEP_SLEEP_MS", "5")) / 1000.0,
+)
+
+# 報表複本（選用）：後台查詢 / 匯出 / 月報讀複本，不與 OCPP 寫入搶主資料庫（見 reporting_replica.py）
+REPORTING_REPLICA_ENABLED = os.getenv("REPORTING_REPLICA_ENABLED", "0") == "1"
+REPORTING_REFRESH_SECONDS = float(os.getenv("REPORTING_REFRESH_SECONDS", "5"))
+report_replica = ReportingReplica(
+    DB_FILE,
+    os.getenv("REPORTING_DB_PATH") or f"{DB_FILE}.reporting",
+    batch_changes=int(os.getenv("REPORTING_REFRESH_BATCH", "5000")),
+    max_staleness_s=float(os.getenv("REPORTING_MAX_STALENESS_SECONDS", "300")),
+)
+REPORT_PATHS = {
+    "/api/transactions",
+    "/api/transactions/export",
+    "/api/payments",
+    "/api/summary",
+    "/api/summary/daily-by-chargepoint",
+    "/api/summary/daily-by-chargepoint-range",
+    "/api/report/monthly",
+    "/api/users/export",
+    "/api/line/message-logs",
+}
+
 SHARED_BALANCE_BY_CARD_SQL = """
     SELECT ha.balance
     FROM account_cards ac
@@ -2206,154 +2527,559 @@ def get_conn(timeout_seconds: float = 15, busy_timeout_ms: int = 15000):
     conn.execute("PRAGMA synchronous=NORMAL;")
     conn.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)};")
     conn.execute("PRAGMA foreign_keys=ON;")
+    for pragma in DB_CONNECTION_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
 
-def get_community_settings():
-    with sqlite3.connect(DB_FILE, check_same_thread=False, timeout=15) as conn:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT enabled, contract_kw, voltage_v, phases, min_current_a, max_current_a, surcharge_per_kwh
-            FROM community_settings
-            WHERE id = 1
-        """
-        )
-        row = cur.fetchone()
-
-    if not row:
-        return {
-            "enabled": False,
-            "contract_kw": 0,
-            "voltage_v": 220,
-            "phases": 1,
-            "min_current_a": 16,
-            "max_current_a": 32,
-            "surcharge_per_kwh": 0,
-        }
+def get_report_conn():
+    """
+    報表 / 匯出 / 統計查詢專用：複本已建立且未過期時讀複本，否則退回主資料庫
+    （與 report_freshness_headers 用同一個判斷）
+    """
+    if REPORTING_REPLICA_ENABLED and report_replica.usable:
+        return report_replica.connect()
+    return get_conn()
 
-    return {
-        "enabled": bool(row[0]),
-        "contract_kw": float(row[1] or 0),
-        "voltage_v": float(row[2] or 220),
-        "phases": int(row[3] or 1),
-        "min_current_a": float(row[4] or 16),
-        "max_current_a": float(row[5] or 32),
-        "surcharge_per_kwh": float(row[6] or 0),
-    }
 
+def report_freshness() -> dict:
+    if not REPORTING_REPLICA_ENABLED:
+        return {"source": "primary", "refreshedAt": None, "stalenessSeconds": None, "lagChanges": 0}
+    return report_replica.freshness()
 
-def _live_voltage_v(cp_id: str, fallback_v: float = 220.0) -> float:
-    """
-    取得某充電樁目前即時電壓
-    優先從 live_status_cache 讀取，取不到就回退到 fallback_v
-    """
-    try:
-        cp_norm = _normalize_cp_id(cp_id)
-        live = live_status_cache.get(cp_norm, {}) or {}
 
-        v = live.get("voltage")
+@app.middleware("http")
+async def report_freshness_headers(request, call_next):
+    response = await call_next(request)
+    path = request.url.path
+    if request.method == "GET" and (
+        path in REPORT_PATHS or path.startswith("/api/line/message-logs/")
+    ):
+        freshness = report_freshness()
+        response.headers["X-Report-Source"] = freshness["source"]
+        if freshness["source"] == "replica":
+            response.headers["X-Report-Refreshed-At"] = freshness["refreshedAt"]
+            response.headers["X-Report-Staleness-Seconds"] = str(freshness["stalenessSeconds"])
+    return response
 
-        if v is None:
-            return float(fallback_v)
 
-        v = float(v)
-        if v <= 0:
-            return float(fallback_v)
+# connection_logs 批次寫入：握手路徑只排入記憶體佇列
+connection_log_batcher = ConnectionLogBatcher(
+    lambda: get_conn(), flush_interval_s=CONNECTION_LOG_FLUSH_SECONDS
+)
+status_log_batcher = StatusLogBatcher(
+    lambda: get_conn(), flush_interval_s=STATUS_LOG_FLUSH_SECONDS
+)
 
-        return v
 
-    except Exception:
-        return float(fallback_v)
+def flush_charge_point_presence() -> int:
+    with get_conn() as _c:
+        return status_tracker.flush_presence(
+            _c, datetime.utcnow().replace(tzinfo=timezone.utc).isoformat()
+        )
 
 
+async def presence_flush_loop():
+    while True:
+        await asyncio.sleep(PRESENCE_FLUSH_SECONDS)
+        try:
+            await asyncio.to_thread(flush_charge_point_presence)
+        except Exception as e:
+            logger.exception(f"[PRESENCE][FLUSH][ERR] err={e}")
 
-def calculate_allocated_power_kw_by_cp_ids(active_cp_ids: list[str]):
-    """
-    社區功率平均分配（不再限制最低充電電流門檻）
-    ------------------------------------------------
-    規則：
-    1. 以 community_settings.contract_kw 作為社區總可分配功率
-    2. 對 active_cp_ids 平均分配
-    3. 每台上限固定 SINGLE_CP_MAX_POWER_KW
-    4. 不再因為低於 min_current_a 而阻擋啟動或停止下發
-    ------------------------------------------------
-    回傳：
-    - float：每台應分配功率（kW）
-    - None：僅代表 contract_kw 無效
-    """
 
-    cfg = get_community_settings()
+async def database_maintenance_loop():
+    while True:
+        await asyncio.sleep(DB_MAINTENANCE_TICK_SECONDS)
+        try:
+            actions = await asyncio.to_thread(database_maintenance.tick)
+        except Exception as e:
+            logger.exception(f"[DB][MAINTENANCE][ERR] err={e}")
+            continue
+        if actions:
+            stats = database_maintenance.stats
+            logger.info(
+                f"[DB][MAINTENANCE] actions={actions} | "
+                f"checkpoint_ms={stats.last_checkpoint_ms} | wal_frames={stats.last_wal_frames}"
+            )
 
-    contract_kw = float(cfg.get("contract_kw") or 0)
-    if contract_kw <= 0:
-        return None
 
-    if not active_cp_ids:
-        return round(float(SINGLE_CP_MAX_POWER_KW), 3)
+@app.get("/api/db/maintenance")
+def get_database_maintenance_status():
+    return {
+        "enabled": DB_MAINTENANCE_ENABLED,
+        "connection_pragmas": list(DB_CONNECTION_PRAGMAS),
+        **database_maintenance.snapshot(),
+    }
 
-    avg_kw = contract_kw / max(1, len(active_cp_ids))
-    allocated_kw = min(float(avg_kw), float(SINGLE_CP_MAX_POWER_KW))
 
-    if allocated_kw <= 0:
-        return None
+@app.post("/api/db/maintenance/analyze")
+def request_database_analyze():
+    """下一個 quiet tick 執行完整 ANALYZE（一般情況由 PRAGMA optimize 定期處理）。"""
+    database_maintenance.request_analyze()
+    return {"requested": "analyze"}
 
-    return round(float(allocated_kw), 3)
 
-def convert_power_kw_to_current_a(power_kw: float, cp_id: str | None = None):
-    """
-    將功率(kW)換算成電流(A)
+async def database_backup_loop():
+    while True:
+        await asyncio.sleep(DB_BACKUP_INTERVAL_SECONDS)
+        try:
+            report = await asyncio.to_thread(database_backup.run)
+        except Exception as e:
+            logger.exception(f"[DB][BACKUP][ERR] err={e}")
+            continue
+        if report:
+            logger.info(
+                f"[DB][BACKUP] snapshot={report['snapshot']} | total_ms={report['total_ms']} | "
+                f"max_step_ms={report['max_step_ms']} | restarts={report['restarts']} | "
+                f"bytes={report['compressed_bytes']}/{report['raw_bytes']}"
+            )
 
-    【社區功率控制正式規則】
-    - 一律使用 community_settings.voltage_v 作為固定控制基準電壓
-    - 不再使用單樁即時電壓參與控制換算
-    - 這樣可避免因現場電壓浮動，導致 limit_a 跟著抖動
-    - cp_id 參數保留僅為相容既有呼叫，不再參與換算
-    """
-    cfg = get_community_settings()
-    control_voltage_v = float(cfg.get("voltage_v") or 220)
 
-    try:
-        power_kw = float(power_kw)
-    except Exception:
-        return None
+@app.get("/api/db/backups")
+def get_database_backup_status():
+    return {"enabled": DB_BACKUP_INTERVAL_SECONDS > 0, **database_backup.snapshot()}
 
-    if power_kw <= 0:
-        return 0.0
 
+@app.post("/api/db/backups")
+async def create_database_backup():
+    """立即備份一次（在 worker thread 執行，不阻塞 OCPP 事件迴圈）。"""
     try:
-        if control_voltage_v <= 0:
-            return None
+        report = await asyncio.to_thread(database_backup.run)
+    except Exception as e:
+        logger.exception(f"[DB][BACKUP][ERR] err={e}")
+        raise HTTPException(status_code=500, detail=f"backup failed: {e}")
+    if report is None:
+        raise HTTPException(status_code=409, detail="backup already running")
+    return report
 
-        current_a = (power_kw * 1000.0) / control_voltage_v
-        current_a = min(float(current_a), float(DEVICE_HARD_LIMIT))
-        return round(current_a, 2)
 
-    except Exception:
-        return None
+async def reporting_replica_loop():
+    while True:
+        try:
+            report = await asyncio.to_thread(report_replica.refresh)
+        except Exception as e:
+            logger.exception(f"[REPORTING][REFRESH][ERR] err={e}")
+        else:
+            if report["rebuilt"]:
+                logger.info(
+                    f"[REPORTING][REBUILD] applied_seq={report['applied_seq']} | "
+                    f"build_ms={report_replica.stats.last_build_ms}"
+                )
+        await asyncio.sleep(REPORTING_REFRESH_SECONDS)
 
 
+def sync_report_tracking() -> None:
+    """主資料庫的異動 log 只在啟用複本時記錄；停用時關閉並清掉殘留 log。"""
+    with get_conn() as _c:
+        set_report_tracking(_c, REPORTING_REPLICA_ENABLED)
 
 
-def calculate_allowed_current_by_cp_ids(active_cp_ids: list[str]):
-    """
-    舊版相容函式（保留）
+@app.get("/api/reporting/status")
+def get_reporting_replica_status():
+    return {"enabled": REPORTING_REPLICA_ENABLED, **report_replica.snapshot()}
 
-    【統一控制邏輯】
-    - 一律使用 community_settings.voltage_v 作為固定控制基準電壓
-    - 不再使用各樁即時電壓總和計算 allowed_A
-    - 回傳值代表：若所有 active CP 平均分攤契約容量時，每樁理論可下發的電流
-    """
-    cfg = get_community_settings()
 
-    contract_kw = float(cfg.get("contract_kw") or 0)
-    if contract_kw <= 0:
-        return None
+@app.post("/api/reporting/rebuild")
+async def rebuild_reporting_replica():
+    if not REPORTING_REPLICA_ENABLED:
+        raise HTTPException(status_code=409, detail="reporting replica disabled")
+    report = await asyncio.to_thread(report_replica.rebuild)
+    return {**report, **report_replica.freshness()}
 
-    per_cp_max_a = float(cfg.get("max_current_a") or DEVICE_HARD_LIMIT)
-    control_voltage_v = float(cfg.get("voltage_v") or 220)
 
-    if control_voltage_v <= 0:
+@app.get("/api/status-tracker")
+def get_status_tracker_status():
+    return {
+        "tracker": status_tracker.snapshot(),
+        "status_logs": status_log_batcher.snapshot(),
+    }
+
+
+# ======================
+# 充電樁記憶體狀態快照（warm restart）
+# ======================
+# 定期把即時狀態寫成本機 JSON；啟動時先還原（保留原 updated_at，LIVE_TTL 會標為 stale），
+# 再以一次查詢補齊進行中交易的曲線與功率分配名單（見 state_snapshot.py）
+CHARGER_STATE_SNAPSHOT_PATH = (
+    os.getenv("CHARGER_STATE_SNAPSHOT_PATH") or f"{DB_FILE}.state.json"
+)
+CHARGER_STATE_SNAPSHOT_SECONDS = float(os.getenv("CHARGER_STATE_SNAPSHOT_SECONDS", "15"))
+CHARGER_STATE_MAX_AGE_SECONDS = float(os.getenv("CHARGER_STATE_MAX_AGE_SECONDS", "900"))
+WARM_RESTART_GRACE_SECONDS = float(os.getenv("WARM_RESTART_GRACE_SECONDS", "60"))
+
+
+def _collect_charger_state() -> dict:
+    """在 event loop 執行緒複製各 dict；序列化與寫檔交給 worker thread。"""
+
+    def _copy(entries):
+        return {key: dict(value) for key, value in entries.items() if isinstance(value, dict)}
+
+    return {
+        "live_status": _copy(live_status_cache),
+        "charging_point_status": _copy(charging_point_status),
+        "current_limit_state": _copy(current_limit_state),
+        "cp_connection_seq": dict(cp_connection_seq),
+        "connected": sorted(connected_charge_points),
+        "whitelist": (
+            sorted(charge_point_whitelist.snapshot().ids)
+            if charge_point_whitelist.loaded
+            else None
+        ),
+    }
+
+
+charger_state_snapshotter = StateSnapshotter(
+    CHARGER_STATE_SNAPSHOT_PATH,
+    _collect_charger_state,
+    interval_s=CHARGER_STATE_SNAPSHOT_SECONDS,
+    max_age_s=CHARGER_STATE_MAX_AGE_SECONDS,
+)
+
+
+def restore_charger_state() -> list[str]:
+    """
+    啟動時、接受第一個連線前還原快照（記憶體內已有的值優先）。
+    回傳快照當下在線的 cp_id，供 hydrate_active_transactions 使用。
+    """
+    payload = charger_state_snapshotter.load()
+    if payload is None:
+        logger.warning(
+            f"[STATE][RESTORE][SKIP] reason={charger_state_snapshotter.stats.restore_skipped}"
+        )
+        return []
+
+    saved_at = float(payload["saved_at"])
+    sections = payload["sections"]
+    restored = {
+        "live_status": merge_missing(
+            live_status_cache, mark_restored(sections.get("live_status"), saved_at)
+        ),
+        "charging_point_status": merge_missing(
+            charging_point_status, mark_restored(sections.get("charging_point_status"), saved_at)
+        ),
+        "current_limit_state": merge_missing(
+            current_limit_state, mark_restored(sections.get("current_limit_state"), saved_at)
+        ),
+        "cp_connection_seq": 0,
+        "whitelist": 0,
+    }
+
+    # connection_seq 只會往上：重啟後新連線不會重用舊序號
+    for cp_id, seq in (sections.get("cp_connection_seq") or {}).items():
+        try:
+            seq = int(seq)
+        except (TypeError, ValueError):
+            continue
+        if seq > int(cp_connection_seq.get(cp_id, 0) or 0):
+            cp_connection_seq[cp_id] = seq
+            restored["cp_connection_seq"] += 1
+
+    whitelist = sections.get("whitelist")
+    if isinstance(whitelist, list) and not charge_point_whitelist.loaded:
+        charge_point_whitelist.replace([str(cp_id) for cp_id in whitelist], reason="snapshot")
+        restored["whitelist"] = len(whitelist)
+
+    charger_state_snapshotter.stats.restored_entries = sum(restored.values())
+    logger.warning(
+        f"[STATE][RESTORE] age_s={charger_state_snapshotter.stats.restored_age_s} | "
+        f"restored={restored}"
+    )
+    return [str(cp_id) for cp_id in sections.get("connected") or []]
+
+
+def _load_active_transaction_state():
+    """進行中交易 + 其降採樣曲線（worker thread；曲線一次查詢）。"""
+    with get_conn() as _c:
+        rows = _c.execute(
+            """
+            SELECT transaction_id, charge_point_id, meter_start
+            FROM transactions
+            WHERE stop_timestamp IS NULL
+              AND start_timestamp IS NOT NULL
+            """
+        ).fetchall()
+        series = transaction_detail.read_timelines(
+            _c,
+            {int(tx_id): meter_start for tx_id, _, meter_start in rows},
+            max_points=TRANSACTION_TIMELINE_MAX_POINTS,
+            min_bucket_s=TRANSACTION_TIMELINE_MIN_BUCKET_SECONDS,
+        )
+    return rows, series
+
+
+async def hydrate_active_transactions(previously_connected: list[str]) -> dict:
+    """
+    重啟後補齊進行中交易：
+    1. 由 meter_values 補建即時曲線（已收到新 MeterValues 的交易不覆蓋）；
+    2. 快照中已結束交易的限流狀態移除；
+    3. 快照當下在線、仍有進行中交易的樁，在 WARM_RESTART_GRACE_SECONDS 內
+       視同 ws disconnect grace 參與功率分配，逐台重連時不會先把整個契約
+       容量分給最早連上的樁。
+    """
+    rows, series = await asyncio.to_thread(_load_active_transaction_state)
+
+    seeded = sum(
+        1
+        for tx_id, timeline in series.items()
+        if timeline.samples and live_transaction_timelines.seed(tx_id, timeline)
+    )
+
+    open_tx_ids = {int(tx_id) for tx_id, _, _ in rows}
+    open_cp_ids = {_normalize_cp_id(str(cp_id or "")) for _, cp_id, _ in rows}
+    dropped_limits = 0
+    for cp_id, state in list(current_limit_state.items()):
+        if not state.get("restored"):
+            continue
+        try:
+            tx_id = int(state.get("last_tx_id"))
+        except (TypeError, ValueError):
+            tx_id = None
+        if tx_id not in open_tx_ids:
+            current_limit_state.pop(cp_id, None)
+            dropped_limits += 1
+
+    graced = []
+    if WARM_RESTART_GRACE_SECONDS > 0:
+        now = time.time()
+        for cp_id in previously_connected:
+            cp_id = _normalize_cp_id(cp_id)
+            if (
+                cp_id in open_cp_ids
+                and cp_id not in connected_charge_points
+                and cp_id not in ws_disconnect_grace
+            ):
+                ws_disconnect_grace[cp_id] = {
+                    "started_at": now,
+                    "expire_at": now + WARM_RESTART_GRACE_SECONDS,
+                    "started_at_iso": datetime.fromtimestamp(now, timezone.utc).isoformat(),
+                    "seq": int(ws_disconnect_seq.get(cp_id, 0) or 0),
+                    "reason": "warm_restart",
+                }
+                graced.append(cp_id)
+
+    report = {
+        "active_transactions": len(rows),
+        "timelines_seeded": seeded,
+        "limit_states_dropped": dropped_limits,
+        "warm_restart_grace": graced,
+    }
+    logger.warning(f"[STATE][HYDRATE] {report}")
+    return report
+
+
+async def warm_restart_task(previously_connected: list[str]):
+    try:
+        report = await hydrate_active_transactions(previously_connected)
+    except Exception as e:
+        logger.exception(f"[STATE][HYDRATE][ERR] err={e}")
+        return
+    # grace 期滿（沒回來的樁不再計入）後重新分配一次
+    if report["warm_restart_grace"]:
+        await asyncio.sleep(WARM_RESTART_GRACE_SECONDS)
+        request_rebalance(reason="warm_restart_grace_expired")
+
+
+async def charger_state_snapshot_loop():
+    while True:
+        await asyncio.sleep(CHARGER_STATE_SNAPSHOT_SECONDS)
+        try:
+            sections = _collect_charger_state()
+            if not await asyncio.to_thread(charger_state_snapshotter.save, sections):
+                logger.error(
+                    f"[STATE][SNAPSHOT][ERR] err={charger_state_snapshotter.stats.last_error}"
+                )
+        except Exception as e:
+            logger.exception(f"[STATE][SNAPSHOT][ERR] err={e}")
+
+
+@app.get("/api/charger-state/snapshot")
+def get_charger_state_snapshot_status():
+    return charger_state_snapshotter.snapshot()
+
+
+@app.get("/api/ws/admission")
+def get_ws_admission_status():
+    whitelist = charge_point_whitelist.snapshot()
+    return {
+        "admission": ws_admission.snapshot(),
+        "whitelist": {
+            "loaded": charge_point_whitelist.loaded,
+            "version": whitelist.version,
+            "count": len(whitelist.ids),
+            "reason": whitelist.reason,
+            "updated_at": whitelist.updated_at,
+        },
+        "connection_logs": connection_log_batcher.snapshot(),
+        "rebalance_storm_max_wait_s": REBALANCE_STORM_MAX_WAIT_SECONDS,
+    }
+
+
+def _load_authorization_from_db(id_tag: str):
+    """授權快取 cold miss：單一 JOIN 查詢；尚未遷移的舊卡先建立戶號再重讀。"""
+    with household_connect(DB_FILE) as account_conn:
+        entry = load_authorization(account_conn, id_tag)
+        if entry is not None and not entry.has_account and entry.legacy_card:
+            if ensure_legacy_account_for_card(account_conn, id_tag):
+                entry = load_authorization(account_conn, id_tag)
+    return entry
+
+
+def get_authorization(id_tag: str):
+    """Authorize / StartTransaction 共用；None = id_tags 查無此卡。"""
+    return authorization_cache.get(DB_FILE, id_tag, _load_authorization_from_db)
+
+
+@app.get("/api/authorization-cache")
+def get_authorization_cache_status():
+    return authorization_cache.snapshot()
+
+
+def get_community_settings():
+    with sqlite3.connect(DB_FILE, check_same_thread=False, timeout=15) as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT enabled, contract_kw, voltage_v, phases, min_current_a, max_current_a, surcharge_per_kwh
+            FROM community_settings
+            WHERE id = 1
+        """
+        )
+        row = cur.fetchone()
+
+    if not row:
+        return {
+            "enabled": False,
+            "contract_kw": 0,
+            "voltage_v": 220,
+            "phases": 1,
+            "min_current_a": 16,
+            "max_current_a": 32,
+            "surcharge_per_kwh": 0,
+        }
+
+    return {
+        "enabled": bool(row[0]),
+        "contract_kw": float(row[1] or 0),
+        "voltage_v": float(row[2] or 220),
+        "phases": int(row[3] or 1),
+        "min_current_a": float(row[4] or 16),
+        "max_current_a": float(row[5] or 32),
+        "surcharge_per_kwh": float(row[6] or 0),
+    }
+
+
+def _live_voltage_v(cp_id: str, fallback_v: float = 220.0) -> float:
+    """
+    取得某充電樁目前即時電壓
+    優先從 live_status_cache 讀取，取不到就回退到 fallback_v
+    """
+    try:
+        cp_norm = _normalize_cp_id(cp_id)
+        live = live_status_cache.get(cp_norm, {}) or {}
+
+        v = live.get("voltage")
+
+        if v is None:
+            return float(fallback_v)
+
+        v = float(v)
+        if v <= 0:
+            return float(fallback_v)
+
+        return v
+
+    except Exception:
+        return float(fallback_v)
+
+
+
+def calculate_allocated_power_kw_by_cp_ids(active_cp_ids: list[str]):
+    """
+    社區功率平均分配（不再限制最低充電電流門檻）
+    ------------------------------------------------
+    規則：
+    1. 以 community_settings.contract_kw 作為社區總可分配功率
+    2. 對 active_cp_ids 平均分配
+    3. 每台上限固定 SINGLE_CP_MAX_POWER_KW
+    4. 不再因為低於 min_current_a 而阻擋啟動或停止下發
+    ------------------------------------------------
+    回傳：
+    - float：每台應分配功率（kW）
+    - None：僅代表 contract_kw 無效
+    """
+
+    cfg = get_community_settings()
+
+    contract_kw = float(cfg.get("contract_kw") or 0)
+    if contract_kw <= 0:
+        return None
+
+    if not active_cp_ids:
+        return round(float(SINGLE_CP_MAX_POWER_KW), 3)
+
+    avg_kw = contract_kw / max(1, len(active_cp_ids))
+    allocated_kw = min(float(avg_kw), float(SINGLE_CP_MAX_POWER_KW))
+
+    if allocated_kw <= 0:
+        return None
+
+    return round(float(allocated_kw), 3)
+
+def convert_power_kw_to_current_a(power_kw: float, cp_id: str | None = None):
+    """
+    將功率(kW)換算成電流(A)
+
+    【社區功率控制正式規則】
+    - 一律使用 community_settings.voltage_v 作為固定控制基準電壓
+    - 不再使用單樁即時電壓參與控制換算
+    - 這樣可避免因現場電壓浮動，導致 limit_a 跟著抖動
+    - cp_id 參數保留僅為相容既有呼叫，不再參與換算
+    """
+    cfg = get_community_settings()
+    control_voltage_v = float(cfg.get("voltage_v") or 220)
+
+    try:
+        power_kw = float(power_kw)
+    except Exception:
+        return None
+
+    if power_kw <= 0:
+        return 0.0
+
+    try:
+        if control_voltage_v <= 0:
+            return None
+
+        current_a = (power_kw * 1000.0) / control_voltage_v
+        current_a = min(float(current_a), float(DEVICE_HARD_LIMIT))
+        return round(current_a, 2)
+
+    except Exception:
+        return None
+
+
+
+
+def calculate_allowed_current_by_cp_ids(active_cp_ids: list[str]):
+    """
+    舊版相容函式（保留）
+
+    【統一控制邏輯】
+    - 一律使用 community_settings.voltage_v 作為固定控制基準電壓
+    - 不再使用各樁即時電壓總和計算 allowed_A
+    - 回傳值代表：若所有 active CP 平均分攤契約容量時，每樁理論可下發的電流
+    """
+    cfg = get_community_settings()
+
+    contract_kw = float(cfg.get("contract_kw") or 0)
+    if contract_kw <= 0:
+        return None
+
+    per_cp_max_a = float(cfg.get("max_current_a") or DEVICE_HARD_LIMIT)
+    control_voltage_v = float(cfg.get("voltage_v") or 220)
+
+    if control_voltage_v <= 0:
         return None
 
     if not active_cp_ids:
@@ -2544,144 +3270,6 @@ async def rebalance_all_charging_points(reason: str):
 
 
 
-def ensure_charge_points_table():
-    """
-    ✅ 保證 charge_points 表一定存在
-    - 新 DB 第一次啟動：建立表（直接包含 max_current_a）
-    - 舊 DB：若已存在，不影響
-    """
-    with get_conn() as c:
-        cur = c.cursor()
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS charge_points (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                charge_point_id TEXT UNIQUE NOT NULL,
-                name TEXT,
-                status TEXT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                max_current_a REAL DEFAULT 16
-            )
-        """
-        )
-        c.commit()
-
-
-def ensure_charge_points_schema():
-    """
-    ✅ 舊 DB 相容用：
-    - 表存在但沒有 max_current_a → 自動補欄位
-    - 表不存在 → 直接跳過（避免 Deploy 炸掉）
-    """
-    with get_conn() as c:
-        cur = c.cursor()
-
-        cur.execute(
-            """
-            SELECT name FROM sqlite_master
-            WHERE type='table' AND name='charge_points'
-        """
-        )
-        if not cur.fetchone():
-            logging.warning("⚠️ [MIGRATION] charge_points table not found, skip ALTER")
-            return
-
-        cur.execute("PRAGMA table_info(charge_points);")
-        cols = [r[1] for r in cur.fetchall()]
-
-        if "max_current_a" not in cols:
-            cur.execute(
-                "ALTER TABLE charge_points " "ADD COLUMN max_current_a REAL DEFAULT 16"
-            )
-            c.commit()
-            logging.warning(
-                "🛠️ [MIGRATION] charge_points add column max_current_a REAL DEFAULT 16"
-            )
-        else:
-            logging.info("✅ [MIGRATION] charge_points.max_current_a exists")
-
-def ensure_community_settings_table():
-    """
-    ✅ 保證 community_settings 表一定存在
-    - 新 DB 第一次啟動：直接建立表
-    - 並保證 id=1 這筆預設資料存在
-    """
-    with get_conn() as c:
-        cur = c.cursor()
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS community_settings (
-                id INTEGER PRIMARY KEY,
-                enabled INTEGER DEFAULT 1,
-                contract_kw REAL DEFAULT 0,
-                voltage_v REAL DEFAULT 220,
-                phases INTEGER DEFAULT 1,
-                min_current_a REAL DEFAULT 16,
-                max_current_a REAL DEFAULT 32,
-                surcharge_per_kwh REAL DEFAULT 0
-            )
-            """
-        )
-
-        # 保證 id=1 一定存在
-        cur.execute("SELECT id FROM community_settings WHERE id = 1")
-        row = cur.fetchone()
-
-        if not row:
-            cur.execute(
-                """
-                INSERT INTO community_settings
-                (id, enabled, contract_kw, voltage_v, phases, min_current_a, max_current_a, surcharge_per_kwh)
-                VALUES (1, 1, 0, 220, 1, 16, 32, 0)
-                """
-            )
-
-        c.commit()
-
-
-def ensure_community_settings_schema():
-    """
-    ✅ 舊 DB 相容用：
-    - 表存在但缺少欄位時，自動補齊欄位
-    - 避免 Render 啟動時因 ensure_community_settings_schema() 未定義而失敗
-    """
-    with get_conn() as c:
-        cur = c.cursor()
-
-        cur.execute("PRAGMA table_info(community_settings);")
-        cols = [r[1] for r in cur.fetchall()]
-
-        migrations = [
-            ("enabled", "ALTER TABLE community_settings ADD COLUMN enabled INTEGER DEFAULT 1"),
-            ("contract_kw", "ALTER TABLE community_settings ADD COLUMN contract_kw REAL DEFAULT 0"),
-            ("voltage_v", "ALTER TABLE community_settings ADD COLUMN voltage_v REAL DEFAULT 220"),
-            ("phases", "ALTER TABLE community_settings ADD COLUMN phases INTEGER DEFAULT 1"),
-            ("min_current_a", "ALTER TABLE community_settings ADD COLUMN min_current_a REAL DEFAULT 16"),
-            ("max_current_a", "ALTER TABLE community_settings ADD COLUMN max_current_a REAL DEFAULT 32"),
-            ("surcharge_per_kwh", "ALTER TABLE community_settings ADD COLUMN surcharge_per_kwh REAL DEFAULT 0"),
-        ]
-
-        for col_name, sql in migrations:
-            if col_name not in cols:
-                cur.execute(sql)
-                logging.warning(f"🛠️ [MIGRATION] community_settings add column {col_name}")
-
-        cur.execute("SELECT id FROM community_settings WHERE id = 1")
-        row = cur.fetchone()
-
-        if not row:
-            cur.execute(
-                """
-                INSERT INTO community_settings
-                (id, enabled, contract_kw, voltage_v, phases, min_current_a, max_current_a, surcharge_per_kwh)
-                VALUES (1, 1, 0, 220, 1, 16, 32, 0)
-                """
-            )
-
-        c.commit()
-        logging.warning("✅ [MIGRATION] community_settings schema checked")
-
-
 def ensure_line_bindings_table():
     """
     ✅ LINE 綁定資料表
@@ -2694,20 +3282,7 @@ def ensure_line_bindings_table():
     - 不修改交易、扣款、餘額、SmartCharging 流程
     """
     with get_conn() as c:
-        cur = c.cursor()
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS line_bindings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                id_tag TEXT NOT NULL UNIQUE,
-                line_user_id TEXT NOT NULL UNIQUE,
-                display_name TEXT,
-                enabled INTEGER DEFAULT 1,
-                created_at TEXT,
-                updated_at TEXT
-            )
-            """
-        )
+        apply_statements(c, LINE_BINDINGS_SCHEMA)
         c.commit()
         logging.warning("✅ [LINE][DB] line_bindings table checked")
 
@@ -2727,83 +3302,11 @@ def ensure_line_message_logs_table():
     - 不新增 Broadcast API
     """
     with get_conn() as c:
-        cur = c.cursor()
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS line_message_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                event_type TEXT NOT NULL,
-                transaction_id INTEGER,
-                id_tag TEXT,
-                line_user_id TEXT,
-                status TEXT,
-                reason TEXT,
-                message TEXT,
-                line_status_code INTEGER,
-                line_response TEXT,
-                created_at TEXT
-            )
-            """
-        )
-
-        cur.execute(
-            """
-            CREATE INDEX IF NOT EXISTS idx_line_message_logs_transaction_id
-            ON line_message_logs (transaction_id)
-            """
-        )
-
-        cur.execute(
-            """
-            CREATE INDEX IF NOT EXISTS idx_line_message_logs_id_tag
-            ON line_message_logs (id_tag)
-            """
-        )
-
-        cur.execute(
-            """
-            CREATE INDEX IF NOT EXISTS idx_line_message_logs_created_at
-            ON line_message_logs (created_at)
-            """
-        )
-
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS line_notification_claims (
-                event_type TEXT NOT NULL,
-                transaction_id INTEGER NOT NULL,
-                status TEXT NOT NULL,
-                claimed_at TEXT NOT NULL,
-                completed_at TEXT,
-                PRIMARY KEY (event_type, transaction_id)
-            )
-            """
-        )
-
-        # Recipient-level claims are separate from the legacy transaction-level
-        # table so existing claims and logs remain untouched.
-        cur.execute(
-            """
-            CREATE TABLE IF NOT EXISTS line_recipient_notification_claims (
-                event_type TEXT NOT NULL,
-                transaction_id INTEGER NOT NULL,
-                line_user_id TEXT NOT NULL,
-                source_card_id TEXT,
-                status TEXT NOT NULL,
-                claimed_at TEXT NOT NULL,
-                completed_at TEXT,
-                error TEXT,
-                PRIMARY KEY (event_type, transaction_id, line_user_id)
-            )
-            """
-        )
-
+        apply_statements(c, LINE_MESSAGE_LOGS_SCHEMA)
         c.commit()
         logging.warning("✅ [LINE][DB] line_message_logs table checked")
 
 
-
-
 # 建立一個全域連線（僅供少數 legacy 用途）
 
 
@@ -2812,18 +3315,9 @@ conn.execute("PRAGMA journal_mode=WAL;")
 conn.execute("PRAGMA synchronous=NORMAL;")
 cursor = conn.cursor()
 
-# ✅ 正確順序：先確保表存在，再做 migration
-ensure_charge_points_table()
-ensure_charge_points_schema()
-
-ensure_community_settings_table()
-ensure_community_settings_schema()
-
-# ✅ LINE 階段 3：建立住戶 / idTag 與 LINE userId 綁定資料表
-ensure_line_bindings_table()
+# 資料表建立 / 欄位補齊已移至 schema_migrations.py，
+# 由 run_startup_migrations.py 在檔案鎖內執行；啟動時只做一次版本檢查。
 
-# ✅ LINE 階段 8：建立 LINE 推播紀錄表
-ensure_line_message_logs_table()
 
 def _price_for_timestamp(ts: str) -> float:
     """
@@ -2888,18 +3382,20 @@ def _price_for_timestamp(ts: str) -> float:
     return 6.0
 
 
-# 📌 預設電價規則資料表（只會存一筆）
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS default_pricing_rules (
-    id INTEGER PRIMARY KEY,
-    weekday_rules TEXT,
-    saturday_rules TEXT,
-    sunday_rules TEXT
-)
-"""
+# 電價規則快取：daily_pricing_rules 任何寫入都會遞增 tariff_state.version（見 pricing_calendar.py）
+TARIFF_VERSION_CHECK_SECONDS = float(os.getenv("TARIFF_VERSION_CHECK_SECONDS", "1"))
+PRICING_IMPORT_BATCH_DAYS = int(os.getenv("PRICING_IMPORT_BATCH_DAYS", "62"))
+PRICING_IMPORT_PAUSE_SECONDS = float(os.getenv("PRICING_IMPORT_PAUSE_SECONDS", "0.005"))
+tariff_rules_cache = TariffRulesCache(
+    check_interval_s=TARIFF_VERSION_CHECK_SECONDS, loader=tariff_engine.rules_for_dates
 )
-conn.commit()
+
+
+@app.get("/api/pricing/tariff-cache")
+def get_tariff_cache_status():
+    with get_conn() as _c:
+        storage = tariff_engine.storage_stats(_c)
+    return {**tariff_rules_cache.snapshot(), "storage": storage}
 
 
 # ============================================================
@@ -2920,472 +3416,44 @@ def _calculate_multi_period_cost(transaction_id: int) -> float:
 
 
 def _calculate_multi_period_cost_detailed(transaction_id: int):
-    import sqlite3
-    from datetime import datetime
-
-    cfg = get_community_settings()
-    surcharge_dec = _to_decimal(cfg.get("surcharge_per_kwh", 0))
-
-    with sqlite3.connect(DB_FILE) as conn:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT timestamp, value FROM meter_values
-            WHERE transaction_id=? AND measurand LIKE 'Energy.Active.Import%'
-            ORDER BY timestamp ASC
-            """,
-            (transaction_id,),
-        )
-        rows = cur.fetchall()
-
-        # 💡 效能優化：一次性把所有日期的規則讀出來，避免在迴圈內不斷 Query
-        cur.execute("SELECT date, start_time, end_time, price FROM daily_pricing_rules")
-        all_rules = cur.fetchall()
-
-    if len(rows) < 2:
-        return {"total": 0.0, "segments": []}
-
-    # 將規則轉為字典方便查詢 dict[date] = [(start, end, price), ...]
-    rules_dict = {}
-    for r_date, r_start, r_end, r_price in all_rules:
-        if r_date not in rules_dict:
-            rules_dict[r_date] = []
-        rules_dict[r_date].append((r_start, r_end, r_price))
-
-    segments_map = {}
-
-    for i in range(1, len(rows)):
-        ts_prev, val_prev = rows[i - 1]
-        ts_curr, val_curr = rows[i]
-
-        val_prev_dec = _to_decimal(val_prev)
-        val_curr_dec = _to_decimal(val_curr)
-        diff_wh_dec = val_curr_dec - val_prev_dec
-
-        if diff_wh_dec < 0:
-            diff_wh_dec = Decimal("0")
-
-        diff_kwh_dec = diff_wh_dec / Decimal("1000")
-
-        # 正規化 UTC timestamp → 轉換為台北時間
-        ts_norm = str(ts_curr).replace("Z", "+00:00")
-        dt_parsed = datetime.fromisoformat(ts_norm)
-
-        if dt_parsed.tzinfo is None:
-            dt_parsed = dt_parsed.replace(tzinfo=timezone.utc)
-
-        dt_local = dt_parsed.astimezone(TZ_TAIPEI)
-
-        date_key = dt_local.strftime("%Y-%m-%d")
-        time_str = dt_local.strftime("%H:%M")
-
-        # ★ 效能優化：改從記憶體 (rules_dict) 查詢當前時段電價
-        start_t, end_t, base_price = "00:00", "23:59", 6.0  # 預設值
-        found_rule = False
-
-        daily_rules = rules_dict.get(date_key, [])
-        for r_start, r_end, r_price in daily_rules:
-            if r_start <= time_str < r_end:
-                start_t, end_t, base_price = r_start, r_end, r_price
-                found_rule = True
-                break
-
-        # 若當天找不到，往前一天找
-        if not found_rule:
-            prev_date = (dt_local - timedelta(days=1)).strftime("%Y-%m-%d")
-            prev_rules = rules_dict.get(prev_date, [])
-            for r_start, r_end, r_price in prev_rules:
-                if r_start <= time_str < r_end:
-                    start_t, end_t, base_price = r_start, r_end, r_price
-                    break
-
-        base_price_dec = _to_decimal(base_price)
-        final_price_dec = base_price_dec + surcharge_dec
-
-        # 用字串當 key，避免 Decimal / float 混用造成 key 不穩定
-        key = (date_key, start_t, end_t, str(final_price_dec))
-
-        if key not in segments_map:
-            segments_map[key] = {
-                "start": f"{date_key}T{start_t}:00",
-                "end": f"{date_key}T{end_t}:00",
-                "kwh_dec": Decimal("0"),
-                "price_dec": final_price_dec,
-                "base_price_dec": base_price_dec,
-                "surcharge_dec": surcharge_dec,
-                "subtotal_raw_dec": Decimal("0"),
-            }
-
-        seg = segments_map[key]
-        seg["kwh_dec"] += diff_kwh_dec
-        seg["subtotal_raw_dec"] += diff_kwh_dec * final_price_dec
-
-    # 轉格式：按時間排序
-    raw_segments = sorted(segments_map.values(), key=lambda s: s["start"])
-
-    segments = []
-    rounded_subtotals = []
-
-    for seg in raw_segments:
-        subtotal_dec = _money_dec(seg["subtotal_raw_dec"])
-        rounded_subtotals.append(subtotal_dec)
-
-        kwh_dec = seg["kwh_dec"].quantize(
-            Decimal("0.000001"),
-            rounding=ROUND_HALF_UP,
-        )
-
-        segments.append(
-            {
-                "start": seg["start"],
-                "end": seg["end"],
-                "kwh": float(kwh_dec),
-                "price": float(seg["price_dec"]),
-                "base_price": float(seg["base_price_dec"]),
-                "surcharge": float(seg["surcharge_dec"]),
-                "subtotal": float(subtotal_dec),
-            }
-        )
-
-    # 關鍵：
-    # total 必須等於「各分段已顯示金額」加總。
-    total_dec = MONEY_ZERO
-    for subtotal_dec in rounded_subtotals:
-        total_dec += subtotal_dec
-
-    total_dec = total_dec.quantize(MONEY_QUANT, rounding=ROUND_HALF_UP)
-
-    return {
-        "total": float(total_dec),
-        "segments": segments,
-    }
-
-
-@app.get("/api/cards/{card_id}/whitelist")
-async def get_card_whitelist(card_id: str):
-    cursor.execute(
-        "SELECT charge_point_id FROM card_whitelist WHERE card_id = ?", (card_id,)
-    )
-    rows = cursor.fetchall()
-    allowed_list = [row[0] for row in rows]
-
-    return {"idTag": card_id, "allowed": allowed_list}
-
-
-# === 卡片白名單 (card_whitelist) ===
-cursor.execute(
-    """
-    CREATE TABLE IF NOT EXISTS card_whitelist (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        card_id TEXT NOT NULL,
-        charge_point_id TEXT NOT NULL
-    )
-"""
-)
-conn.commit()
-
-
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS card_owners (
-    card_id TEXT PRIMARY KEY,
-    name TEXT
-)
-"""
-)
-conn.commit()
-
-
-# 初始化 connection_logs 表格（如不存在就建立）
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS connection_logs (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    charge_point_id TEXT,
-    ip TEXT,
-    time TEXT
-)
-"""
-)
-conn.commit()
-
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS reservations (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    charge_point_id TEXT NOT NULL,
-    id_tag TEXT NOT NULL,
-    start_time TEXT NOT NULL,
-    end_time   TEXT NOT NULL,
-    status     TEXT NOT NULL
-)
-"""
-)
-conn.commit()
-
-
-# === 新增 cards 資料表，用於管理卡片餘額 ===
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS cards (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    card_id TEXT UNIQUE,
-    balance REAL DEFAULT 0
-)
-"""
-)
-
-# 建立 daily_pricing 表（若尚未存在）
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS daily_pricing (
-    date TEXT PRIMARY KEY,
-    price_per_kwh REAL
-)
-"""
-)
-
-
-# ★ 新增：每日「多時段」電價規則，供 /api/pricing/price-now 使用
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS daily_pricing_rules (
-    date TEXT,          -- YYYY-MM-DD
-    start_time TEXT,    -- HH:MM
-    end_time TEXT,      -- HH:MM
-    price REAL,         -- 當時段電價
-    label TEXT          -- 可選：顯示用標籤（例如 尖峰/離峰/活動價）
-)
-"""
-)
-conn.commit()
-
-
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS stop_transactions (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    transaction_id TEXT,
-    meter_stop INTEGER,
-    timestamp TEXT,
-    reason TEXT
-)
-"""
-)
-
-
-# ✅ 加在這裡！
-cursor.execute(
     """
-    CREATE TABLE IF NOT EXISTS payments (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        transaction_id INTEGER,
-        base_fee REAL,
-        energy_fee REAL,
-        overuse_fee REAL,
-        total_amount REAL,
-        paid_at TEXT
-    )
-"""
-)
-
-
-conn.commit()
-
-
-cursor.execute(
+    多時段電價分段明細；計算本體在 billing.multi_period_breakdown，
+    與 payments 重算共用同一套邏輯。
     """
-CREATE TABLE IF NOT EXISTS transactions (
-    transaction_id INTEGER PRIMARY KEY,
-    charge_point_id TEXT,
-    connector_id INTEGER,
-    id_tag TEXT,
-    meter_start INTEGER,
-    start_timestamp TEXT,
-    meter_stop INTEGER,
-    stop_timestamp TEXT,
-    reason TEXT,
-    balance_before REAL,
-    balance_after REAL,
-    auto_stop_reason TEXT,
-    auto_stop_triggered_at TEXT,
-    auto_stop_balance REAL,
-    auto_stop_estimated_amount REAL
-)
-"""
-)
-
-cursor.execute("PRAGMA table_info(transactions)")
-_tx_cols = [r[1] for r in cursor.fetchall()]
-
-if "balance_before" not in _tx_cols:
-    cursor.execute("ALTER TABLE transactions ADD COLUMN balance_before REAL")
-
-if "balance_after" not in _tx_cols:
-    cursor.execute("ALTER TABLE transactions ADD COLUMN balance_after REAL")
-
-if "auto_stop_reason" not in _tx_cols:
-    cursor.execute("ALTER TABLE transactions ADD COLUMN auto_stop_reason TEXT")
-
-if "auto_stop_triggered_at" not in _tx_cols:
-    cursor.execute("ALTER TABLE transactions ADD COLUMN auto_stop_triggered_at TEXT")
-
-if "auto_stop_balance" not in _tx_cols:
-    cursor.execute("ALTER TABLE transactions ADD COLUMN auto_stop_balance REAL")
-
-if "auto_stop_estimated_amount" not in _tx_cols:
-    cursor.execute("ALTER TABLE transactions ADD COLUMN auto_stop_estimated_amount REAL")
-
-if "surplus_amount" not in _tx_cols:
-    cursor.execute("ALTER TABLE transactions ADD COLUMN surplus_amount REAL DEFAULT 0")
-
-conn.commit()
-
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS id_tags (
-    id_tag TEXT PRIMARY KEY,
-    status TEXT,
-    valid_until TEXT
-)
-"""
-)
-
-
-# ✅ 請插入這段
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS users (
-    id_tag TEXT PRIMARY KEY,
-    name TEXT,
-    department TEXT,
-    card_number TEXT
-)
-"""
-)
-
-conn.commit()
-
-
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS weekly_pricing (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    season TEXT,
-    weekday TEXT,
-    type TEXT,          -- 尖峰、離峰、半尖峰
-    start_time TEXT,    -- HH:MM
-    end_time TEXT,      -- HH:MM
-    price REAL
-)
-"""
-)
-conn.commit()
-
-
-# ★ 新增：一般季別/日別的時段電價規則，供 /api/pricing-rules 使用
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS pricing_rules (
-    season TEXT,        -- 例如：summer、winter…（你自訂）
-    day_type TEXT,      -- 例如：weekday、weekend…（你自訂）
-    start_time TEXT,    -- HH:MM
-    end_time TEXT,      -- HH:MM
-    price REAL
-)
-"""
-)
-conn.commit()
-
-
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS meter_values (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    transaction_id INTEGER,
-    charge_point_id TEXT,
-    connector_id INTEGER,
-    timestamp TEXT,
-    value REAL,
-    measurand TEXT,
-    unit TEXT,
-    context TEXT,
-    format TEXT,
-    phase TEXT               -- ★ 新增：存相別 L1/L2/L3/N 等
-)
-"""
-)
+    cfg = get_community_settings()
 
-# ★ 舊庫相容：若既有資料表沒有 phase 欄位，自動補上
-cursor.execute("PRAGMA table_info(meter_values)")
-_cols = [r[1] for r in cursor.fetchall()]
-if "phase" not in _cols:
-    cursor.execute("ALTER TABLE meter_values ADD COLUMN phase TEXT")
-conn.commit()
-
-# 🚀 效能救星 1：建立關鍵索引，消滅全表掃描，讓查詢從 10 秒變 1 毫秒！
-cursor.execute("CREATE INDEX IF NOT EXISTS idx_meter_values_tx_id ON meter_values(transaction_id);")
-cursor.execute("CREATE INDEX IF NOT EXISTS idx_meter_values_cp_ts ON meter_values(charge_point_id, timestamp);")
-cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_cp_stop ON transactions(charge_point_id, stop_timestamp);")
-conn.commit()
-
-# Shared household balances and RFID enrollment.  This creates only additive,
-# idempotent schema; legacy balance migration remains an explicit backed-up
-# operation in migrate_household_accounts.py.
-with household_connect(DB_FILE) as _household_schema_conn:
-    ensure_household_schema(_household_schema_conn)
-
-
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS status_logs (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    charge_point_id TEXT,
-    connector_id INTEGER,
-    status TEXT,
-    timestamp TEXT
-)
-"""
-)
+    with sqlite3.connect(DB_FILE) as conn:
+        rows = conn.execute(
+            """
+            SELECT timestamp, value FROM meter_values
+            WHERE transaction_id=? AND measurand LIKE 'Energy.Active.Import%'
+            ORDER BY timestamp ASC
+            """,
+            (transaction_id,),
+        ).fetchall()
 
-# ★ 舊庫相容：若既有資料表沒有 error_code 欄位，自動補上
-cursor.execute("PRAGMA table_info(status_logs)")
-_cols = [r[1] for r in cursor.fetchall()]
-if "error_code" not in _cols:
-    cursor.execute("ALTER TABLE status_logs ADD COLUMN error_code TEXT")
-    logging.warning("[DB][MIGRATE] status_logs.error_code added")
-else:
-    logging.warning("[DB][MIGRATE] status_logs.error_code already exists")
+        if len(rows) < 2:
+            return {"total": 0.0, "segments": []}
 
-conn.commit()
+    # 💡 只取本次交易涵蓋日期（含前一天）的規則；依電價版本快取於記憶體
+    rules_by_date = tariff_rules_cache.rules_for_dates(
+        get_conn, billing.rule_dates(rows), DB_FILE
+    )
 
+    return billing.multi_period_breakdown(
+        rows, rules_by_date, cfg.get("surcharge_per_kwh", 0)
+    )
 
-# ============================================================
-# 🏘️ 社區 Smart Charging 設定（契約容量）
-# ============================================================
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS community_settings (
-    id INTEGER PRIMARY KEY CHECK (id = 1),
-    enabled INTEGER DEFAULT 0,          -- 0=false, 1=true
-    contract_kw REAL DEFAULT 0,          -- 契約容量 (kW)
-    voltage_v REAL DEFAULT 220,          -- 電壓 (V)
-    phases INTEGER DEFAULT 1,            -- 相數（先保留）
-    min_current_a REAL DEFAULT 16,       -- 最低充電電流
-    max_current_a REAL DEFAULT 32        -- 每樁最大上限
-)
-"""
-)
 
-# ✅ 確保一定有一筆 id=1
-cursor.execute(
-    """
-INSERT OR IGNORE INTO community_settings (id)
-VALUES (1)
-"""
-)
+@app.get("/api/cards/{card_id}/whitelist")
+async def get_card_whitelist(card_id: str):
+    cursor.execute(
+        "SELECT charge_point_id FROM card_whitelist WHERE card_id = ?", (card_id,)
+    )
+    rows = cursor.fetchall()
+    allowed_list = [row[0] for row in rows]
 
-conn.commit()
+    return {"idTag": card_id, "allowed": allowed_list}
 
 
 from ocpp.v16 import call
@@ -3795,12 +3863,6 @@ class ChargePoint(OcppChargePoint):
         try:
             cp_id = getattr(self, "id", None)
 
-            logging.warning(
-                f"[DEBUG][STATUS][ENTER] "
-                f"cp_id={cp_id} | connector_id={connector_id} | "
-                f"status={status} | error_code={error_code} | timestamp={timestamp} | kwargs={kwargs}"
-            )
-
             if cp_id is None:
                 logging.error("[STATUS][INVALID] cp_id is None")
                 return call_result.StatusNotificationPayload()
@@ -3826,50 +3888,19 @@ class ChargePoint(OcppChargePoint):
             else:
                 status_ts_utc = datetime.utcnow().replace(tzinfo=timezone.utc).isoformat()
 
-            # 1) 寫 status_logs（這才是 StatusNotification 應該做的事）
-            try:
-                with sqlite3.connect(DB_FILE, check_same_thread=False, timeout=15) as conn:
-                    cursor = conn.cursor()
-
-                    try:
-                        cursor.execute(
-                            """
-                            INSERT INTO status_logs
-                            (charge_point_id, connector_id, status, timestamp, error_code)
-                            VALUES (?, ?, ?, ?, ?)
-                            """,
-                            (cp_id, connector_id, status, status_ts_utc, error_code),
-                        )
-                        conn.commit()
-
-                    except sqlite3.OperationalError as e:
-                        if "no column named error_code" in str(e):
-                            logging.warning(
-                                f"[STATUS][DB_LOG_FALLBACK] "
-                                f"cp_id={cp_id} | connector_id={connector_id} | err={e}"
-                            )
-                            cursor.execute(
-                                """
-                                INSERT INTO status_logs
-                                (charge_point_id, connector_id, status, timestamp)
-                                VALUES (?, ?, ?, ?)
-                                """,
-                                (cp_id, connector_id, status, status_ts_utc),
-                            )
-                            conn.commit()
-
-                            logging.warning(
-                                f"[STATUS][DB_LOG_FALLBACK_OK] "
-                                f"cp_id={cp_id} | connector_id={connector_id} | "
-                                f"status={status} | timestamp={status_ts_utc}"
-                            )
-
-                        else:
-                            raise
-
-            except Exception as e:
-                logging.exception(
-                    f"[STATUS][DB_LOG_ERR] cp_id={cp_id} | connector_id={connector_id} | err={e}"
+            # 1) status_logs：只落地狀態轉換（與定期 keepalive touch），批次寫入；
+            #    樁重送相同狀態只更新記憶體
+            status_change = status_tracker.observe(
+                cp_id,
+                connector_id,
+                status,
+                error_code,
+                status_ts_utc,
+                seen_at=datetime.utcnow().replace(tzinfo=timezone.utc).isoformat(),
+            )
+            if status_change != STATUS_DUPLICATE:
+                status_log_batcher.add(
+                    cp_id, connector_id, status, status_ts_utc, error_code
                 )
 
             # 2) 更新記憶體狀態
@@ -3912,7 +3943,7 @@ class ChargePoint(OcppChargePoint):
                         safe_status = "Available"
 
                     charging_point_status[cp_id] = {
-                        **previous_status,
+                        **clear_restored(previous_status),
                         "connector_id": connector_id,
                         "status": safe_status,
                         "raw_status": status,
@@ -3930,7 +3961,7 @@ class ChargePoint(OcppChargePoint):
                         safe_live_status = safe_status
 
                     live_status_cache[cp_id] = {
-                        **previous_live,
+                        **clear_restored(previous_live),
                         "status": safe_live_status,
                         "raw_status": status,
                         "raw_timestamp": status_ts_utc,
@@ -3952,7 +3983,7 @@ class ChargePoint(OcppChargePoint):
 
             prev_status = charging_point_status.get(cp_id, {}) or {}
             charging_point_status[cp_id] = {
-                **prev_status,
+                **clear_restored(prev_status),
                 "connector_id": connector_id,
                 "status": status,
                 "raw_status": status,
@@ -3972,7 +4003,7 @@ class ChargePoint(OcppChargePoint):
             # 3) 順手 patch live cache 的 status，不清空功率/電流
             prev_live = live_status_cache.get(cp_id, {}) or {}
             live_status_cache[cp_id] = {
-                **prev_live,
+                **clear_restored(prev_live),
                 "status": status,
                 "raw_status": status,
                 "raw_timestamp": status_ts_utc,
@@ -3989,10 +4020,12 @@ class ChargePoint(OcppChargePoint):
                 "derived": prev_live.get("derived", False),
             }
 
-            logging.warning(
+            logging.log(
+                logging.DEBUG if status_change == STATUS_DUPLICATE else logging.WARNING,
                 f"[STATUS][OK] "
                 f"cp_id={cp_id} | connector_id={connector_id} | "
-                f"status={status} | error_code={error_code} | timestamp={status_ts_utc}"
+                f"status={status} | error_code={error_code} | "
+                f"timestamp={status_ts_utc} | change={status_change}",
             )
 
             return call_result.StatusNotificationPayload()
@@ -4055,6 +4088,9 @@ class ChargePoint(OcppChargePoint):
                 )
             # =====================================================
 
+            # 本地授權清單：開機後補送（LOCAL_AUTH_LIST_ENABLED=1 才會執行）
+            schedule_local_list_sync(self.id)
+
             # =====================================================
             # ✅ 正常回應 BootNotification（永遠 Accepted）
             # =====================================================
@@ -4076,7 +4112,9 @@ class ChargePoint(OcppChargePoint):
     @on(Action.Heartbeat)
     async def on_heartbeat(self):
         now = datetime.utcnow().replace(tzinfo=timezone.utc)
-        logging.warning(f"❤️ Heartbeat | CP={self.id}")
+        # 只更新記憶體 last-seen，由 presence_flush_loop 定期批次落地
+        status_tracker.heartbeat(self.id, now.isoformat())
+        logging.debug(f"❤️ Heartbeat | CP={self.id}")
         return call_result.HeartbeatPayload(current_time=now.isoformat())
 
     @on(Action.Authorize)
@@ -4091,14 +4129,11 @@ class ChargePoint(OcppChargePoint):
         try:
             t_db = time.perf_counter()
 
-            with get_conn() as _c:
-                cur = _c.cursor()
-                cur.execute("SELECT status FROM id_tags WHERE id_tag = ?", (id_tag,))
-                row = cur.fetchone()
+            authorization = get_authorization(id_tag)
 
             db_ms = _ms_since(t_db)
 
-            if not row:
+            if authorization is None:
                 status = "Invalid"
                 status_db = None
                 # Every unknown Authorize is audited.  A matching active
@@ -4107,20 +4142,8 @@ class ChargePoint(OcppChargePoint):
                 with household_connect(DB_FILE) as enrollment_conn:
                     capture_unknown_card(enrollment_conn, id_tag, cp_id)
             else:
-                status_db = row[0]
-                with household_connect(DB_FILE) as account_conn:
-                    account_card = (
-                        resolve_account_by_card(account_conn, id_tag)
-                        or ensure_legacy_account_for_card(account_conn, id_tag)
-                    )
-                status = (
-                    "Accepted"
-                    if status_db == "Accepted"
-                    and account_card
-                    and account_card["card_status"] == "active"
-                    and account_card["account_status"] == "active"
-                    else "Blocked"
-                )
+                status_db = authorization.status
+                status = authorization.authorize_status()
 
             total_ms = _ms_since(t0)
 
@@ -4180,17 +4203,14 @@ class ChargePoint(OcppChargePoint):
             # [1] idTag 驗證
             # =================================================
             t_step = time.perf_counter()
-            with get_conn() as _c:
-                cur = _c.cursor()
-                cur.execute("SELECT status FROM id_tags WHERE id_tag = ?", (id_tag,))
-                row = cur.fetchone()
+            authorization = get_authorization(id_tag)
 
             logging.warning(
                 f"[DEBUG][START_TX][STEP] "
-                f"cp_id={self.id} | step=id_tags_lookup | ms={_ms_since(t_step)}"
+                f"cp_id={self.id} | step=authorization_lookup | ms={_ms_since(t_step)}"
             )
 
-            if not row:
+            if authorization is None:
                 logging.warning(f"🔴 StartTransaction Invalid：idTag={id_tag} 不存在")
                 logging.warning(
                     f"[DEBUG][START_TX][EXIT] "
@@ -4200,21 +4220,7 @@ class ChargePoint(OcppChargePoint):
                     transaction_id=0, id_tag_info={"status": "Invalid"}
                 )
 
-            status_db = row[0]
-
-            if status_db != "Accepted":
-                logging.warning(
-                    f"🔴 StartTransaction Blocked：idTag={id_tag} | status_db={status_db}"
-                )
-                logging.warning(
-                    f"[DEBUG][START_TX][EXIT] "
-                    f"cp_id={self.id} | transaction_id=0 | result=Blocked | total_ms={_ms_since(tx_t0)}"
-                )
-                return call_result.StartTransactionPayload(
-                    transaction_id=0, id_tag_info={"status": "Blocked"}
-                )
-
-            status_db = row[0]
+            status_db = authorization.status
 
             if status_db != "Accepted":
                 logging.warning(
@@ -4245,24 +4251,29 @@ class ChargePoint(OcppChargePoint):
                 )
 
             t_step = time.perf_counter()
-            with sqlite3.connect(DB_FILE, check_same_thread=False, timeout=15) as conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    """
-                    SELECT id FROM reservations
-                    WHERE charge_point_id=? AND id_tag=? AND status='active'
-                      AND start_time<=? AND end_time>=?
-                    """,
-                    (self.id, id_tag, now_utc, now_utc),
-                )
-                res = cursor.fetchone()
-
-                if res:
+            res = None
+            # 授權快取已知此卡沒有 active 預約時，略過這次連線
+            if authorization.has_active_reservation:
+                with sqlite3.connect(DB_FILE, check_same_thread=False, timeout=15) as conn:
+                    cursor = conn.cursor()
                     cursor.execute(
-                        "UPDATE reservations SET status='completed' WHERE id=?",
-                        (res[0],),
+                        """
+                        SELECT id FROM reservations
+                        WHERE charge_point_id=? AND id_tag=? AND status='active'
+                          AND start_time<=? AND end_time>=?
+                        """,
+                        (self.id, id_tag, now_utc, now_utc),
                     )
-                    conn.commit()
+                    res = cursor.fetchone()
+
+                    if res:
+                        cursor.execute(
+                            "UPDATE reservations SET status='completed' WHERE id=?",
+                            (res[0],),
+                        )
+                        conn.commit()
+                if res:
+                    auth_cache.invalidate_card(id_tag)
 
             logging.warning(
                 f"[DEBUG][START_TX][STEP] "
@@ -4276,34 +4287,9 @@ class ChargePoint(OcppChargePoint):
             # =================================================
             # [3] 餘額檢查
             # =================================================
-            t_step = time.perf_counter()
-            with household_connect(DB_FILE) as legacy_conn:
-                ensure_legacy_account_for_card(legacy_conn, id_tag)
-            with get_conn() as account_conn:
-                cursor = account_conn.cursor()
-                cursor.execute(
-                    """
-                    SELECT ac.account_id, ha.floor_no, ha.parking_space_no,
-                           ac.status, ha.status, ha.balance,
-                           EXISTS(
-                               SELECT 1 FROM card_whitelist cw
-                               WHERE cw.card_id = ac.card_id
-                                 AND cw.charge_point_id = ?
-                           ) AS cp_allowed
-                    FROM account_cards ac
-                    JOIN household_accounts ha ON ha.account_id = ac.account_id
-                    WHERE ac.card_id = ?
-                    """,
-                    (self.id, id_tag),
-                )
-                card = cursor.fetchone()
-
-            logging.warning(
-                f"[DEBUG][START_TX][STEP] "
-                f"cp_id={self.id} | step=card_balance_lookup | ms={_ms_since(t_step)}"
-            )
-
-            if not card:
+            # 戶號、卡片狀態、白名單與餘額等級皆來自同一筆授權快取
+            # （舊卡的 ensure_legacy_account_for_card 已在 cold miss 時處理）
+            if not authorization.has_account:
                 logging.warning(f"🔴 StartTransaction Invalid：card {id_tag} 不存在")
                 logging.warning(
                     f"[DEBUG][START_TX][EXIT] "
@@ -4313,16 +4299,12 @@ class ChargePoint(OcppChargePoint):
                     transaction_id=0, id_tag_info={"status": "Invalid"}
                 )
 
-            (
-                account_id,
-                floor_no,
-                parking_space_no,
-                card_status,
-                account_status,
-                shared_balance,
-                cp_allowed,
-            ) = card
-            if card_status != "active" or account_status != "active":
+            account_id = authorization.account_id
+            floor_no = authorization.floor_no
+            parking_space_no = authorization.parking_space_no
+            card_status = authorization.card_status
+            account_status = authorization.account_status
+            if not authorization.account_active:
                 logging.warning(
                     f"[START_TX][BLOCKED] idTag={id_tag} | card_status={card_status} | "
                     f"account_status={account_status}"
@@ -4330,7 +4312,7 @@ class ChargePoint(OcppChargePoint):
                 return call_result.StartTransactionPayload(
                     transaction_id=0, id_tag_info={"status": "Blocked"}
                 )
-            if not cp_allowed:
+            if not authorization.allows_charge_point(self.id):
                 logging.warning(
                     f"[START_TX][BLOCKED] idTag={id_tag} | cp_id={self.id} | reason=not_whitelisted"
                 )
@@ -4338,10 +4320,10 @@ class ChargePoint(OcppChargePoint):
                     transaction_id=0, id_tag_info={"status": "Blocked"}
                 )
 
-            balance = float(shared_balance or 0)
-            if balance <= 0:
+            if authorization.balance_class != auth_cache.BALANCE_POSITIVE:
                 logging.warning(
-                    f"🔴 StartTransaction Blocked：idTag={id_tag} | balance={balance}"
+                    f"🔴 StartTransaction Blocked：idTag={id_tag} | "
+                    f"balance_class={authorization.balance_class}"
                 )
                 logging.warning(
                     f"[DEBUG][START_TX][EXIT] "
@@ -4535,7 +4517,7 @@ class ChargePoint(OcppChargePoint):
             logging.warning(
                 f"🟢 StartTransaction Accepted | "
                 f"cp={self.id} | connector={connector_id} | "
-                f"idTag={id_tag} | tx_id={tx_id} | balance={balance}"
+                f"idTag={id_tag} | tx_id={tx_id} | balance_class={authorization.balance_class}"
             )
 
             # ==================================================
@@ -4716,7 +4698,7 @@ class ChargePoint(OcppChargePoint):
                 # ==================================================
                 _cur.execute(
                     """
-                    SELECT id_tag, meter_start, account_id
+                    SELECT id_tag, meter_start, account_id, start_timestamp
                     FROM transactions
                     WHERE transaction_id = ?
                     """,
@@ -4729,7 +4711,7 @@ class ChargePoint(OcppChargePoint):
                         f"[STOP][ERR] transaction not found | tx_id={transaction_id}"
                     )
                 else:
-                    id_tag, meter_start, transaction_account_id = row
+                    id_tag, meter_start, transaction_account_id, tx_start_ts = row
 
                     try:
                         used_kwh = max(
@@ -4749,6 +4731,7 @@ class ChargePoint(OcppChargePoint):
                     # ==================================================
                     # 多時段電價（若有）
                     # ==================================================
+                    billing_segments = None
                     try:
                         breakdown = _calculate_multi_period_cost_detailed(transaction_id)
                         mp_amount = _money_float(breakdown.get("total", 0.0))
@@ -4758,6 +4741,7 @@ class ChargePoint(OcppChargePoint):
                             # 正式扣款金額 = 各分段 subtotal 已四捨五入後的加總
                             # 這樣 LINE 電價摘要加總會等於本次費用
                             total_amount = mp_amount
+                            billing_segments = breakdown.get("segments") or []
                             logger.info(
                                 f"🧮 多時段電價計算結果：{total_amount} "
                                 f"| segments={len(breakdown.get('segments') or [])}"
@@ -4806,39 +4790,39 @@ class ChargePoint(OcppChargePoint):
                                 ),
                             )
 
-                    _cur.execute(
-                        "SELECT balance FROM household_accounts WHERE account_id = ?",
-                        (transaction_account_id,),
-                    )
-                    card = _cur.fetchone()
+                    # 帳本扣款：單一 INSERT，餘額快取由 trigger 更新；
+                    # settlement 冪等鍵確保重送的 StopTransaction 不會重複扣款
+                    ledger_entry = None
+                    if transaction_account_id is not None:
+                        try:
+                            ledger_entry, ledger_created = balance_ledger.post_entry(
+                                _cur,
+                                transaction_account_id,
+                                "debit",
+                                -_money_dec(total_amount),
+                                idempotency_key=balance_ledger.settlement_key_for_transaction(
+                                    _cur, transaction_id, transaction_account_id
+                                ),
+                                transaction_id=transaction_id,
+                                clamp=True,
+                            )
+                            if not ledger_created:
+                                logger.warning(
+                                    f"[STOP][LEDGER][DUPLICATE] tx_id={transaction_id} "
+                                    f"| entry_id={ledger_entry.entry_id}"
+                                )
+                        except balance_ledger.LedgerError as e:
+                            logger.error(f"[STOP][LEDGER][ERR] tx_id={transaction_id} | err={e}")
 
-                    if not card:
+                    if ledger_entry is None:
                         logger.error(
                             f"[STOP][ERR] household account not found | "
                             f"account_id={transaction_account_id} | card_id={id_tag}"
                         )
                     else:
-                        balance_before = _money_float(card[0] or 0)
+                        balance_before = ledger_entry.balance_before
+                        balance_after = ledger_entry.balance_after
 
-                        balance_after_dec = _money_dec(balance_before) - _money_dec(total_amount)
-                        if balance_after_dec < MONEY_ZERO:
-                            balance_after_dec = MONEY_ZERO
-
-                        balance_after = float(
-                            balance_after_dec.quantize(
-                                MONEY_QUANT,
-                                rounding=ROUND_HALF_UP,
-                            )
-                        )
-
-                        _cur.execute(
-                            """
-                            UPDATE household_accounts
-                            SET balance = ?, updated_at = ?
-                            WHERE account_id = ?
-                            """,
-                            (balance_after, stop_ts, transaction_account_id),
-                        )
                         # Compatibility shadow for a lazily adopted, single
                         # legacy card only.  Shared/multi-card accounts are
                         # never mirrored; household_accounts remains the
@@ -4915,9 +4899,39 @@ class ChargePoint(OcppChargePoint):
                         ),
                     )
 
+                    # ==================================================
+                    # 結算快照：LINE 訊息直接由此渲染，不再重算費用
+                    # ==================================================
+                    persist_transaction_settlement_snapshot(
+                        _cur,
+                        transaction_id,
+                        cost=total_amount,
+                        unit_price=unit_price,
+                        energy_kwh=used_kwh,
+                        segments=billing_segments,
+                    )
+
+                # ==================================================
+                # LINE outbox：與扣款同一個 transaction 寫入，
+                # commit 之後才由 worker pool 發送（重啟不會遺失通知）
+                # ==================================================
+                line_events = enqueue_stop_transaction_line_events(
+                    _cur,
+                    transaction_id,
+                    locals().get("balance_after"),
+                )
+
                 _conn.commit()
                 settlement_committed = True
                 logger.error("[STOP][COMMIT] DB commit done")
+                auth_cache.invalidate_account(locals().get("transaction_account_id"))
+                transaction_detail_cache.invalidate(transaction_id)
+                # 明細頁曲線在 commit 後由 worker thread 寫入，不佔用結算的寫入鎖
+                schedule_transaction_timeline(
+                    transaction_id,
+                    locals().get("meter_start"),
+                    live_transaction_timelines.pop(transaction_id),
+                )
 
                 # Remove only the in-memory Smart Charging state that is still
                 # bound to this completed transaction. Do not send an untested
@@ -4938,97 +4952,110 @@ class ChargePoint(OcppChargePoint):
                         )
 
                 # ==================================================
-                # LINE 階段 7：StopTransaction 完成後自動推播
-                # 放在 DB commit 後，確保交易、扣款、餘額已完成。
-                # 注意：此處只排程，不等待 LINE API，避免影響 StopTransaction 回覆。
+                # LINE 通知：outbox 已在結算 transaction 內寫入，commit 後喚醒
+                # worker pool 一次即可；只有 in-transaction 寫入失敗（回傳 []）
+                # 才退回下方各別的 schedule_*（各自開連線補寫 outbox）。
                 # ==================================================
-                try:
-                    schedule_charge_completed_line_notification(transaction_id)
-                except Exception as e:
-                    logger.exception(
-                        f"[LINE][CHARGE_COMPLETED][SCHEDULE_CALL_ERR] "
-                        f"tx_id={transaction_id} | err={e}"
-                    )
+                if line_events:
+                    try:
+                        wake_line_outbox(f"stop tx_id={transaction_id} events={line_events}")
+                    except Exception as e:
+                        logger.exception(
+                            f"[LINE][OUTBOX][WAKE_ERR] tx_id={transaction_id} | err={e}"
+                        )
+                else:
+                    # ==================================================
+                    # LINE 階段 7：StopTransaction 完成後自動推播
+                    # 放在 DB commit 後，確保交易、扣款、餘額已完成。
+                    # 注意：此處只排程，不等待 LINE API，避免影響 StopTransaction 回覆。
+                    # ==================================================
+                    try:
+                        schedule_charge_completed_line_notification(transaction_id)
+                    except Exception as e:
+                        logger.exception(
+                            f"[LINE][CHARGE_COMPLETED][SCHEDULE_CALL_ERR] "
+                            f"tx_id={transaction_id} | err={e}"
+                        )
 
-                # ==================================================
-                # LINE 階段 1：交易完成後低餘額提醒
-                # 規則：
-                # - 每一筆交易完成後都重新判斷一次
-                # - 不使用永久 already_warned_low_balance 旗標
-                # - LINE 發送失敗不得影響 StopTransaction 回覆
-                # ==================================================
-                try:
-                    balance_after_for_low_balance = locals().get("balance_after")
+                    # ==================================================
+                    # LINE 階段 1：交易完成後低餘額提醒
+                    # 規則：
+                    # - 每一筆交易完成後都重新判斷一次
+                    # - 不使用永久 already_warned_low_balance 旗標
+                    # - LINE 發送失敗不得影響 StopTransaction 回覆
+                    # ==================================================
+                    try:
+                        balance_after_for_low_balance = locals().get("balance_after")
+
+                        if (
+                            balance_after_for_low_balance is not None
+                            and float(balance_after_for_low_balance) < float(LOW_BALANCE_LINE_THRESHOLD)
+                        ):
+                            schedule_low_balance_line_notification(transaction_id)
+                            logger.warning(
+                                f"[LINE][LOW_BALANCE][TRIGGERED] "
+                                f"tx_id={transaction_id} | "
+                                f"balance_after={balance_after_for_low_balance} | "
+                                f"threshold={LOW_BALANCE_LINE_THRESHOLD}"
+                            )
+                        else:
+                            logger.warning(
+                                f"[LINE][LOW_BALANCE][SKIP_TRIGGER] "
+                                f"tx_id={transaction_id} | "
+                                f"balance_after={balance_after_for_low_balance} | "
+                                f"threshold={LOW_BALANCE_LINE_THRESHOLD}"
+                            )
 
-                    if (
-                        balance_after_for_low_balance is not None
-                        and float(balance_after_for_low_balance) < float(LOW_BALANCE_LINE_THRESHOLD)
-                    ):
-                        schedule_low_balance_line_notification(transaction_id)
-                        logger.warning(
-                            f"[LINE][LOW_BALANCE][TRIGGERED] "
-                            f"tx_id={transaction_id} | "
-                            f"balance_after={balance_after_for_low_balance} | "
-                            f"threshold={LOW_BALANCE_LINE_THRESHOLD}"
-                        )
-                    else:
-                        logger.warning(
-                            f"[LINE][LOW_BALANCE][SKIP_TRIGGER] "
-                            f"tx_id={transaction_id} | "
-                            f"balance_after={balance_after_for_low_balance} | "
-                            f"threshold={LOW_BALANCE_LINE_THRESHOLD}"
+                    except Exception as e:
+                        logger.exception(
+                            f"[LINE][LOW_BALANCE][SCHEDULE_CALL_ERR] "
+                            f"tx_id={transaction_id} | err={e}"
                         )
 
-                except Exception as e:
-                    logger.exception(
-                        f"[LINE][LOW_BALANCE][SCHEDULE_CALL_ERR] "
-                        f"tx_id={transaction_id} | err={e}"
-                    )
+                    # ==================================================
+                    # LINE 第三階段：餘額不足自動停充後推播
+                    # 規則：
+                    # - 第二階段已在 auto_stop_reason 標記 balance_insufficient
+                    # - StopTransaction 完成、扣款與 DB commit 後才判斷
+                    # - LINE 發送失敗不得影響 StopTransaction 回覆
+                    # ==================================================
+                    try:
+                        auto_stop_reason_for_line = None
 
-                # ==================================================
-                # LINE 第三階段：餘額不足自動停充後推播
-                # 規則：
-                # - 第二階段已在 auto_stop_reason 標記 balance_insufficient
-                # - StopTransaction 完成、扣款與 DB commit 後才判斷
-                # - LINE 發送失敗不得影響 StopTransaction 回覆
-                # ==================================================
-                try:
-                    auto_stop_reason_for_line = None
+                        with sqlite3.connect(DB_FILE, check_same_thread=False, timeout=15) as _line_conn:
+                            _line_cur = _line_conn.cursor()
+                            _line_cur.execute(
+                                """
+                                SELECT auto_stop_reason
+                                FROM transactions
+                                WHERE transaction_id = ?
+                                """,
+                                (transaction_id,),
+                            )
+                            _line_row = _line_cur.fetchone()
 
-                    with sqlite3.connect(DB_FILE, check_same_thread=False, timeout=15) as _line_conn:
-                        _line_cur = _line_conn.cursor()
-                        _line_cur.execute(
-                            """
-                            SELECT auto_stop_reason
-                            FROM transactions
-                            WHERE transaction_id = ?
-                            """,
-                            (transaction_id,),
-                        )
-                        _line_row = _line_cur.fetchone()
+                        if _line_row:
+                            auto_stop_reason_for_line = _line_row[0]
 
-                    if _line_row:
-                        auto_stop_reason_for_line = _line_row[0]
+                        if auto_stop_reason_for_line == AUTO_STOP_REASON_BALANCE_INSUFFICIENT:
+                            schedule_auto_stop_balance_insufficient_line_notification(transaction_id)
+                            logger.warning(
+                                f"[LINE][AUTO_STOP_BALANCE][TRIGGERED] "
+                                f"tx_id={transaction_id} | "
+                                f"auto_stop_reason={auto_stop_reason_for_line}"
+                            )
+                        else:
+                            logger.warning(
+                                f"[LINE][AUTO_STOP_BALANCE][SKIP_TRIGGER] "
+                                f"tx_id={transaction_id} | "
+                                f"auto_stop_reason={auto_stop_reason_for_line}"
+                            )
 
-                    if auto_stop_reason_for_line == AUTO_STOP_REASON_BALANCE_INSUFFICIENT:
-                        schedule_auto_stop_balance_insufficient_line_notification(transaction_id)
-                        logger.warning(
-                            f"[LINE][AUTO_STOP_BALANCE][TRIGGERED] "
-                            f"tx_id={transaction_id} | "
-                            f"auto_stop_reason={auto_stop_reason_for_line}"
-                        )
-                    else:
-                        logger.warning(
-                            f"[LINE][AUTO_STOP_BALANCE][SKIP_TRIGGER] "
-                            f"tx_id={transaction_id} | "
-                            f"auto_stop_reason={auto_stop_reason_for_line}"
+                    except Exception as e:
+                        logger.exception(
+                            f"[LINE][AUTO_STOP_BALANCE][SCHEDULE_CALL_ERR] "
+                            f"tx_id={transaction_id} | err={e}"
                         )
-
-                except Exception as e:
-                    logger.exception(
-                        f"[LINE][AUTO_STOP_BALANCE][SCHEDULE_CALL_ERR] "
-                        f"tx_id={transaction_id} | err={e}"
-                    )
         except Exception as e:
             logger.exception(f"🔴 StopTransaction DB/計算發生錯誤：{e}")
 
@@ -5568,6 +5595,13 @@ class ChargePoint(OcppChargePoint):
                                     live_patch["summaryEstimatedAmount"] = batch_estimated_amount
 
                                 _upsert_live(cp_id, **live_patch)
+                                # 進行中交易的明細頁曲線（記憶體內降採樣）
+                                live_transaction_timelines.add(
+                                    transaction_id,
+                                    ts,
+                                    kwh=batch_energy_kwh,
+                                    kw=batch_power_kw,
+                                )
 
                                 auto_stop_candidates[int(transaction_id)] = float(total)
                             except Exception as e:
@@ -5889,6 +5923,7 @@ async def update_card_whitelist(card_id: str, data: dict = Body(...)):
             )
 
         conn.commit()
+    auth_cache.invalidate_card(card_id)
 
     return {"message": "Whitelist updated", "allowed": allowed}
 
@@ -7144,22 +7179,13 @@ from fastapi import Query
 @app.get("/api/daily-pricing")
 def get_daily_pricing(date: str = Query(..., description="查詢的日期 YYYY-MM-DD")):
     """
-    查詢某一天的電價設定
+    查詢某一天的電價設定（逐日覆寫優先，其次為萬年曆編譯結果）
     """
     with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT start_time, end_time, price, label
-            FROM daily_pricing_rules
-            WHERE date = ?
-            ORDER BY start_time
-        """,
-            (date,),
-        )
-        rows = cur.fetchall()
+        rows = tariff_engine.resolve(conn, [date])[date]
     return [
-        {"startTime": r[0], "endTime": r[1], "price": r[2], "label": r[3]} for r in rows
+        {"startTime": r[0], "endTime": r[1], "price": r[2], "label": r[3]}
+        for r in sorted(rows, key=lambda r: r[0])
     ]
 
 
@@ -7179,6 +7205,8 @@ def add_daily_pricing(data: dict = Body(...)):
 
     with get_conn() as conn:
         cur = conn.cursor()
+        # 萬年曆編譯的日期先展開成覆寫列，新增的時段才不會取代整天
+        tariff_engine.materialize(conn, date)
         cur.execute(
             """
             INSERT INTO daily_pricing_rules (date, start_time, end_time, price, label)
@@ -7187,18 +7215,20 @@ def add_daily_pricing(data: dict = Body(...)):
             (date, start_time, end_time, price, label),
         )
         conn.commit()
+    tariff_rules_cache.invalidate()
     return {"message": "✅ 新增成功"}
 
 
 @app.delete("/api/daily-pricing")
 def delete_daily_pricing(date: str = Query(..., description="要刪除的日期 YYYY-MM-DD")):
     """
-    刪除某一天的所有電價規則
+    刪除某一天的所有電價規則（逐日覆寫）；該年已建立萬年曆時回到萬年曆電價
     """
     with get_conn() as conn:
         cur = conn.cursor()
         cur.execute("DELETE FROM daily_pricing_rules WHERE date=?", (date,))
         conn.commit()
+    tariff_rules_cache.invalidate()
     return {"message": f"✅ 已刪除 {date} 的所有規則"}
 
 
@@ -7439,12 +7469,7 @@ def _taipower_season_for_date(target_date) -> str:
     - 6/1 ～ 9/30：summer (夏月)
     - 其他日期：non_summer (非夏月)
     """
-    month_day = (target_date.month, target_date.day)
-
-    if (6, 1) <= month_day <= (9, 30):
-        return "summer"
-
-    return "non_summer"
+    return pricing_calendar.season_for_date(target_date)
 
 
 def _load_default_pricing_rules_for_import():
@@ -7547,8 +7572,7 @@ def _load_holiday_calendar_for_year(year: int) -> dict:
         return {}
 
     try:
-        with open(holiday_file, "r", encoding="utf-8") as f:
-            raw = json.load(f)
+        raw = pricing_calendar.read_json_cached(holiday_file)
     except Exception as e:
         raise HTTPException(
             status_code=400,
@@ -7605,8 +7629,7 @@ def _load_special_days_for_apply(year: int):
         return [], f"holidays/{year}.json"
 
     try:
-        with open(holiday_file, "r", encoding="utf-8") as f:
-            raw = json.load(f)
+        raw = pricing_calendar.read_json_cached(holiday_file)
     except Exception as e:
         raise HTTPException(
             status_code=400,
@@ -7682,22 +7705,7 @@ def _pricing_day_type_for_date(target_date, holiday_map: dict) -> str:
     4. 星期六 → saturday
     5. 其他 → weekday
     """
-    date_str = target_date.strftime("%Y-%m-%d")
-    override = holiday_map.get(date_str)
-
-    if override == "workday":
-        return "weekday"
-
-    if override == "holiday":
-        return "holiday"
-
-    # Python weekday(): Monday=0, Sunday=6
-    wd = target_date.weekday()
-    if wd == 6:
-        return "sunday"
-    if wd == 5:
-        return "saturday"
-    return "weekday"
+    return pricing_calendar.day_type_for_date(target_date, holiday_map)
 
 
 @app.post("/api/daily-pricing/import-calendar")
@@ -7713,8 +7721,11 @@ def import_daily_pricing_calendar(data: dict = Body(...)):
     }
 
     mode:
-    - fill_missing：只補沒有資料的日期（預設，較安全）
-    - overwrite：覆蓋指定年份範圍內既有每日電價
+    - fill_missing：只補尚未建立萬年曆的年份；既有逐日覆寫保留（預設，較安全）
+    - overwrite：以目前模板重建指定年份萬年曆，並清除範圍內逐日覆寫
+
+    每年只存模板快照與例假日（tariff_calendars / tariff_holidays），
+    逐日規則由 tariff_engine 編譯；daysCreated 為實際電價有變動的天數。
     """
     try:
         start_year = int(data.get("startYear"))
@@ -7746,9 +7757,38 @@ def import_daily_pricing_calendar(data: dict = Body(...)):
     start_date = datetime(start_year, 1, 1).date()
     end_date = datetime(end_year, 12, 31).date()
 
-    rows_to_insert = []
-    days_created = 0
-    days_skipped = 0
+    targets = pricing_calendar.target_rules(templates, holiday_maps, start_date, end_date)
+    first_str = start_date.strftime("%Y-%m-%d")
+    last_str = end_date.strftime("%Y-%m-%d")
+
+    # 每年只存一筆模板快照 + 例假日；逐日規則由 tariff_engine 編譯，不再逐日寫入 daily_pricing_rules
+    with get_conn() as conn:
+        before = tariff_engine.effective_rules(conn, targets)
+        calendar_years = tariff_engine.register_calendars(
+            conn,
+            range(start_year, end_year + 1),
+            tariff_engine.make_definition(templates),
+            holiday_maps,
+            replace=(mode == "overwrite"),
+        )
+        # overwrite：清掉範圍內所有逐日覆寫（等同舊版整段重建）；
+        # fill_missing：只清掉與萬年曆編譯結果相同的覆寫（舊版逐日展開的資料）
+        compaction = tariff_engine.plan_compaction(
+            conn, first_str, last_str, drop_all=(mode == "overwrite")
+        )
+        report = pricing_calendar.apply_changes(
+            conn,
+            compaction,
+            batch_days=PRICING_IMPORT_BATCH_DAYS,
+            pause_s=PRICING_IMPORT_PAUSE_SECONDS,
+        )
+        after = tariff_engine.effective_rules(conn, targets)
+        storage = tariff_engine.storage_stats(conn)
+    tariff_rules_cache.invalidate()
+    if report.deleted_rows:
+        database_maintenance.request_vacuum()
+
+    changes = [date_str for date_str in targets if before[date_str] != after[date_str]]
 
     day_type_counts = {
         "weekday": 0,
@@ -7760,91 +7800,22 @@ def import_daily_pricing_calendar(data: dict = Body(...)):
         "summer": 0,
         "non_summer": 0,
     }
+    for date_str in changes:
+        day_type = targets[date_str][0]
+        season = _taipower_season_for_date(datetime.strptime(date_str, "%Y-%m-%d").date())
+        day_type_counts[day_type] = day_type_counts.get(day_type, 0) + 1
+        season_counts[season] = season_counts.get(season, 0) + 1
 
-    with get_conn() as conn:
-        cur = conn.cursor()
-
-        if mode == "overwrite":
-            cur.execute(
-                """
-                DELETE FROM daily_pricing_rules
-                WHERE date BETWEEN ? AND ?
-                """,
-                (start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")),
-            )
-            deleted_rows = cur.rowcount if cur.rowcount is not None else 0
-            existing_dates = set()
-        else:
-            deleted_rows = 0
-            cur.execute(
-                """
-                SELECT DISTINCT date
-                FROM daily_pricing_rules
-                WHERE date BETWEEN ? AND ?
-                """,
-                (start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")),
-            )
-            existing_dates = {r[0] for r in cur.fetchall()}
-
-        current_date = start_date
-        while current_date <= end_date:
-            date_str = current_date.strftime("%Y-%m-%d")
-
-            if mode == "fill_missing" and date_str in existing_dates:
-                days_skipped += 1
-                current_date += timedelta(days=1)
-                continue
-
-            holiday_map = holiday_maps.get(current_date.year, {})
-            day_type = _pricing_day_type_for_date(current_date, holiday_map)
-            season = _taipower_season_for_date(current_date)
-            season_templates = templates.get(season) or {}
-
-            if day_type == "holiday":
-                rules = season_templates["sunday"]
-                insert_label_override = "holiday"
-            elif day_type == "sunday":
-                rules = season_templates["sunday"]
-                insert_label_override = None
-            elif day_type == "saturday":
-                rules = season_templates["saturday"]
-                insert_label_override = None
-            else:
-                rules = season_templates["weekday"]
-                insert_label_override = None
-            for rule in rules:
-                rows_to_insert.append(
-                    (
-                        date_str,
-                        rule.get("startTime"),
-                        rule.get("endTime"),
-                        float(rule.get("price")),
-                        insert_label_override or rule.get("label", ""),
-                    )
-                )
-
-            day_type_counts[day_type] = day_type_counts.get(day_type, 0) + 1
-            season_counts[season] = season_counts.get(season, 0) + 1
-            days_created += 1
-            current_date += timedelta(days=1)
-
-        if rows_to_insert:
-            cur.executemany(
-                """
-                INSERT INTO daily_pricing_rules
-                (date, start_time, end_time, price, label)
-                VALUES (?, ?, ?, ?, ?)
-                """,
-                rows_to_insert,
-            )
-
-        conn.commit()
+    days_created = len(changes)
+    days_skipped = len(targets) - days_created
 
     logging.warning(
         f"[PRICING_IMPORT][DONE] "
         f"start_year={start_year} | end_year={end_year} | mode={mode} | "
         f"days_created={days_created} | days_skipped={days_skipped} | "
-        f"rules_inserted={len(rows_to_insert)} | deleted_rows={deleted_rows} | "
+        f"calendar_years={calendar_years} | deleted_rows={report.deleted_rows} | "
+        f"batches={report.batches} | lock_ms={report.lock_ms:.1f} | "
+        f"tariff_version={report.tariff_version} | override_rows={storage['overrideRows']} | "
         f"day_type_counts={day_type_counts} | season_counts={season_counts}"
     )
 
@@ -7855,10 +7826,13 @@ def import_daily_pricing_calendar(data: dict = Body(...)):
         "mode": mode,
         "daysCreated": days_created,
         "daysSkipped": days_skipped,
-        "rulesInserted": len(rows_to_insert),
-        "deletedRows": deleted_rows,
+        "rulesInserted": report.rules_inserted,
+        "deletedRows": report.deleted_rows,
         "dayTypeCounts": day_type_counts,
         "seasonCounts": season_counts,
+        "calendarYears": calendar_years,
+        "storage": storage,
+        **report.as_dict(),
     }
 
 
@@ -7976,7 +7950,12 @@ def apply_special_days_pricing(data: dict = Body(...)):
     special_date_values = sorted(set(date_str for _, date_str in all_special_dates))
 
     with get_conn() as conn:
-        cur = conn.cursor()
+        # 目前實際生效的規則（逐日覆寫或萬年曆編譯結果）
+        existing = {
+            date_str: rules
+            for date_str, rules in tariff_engine.effective_rules(conn, special_date_values).items()
+            if rules
+        }
 
         # =====================================================
         # 防呆檢查：
@@ -7985,20 +7964,9 @@ def apply_special_days_pricing(data: dict = Body(...)):
         # 這可避免使用者還沒執行萬年曆匯入，就直接套用 Special Days。
         # =====================================================
         if require_existing_calendar:
-            placeholders = ",".join(["?"] * len(special_date_values))
-            cur.execute(
-                f"""
-                SELECT DISTINCT date
-                FROM daily_pricing_rules
-                WHERE date IN ({placeholders})
-                """,
-                special_date_values,
-            )
-            existing_dates = {row[0] for row in cur.fetchall()}
-
             missing_pricing_dates = [
                 date_str for date_str in special_date_values
-                if date_str not in existing_dates
+                if date_str not in existing
             ]
 
             if missing_pricing_dates:
@@ -8016,77 +7984,63 @@ def apply_special_days_pricing(data: dict = Body(...)):
                     },
                 )
 
-        total_applied_day_count = 0
-        total_rules_inserted = 0
-        total_deleted_rows = 0
-        season_counts = {
-            "summer": 0,
-            "non_summer": 0,
+        # 特殊節日一律套用該季節的星期日模板（label=holiday），只寫有變動的日期
+        targets = {
+            date_str: pricing_calendar.template_rules(
+                templates, datetime.strptime(date_str, "%Y-%m-%d").date(), "holiday"
+            )
+            for date_str in special_date_values
         }
+        changes = pricing_calendar.plan_changes(existing, targets, "overwrite")
 
-        # 依年份逐筆套用，方便統計每一年結果
-        for year_result in year_results:
-            year = year_result["year"]
-            year_special_dates = [
-                date_str for item_year, date_str in all_special_dates
-                if item_year == year
-            ]
-
-            if not year_special_dates:
-                continue
-
-            year_applied_day_count = 0
-            year_rules_inserted = 0
-            year_deleted_rows = 0
-
-            for date_str in year_special_dates:
-                cur.execute(
-                    """
-                    DELETE FROM daily_pricing_rules
-                    WHERE date = ?
-                    """,
-                    (date_str,),
-                )
-                deleted_rows = cur.rowcount if cur.rowcount is not None else 0
-                year_deleted_rows += deleted_rows
-
-                target_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-                season = _taipower_season_for_date(target_date)
-                sunday_rules = (templates.get(season) or {}).get("sunday") or []
-
-                rows_to_insert = []
-                for rule in sunday_rules:
-                    rows_to_insert.append(
-                        (
-                            date_str,
-                            rule.get("startTime"),
-                            rule.get("endTime"),
-                            float(rule.get("price")),
-                            "holiday",
-                        )
-                    )
-                cur.executemany(
-                    """
-                    INSERT INTO daily_pricing_rules
-                    (date, start_time, end_time, price, label)
-                    VALUES (?, ?, ?, ?, ?)
-                    """,
-                    rows_to_insert,
-                )
+        # 先標記為例假日；萬年曆編譯結果已等於目標的日期不需要逐日覆寫列
+        tariff_engine.set_holidays(conn, special_date_values, "holiday")
+        conn.commit()
+        base = tariff_engine.base_schedules(conn, special_date_values)
+        stored = pricing_calendar.load_existing(conn, special_date_values)
+        override_changes = {}
+        for date_str, rules in targets.items():
+            wanted = () if date_str in base and base[date_str][1] == rules else rules
+            if stored.get(date_str, ()) != wanted:
+                override_changes[date_str] = wanted
+        report = pricing_calendar.apply_changes(
+            conn,
+            override_changes,
+            batch_days=PRICING_IMPORT_BATCH_DAYS,
+            pause_s=PRICING_IMPORT_PAUSE_SECONDS,
+        )
+    tariff_rules_cache.invalidate()
+
+    total_applied_day_count = 0
+    total_rules_inserted = 0
+    total_deleted_rows = 0
+    season_counts = {
+        "summer": 0,
+        "non_summer": 0,
+    }
 
-                season_counts[season] = season_counts.get(season, 0) + 1
-                year_applied_day_count += 1
-                year_rules_inserted += len(rows_to_insert)
+    # 依年份統計結果
+    for year_result in year_results:
+        year = year_result["year"]
+        year_changed = [
+            date_str for item_year, date_str in all_special_dates
+            if item_year == year and date_str in changes
+        ]
+        year_rules_inserted = sum(len(changes[date_str]) for date_str in year_changed)
+        year_deleted_rows = sum(len(existing.get(date_str, ())) for date_str in year_changed)
 
-            year_result["appliedDayCount"] = year_applied_day_count
-            year_result["rulesInserted"] = year_rules_inserted
-            year_result["deletedRows"] = year_deleted_rows
+        for date_str in year_changed:
+            season = _taipower_season_for_date(datetime.strptime(date_str, "%Y-%m-%d").date())
+            season_counts[season] = season_counts.get(season, 0) + 1
 
-            total_applied_day_count += year_applied_day_count
-            total_rules_inserted += year_rules_inserted
-            total_deleted_rows += year_deleted_rows
+        year_result["appliedDayCount"] = len(year_changed)
+        year_result["unchangedDayCount"] = year_result["specialDayCount"] - len(year_changed)
+        year_result["rulesInserted"] = year_rules_inserted
+        year_result["deletedRows"] = year_deleted_rows
 
-        conn.commit()
+        total_applied_day_count += len(year_changed)
+        total_rules_inserted += year_rules_inserted
+        total_deleted_rows += year_deleted_rows
 
     logging.warning(
         f"[SPECIAL_DAYS][APPLY_DONE] "
@@ -8112,6 +8066,7 @@ def apply_special_days_pricing(data: dict = Body(...)):
         "seasonCounts": season_counts,
         "missingYears": missing_years,
         "years": year_results,
+        **report.as_dict(),
     }
 
 
@@ -8158,6 +8113,7 @@ async def delete_card(id_tag: str):
             cur.execute("DELETE FROM id_tags WHERE id_tag = ?", (id_tag,))
 
             conn.commit()
+        auth_cache.invalidate_card(id_tag)
 
         return {"message": f"Card {id_tag} deleted"}
 
@@ -8356,15 +8312,12 @@ async def delete_pricing_rule(rule: dict = Body(...)):
         raise HTTPException(status_code=400, detail=str(e))
 
 
-conn.commit()
-
-
 @app.get("/api/payments")
 async def list_payments():
-    cursor.execute(
-        "SELECT transaction_id, base_fee, energy_fee, overuse_fee, total_amount FROM payments ORDER BY transaction_id DESC"
-    )
-    rows = cursor.fetchall()
+    with get_report_conn() as _c:
+        rows = _c.execute(
+            "SELECT transaction_id, base_fee, energy_fee, overuse_fee, total_amount FROM payments ORDER BY transaction_id DESC"
+        ).fetchall()
     return [
         {
             "transactionId": r[0],
@@ -8460,6 +8413,7 @@ async def get_transactions(
             t.floor_no,
             t.parking_space_no
         FROM transactions t
+        -- 比對運算式須與 idx_users_*_key / idx_card_owners_card_key 一致才會走索引
         LEFT JOIN users u
             ON UPPER(TRIM(u.id_tag)) = UPPER(TRIM(t.id_tag))
             OR UPPER(TRIM(u.card_number)) = UPPER(TRIM(t.id_tag))
@@ -8502,7 +8456,7 @@ async def get_transactions(
             t.transaction_id DESC
     """
 
-    with get_conn() as conn:
+    with get_report_conn() as conn:
         cur = conn.cursor()
         cur.execute(query, params)
         rows = cur.fetchall()
@@ -8728,16 +8682,7 @@ def compute_transaction_cost(transaction_id: int):
         breakdown_total = float(breakdown.get("total") or 0.0)
         segments = breakdown.get("segments") or []
 
-        details = [
-            {
-                "from": seg.get("start"),
-                "to": seg.get("end"),
-                "kWh": round(float(seg.get("kwh") or 0.0), 6),
-                "price": float(seg.get("price") or 0.0),
-                "cost": round(float(seg.get("subtotal") or 0.0), 2),
-            }
-            for seg in segments
-        ]
+        details = settlement_snapshot.billing_details(segments)
 
         final_cost = round(
             float(payment_total if payment_total is not None else breakdown_total), 2
@@ -9035,22 +8980,27 @@ def _build_line_price_summary_lines(
 
 
 
-def build_charge_completed_line_message(transaction_id: int) -> dict:
+def persist_transaction_settlement_snapshot(
+    cur,
+    transaction_id,
+    *,
+    cost,
+    unit_price,
+    energy_kwh,
+    segments=None,
+) -> dict | None:
     """
-    階段 6：建立充電完成 LINE 通知訊息。
+    在 StopTransaction 結算的同一個 transaction 內寫入結算快照。
 
-    注意：
-    - 只產生 message，不發送 LINE
-    - 沿用 compute_transaction_cost(transaction_id)，避免費用邏輯分岔
-    - 欄位缺失時用 fallback，避免 preview API 直接崩潰
+    segments=None 代表本次以單一電價扣款（多時段計算失敗或為 0），
+    快照記錄單一分段，確保 LINE 電價摘要加總等於實際扣款金額。
     """
-    try:
-        tx_id_param = int(transaction_id)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid transaction_id")
+    tx_id = int(transaction_id)
 
-    with get_conn() as conn:
-        cur = conn.cursor()
+    # SAVEPOINT：快照寫入失敗只影響 LINE 訊息來源（會退回即時查詢），
+    # 不得讓扣款 rollback
+    cur.execute("SAVEPOINT settlement_snapshot")
+    try:
         cur.execute(
             """
             SELECT
@@ -9058,29 +9008,205 @@ def build_charge_completed_line_message(transaction_id: int) -> dict:
                 t.charge_point_id,
                 t.connector_id,
                 t.id_tag,
+                u.card_number,
+                t.account_id,
+                t.floor_no,
+                t.parking_space_no,
                 t.meter_start,
-                t.start_timestamp,
                 t.meter_stop,
+                t.start_timestamp,
                 t.stop_timestamp,
                 t.reason,
                 t.balance_before,
                 t.balance_after,
-                u.card_number,
-                ha.balance AS current_account_balance,
-                t.floor_no,
-                t.parking_space_no
+                t.surplus_amount,
+                t.auto_stop_reason,
+                t.auto_stop_triggered_at,
+                t.auto_stop_balance,
+                t.auto_stop_estimated_amount
             FROM transactions t
-            LEFT JOIN card_owners co
-                ON co.card_id = t.id_tag
             LEFT JOIN users u
                 ON u.id_tag = t.id_tag
-            LEFT JOIN household_accounts ha
-                ON ha.account_id = t.account_id
             WHERE t.transaction_id = ?
             """,
-            (tx_id_param,),
+            (tx_id,),
         )
         row = cur.fetchone()
+        if not row:
+            cur.execute("RELEASE SAVEPOINT settlement_snapshot")
+            return None
+
+        snapshot = dict(zip([col[0] for col in cur.description], row))
+
+        if segments is None:
+            segments = []
+            if energy_kwh and float(energy_kwh) > 0:
+                segments = [
+                    {
+                        "start": snapshot["start_timestamp"],
+                        "end": snapshot["stop_timestamp"],
+                        "kwh": energy_kwh,
+                        "price": unit_price,
+                        "subtotal": cost,
+                    }
+                ]
+
+        snapshot.update(
+            {
+                "energy_kwh": round(float(energy_kwh or 0.0), 6),
+                "unit_price": float(unit_price or 0.0),
+                "cost": round(float(cost or 0.0), 2),
+                "cost_details": settlement_snapshot.billing_details(segments),
+                "duration_text": _build_line_duration_text(
+                    snapshot["start_timestamp"], snapshot["stop_timestamp"]
+                ),
+            }
+        )
+        settlement_snapshot.save(cur, tx_id, snapshot)
+    except Exception as e:
+        cur.execute("ROLLBACK TO SAVEPOINT settlement_snapshot")
+        cur.execute("RELEASE SAVEPOINT settlement_snapshot")
+        logger.exception(f"[STOP][SNAPSHOT_ERR] tx_id={tx_id} | err={e}")
+        return None
+    cur.execute("RELEASE SAVEPOINT settlement_snapshot")
+
+    return snapshot
+
+
+# 尚未完成的曲線寫入（保留參照避免 task 被回收；測試可 await）
+transaction_timeline_tasks: set = set()
+
+
+def persist_transaction_timeline(transaction_id, meter_start, series=None) -> bool:
+    """
+    結算 commit 之後寫入降採樣曲線（worker thread，自己的連線）。
+    優先使用 MeterValues 期間已累積的即時曲線；沒有時（重啟後未收到新
+    MeterValues 等）才掃描 meter_values。失敗只影響明細頁曲線（第一次查詢時補建）。
+    """
+    try:
+        with get_conn() as conn:
+            if series is None or not series.samples:
+                series = transaction_detail.read_timeline(
+                    conn,
+                    transaction_id,
+                    meter_start,
+                    max_points=TRANSACTION_TIMELINE_MAX_POINTS,
+                    min_bucket_s=TRANSACTION_TIMELINE_MIN_BUCKET_SECONDS,
+                )
+            saved = transaction_detail.save_timeline(conn, transaction_id, series)
+            conn.commit()
+    except Exception as e:
+        logger.warning(f"[STOP][TIMELINE_ERR] tx_id={transaction_id} | err={e}")
+        return False
+    if saved:
+        transaction_detail_cache.invalidate(transaction_id)
+    return saved
+
+
+def schedule_transaction_timeline(transaction_id, meter_start, series=None) -> None:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        persist_transaction_timeline(transaction_id, meter_start, series)
+        return
+    task = asyncio.create_task(
+        asyncio.to_thread(persist_transaction_timeline, transaction_id, meter_start, series)
+    )
+    transaction_timeline_tasks.add(task)
+    task.add_done_callback(transaction_timeline_tasks.discard)
+
+
+def load_transaction_settlement_snapshot(transaction_id: int) -> dict | None:
+    """
+    讀取結算快照；舊交易（快照功能上線前結算）回傳 None，
+    呼叫端改用即時查詢 fallback。
+    """
+    try:
+        with get_conn() as conn:
+            return settlement_snapshot.load(conn, transaction_id)
+    except Exception as e:
+        logging.warning(
+            f"[LINE][SNAPSHOT][LOAD_ERR] transaction_id={transaction_id} | err={e}"
+        )
+        return None
+
+
+def _settlement_snapshot_row(snapshot: dict, keys) -> tuple:
+    """依 SELECT 欄位順序把快照轉成與即時查詢相同的 row tuple。"""
+    return tuple(snapshot.get(key) for key in keys)
+
+
+def build_charge_completed_line_message(transaction_id: int) -> dict:
+    """
+    階段 6：建立充電完成 LINE 通知訊息。
+
+    注意：
+    - 只產生 message，不發送 LINE
+    - 優先使用 StopTransaction 寫入的結算快照（與扣款金額一致）；
+      快照不存在時才沿用 compute_transaction_cost(transaction_id)
+    - 欄位缺失時用 fallback，避免 preview API 直接崩潰
+    """
+    try:
+        tx_id_param = int(transaction_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid transaction_id")
+
+    snapshot = load_transaction_settlement_snapshot(tx_id_param)
+
+    if snapshot is not None:
+        row = _settlement_snapshot_row(
+            snapshot,
+            (
+                "transaction_id",
+                "charge_point_id",
+                "connector_id",
+                "id_tag",
+                "meter_start",
+                "start_timestamp",
+                "meter_stop",
+                "stop_timestamp",
+                "reason",
+                "balance_before",
+                "balance_after",
+                "card_number",
+                "balance_after",
+                "floor_no",
+                "parking_space_no",
+            ),
+        )
+    else:
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT
+                    t.transaction_id,
+                    t.charge_point_id,
+                    t.connector_id,
+                    t.id_tag,
+                    t.meter_start,
+                    t.start_timestamp,
+                    t.meter_stop,
+                    t.stop_timestamp,
+                    t.reason,
+                    t.balance_before,
+                    t.balance_after,
+                    u.card_number,
+                    ha.balance AS current_account_balance,
+                    t.floor_no,
+                    t.parking_space_no
+                FROM transactions t
+                LEFT JOIN card_owners co
+                    ON co.card_id = t.id_tag
+                LEFT JOIN users u
+                    ON u.id_tag = t.id_tag
+                LEFT JOIN household_accounts ha
+                    ON ha.account_id = t.account_id
+                WHERE t.transaction_id = ?
+                """,
+                (tx_id_param,),
+            )
+            row = cur.fetchone()
 
     if not row:
         raise HTTPException(status_code=404, detail="Transaction not found")
@@ -9119,15 +9245,22 @@ def build_charge_completed_line_message(transaction_id: int) -> dict:
     cost_info = {}
     cost_error = None
 
-    try:
-        cost_info = compute_transaction_cost(tx_id)
-    except HTTPException as e:
-        cost_error = str(e.detail)
-    except Exception as e:
-        cost_error = str(e)
-        logging.exception(
-            f"[LINE][CHARGE_COMPLETED_MESSAGE][COST_ERR] transaction_id={tx_id} | err={e}"
-        )
+    if snapshot is not None:
+        cost_info = {
+            "cost": snapshot.get("cost"),
+            "details": snapshot.get("cost_details") or [],
+            "balanceAfter": snapshot.get("balance_after"),
+        }
+    else:
+        try:
+            cost_info = compute_transaction_cost(tx_id)
+        except HTTPException as e:
+            cost_error = str(e.detail)
+        except Exception as e:
+            cost_error = str(e)
+            logging.exception(
+                f"[LINE][CHARGE_COMPLETED_MESSAGE][COST_ERR] transaction_id={tx_id} | err={e}"
+            )
 
     cost_value = cost_info.get("cost") if isinstance(cost_info, dict) else None
     details = cost_info.get("details", []) if isinstance(cost_info, dict) else []
@@ -9144,12 +9277,10 @@ def build_charge_completed_line_message(transaction_id: int) -> dict:
     if balance_after_value is None:
         balance_after_value = current_account_balance
 
-    duration_text = _build_line_duration_text(start_timestamp, stop_timestamp)
-
-    message_lines = ["充電完成通知"]
-
-    if not is_completed:
-        message_lines.append("提醒：此交易目前尚未有結束時間，以下為預覽內容。")
+    if snapshot is not None and snapshot.get("duration_text"):
+        duration_text = snapshot["duration_text"]
+    else:
+        duration_text = _build_line_duration_text(start_timestamp, stop_timestamp)
 
     message_lines = ["充電完成通知"]
 
@@ -9223,6 +9354,7 @@ def build_charge_completed_line_message(transaction_id: int) -> dict:
             "reason": reason,
             "costDetails": details,
             "costError": cost_error,
+            "source": "settlement_snapshot" if snapshot is not None else "transaction",
         },
     }
 
@@ -9381,6 +9513,7 @@ def insert_line_message_log(
     reason: str | None = None,
     message: str | None = None,
     line_result: dict | None = None,
+    conn=None,
 ) -> dict:
     """
     新增 LINE 推播紀錄。
@@ -9388,6 +9521,7 @@ def insert_line_message_log(
     注意：
     - 此函式失敗時不可影響主流程
     - 只記錄結果，不改變交易、扣款、餘額、SmartCharging
+    - 傳入 conn 時寫在呼叫端的 transaction 內，由呼叫端 commit
     """
 
     try:
@@ -9411,7 +9545,10 @@ def insert_line_message_log(
         elif line_result is not None:
             line_response = str(line_result)
 
-        with get_conn() as conn:
+        own_conn = conn is None
+        if own_conn:
+            conn = get_conn()
+        with conn if own_conn else nullcontext():
             cur = conn.cursor()
             cur.execute(
                 """
@@ -9443,7 +9580,8 @@ def insert_line_message_log(
                 ),
             )
             log_id = cur.lastrowid
-            conn.commit()
+            if own_conn:
+                conn.commit()
 
         logging.warning(
             f"[LINE][MESSAGE_LOG][INSERTED] "
@@ -9517,17 +9655,15 @@ def complete_line_notification_claim(
         )
 
 
-def claim_line_recipient_notification(
-    event_type: str,
-    transaction_id: int,
-    line_user_id: str,
-    source_card_id: str | None = None,
+def _claim_line_recipient(
+    conn,
+    params: tuple,
+    reclaim_failed: bool = False,
+    stale_sending_before: str | None = None,
 ) -> bool:
-    """Claim one event for one LINE recipient using persistent SQLite state."""
-    claimed_at = datetime.now(timezone.utc).isoformat()
-    try:
-        with get_conn() as conn:
-            conn.execute("BEGIN IMMEDIATE")
+    """Insert (or re-open) one recipient claim on the caller's transaction."""
+    if not reclaim_failed and not stale_sending_before:
+        try:
             conn.execute(
                 """
                 INSERT INTO line_recipient_notification_claims(
@@ -9535,18 +9671,81 @@ def claim_line_recipient_notification(
                     status, claimed_at
                 ) VALUES (?, ?, ?, ?, 'sending', ?)
                 """,
-                (
-                    event_type,
-                    int(transaction_id),
-                    str(line_user_id).strip(),
-                    str(source_card_id or "").strip() or None,
-                    claimed_at,
-                ),
+                params,
             )
-            conn.commit()
+        except sqlite3.IntegrityError:
+            return False
         return True
-    except sqlite3.IntegrityError:
-        return False
+
+    cur = conn.execute(
+        """
+        INSERT INTO line_recipient_notification_claims(
+            event_type, transaction_id, line_user_id, source_card_id,
+            status, claimed_at
+        ) VALUES (?, ?, ?, ?, 'sending', ?)
+        ON CONFLICT(event_type, transaction_id, line_user_id) DO UPDATE SET
+            status='sending',
+            claimed_at=excluded.claimed_at,
+            completed_at=NULL,
+            error=NULL
+        WHERE (? AND status='failed')
+           OR (status='sending' AND claimed_at < ?)
+        """,
+        params + (1 if reclaim_failed else 0, stale_sending_before or ""),
+    )
+    return cur.rowcount == 1
+
+
+def claim_line_recipient_notification(
+    event_type: str,
+    transaction_id: int,
+    line_user_id: str,
+    source_card_id: str | None = None,
+    reclaim_failed: bool = False,
+    stale_sending_before: str | None = None,
+) -> bool:
+    """
+    Claim one event for one LINE recipient using persistent SQLite state.
+
+    An existing claim is only re-opened when the outbox asks for it: a
+    ``failed`` claim on retry, or a ``sending`` claim older than the lease
+    (the worker that held it crashed before recording the result).
+    """
+    claimed = claim_line_recipient_notifications(
+        event_type,
+        transaction_id,
+        [(line_user_id, source_card_id)],
+        reclaim_failed=reclaim_failed,
+        stale_sending_before=stale_sending_before,
+    )
+    return str(line_user_id).strip() in claimed
+
+
+def claim_line_recipient_notifications(
+    event_type: str,
+    transaction_id: int,
+    recipients: list[tuple[str, str | None]],
+    reclaim_failed: bool = False,
+    stale_sending_before: str | None = None,
+) -> set[str]:
+    """Claim several ``(line_user_id, source_card_id)`` recipients in one transaction."""
+    claimed_at = datetime.now(timezone.utc).isoformat()
+    claimed = set()
+    with get_conn() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for line_user_id, source_card_id in recipients:
+            user_id = str(line_user_id).strip()
+            params = (
+                event_type,
+                int(transaction_id),
+                user_id,
+                str(source_card_id or "").strip() or None,
+                claimed_at,
+            )
+            if _claim_line_recipient(conn, params, reclaim_failed, stale_sending_before):
+                claimed.add(user_id)
+        conn.commit()
+    return claimed
 
 
 def complete_line_recipient_notification_claim(
@@ -9555,11 +9754,15 @@ def complete_line_recipient_notification_claim(
     line_user_id: str | None,
     status: str | None,
     error: str | None = None,
+    conn=None,
 ) -> None:
     if transaction_id is None or not str(line_user_id or "").strip():
         return
+    own_conn = conn is None
     try:
-        with get_conn() as conn:
+        if own_conn:
+            conn = get_conn()
+        with conn if own_conn else nullcontext():
             conn.execute(
                 """
                 UPDATE line_recipient_notification_claims
@@ -9575,15 +9778,169 @@ def complete_line_recipient_notification_claim(
                     str(line_user_id).strip(),
                 ),
             )
-            conn.commit()
-    except Exception:
-        logging.exception(
-            "[LINE][RECIPIENT_CLAIM][COMPLETE_ERR] "
-            "event_type=%s tx_id=%s line_user_id=%s",
-            event_type,
-            transaction_id,
-            line_user_id,
+            if own_conn:
+                conn.commit()
+    except Exception:
+        logging.exception(
+            "[LINE][RECIPIENT_CLAIM][COMPLETE_ERR] "
+            "event_type=%s tx_id=%s line_user_id=%s",
+            event_type,
+            transaction_id,
+            line_user_id,
+        )
+
+
+def _duplicate_line_recipient_result(transaction_id, id_tag, recipient) -> dict:
+    return {
+        "ok": True,
+        "status": "skipped",
+        "reason": "duplicate_notification",
+        "transactionId": transaction_id,
+        "idTag": id_tag,
+        "lineUserId": recipient["line_user_id"],
+        "sourceCardIds": recipient["source_card_ids"],
+    }
+
+
+def _line_recipient_result(transaction_id, id_tag, recipient, line_result: dict) -> dict:
+    sent = bool(line_result.get("ok"))
+    return {
+        "ok": sent,
+        "status": "sent" if sent else "failed",
+        "reason": "ok" if sent else "line_api_failed",
+        "transactionId": transaction_id,
+        "idTag": id_tag,
+        "lineUserId": recipient["line_user_id"],
+        "sourceCardIds": recipient["source_card_ids"],
+        "lineResult": line_result,
+    }
+
+
+def _push_line_recipient(
+    event_type, transaction_id, id_tag, message, finalize_result, recipient
+) -> dict:
+    """Single push for one already-claimed recipient, then log + close the claim."""
+    line_user_id = recipient["line_user_id"]
+    try:
+        line_result = send_line_message(
+            line_user_id=line_user_id,
+            message=message,
+            retry_key=line_outbox.retry_key(event_type, transaction_id, [line_user_id]),
+        )
+    except Exception as exc:
+        line_result = {"ok": False, "error": str(exc)}
+
+    return finalize_result(
+        _line_recipient_result(transaction_id, id_tag, recipient, line_result),
+        message=message,
+        line_user_id=line_user_id,
+    )
+
+
+def _send_household_line_multicast(
+    *,
+    event_type: str,
+    transaction_id: int,
+    id_tag: str,
+    message: str,
+    finalize_result,
+    recipients: list[dict],
+    delivery: LineDeliveryOptions | None,
+) -> list[dict]:
+    """
+    LINE_DELIVERY_MODE=multicast：同一事件的相同訊息合併成一次 multicast。
+
+    - 所有收件者的 claim 在同一個 transaction 內完成
+    - multicast 成功：整組的 line_message_logs 與 claim 完成狀態一次 commit
+    - LINE 明確拒絕（不可重試的 4xx）：改為逐一 push，讓單一收件者的錯誤不影響其他人
+    - 其他失敗（逾時、429、5xx）：整組記為 failed 交給 outbox 重試；重試時同一組
+      收件者沿用同一個 X-Line-Retry-Key，前一次其實已送達時 LINE 回 409 而不會重送
+    """
+    claimed = claim_line_recipient_notifications(
+        event_type,
+        transaction_id,
+        [
+            (r["line_user_id"], r["source_card_ids"][0] if r["source_card_ids"] else None)
+            for r in recipients
+        ],
+        reclaim_failed=bool(delivery and delivery.reclaim_failed),
+        stale_sending_before=delivery.stale_sending_before if delivery else None,
+    )
+
+    results = []
+    pending = []
+    for recipient in recipients:
+        if recipient["line_user_id"] in claimed:
+            pending.append(recipient)
+        else:
+            results.append(_duplicate_line_recipient_result(transaction_id, id_tag, recipient))
+
+    if delivery and delivery.rate_limiter is not None and pending:
+        delay = max(delivery.rate_limiter.reserve(r["line_user_id"]) for r in pending)
+        if delay > 0:
+            time.sleep(delay)
+
+    for start in range(0, len(pending), LINE_MULTICAST_MAX_RECIPIENTS):
+        group = pending[start:start + LINE_MULTICAST_MAX_RECIPIENTS]
+        if len(group) == 1:
+            results.append(
+                _push_line_recipient(
+                    event_type, transaction_id, id_tag, message, finalize_result, group[0]
+                )
+            )
+            continue
+
+        line_user_ids = [r["line_user_id"] for r in group]
+        try:
+            line_result = send_line_multicast(
+                line_user_ids=line_user_ids,
+                message=message,
+                retry_key=line_outbox.retry_key(event_type, transaction_id, line_user_ids),
+            )
+        except Exception as exc:
+            line_result = {"ok": False, "error": str(exc)}
+
+        status_code = line_result.get("status_code")
+        rejected = (
+            isinstance(status_code, int)
+            and 400 <= status_code < 500
+            and not line_result.get("retryable")
         )
+        if not line_result.get("ok") and not rejected:
+            logging.warning(
+                f"[LINE][MULTICAST][RETRY_LATER] event_type={event_type} | "
+                f"tx_id={transaction_id} | recipients={len(group)} | "
+                f"status_code={status_code}"
+            )
+        elif not line_result.get("ok"):
+            logging.warning(
+                f"[LINE][MULTICAST][FALLBACK_PUSH] event_type={event_type} | "
+                f"tx_id={transaction_id} | recipients={len(group)} | "
+                f"status_code={status_code}"
+            )
+            for recipient in group:
+                results.append(
+                    _push_line_recipient(
+                        event_type, transaction_id, id_tag, message, finalize_result, recipient
+                    )
+                )
+            continue
+
+        # 送達或交給 outbox 重試：整組的 log 與 claim 狀態一次 commit
+        with get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for recipient in group:
+                results.append(
+                    finalize_result(
+                        _line_recipient_result(transaction_id, id_tag, recipient, dict(line_result)),
+                        message=message,
+                        line_user_id=recipient["line_user_id"],
+                        conn=conn,
+                    )
+                )
+            conn.commit()
+
+    return results
 
 
 def send_household_line_notification(
@@ -9593,8 +9950,16 @@ def send_household_line_notification(
     id_tag: str,
     message: str,
     finalize_result,
+    delivery: LineDeliveryOptions | None = None,
 ) -> dict:
-    """Send one transaction event to every unique current household recipient."""
+    """
+    Send one transaction event to every unique current household recipient.
+
+    Direct calls are at-most-once per recipient.  ``delivery`` is passed by
+    the LINE outbox: a retry re-opens failed (or stale ``sending``) recipient
+    claims and pushes are spaced out per recipient.  With
+    ``LINE_DELIVERY_MODE=multicast`` several recipients share one request.
+    """
     with get_conn() as conn:
         recipients = resolve_household_line_recipients(conn, transaction_id)
 
@@ -9610,56 +9975,43 @@ def send_household_line_notification(
             message=message,
         )
 
-    results = []
-    for recipient in recipients:
-        line_user_id = recipient["line_user_id"]
-        source_card_ids = recipient["source_card_ids"]
-        source_card_id = source_card_ids[0] if source_card_ids else None
-        if not claim_line_recipient_notification(
-            event_type,
-            transaction_id,
-            line_user_id,
-            source_card_id=source_card_id,
-        ):
-            results.append(
-                {
-                    "ok": True,
-                    "status": "skipped",
-                    "reason": "duplicate_notification",
-                    "transactionId": transaction_id,
-                    "idTag": id_tag,
-                    "lineUserId": line_user_id,
-                    "sourceCardIds": source_card_ids,
-                }
-            )
-            continue
+    if LINE_DELIVERY_MODE == "multicast" and len(recipients) > 1:
+        results = _send_household_line_multicast(
+            event_type=event_type,
+            transaction_id=transaction_id,
+            id_tag=id_tag,
+            message=message,
+            finalize_result=finalize_result,
+            recipients=recipients,
+            delivery=delivery,
+        )
+    else:
+        results = []
+        for recipient in recipients:
+            line_user_id = recipient["line_user_id"]
+            source_card_ids = recipient["source_card_ids"]
+            source_card_id = source_card_ids[0] if source_card_ids else None
+            if not claim_line_recipient_notification(
+                event_type,
+                transaction_id,
+                line_user_id,
+                source_card_id=source_card_id,
+                reclaim_failed=bool(delivery and delivery.reclaim_failed),
+                stale_sending_before=delivery.stale_sending_before if delivery else None,
+            ):
+                results.append(
+                    _duplicate_line_recipient_result(transaction_id, id_tag, recipient)
+                )
+                continue
 
-        try:
-            line_result = send_line_message(
-                line_user_id=line_user_id,
-                message=message,
-            )
-        except Exception as exc:
-            line_result = {"ok": False, "error": str(exc)}
+            if delivery and delivery.rate_limiter is not None:
+                delivery.rate_limiter.wait(line_user_id)
 
-        sent = bool(line_result.get("ok"))
-        result = {
-            "ok": sent,
-            "status": "sent" if sent else "failed",
-            "reason": "ok" if sent else "line_api_failed",
-            "transactionId": transaction_id,
-            "idTag": id_tag,
-            "lineUserId": line_user_id,
-            "sourceCardIds": source_card_ids,
-            "lineResult": line_result,
-        }
-        results.append(
-            finalize_result(
-                result,
-                message=message,
-                line_user_id=line_user_id,
+            results.append(
+                _push_line_recipient(
+                    event_type, transaction_id, id_tag, message, finalize_result, recipient
+                )
             )
-        )
 
     sent_count = sum(item.get("status") == "sent" for item in results)
     failed_count = sum(item.get("status") == "failed" for item in results)
@@ -9692,6 +10044,7 @@ def finalize_charge_completed_line_result(
     result: dict,
     message: str | None = None,
     line_user_id: str | None = None,
+    conn=None,
 ) -> dict:
     """
     將 send_charge_completed_line_notification 的結果寫入 line_message_logs。
@@ -9724,6 +10077,7 @@ def finalize_charge_completed_line_result(
             reason=reason,
             message=message,
             line_result=line_result,
+            conn=conn,
         )
 
         result["messageLog"] = log_result
@@ -9733,6 +10087,7 @@ def finalize_charge_completed_line_result(
             result.get("lineUserId") or line_user_id,
             status,
             error=reason if status == "failed" else None,
+            conn=conn,
         )
         return result
 
@@ -9751,7 +10106,10 @@ def finalize_charge_completed_line_result(
 
 
 
-def send_charge_completed_line_notification(transaction_id: int) -> dict:
+def send_charge_completed_line_notification(
+    transaction_id: int,
+    delivery: LineDeliveryOptions | None = None,
+) -> dict:
     """
     StopTransaction 完成後發送充電完成 LINE 通知。
 
@@ -9822,6 +10180,7 @@ def send_charge_completed_line_notification(transaction_id: int) -> dict:
             id_tag=id_tag,
             message=message,
             finalize_result=finalize_charge_completed_line_result,
+            delivery=delivery,
         )
 
     except HTTPException as e:
@@ -9859,7 +10218,7 @@ def schedule_charge_completed_line_notification(transaction_id: int) -> None:
 
     重點：
     - StopTransaction 不等待 LINE API 回應
-    - send_line_message 內部使用 urllib，放到 thread 避免阻塞 OCPP handler
+    - 實際發送由 line_outbox worker pool 處理，不佔用 OCPP handler
     - 任何錯誤只 log，不影響 StopTransaction 回覆
     """
 
@@ -9871,38 +10230,10 @@ def schedule_charge_completed_line_notification(transaction_id: int) -> None:
         )
         return
 
-    async def _runner():
-        try:
-            result = await asyncio.to_thread(
-                send_charge_completed_line_notification,
-                tx_id,
-            )
-            logging.warning(
-                f"[LINE][CHARGE_COMPLETED][SCHEDULE_DONE] tx_id={tx_id} | result={result}"
-            )
-        except Exception as e:
-            logging.exception(
-                f"[LINE][CHARGE_COMPLETED][SCHEDULE_ERR] tx_id={tx_id} | err={e}"
-            )
-
-    try:
-        asyncio.create_task(_runner())
-        logging.warning(
-            f"[LINE][CHARGE_COMPLETED][SCHEDULED] tx_id={tx_id}"
-        )
-
-    except RuntimeError:
-        # 理論上 StopTransaction 內會有 event loop；
-        # 此 fallback 只避免未來被同步流程誤呼叫時直接炸掉。
-        try:
-            result = send_charge_completed_line_notification(tx_id)
-            logging.warning(
-                f"[LINE][CHARGE_COMPLETED][SYNC_DONE] tx_id={tx_id} | result={result}"
-            )
-        except Exception as e:
-            logging.exception(
-                f"[LINE][CHARGE_COMPLETED][SYNC_ERR] tx_id={tx_id} | err={e}"
-            )
+    schedule_line_outbox_event("charge_completed", tx_id)
+    logging.warning(
+        f"[LINE][CHARGE_COMPLETED][SCHEDULED] tx_id={tx_id}"
+    )
 
 
 # =====================================================
@@ -9916,7 +10247,7 @@ def schedule_charge_completed_line_notification(transaction_id: int) -> None:
 def build_low_balance_line_message(transaction_id: int) -> dict:
     """
     建立交易完成後低餘額 LINE 提醒訊息。
-    只負責組訊息，不發送 LINE。
+    只負責組訊息，不發送 LINE；優先使用結算快照的扣款後餘額。
     """
 
     try:
@@ -9924,32 +10255,50 @@ def build_low_balance_line_message(transaction_id: int) -> dict:
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid transaction_id")
 
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT
-                t.transaction_id,
-                t.charge_point_id,
-                t.id_tag,
-                t.stop_timestamp,
-                t.balance_after,
-                u.card_number,
-                ha.balance AS current_account_balance,
-                t.floor_no,
-                t.parking_space_no
-            FROM transactions t
-            LEFT JOIN card_owners co
-                ON co.card_id = t.id_tag
-            LEFT JOIN users u
-                ON u.id_tag = t.id_tag
-            LEFT JOIN household_accounts ha
-                ON ha.account_id = t.account_id
-            WHERE t.transaction_id = ?
-            """,
-            (tx_id_param,),
+    snapshot = load_transaction_settlement_snapshot(tx_id_param)
+
+    if snapshot is not None:
+        row = _settlement_snapshot_row(
+            snapshot,
+            (
+                "transaction_id",
+                "charge_point_id",
+                "id_tag",
+                "stop_timestamp",
+                "balance_after",
+                "card_number",
+                "balance_after",
+                "floor_no",
+                "parking_space_no",
+            ),
         )
-        row = cur.fetchone()
+    else:
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT
+                    t.transaction_id,
+                    t.charge_point_id,
+                    t.id_tag,
+                    t.stop_timestamp,
+                    t.balance_after,
+                    u.card_number,
+                    ha.balance AS current_account_balance,
+                    t.floor_no,
+                    t.parking_space_no
+                FROM transactions t
+                LEFT JOIN card_owners co
+                    ON co.card_id = t.id_tag
+                LEFT JOIN users u
+                    ON u.id_tag = t.id_tag
+                LEFT JOIN household_accounts ha
+                    ON ha.account_id = t.account_id
+                WHERE t.transaction_id = ?
+                """,
+                (tx_id_param,),
+            )
+            row = cur.fetchone()
 
     if not row:
         raise HTTPException(status_code=404, detail="Transaction not found")
@@ -10009,6 +10358,7 @@ def build_low_balance_line_message(transaction_id: int) -> dict:
                 else None
             ),
             "threshold": LOW_BALANCE_LINE_THRESHOLD,
+            "source": "settlement_snapshot" if snapshot is not None else "transaction",
         },
     }
 
@@ -10017,6 +10367,7 @@ def finalize_low_balance_line_result(
     result: dict,
     message: str | None = None,
     line_user_id: str | None = None,
+    conn=None,
 ) -> dict:
     """
     將低餘額 LINE 推播結果寫入 line_message_logs。
@@ -10048,6 +10399,7 @@ def finalize_low_balance_line_result(
             reason=reason,
             message=message,
             line_result=line_result,
+            conn=conn,
         )
 
         result["messageLog"] = log_result
@@ -10057,6 +10409,7 @@ def finalize_low_balance_line_result(
             result.get("lineUserId") or line_user_id,
             status,
             error=reason if status == "failed" else None,
+            conn=conn,
         )
         return result
 
@@ -10074,7 +10427,10 @@ def finalize_low_balance_line_result(
         return result
 
 
-def send_low_balance_line_notification(transaction_id: int) -> dict:
+def send_low_balance_line_notification(
+    transaction_id: int,
+    delivery: LineDeliveryOptions | None = None,
+) -> dict:
     """
     交易完成後，扣款後餘額低於門檻時發送 LINE 提醒。
 
@@ -10196,6 +10552,7 @@ def send_low_balance_line_notification(transaction_id: int) -> dict:
             id_tag=id_tag,
             message=message,
             finalize_result=finalize_low_balance_line_result,
+            delivery=delivery,
         )
 
     except HTTPException as e:
@@ -10233,7 +10590,7 @@ def schedule_low_balance_line_notification(transaction_id: int) -> None:
 
     重點：
     - StopTransaction 不等待 LINE API 回應
-    - send_line_message 內部使用 urllib，放到 thread 避免阻塞 OCPP handler
+    - 實際發送由 line_outbox worker pool 處理，不佔用 OCPP handler
     - 任何錯誤只 log，不影響 StopTransaction 回覆
     """
 
@@ -10245,36 +10602,10 @@ def schedule_low_balance_line_notification(transaction_id: int) -> None:
         )
         return
 
-    async def _runner():
-        try:
-            result = await asyncio.to_thread(
-                send_low_balance_line_notification,
-                tx_id,
-            )
-            logging.warning(
-                f"[LINE][LOW_BALANCE][SCHEDULE_DONE] tx_id={tx_id} | result={result}"
-            )
-        except Exception as e:
-            logging.exception(
-                f"[LINE][LOW_BALANCE][SCHEDULE_ERR] tx_id={tx_id} | err={e}"
-            )
-
-    try:
-        asyncio.create_task(_runner())
-        logging.warning(
-            f"[LINE][LOW_BALANCE][SCHEDULED] tx_id={tx_id}"
-        )
-
-    except RuntimeError:
-        try:
-            result = send_low_balance_line_notification(tx_id)
-            logging.warning(
-                f"[LINE][LOW_BALANCE][SYNC_DONE] tx_id={tx_id} | result={result}"
-            )
-        except Exception as e:
-            logging.exception(
-                f"[LINE][LOW_BALANCE][SYNC_ERR] tx_id={tx_id} | err={e}"
-            )
+    schedule_line_outbox_event("low_balance_after_transaction", tx_id)
+    logging.warning(
+        f"[LINE][LOW_BALANCE][SCHEDULED] tx_id={tx_id}"
+    )
 
 
 # =====================================================
@@ -10288,7 +10619,7 @@ def schedule_low_balance_line_notification(transaction_id: int) -> None:
 def build_auto_stop_balance_insufficient_line_message(transaction_id: int) -> dict:
     """
     建立「餘額不足，系統已自動停止充電」LINE 訊息。
-    只負責組訊息，不發送 LINE。
+    只負責組訊息，不發送 LINE；優先使用結算快照。
     """
 
     try:
@@ -10296,37 +10627,60 @@ def build_auto_stop_balance_insufficient_line_message(transaction_id: int) -> di
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid transaction_id")
 
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT
-                t.transaction_id,
-                t.charge_point_id,
-                t.id_tag,
-                t.stop_timestamp,
-                t.balance_before,
-                t.balance_after,
-                t.auto_stop_reason,
-                t.auto_stop_triggered_at,
-                t.auto_stop_balance,
-                t.auto_stop_estimated_amount,
-                u.card_number,
-                ha.balance AS current_account_balance,
-                t.floor_no,
-                t.parking_space_no
-            FROM transactions t
-            LEFT JOIN card_owners co
-                ON co.card_id = t.id_tag
-            LEFT JOIN users u
-                ON u.id_tag = t.id_tag
-            LEFT JOIN household_accounts ha
-                ON ha.account_id = t.account_id
-            WHERE t.transaction_id = ?
-            """,
-            (tx_id_param,),
+    snapshot = load_transaction_settlement_snapshot(tx_id_param)
+
+    if snapshot is not None:
+        row = _settlement_snapshot_row(
+            snapshot,
+            (
+                "transaction_id",
+                "charge_point_id",
+                "id_tag",
+                "stop_timestamp",
+                "balance_before",
+                "balance_after",
+                "auto_stop_reason",
+                "auto_stop_triggered_at",
+                "auto_stop_balance",
+                "auto_stop_estimated_amount",
+                "card_number",
+                "balance_after",
+                "floor_no",
+                "parking_space_no",
+            ),
         )
-        row = cur.fetchone()
+    else:
+        with get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT
+                    t.transaction_id,
+                    t.charge_point_id,
+                    t.id_tag,
+                    t.stop_timestamp,
+                    t.balance_before,
+                    t.balance_after,
+                    t.auto_stop_reason,
+                    t.auto_stop_triggered_at,
+                    t.auto_stop_balance,
+                    t.auto_stop_estimated_amount,
+                    u.card_number,
+                    ha.balance AS current_account_balance,
+                    t.floor_no,
+                    t.parking_space_no
+                FROM transactions t
+                LEFT JOIN card_owners co
+                    ON co.card_id = t.id_tag
+                LEFT JOIN users u
+                    ON u.id_tag = t.id_tag
+                LEFT JOIN household_accounts ha
+                    ON ha.account_id = t.account_id
+                WHERE t.transaction_id = ?
+                """,
+                (tx_id_param,),
+            )
+            row = cur.fetchone()
 
     if not row:
         raise HTTPException(status_code=404, detail="Transaction not found")
@@ -10427,6 +10781,7 @@ def build_auto_stop_balance_insufficient_line_message(transaction_id: int) -> di
                 if final_balance_value is not None
                 else None
             ),
+            "source": "settlement_snapshot" if snapshot is not None else "transaction",
         },
     }
 
@@ -10435,6 +10790,7 @@ def finalize_auto_stop_balance_insufficient_line_result(
     result: dict,
     message: str | None = None,
     line_user_id: str | None = None,
+    conn=None,
 ) -> dict:
     """
     將餘額不足自動停充 LINE 推播結果寫入 line_message_logs。
@@ -10466,6 +10822,7 @@ def finalize_auto_stop_balance_insufficient_line_result(
             reason=reason,
             message=message,
             line_result=line_result,
+            conn=conn,
         )
 
         result["messageLog"] = log_result
@@ -10475,6 +10832,7 @@ def finalize_auto_stop_balance_insufficient_line_result(
             result.get("lineUserId") or line_user_id,
             status,
             error=reason if status == "failed" else None,
+            conn=conn,
         )
         return result
 
@@ -10492,7 +10850,10 @@ def finalize_auto_stop_balance_insufficient_line_result(
         return result
 
 
-def send_auto_stop_balance_insufficient_line_notification(transaction_id: int) -> dict:
+def send_auto_stop_balance_insufficient_line_notification(
+    transaction_id: int,
+    delivery: LineDeliveryOptions | None = None,
+) -> dict:
     """
     StopTransaction 完成後，如果該交易是因餘額不足自動停充，
     則發送 LINE 通知。
@@ -10582,6 +10943,7 @@ def send_auto_stop_balance_insufficient_line_notification(transaction_id: int) -
             id_tag=id_tag,
             message=message,
             finalize_result=finalize_auto_stop_balance_insufficient_line_result,
+            delivery=delivery,
         )
 
     except HTTPException as e:
@@ -10619,7 +10981,7 @@ def schedule_auto_stop_balance_insufficient_line_notification(transaction_id: in
 
     重點：
     - StopTransaction 不等待 LINE API 回應
-    - send_line_message 內部使用 urllib，放到 thread 避免阻塞 OCPP handler
+    - 實際發送由 line_outbox worker pool 處理，不佔用 OCPP handler
     - 任何錯誤只 log，不影響 StopTransaction 回覆
     """
 
@@ -10631,38 +10993,145 @@ def schedule_auto_stop_balance_insufficient_line_notification(transaction_id: in
         )
         return
 
-    async def _runner():
-        try:
-            result = await asyncio.to_thread(
-                send_auto_stop_balance_insufficient_line_notification,
-                tx_id,
-            )
-            logging.warning(
-                f"[LINE][AUTO_STOP_BALANCE][SCHEDULE_DONE] tx_id={tx_id} | result={result}"
-            )
-        except Exception as e:
-            logging.exception(
-                f"[LINE][AUTO_STOP_BALANCE][SCHEDULE_ERR] tx_id={tx_id} | err={e}"
-            )
+    schedule_line_outbox_event("auto_stop_balance_insufficient", tx_id)
+    logging.warning(
+        f"[LINE][AUTO_STOP_BALANCE][SCHEDULED] tx_id={tx_id}"
+    )
+
+
+# =====================================================
+# LINE outbox：StopTransaction 結算時寫入，worker pool 非同步發送
+# - 結算 transaction 內寫入 line_outbox，重啟 / 當機不會遺失通知
+# - worker pool 使用獨立 thread pool 與共用 keep-alive HTTP session
+# - 暫時性錯誤（網路 / 429 / 5xx）以指數退避重試，超過次數標記 dead
+# =====================================================
+
+LINE_OUTBOX_HANDLERS = {
+    "charge_completed": lambda tx_id, delivery: send_charge_completed_line_notification(
+        tx_id, delivery=delivery
+    ),
+    "low_balance_after_transaction": lambda tx_id, delivery: send_low_balance_line_notification(
+        tx_id, delivery=delivery
+    ),
+    "auto_stop_balance_insufficient": lambda tx_id, delivery: (
+        send_auto_stop_balance_insufficient_line_notification(tx_id, delivery=delivery)
+    ),
+}
 
+
+def enqueue_stop_transaction_line_events(cur, transaction_id, balance_after=None) -> list[str]:
+    """
+    在 StopTransaction 結算的同一個 transaction 內寫入 LINE outbox。
+
+    回傳寫入的事件；commit 後呼叫端只需 ``wake_line_outbox`` 一次。
+    回傳 [] 代表寫入失敗，呼叫端退回各別的 schedule_*（重複寫入由
+    UNIQUE(event_type, transaction_id) 忽略）。
+    """
+    tx_id = int(transaction_id)
+    events = ["charge_completed"]
+
+    if balance_after is not None and float(balance_after) < float(LOW_BALANCE_LINE_THRESHOLD):
+        events.append("low_balance_after_transaction")
+
+    # SAVEPOINT：outbox 寫入失敗只放棄通知，不得讓扣款 rollback；
+    # 回傳 [] 時 commit 後的 schedule_* 會再嘗試寫入一次
+    cur.execute("SAVEPOINT line_outbox_enqueue")
     try:
-        asyncio.create_task(_runner())
-        logging.warning(
-            f"[LINE][AUTO_STOP_BALANCE][SCHEDULED] tx_id={tx_id}"
+        row = cur.execute(
+            "SELECT auto_stop_reason FROM transactions WHERE transaction_id = ?",
+            (tx_id,),
+        ).fetchone()
+        if row and row[0] == AUTO_STOP_REASON_BALANCE_INSUFFICIENT:
+            events.append("auto_stop_balance_insufficient")
+
+        for event_type in events:
+            line_outbox.enqueue(cur, event_type, tx_id)
+    except Exception as e:
+        cur.execute("ROLLBACK TO SAVEPOINT line_outbox_enqueue")
+        cur.execute("RELEASE SAVEPOINT line_outbox_enqueue")
+        logger.exception(f"[LINE][OUTBOX][ENQUEUE_ERR] tx_id={tx_id} | events={events} | err={e}")
+        return []
+    cur.execute("RELEASE SAVEPOINT line_outbox_enqueue")
+
+    logger.warning(f"[LINE][OUTBOX][ENQUEUE] tx_id={tx_id} | events={events}")
+    return events
+
+
+def run_line_outbox_job(job, delivery: LineDeliveryOptions) -> dict:
+    handler = LINE_OUTBOX_HANDLERS.get(job.event_type)
+    if handler is None:
+        logging.error(
+            f"[LINE][OUTBOX][UNKNOWN_EVENT] job_id={job.id} | event={job.event_type}"
         )
+        return {"ok": False, "status": "skipped", "reason": "unknown_event_type"}
+    return handler(job.transaction_id, delivery)
 
+
+line_outbox_pool = LineOutboxWorkerPool(
+    connect=lambda: get_conn(),
+    handler=run_line_outbox_job,
+    workers=LINE_OUTBOX_WORKERS,
+    poll_interval_s=LINE_OUTBOX_POLL_SECONDS,
+    lease_s=LINE_OUTBOX_LEASE_SECONDS,
+    max_attempts=LINE_OUTBOX_MAX_ATTEMPTS,
+    rate_limiter=RecipientRateLimiter(LINE_RECIPIENT_MIN_INTERVAL_SECONDS),
+)
+
+
+def schedule_line_outbox_event(event_type: str, transaction_id: int) -> None:
+    """確保 outbox 有這筆事件並喚醒 worker pool（``wake_line_outbox``）。"""
+    tx_id = int(transaction_id)
+    try:
+        with get_conn() as conn:
+            line_outbox.enqueue(conn, event_type, tx_id)
+            conn.commit()
+    except Exception as e:
+        logging.exception(
+            f"[LINE][OUTBOX][ENQUEUE_ERR] event={event_type} | tx_id={tx_id} | err={e}"
+        )
+        return
+
+    wake_line_outbox(f"event={event_type} | tx_id={tx_id}")
+
+
+def wake_line_outbox(label: str) -> None:
+    """
+    outbox 已有待送工作：喚醒 worker pool；不等待 LINE API。
+
+    pool 尚未啟動時（例如未經 startup 的測試 / 腳本），退回背景 thread
+    或同步處理一次到期的 outbox 工作。
+    """
+    try:
+        asyncio.get_running_loop()
     except RuntimeError:
         try:
-            result = send_auto_stop_balance_insufficient_line_notification(tx_id)
-            logging.warning(
-                f"[LINE][AUTO_STOP_BALANCE][SYNC_DONE] tx_id={tx_id} | result={result}"
-            )
+            outcomes = line_outbox_pool.drain_once()
+            logging.warning(f"[LINE][OUTBOX][SYNC_DONE] {label} | outcomes={outcomes}")
         except Exception as e:
-            logging.exception(
-                f"[LINE][AUTO_STOP_BALANCE][SYNC_ERR] tx_id={tx_id} | err={e}"
-            )
+            logging.exception(f"[LINE][OUTBOX][SYNC_ERR] {label} | err={e}")
+        return
+
+    if line_outbox_pool.running:
+        line_outbox_pool.wake()
+        return
+
+    async def _runner():
+        try:
+            outcomes = await asyncio.to_thread(line_outbox_pool.drain_once)
+            logging.warning(f"[LINE][OUTBOX][DRAIN_DONE] {label} | outcomes={outcomes}")
+        except Exception as e:
+            logging.exception(f"[LINE][OUTBOX][DRAIN_ERR] {label} | err={e}")
+
+    asyncio.create_task(_runner())
 
 
+@app.get("/api/line/outbox")
+def get_line_outbox_status():
+    with get_conn() as conn:
+        summary = line_outbox.outbox_summary(conn)
+    summary["pool"] = line_outbox_pool.snapshot()
+    return summary
+
 
 @app.get("/api/line/message-logs")
 def get_line_message_logs(
@@ -10705,7 +11174,7 @@ def get_line_message_logs(
 
         params.append(int(limit))
 
-        with get_conn() as conn:
+        with get_report_conn() as conn:
             cur = conn.cursor()
             cur.execute(
                 f"""
@@ -10774,7 +11243,7 @@ def get_line_message_logs_by_transaction(transaction_id: int = Path(...)):
     """
 
     try:
-        with get_conn() as conn:
+        with get_report_conn() as conn:
             cur = conn.cursor()
             cur.execute(
                 """
@@ -10849,65 +11318,110 @@ async def get_transaction_cost(transaction_id: int):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/api/transactions/{transaction_id}")
-async def get_transaction_detail(transaction_id: int):
-    cursor.execute(
+_TRANSACTION_DETAIL_COLUMNS = (
+    "transaction_id",
+    "charge_point_id",
+    "connector_id",
+    "id_tag",
+    "meter_start",
+    "start_timestamp",
+    "meter_stop",
+    "stop_timestamp",
+    "reason",
+    "balance_before",
+    "balance_after",
+    "surplus_amount",
+    "floor_no",
+    "parking_space_no",
+)
+
+
+def _transaction_identity(conn, id_tag) -> tuple:
+    """
+    (resident_name, department, card_number)。
+    先以原值比對（主鍵）；找不到才用 UPPER(TRIM()) 容錯比對（走 migration 16 的表達式索引）。
+    """
+    key = str(id_tag or "").strip()
+    if not key:
+        return None, None, None
+
+    user_sql = """
+        SELECT NULLIF(TRIM(name), ''), NULLIF(TRIM(department), ''), NULLIF(TRIM(card_number), '')
+        FROM users
+        WHERE {match}
+        LIMIT 1
+    """
+    user = conn.execute(
+        user_sql.format(match="id_tag = ? OR card_number = ?"), (id_tag, id_tag)
+    ).fetchone() or conn.execute(
+        user_sql.format(match="UPPER(TRIM(id_tag)) = UPPER(TRIM(?)) OR UPPER(TRIM(card_number)) = UPPER(TRIM(?))"),
+        (key, key),
+    ).fetchone()
+
+    owner_name = None
+    if not (user and user[0]):
+        owner_sql = "SELECT NULLIF(TRIM(name), '') FROM card_owners WHERE {match} LIMIT 1"
+        owner = conn.execute(
+            owner_sql.format(match="card_id = ?"), (id_tag,)
+        ).fetchone() or conn.execute(
+            owner_sql.format(match="UPPER(TRIM(card_id)) = UPPER(TRIM(?))"), (key,)
+        ).fetchone()
+        owner_name = owner[0] if owner else None
+
+    if user:
+        return user[0] or owner_name, user[1], user[2]
+    return owner_name, None, None
+
+
+def _raw_transaction_meter_values(conn, transaction_id: int) -> list:
+    rows = conn.execute(
         """
-        SELECT
-            t.transaction_id,
-            t.charge_point_id,
-            t.connector_id,
-            t.id_tag,
-            t.meter_start,
-            t.start_timestamp,
-            t.meter_stop,
-            t.stop_timestamp,
-            t.reason,
-            t.balance_before,
-            t.balance_after,
-            t.surplus_amount, -- ⭐ 加入這行
-            t.floor_no,
-            t.parking_space_no,
-            COALESCE(
-                NULLIF(TRIM(u.name), ''),
-                NULLIF(TRIM(co.name), '')
-            ) AS resident_name,
-            NULLIF(TRIM(u.department), '') AS department,
-            NULLIF(TRIM(u.card_number), '') AS card_number
-        FROM transactions t
-        LEFT JOIN users u
-            ON UPPER(TRIM(u.id_tag)) = UPPER(TRIM(t.id_tag))
-            OR UPPER(TRIM(u.card_number)) = UPPER(TRIM(t.id_tag))
-        LEFT JOIN card_owners co
-            ON UPPER(TRIM(co.card_id)) = UPPER(TRIM(t.id_tag))
-        WHERE t.transaction_id = ?
+        SELECT timestamp, value, measurand, unit, context, format
+        FROM meter_values WHERE transaction_id = ?
+        ORDER BY timestamp ASC
         """,
         (transaction_id,),
-    )
-    row = cursor.fetchone()
+    ).fetchall()
+    return [
+        {
+            "timestamp": mv[0],
+            "sampledValue": [
+                {
+                    "value": mv[1],
+                    "measurand": mv[2],
+                    "unit": mv[3],
+                    "context": mv[4],
+                    "format": mv[5],
+                }
+            ],
+        }
+        for mv in rows
+    ]
 
-    if not row:
-        raise HTTPException(status_code=404, detail="Transaction not found")
 
-    (
-        tx_id,
-        charge_point_id,
-        connector_id,
-        id_tag,
-        meter_start,
-        start_timestamp,
-        meter_stop,
-        stop_timestamp,
-        reason,
-        balance_before,
-        balance_after,
-        surplus_amount, # ⭐ 加入這行
-        floor_no,
-        parking_space_no,
-        resident_name,
-        department,
-        card_number,
-    ) = row
+def _build_transaction_detail(conn, transaction_id: int) -> dict | None:
+    """
+    已結束交易：結算快照 + 結算時寫入的降採樣曲線（舊交易第一次查詢時補建）。
+    進行中交易：transactions 主鍵查詢 + live_status_cache + 記憶體內即時曲線。
+    """
+    snapshot = settlement_snapshot.load(conn, transaction_id)
+    if snapshot is not None:
+        tx = {key: snapshot.get(key) for key in _TRANSACTION_DETAIL_COLUMNS}
+        source = "settlement_snapshot"
+    else:
+        row = conn.execute(
+            f"SELECT {', '.join(_TRANSACTION_DETAIL_COLUMNS)} FROM transactions WHERE transaction_id = ?",
+            (transaction_id,),
+        ).fetchone()
+        if not row:
+            return None
+        tx = dict(zip(_TRANSACTION_DETAIL_COLUMNS, row))
+        source = "transaction"
+
+    active = snapshot is None and tx["meter_stop"] is None and tx["stop_timestamp"] is None
+    resident_name, department, card_number = _transaction_identity(conn, tx["id_tag"])
+    meter_start = tx["meter_start"]
+    meter_stop = tx["meter_stop"]
 
     energy_kwh = None
     if meter_start is not None and meter_stop is not None:
@@ -10918,73 +11432,114 @@ async def get_transaction_detail(transaction_id: int):
         except Exception:
             energy_kwh = None
 
+    def _money(value, default=None):
+        return round(float(value), 2) if value is not None else default
+
     result = {
-        "transactionId": tx_id,
-        "chargePointId": charge_point_id,
-        "connectorId": connector_id,
-        "idTag": id_tag,
-        "cardNumber": card_number or id_tag,
-        "cardId": card_number or id_tag,
+        "transactionId": tx["transaction_id"],
+        "chargePointId": tx["charge_point_id"],
+        "connectorId": tx["connector_id"],
+        "idTag": tx["id_tag"],
+        "cardNumber": card_number or tx["id_tag"],
+        "cardId": card_number or tx["id_tag"],
         "residentName": resident_name or "--",
         "department": department,
-        "householdDisplay": _floor_parking_display(
-            floor_no, parking_space_no
-        ),
-        "floorNo": floor_no,
-        "parkingSpaceNo": parking_space_no,
+        "householdDisplay": _floor_parking_display(tx["floor_no"], tx["parking_space_no"]),
+        "floorNo": tx["floor_no"],
+        "parkingSpaceNo": tx["parking_space_no"],
         "meterStart": meter_start,
-        "startTimestamp": start_timestamp,
+        "startTimestamp": tx["start_timestamp"],
         "meterStop": meter_stop,
-        "stopTimestamp": stop_timestamp,
-        "reason": reason,
+        "stopTimestamp": tx["stop_timestamp"],
+        "reason": tx["reason"],
         "energyKwh": energy_kwh,
-        "balanceBefore": (
-            round(float(balance_before), 2)
-            if balance_before is not None
-            else None
-        ),
-        "balanceAfter": (
-            round(float(balance_after), 2)
-            if balance_after is not None
-            else None
-        ),
-        "surplusAmount": ( # ⭐ 加入這行
-            round(float(surplus_amount), 2)
-            if surplus_amount is not None
-            else 0.0
-        ),
-        "meterValues": [],
+        "balanceBefore": _money(tx["balance_before"]),
+        "balanceAfter": _money(tx["balance_after"]),
+        "surplusAmount": _money(tx["surplus_amount"], 0.0),
+        "active": active,
+        "source": "live" if active else source,
     }
 
-    # ... 後面 meterValues 相關的保留不變
-    cursor.execute(
-        """
-        SELECT timestamp, value, measurand, unit, context, format
-        FROM meter_values WHERE transaction_id = ?
-        ORDER BY timestamp ASC
-    """,
-        (transaction_id,),
+    if active:
+        live = live_status_cache.get(_normalize_cp_id(tx["charge_point_id"] or ""), {}) or {}
+        points = live_transaction_timelines.points(transaction_id) or []
+        result["energyKwh"] = live.get("energy_kwh")
+        result["live"] = {
+            "powerKw": live.get("power"),
+            "energyKwh": live.get("energy_kwh"),
+            "estimatedAmount": live.get("estimated_amount"),
+            "timestamp": live.get("timestamp"),
+        }
+        result["timeline"] = {"points": points, "samples": None, "bucketSeconds": None}
+    else:
+        timeline = transaction_detail.load_timeline(conn, transaction_id)
+        if timeline is None:
+            # 功能上線前結束的交易：第一次查詢時補建一次
+            timeline = {"points": [], "samples": 0, "bucketSeconds": None}
+            try:
+                series = transaction_detail.read_timeline(
+                    conn,
+                    transaction_id,
+                    meter_start,
+                    max_points=TRANSACTION_TIMELINE_MAX_POINTS,
+                    min_bucket_s=TRANSACTION_TIMELINE_MIN_BUCKET_SECONDS,
+                )
+                timeline = {
+                    "points": series.points(),
+                    "samples": series.samples,
+                    "bucketSeconds": series.width,
+                }
+                transaction_detail.save_timeline(conn, transaction_id, series)
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                logging.warning(f"[TX_DETAIL][TIMELINE_BACKFILL_ERR] tx_id={transaction_id} | err={e}")
+        result["timeline"] = timeline
+        paid = conn.execute(
+            "SELECT total_amount FROM payments WHERE transaction_id = ? ORDER BY id DESC LIMIT 1",
+            (transaction_id,),
+        ).fetchone()
+        result["paidAmount"] = _money(paid[0]) if paid else None
+        if snapshot is not None:
+            result["cost"] = snapshot.get("cost")
+            result["unitPrice"] = snapshot.get("unit_price")
+            result["costDetails"] = snapshot.get("cost_details") or []
+
+    result["meterValues"] = transaction_detail.meter_values_view(
+        result["timeline"]["points"], meter_start
     )
-    mv_rows = cursor.fetchall()
-    for mv in mv_rows:
-        result["meterValues"].append(
-            {
-                "timestamp": mv[0],
-                "sampledValue": [
-                    {
-                        "value": mv[1],
-                        "measurand": mv[2],
-                        "unit": mv[3],
-                        "context": mv[4],
-                        "format": mv[5],
-                    }
-                ],
-            }
-        )
+    return result
+
+
+@app.get("/api/transactions/{transaction_id}")
+async def get_transaction_detail(transaction_id: int, raw: bool = False):
+    """
+    交易明細。meterValues 為降採樣後的曲線（舊前端格式）；raw=true 回傳原始 meter_values（不快取）。
+    """
+    cached, generation = transaction_detail_cache.lookup(DB_FILE, transaction_id)
+    if cached is not None and not raw:
+        return JSONResponse(content=cached)
+
+    with get_conn() as conn:
+        result = _build_transaction_detail(conn, transaction_id)
+        if result is None:
+            raise HTTPException(status_code=404, detail="Transaction not found")
+        if raw:
+            result["meterValues"] = _raw_transaction_meter_values(conn, transaction_id)
 
+    if not raw and not result["active"]:
+        transaction_detail_cache.store(DB_FILE, transaction_id, result, generation)
     return JSONResponse(content=result)
 
 
+@app.get("/api/cache/transaction-detail")
+def get_transaction_detail_cache_status():
+    return {
+        **transaction_detail_cache.snapshot(),
+        "live_sessions": len(live_transaction_timelines),
+    }
+
+
 @app.get("/api/transactions/export")
 async def export_transactions_csv(
     idTag: str = Query(None),
@@ -11008,8 +11563,8 @@ async def export_transactions_csv(
         query += " AND start_timestamp <= ?"
         params.append(end)
 
-    cursor.execute(query, params)
-    rows = cursor.fetchall()
+    with get_report_conn() as _c:
+        rows = _c.execute(query, params).fetchall()
 
     # 建立 CSV 內容
     output = io.StringIO()
@@ -11089,6 +11644,7 @@ async def add_id_tag(data: dict = Body(...)):
             )
 
             conn.commit()
+        auth_cache.invalidate_card(id_tag)
 
         print(f"✅ 已成功新增卡片：{id_tag}, {status}, {valid_str}")
         return {"message": "Added successfully"}
@@ -11118,6 +11674,7 @@ async def update_id_tag(id_tag: str = Path(...), data: dict = Body(...)):
             "UPDATE id_tags SET valid_until = ? WHERE id_tag = ?", (valid_until, id_tag)
         )
     conn.commit()
+    auth_cache.invalidate_card(id_tag)
     return {"message": "Updated successfully"}
 
 
@@ -11135,6 +11692,7 @@ async def delete_id_tag(id_tag: str = Path(...)):
         cur.execute("DELETE FROM cards WHERE card_id = ?", (id_tag,))
         cur.execute("DELETE FROM id_tags WHERE id_tag = ?", (id_tag,))
         conn.commit()
+    auth_cache.invalidate_card(id_tag)
 
     return {"message": "Deleted successfully"}
 
@@ -11153,18 +11711,18 @@ async def get_summary(group_by: str = Query("day")):
             content={"error": "Invalid group_by. Use 'day', 'week', or 'month'."},
         )
 
-    cursor.execute(
-        f"""
-        SELECT {date_expr} as period,
-               COUNT(*) as transaction_count,
-               SUM(meter_stop - meter_start) as total_energy
-        FROM transactions
-        WHERE meter_stop IS NOT NULL
-        GROUP BY period
-        ORDER BY period ASC
-    """
-    )
-    rows = cursor.fetchall()
+    with get_report_conn() as _c:
+        rows = _c.execute(
+            f"""
+            SELECT {date_expr} as period,
+                   COUNT(*) as transaction_count,
+                   SUM(meter_stop - meter_start) as total_energy
+            FROM transactions
+            WHERE meter_stop IS NOT NULL
+            GROUP BY period
+            ORDER BY period ASC
+        """
+        ).fetchall()
 
     result = []
     for row in rows:
@@ -11195,11 +11753,52 @@ LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "").strip()
 LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET", "").strip()
 LINE_TEST_USER_ID = os.getenv("LINE_TEST_USER_ID", "").strip()
 
-LINE_PUSH_API_URL = "https://api.line.me/v2/bot/message/push"
-LINE_REPLY_API_URL = "https://api.line.me/v2/bot/message/reply"
+# 測試 / 壓測可指向本機 emulator：LINE_API_BASE_URL=http://127.0.0.1:8089
+# （見 line_emulator.py）
+LINE_API_BASE_URL = os.getenv("LINE_API_BASE_URL", "https://api.line.me").strip().rstrip("/")
+LINE_PUSH_API_URL = f"{LINE_API_BASE_URL}/v2/bot/message/push"
+LINE_REPLY_API_URL = f"{LINE_API_BASE_URL}/v2/bot/message/reply"
+LINE_MULTICAST_API_URL = f"{LINE_API_BASE_URL}/v2/bot/message/multicast"
+
+# push：每位收件者一次 push（預設）
+# multicast：同一事件的相同訊息合併為一次 multicast，失敗時退回逐一 push
+LINE_DELIVERY_MODE = os.getenv("LINE_DELIVERY_MODE", "push").strip().lower()
+LINE_MULTICAST_MAX_RECIPIENTS = 500  # LINE multicast API 單次上限
+LINE_HTTP_TIMEOUT_SECONDS = float(os.getenv("LINE_HTTP_TIMEOUT_SECONDS", "10"))
 
+_line_http_session = None
+_line_http_session_lock = threading.Lock()
 
-def send_line_message(line_user_id: str, message: str) -> dict:
+
+def get_line_http_session():
+    """
+    共用的 keep-alive HTTP session（connection pool 大小 = outbox worker 數）。
+
+    每則推播不再重新建立 TLS 連線；requests 延遲到第一次推播才載入。
+    """
+    global _line_http_session
+
+    if _line_http_session is not None:
+        return _line_http_session
+
+    with _line_http_session_lock:
+        if _line_http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=max(1, LINE_OUTBOX_WORKERS),
+            )
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _line_http_session = session
+
+    return _line_http_session
+
+
+def send_line_message(line_user_id: str, message: str, retry_key: str | None = None) -> dict:
     """
     發送 LINE 文字推播。
 
@@ -11219,6 +11818,7 @@ def send_line_message(line_user_id: str, message: str) -> dict:
             "ok": False,
             "status_code": None,
             "error": "LINE_CHANNEL_ACCESS_TOKEN 尚未設定",
+            "retryable": False,
         }
 
     if not line_user_id:
@@ -11226,6 +11826,7 @@ def send_line_message(line_user_id: str, message: str) -> dict:
             "ok": False,
             "status_code": None,
             "error": "line_user_id 不可為空",
+            "retryable": False,
         }
 
     if not message:
@@ -11233,6 +11834,7 @@ def send_line_message(line_user_id: str, message: str) -> dict:
             "ok": False,
             "status_code": None,
             "error": "message 不可為空",
+            "retryable": False,
         }
 
     payload = {
@@ -11245,57 +11847,150 @@ def send_line_message(line_user_id: str, message: str) -> dict:
         ],
     }
 
-    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
-
-    req = urllib.request.Request(
+    return _post_line_json(
         LINE_PUSH_API_URL,
-        data=body,
-        method="POST",
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}",
-        },
+        payload,
+        log_tag="PUSH",
+        log_context=f"user_id={line_user_id}",
+        retry_key=retry_key,
     )
 
-    try:
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            response_body = resp.read().decode("utf-8", errors="replace")
 
-            logging.warning(
-                f"[LINE][PUSH][OK] status_code={resp.status} | user_id={line_user_id}"
-            )
+def send_line_multicast(
+    line_user_ids: list[str], message: str, retry_key: str | None = None
+) -> dict:
+    """
+    同一則文字訊息一次送給多位 LINE 使用者（Multicast API）。
 
-            return {
-                "ok": True,
-                "status_code": resp.status,
-                "response": response_body,
-            }
+    回傳格式與 send_line_message 相同；LINE 不回報個別收件者結果，
+    因此失敗時由呼叫端決定是否改為逐一 push。
+    """
 
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode("utf-8", errors="replace")
+    if not LINE_CHANNEL_ACCESS_TOKEN:
+        return {
+            "ok": False,
+            "status_code": None,
+            "error": "LINE_CHANNEL_ACCESS_TOKEN 尚未設定",
+            "retryable": False,
+        }
 
-        logging.error(
-            f"[LINE][PUSH][HTTP_ERR] status_code={e.code} | "
-            f"user_id={line_user_id} | error={error_body}"
-        )
+    user_ids = [str(u).strip() for u in line_user_ids if str(u or "").strip()]
+    if not user_ids or len(user_ids) > LINE_MULTICAST_MAX_RECIPIENTS:
+        return {
+            "ok": False,
+            "status_code": None,
+            "error": f"line_user_ids 數量必須為 1~{LINE_MULTICAST_MAX_RECIPIENTS}",
+            "retryable": False,
+        }
 
+    if not message:
         return {
             "ok": False,
-            "status_code": e.code,
-            "error": error_body,
+            "status_code": None,
+            "error": "message 不可為空",
+            "retryable": False,
         }
 
+    payload = {
+        "to": user_ids,
+        "messages": [
+            {
+                "type": "text",
+                "text": message,
+            }
+        ],
+    }
+
+    return _post_line_json(
+        LINE_MULTICAST_API_URL,
+        payload,
+        log_tag="MULTICAST",
+        log_context=f"recipients={len(user_ids)}",
+        retry_key=retry_key,
+    )
+
+
+def _post_line_json(
+    url: str,
+    payload: dict,
+    *,
+    log_tag: str,
+    log_context: str,
+    retry_key: str | None = None,
+) -> dict:
+    """
+    POST 到 LINE Messaging API；網路錯誤與 408 / 429 / 5xx 標記為 retryable。
+
+    retry_key 以 X-Line-Retry-Key 送出：同一 key 的請求 LINE 只接受一次，
+    之後的重送回 409，視同已送達（前一次的回應遺失時不會重複發送）。
+    """
+
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}",
+    }
+    if retry_key:
+        headers["X-Line-Retry-Key"] = retry_key
+
+    try:
+        resp = get_line_http_session().post(
+            url,
+            data=body,
+            headers=headers,
+            timeout=LINE_HTTP_TIMEOUT_SECONDS,
+        )
     except Exception as e:
         logging.exception(
-            f"[LINE][PUSH][ERR] user_id={line_user_id} | err={e}"
+            f"[LINE][{log_tag}][ERR] {log_context} | err={e}"
         )
 
+        # 連線 / timeout 類錯誤：outbox 會以退避重試
         return {
             "ok": False,
             "status_code": None,
             "error": str(e),
+            "retryable": True,
+        }
+
+    if 200 <= resp.status_code < 300:
+        logging.warning(
+            f"[LINE][{log_tag}][OK] status_code={resp.status_code} | {log_context}"
+        )
+
+        return {
+            "ok": True,
+            "status_code": resp.status_code,
+            "response": resp.text,
+        }
+
+    if resp.status_code == 409 and retry_key:
+        accepted_request_id = resp.headers.get("X-Line-Accepted-Request-Id")
+        logging.warning(
+            f"[LINE][{log_tag}][ALREADY_ACCEPTED] retry_key={retry_key} | "
+            f"accepted_request_id={accepted_request_id} | {log_context}"
+        )
+
+        return {
+            "ok": True,
+            "status_code": resp.status_code,
+            "duplicate": True,
+            "accepted_request_id": accepted_request_id,
+            "response": resp.text,
         }
 
+    logging.error(
+        f"[LINE][{log_tag}][HTTP_ERR] status_code={resp.status_code} | "
+        f"{log_context} | error={resp.text}"
+    )
+
+    return {
+        "ok": False,
+        "status_code": resp.status_code,
+        "error": resp.text,
+        "retryable": resp.status_code in (408, 429) or resp.status_code >= 500,
+    }
+
 
 
 
@@ -11342,43 +12037,16 @@ def reply_line_message(reply_token: str, message: str) -> dict:
 
     body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
 
-    req = urllib.request.Request(
-        LINE_REPLY_API_URL,
-        data=body,
-        method="POST",
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}",
-        },
-    )
-
     try:
-        with urllib.request.urlopen(req, timeout=10) as resp:
-            response_body = resp.read().decode("utf-8", errors="replace")
-
-            logging.warning(
-                f"[LINE][REPLY][OK] status_code={resp.status}"
-            )
-
-            return {
-                "ok": True,
-                "status_code": resp.status,
-                "response": response_body,
-            }
-
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode("utf-8", errors="replace")
-
-        logging.error(
-            f"[LINE][REPLY][HTTP_ERR] status_code={e.code} | error={error_body}"
+        resp = get_line_http_session().post(
+            LINE_REPLY_API_URL,
+            data=body,
+            headers={
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}",
+            },
+            timeout=LINE_HTTP_TIMEOUT_SECONDS,
         )
-
-        return {
-            "ok": False,
-            "status_code": e.code,
-            "error": error_body,
-        }
-
     except Exception as e:
         logging.exception(f"[LINE][REPLY][ERR] err={e}")
 
@@ -11388,6 +12056,27 @@ def reply_line_message(reply_token: str, message: str) -> dict:
             "error": str(e),
         }
 
+    if 200 <= resp.status_code < 300:
+        logging.warning(
+            f"[LINE][REPLY][OK] status_code={resp.status_code}"
+        )
+
+        return {
+            "ok": True,
+            "status_code": resp.status_code,
+            "response": resp.text,
+        }
+
+    logging.error(
+        f"[LINE][REPLY][HTTP_ERR] status_code={resp.status_code} | error={resp.text}"
+    )
+
+    return {
+        "ok": False,
+        "status_code": resp.status_code,
+        "error": resp.text,
+    }
+
 
 
 
@@ -12561,178 +13250,195 @@ async def delete_line_binding(id_tag: str = Path(...)):
         "idTag": id_tag,
     }
 
-@app.post("/webhook")
-async def webhook(request: Request):
+def process_line_webhook_event(event: dict) -> dict:
     """
-    LINE Webhook：階段 4 綁定流程。
+    處理單一 LINE webhook event（在 line_webhook_queue 的 worker thread 執行）。
 
     支援使用者在 LINE 官方帳號輸入：
     綁定 TEST_CARD_001
 
     注意：
-    - 保留 userId debug log
     - 不接 StopTransaction
     - 不自動推播充電完成通知
     - 不修改交易、扣款、餘額、SmartCharging、OCPP WebSocket 主流程
     """
+    event_type = event.get("type")
+    source = event.get("source", {}) or {}
+    user_id = source.get("userId")
+    reply_token = event.get("replyToken")
 
-    try:
-        raw_body = await request.body()
-        body = json.loads(raw_body.decode("utf-8")) if raw_body else {}
-    except Exception as e:
-        logging.exception(f"[LINE][WEBHOOK][BODY_PARSE_ERR] err={e}")
-        body = {}
+    logging.warning(
+        f"[LINE][WEBHOOK][EVENT] type={event_type} | user_id={user_id} "
+        f"| event_id={line_webhook.event_id(event)} | has_reply_token={bool(reply_token)}"
+    )
 
-    logging.warning(f"[LINE][WEBHOOK][RAW] {body}")
+    # 目前只處理文字訊息
+    message_obj = event.get("message", {}) or {}
+    message_type = message_obj.get("type")
+    text = str(message_obj.get("text") or "").strip()
 
-    events = body.get("events", []) if isinstance(body, dict) else []
+    if event_type != "message" or message_type != "text":
+        return {
+            "ok": True,
+            "action": "ignored_non_text_event",
+            "eventType": event_type,
+            "messageType": message_type,
+        }
 
-    found_users = []
-    processed_results = []
+    bind_command = parse_line_bind_command(text)
+
+    # 不是正式綁定指令時，不要一律回覆提示
+    # 只有使用者明確表示想綁定 / 查詢說明時，才回覆綁定教學
+    if not bind_command:
+        normalized_text = str(text or "").replace("\u3000", " ").strip().lower()
+
+        help_keywords = {
+            "綁定",
+            "绑定",
+            "我要綁定",
+            "我要绑定",
+            "綁定卡號",
+            "绑定卡号",
+            "綁定充電卡",
+            "綁定電卡",
+            "绑定充电卡",
+            "bind",
+            "help",
+            "說明",
+            "说明",
+        }
 
-    for event in events:
-        try:
-            event_type = event.get("type")
-            source = event.get("source", {}) or {}
-            user_id = source.get("userId")
-            reply_token = event.get("replyToken")
+        if normalized_text not in help_keywords:
+            # 一般聊天內容不回覆，避免官方帳號對每一句話都跳綁定提示
+            return {
+                "ok": True,
+                "action": "ignored_unrecognized_text",
+                "text": text,
+            }
 
-            if user_id:
-                found_users.append(user_id)
-                logging.warning(f"[LINE][WEBHOOK][USER_ID] {user_id}")
+        reply_text = (
+            "您好，若要綁定充電卡，請輸入：\n"
+            "綁定 卡號\n\n"
+            "例如：\n"
+            "綁定 TEST_CARD_001"
+        )
 
-            logging.warning(
-                f"[LINE][WEBHOOK][EVENT] type={event_type} | user_id={user_id} | has_reply_token={bool(reply_token)}"
-            )
+        reply_result = None
+        if reply_token:
+            reply_result = reply_line_message(reply_token, reply_text)
 
-            # 目前只處理文字訊息
-            message_obj = event.get("message", {}) or {}
-            message_type = message_obj.get("type")
-            text = str(message_obj.get("text") or "").strip()
+        return {
+            "ok": True,
+            "action": "help_replied",
+            "text": text,
+            "replyResult": reply_result,
+        }
 
-            if event_type != "message" or message_type != "text":
-                processed_results.append(
-                    {
-                        "ok": True,
-                        "action": "ignored_non_text_event",
-                        "eventType": event_type,
-                        "messageType": message_type,
-                    }
-                )
-                continue
+    id_tag = bind_command["id_tag"]
 
-            bind_command = parse_line_bind_command(text)
-
-            # 不是正式綁定指令時，不要一律回覆提示
-            # 只有使用者明確表示想綁定 / 查詢說明時，才回覆綁定教學
-            if not bind_command:
-                normalized_text = str(text or "").replace("\u3000", " ").strip().lower()
-
-                help_keywords = {
-                    "綁定",
-                    "绑定",
-                    "我要綁定",
-                    "我要绑定",
-                    "綁定卡號",
-                    "绑定卡号",
-                    "綁定充電卡",
-                    "綁定電卡",
-                    "绑定充电卡",
-                    "bind",
-                    "help",
-                    "說明",
-                    "说明",
-                }
+    bind_result = bind_line_user_to_id_tag(
+        id_tag=id_tag,
+        line_user_id=user_id,
+        display_name=None,
+    )
 
-                if normalized_text in help_keywords:
-                    reply_text = (
-                        "您好，若要綁定充電卡，請輸入：\n"
-                        "綁定 卡號\n\n"
-                        "例如：\n"
-                        "綁定 TEST_CARD_001"
-                    )
+    if bind_result.get("ok"):
+        reply_text = (
+            "✅ LINE 綁定成功\n"
+            f"卡號：{id_tag}\n\n"
+            "之後可用於接收充電相關通知。"
+        )
+    else:
+        reply_text = (
+            "❌ LINE 綁定失敗\n"
+            f"{bind_result.get('message') or '請確認卡號是否正確。'}"
+        )
 
-                    reply_result = None
-                    if reply_token:
-                        reply_result = reply_line_message(reply_token, reply_text)
+    reply_result = None
+    if reply_token:
+        reply_result = reply_line_message(reply_token, reply_text)
 
-                    processed_results.append(
-                        {
-                            "ok": True,
-                            "action": "help_replied",
-                            "text": text,
-                            "replyResult": reply_result,
-                        }
-                    )
-                else:
-                    # 一般聊天內容不回覆，避免官方帳號對每一句話都跳綁定提示
-                    processed_results.append(
-                        {
-                            "ok": True,
-                            "action": "ignored_unrecognized_text",
-                            "text": text,
-                        }
-                    )
+    return {
+        "ok": bind_result.get("ok", False),
+        "action": "bind_command",
+        "idTag": id_tag,
+        "bindResult": bind_result,
+        "replyResult": reply_result,
+    }
 
-                continue
 
-            id_tag = bind_command["id_tag"]
+line_webhook_queue = WebhookEventQueue(
+    process_line_webhook_event,
+    workers=LINE_WEBHOOK_WORKERS,
+    maxsize=LINE_WEBHOOK_QUEUE_SIZE,
+    dedup=EventDeduplicator(ttl_s=LINE_WEBHOOK_DEDUP_SECONDS),
+)
 
-            bind_result = bind_line_user_to_id_tag(
-                id_tag=id_tag,
-                line_user_id=user_id,
-                display_name=None,
-            )
 
-            if bind_result.get("ok"):
-                reply_text = (
-                    "✅ LINE 綁定成功\n"
-                    f"卡號：{id_tag}\n\n"
-                    "之後可用於接收充電相關通知。"
-                )
-            else:
-                reply_text = (
-                    "❌ LINE 綁定失敗\n"
-                    f"{bind_result.get('message') or '請確認卡號是否正確。'}"
-                )
+@app.post("/webhook")
+async def webhook(request: Request):
+    """
+    LINE Webhook：驗證簽章後立即回覆 200，事件交給 line_webhook_queue 背景處理。
 
-            reply_result = None
-            if reply_token:
-                reply_result = reply_line_message(reply_token, reply_text)
+    - 未設定 LINE_CHANNEL_SECRET 時一律回 503；X-Line-Signature 不符回 401
+    - 同一個 webhookEventId（LINE 重送）只處理一次
+    - 佇列已滿時回 503，讓 LINE 重送未接受的事件
+    """
 
-            processed_results.append(
-                {
-                    "ok": bind_result.get("ok", False),
-                    "action": "bind_command",
-                    "idTag": id_tag,
-                    "bindResult": bind_result,
-                    "replyResult": reply_result,
-                }
-            )
+    if not LINE_CHANNEL_SECRET:
+        # 未設定 secret 無法驗證來源：拒收，不讓未簽章的請求進入佇列
+        logging.error("[LINE][WEBHOOK][NO_SECRET] LINE_CHANNEL_SECRET is not set; request rejected")
+        raise HTTPException(status_code=503, detail="LINE webhook is not configured")
 
-        except Exception as e:
-            logging.exception(f"[LINE][WEBHOOK][EVENT_ERR] event={event} | err={e}")
+    raw_body = await request.body()
 
-            processed_results.append(
-                {
-                    "ok": False,
-                    "action": "event_error",
-                    "error": str(e),
-                }
-            )
+    signature = request.headers.get("X-Line-Signature")
+    if not line_webhook.verify_signature(raw_body, signature, LINE_CHANNEL_SECRET):
+        logging.warning(
+            f"[LINE][WEBHOOK][BAD_SIGNATURE] has_signature={bool(signature)} "
+            f"| body_bytes={len(raw_body)}"
+        )
+        raise HTTPException(status_code=401, detail="Invalid LINE signature")
 
-            # 避免單一 event 錯誤造成 LINE webhook 驗證失敗
-            continue
+    try:
+        body = json.loads(raw_body.decode("utf-8")) if raw_body else {}
+    except Exception as e:
+        logging.warning(f"[LINE][WEBHOOK][BODY_PARSE_ERR] err={e}")
+        body = {}
+
+    events = body.get("events", []) if isinstance(body, dict) else []
+    if not isinstance(events, list):
+        events = []
+
+    found_users = [
+        (event.get("source") or {}).get("userId")
+        for event in events
+        if isinstance(event, dict) and (event.get("source") or {}).get("userId")
+    ]
+
+    submitted = line_webhook_queue.submit(events)
+
+    if submitted.dropped:
+        logging.error(
+            f"[LINE][WEBHOOK][QUEUE_FULL] events={len(events)} | dropped={submitted.dropped}"
+        )
+        raise HTTPException(status_code=503, detail="LINE webhook queue is full")
 
     return {
         "ok": True,
         "events_count": len(events),
+        "accepted": submitted.accepted,
+        "duplicates": submitted.duplicates,
         "found_user_ids": found_users,
-        "results": processed_results,
         "message": "LINE webhook received.",
     }
 
 
+@app.get("/api/line/webhook/queue")
+def get_line_webhook_queue_status():
+    return line_webhook_queue.snapshot()
+
+
 @app.get("/api/users/{id_tag}")
 async def get_user(id_tag: str = Path(...)):
     cursor.execute(
@@ -12761,6 +13467,7 @@ async def create_reservation(data: dict = Body(...)):
         ),
     )
     conn.commit()
+    auth_cache.invalidate_card(data["idTag"])
     return {"message": "Reservation created"}
 
 
@@ -12798,6 +13505,8 @@ async def update_reservation(id: int, data: dict = Body(...)):
         values,
     )
     conn.commit()
+    # 無法得知舊的 idTag，整批失效
+    authorization_cache.clear()
     return {"message": "Reservation updated"}
 
 
@@ -12805,6 +13514,7 @@ async def update_reservation(id: int, data: dict = Body(...)):
 async def delete_reservation(id: int = Path(...)):
     cursor.execute("DELETE FROM reservations WHERE id = ?", (id,))
     conn.commit()
+    authorization_cache.clear()
     return {"message": "Reservation deleted"}
 
 
@@ -12856,18 +13566,18 @@ async def get_pricing_matrix():
 
 @app.get("/api/summary/daily-by-chargepoint")
 async def get_daily_by_chargepoint():
-    cursor.execute(
+    with get_report_conn() as _c:
+        rows = _c.execute(
+            """
+            SELECT strftime('%Y-%m-%d', start_timestamp) as day,
+                   charge_point_id,
+                   SUM(meter_stop - meter_start) as total_energy
+            FROM transactions
+            WHERE meter_stop IS NOT NULL
+            GROUP BY day, charge_point_id
+            ORDER BY day ASC
         """
-        SELECT strftime('%Y-%m-%d', start_timestamp) as day,
-               charge_point_id,
-               SUM(meter_stop - meter_start) as total_energy
-        FROM transactions
-        WHERE meter_stop IS NOT NULL
-        GROUP BY day, charge_point_id
-        ORDER BY day ASC
-    """
-    )
-    rows = cursor.fetchall()
+        ).fetchall()
 
     result_map = {}
     for day, cp_id, energy in rows:
@@ -12880,8 +13590,8 @@ async def get_daily_by_chargepoint():
 
 @app.get("/api/users/export")
 async def export_users_csv():
-    cursor.execute("SELECT id_tag, name, department, card_number FROM users")
-    rows = cursor.fetchall()
+    with get_report_conn() as _c:
+        rows = _c.execute("SELECT id_tag, name, department, card_number FROM users").fetchall()
 
     output = io.StringIO()
     writer = csv.writer(output)
@@ -12928,18 +13638,20 @@ async def generate_monthly_pdf(month: str):
         return {"error": "Invalid month format"}
 
     # 查詢交易資料
-    cursor.execute(
-        """
-        SELECT id_tag, charge_point_id, SUM(meter_stop - meter_start) AS total_energy, COUNT(*) as txn_count
-        FROM transactions
-        WHERE start_timestamp >= ? AND start_timestamp <= ? AND meter_stop IS NOT NULL
-        GROUP BY id_tag, charge_point_id
-    """,
-        (start_date, end_date),
-    )
-    rows = cursor.fetchall()
+    with get_report_conn() as _c:
+        rows = _c.execute(
+            """
+            SELECT id_tag, charge_point_id, SUM(meter_stop - meter_start) AS total_energy, COUNT(*) as txn_count
+            FROM transactions
+            WHERE start_timestamp >= ? AND start_timestamp <= ? AND meter_stop IS NOT NULL
+            GROUP BY id_tag, charge_point_id
+        """,
+            (start_date, end_date),
+        ).fetchall()
+
+    # PDF 產出（reportlab 只在此路徑載入）
+    from reportlab.pdfgen import canvas
 
-    # PDF 產出
     buffer = io.BytesIO()
     p = canvas.Canvas(buffer)
     p.setTitle(f"Monthly Report - {month}")
@@ -13267,7 +13979,7 @@ async def get_daily_by_chargepoint_range(
     start: str = Query(...), end: str = Query(...)
 ):
     result_map = {}
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_report_conn() as conn:
         cursor = conn.cursor()
         cursor.execute(
             """
@@ -13314,17 +14026,8 @@ def price_now(date: str | None = Query(None), time: str | None = Query(None)):
     d = date or now.strftime("%Y-%m-%d")
     t = time or now.strftime("%H:%M")
 
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT start_time, end_time, price, COALESCE(label,'')
-        FROM daily_pricing_rules
-        WHERE date = ?
-        ORDER BY start_time
-    """,
-        (d,),
-    )
-    rows = c.fetchall()
+    with get_conn() as _c:
+        rows = tariff_engine.resolve(_c, [d])[d]
 
     hits = [
         (s, e, float(p), lbl)
@@ -13348,38 +14051,18 @@ def _price_for_timestamp(ts_iso: str) -> float:
     d = dt.strftime("%Y-%m-%d")
     t = dt.strftime("%H:%M")
 
-    c = conn.cursor()
-    c.execute(
-        """
-        SELECT start_time, end_time, price
-        FROM daily_pricing_rules
-        WHERE date = ?
-        ORDER BY start_time
-    """,
-        (d,),
-    )
-    rows = c.fetchall()
+    # 熱路徑（MeterValues / StopTransaction）：命中快取時不開 DB 連線
+    try:
+        rows = tariff_rules_cache.rules_for_dates(get_conn, [d], DB_FILE)[d]
+    except sqlite3.OperationalError as e:
+        # 尚未建立 daily_pricing_rules 的資料庫：沿用預設電價
+        logging.warning(f"[PRICE][RULES_UNAVAILABLE] date={d} err={e}")
+        rows = []
 
     hits = [float(p) for (s, e, p) in rows if _price_time_in_range(t, s, e)]
     return max(hits) if hits else 6.0
 
 
-# 建表（若已存在會略過）
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS daily_pricing_rules (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    date TEXT,        -- yyyy-mm-dd
-    start_time TEXT,  -- HH:MM
-    end_time TEXT,    -- HH:MM
-    price REAL,
-    label TEXT DEFAULT ''
-)
-"""
-)
-conn.commit()
-
-
 # 取得指定日期設定
 @app.get("/api/daily-pricing")
 async def get_daily_pricing(date: str = Query(...)):
@@ -13470,13 +14153,11 @@ async def duplicate_pricing(data: dict = Body(...)):
     source_date = data["sourceDate"]
     target_dates = data["targetDates"]  # list[str]
 
-    cursor.execute(
-        "SELECT start_time, end_time, price, label FROM daily_pricing_rules WHERE date = ?",
-        (source_date,),
-    )
-    rows = cursor.fetchall()
+    # 來源日期可能只有萬年曆編譯規則（沒有逐日覆寫列）
+    rows = tariff_engine.resolve(conn, [source_date])[source_date]
 
     for target in target_dates:
+        tariff_engine.materialize(conn, target)
         for s, e, p, lbl in rows:
             cursor.execute(
                 """
@@ -13489,37 +14170,6 @@ async def duplicate_pricing(data: dict = Body(...)):
     return {"message": f"已複製 {len(rows)} 筆設定至 {len(target_dates)} 天"}
 
 
-# 🔹 補上 pricing_rules 表
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS pricing_rules (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    season TEXT,
-    day_type TEXT,
-    start_time TEXT,
-    end_time TEXT,
-    price REAL
-)
-"""
-)
-
-# 🔹 補上 reservations 表
-cursor.execute(
-    """
-CREATE TABLE IF NOT EXISTS reservations (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    charge_point_id TEXT,
-    id_tag TEXT,
-    start_time TEXT,
-    end_time TEXT,
-    status TEXT
-)
-"""
-)
-
-conn.commit()
-
-
 @app.get("/")
 async def root():
     return {"status": "API is running"}
@@ -13610,124 +14260,109 @@ async def mock_daily_pricing(
     return {"message": f"✅ 已建立 {count} 筆日電價", "start": start, "days": days}
 
 
-@app.post("/api/internal/recalculate-all-payments")
-async def recalculate_all_payments():
-    cursor.execute("DELETE FROM payments")
-    conn.commit()
+# ===============================
+# 💰 payments 背景重算（見 payments_recalc.py）
+# ===============================
+PAYMENTS_RECALC_CHUNK_SIZE = int(os.getenv("PAYMENTS_RECALC_CHUNK_SIZE", "200"))
+PAYMENTS_RECALC_WORKERS = int(os.getenv("PAYMENTS_RECALC_WORKERS", "4"))
+payments_recalc_tasks: dict[int, asyncio.Task] = {}
 
-    cursor.execute(
-        """
-        SELECT transaction_id, charge_point_id, meter_start, meter_stop,
-               start_timestamp, stop_timestamp, id_tag
-        FROM transactions
-        WHERE meter_stop IS NOT NULL
-    """
+
+def _on_payments_swapped(_job_id: int) -> None:
+    # 交易明細含 paidAmount：重算套用後清空明細快取
+    transaction_detail_cache.invalidate()
+    # swap 刪除整批舊 payments / shadow 列，交給維護排程 incremental vacuum
+    database_maintenance.request_vacuum()
+
+
+def _run_payments_recalc_job(job_id: int) -> dict:
+    recalculator = PaymentRecalculator(
+        get_conn,
+        surcharge_per_kwh=get_community_settings().get("surcharge_per_kwh", 0),
+        on_swapped=_on_payments_swapped,
     )
-    rows = cursor.fetchall()
-    created = 0
-    skipped = 0
+    return recalculator.run(job_id)
 
-    for row in rows:
-        txn_id, cp_id, meter_start, meter_stop, start_ts, stop_ts, id_tag = row
 
-        try:
-            if not meter_start or not meter_stop or not start_ts or not stop_ts:
-                skipped += 1
-                continue
+def start_payments_recalc_task(job_id: int) -> asyncio.Task:
+    task = payments_recalc_tasks.get(job_id)
+    if task is not None and not task.done():
+        return task
 
-            start_obj = datetime.fromisoformat(start_ts)
-            stop_obj = datetime.fromisoformat(stop_ts)
+    async def _run():
+        try:
+            await asyncio.to_thread(_run_payments_recalc_job, job_id)
+        except Exception as e:
+            logger.error(f"[PAYMENTS][RECALC][TASK_ERR] job_id={job_id} | err={e}")
+        finally:
+            payments_recalc_tasks.pop(job_id, None)
 
-            if start_obj.date() != stop_obj.date():
-                skipped += 1
-                continue
+    task = asyncio.create_task(_run())
+    payments_recalc_tasks[job_id] = task
+    return task
 
-            date_str = start_obj.strftime("%Y-%m-%d")
-            t_start = start_obj.strftime("%H:%M")
 
-            cursor.execute(
-                """
-                SELECT start_time, end_time, price FROM daily_pricing_rules
-                WHERE date = ?
-                ORDER BY start_time ASC
-            """,
-                (date_str,),
+def resume_payments_recalc_jobs() -> list[int]:
+    """啟動時續跑上次中斷（仍為 running）的重算 job。"""
+    with get_conn() as _c:
+        job_ids = payments_recalc.running_job_ids(_c)
+    for job_id in job_ids:
+        logger.warning(f"[PAYMENTS][RECALC][RESUME] job_id={job_id}")
+        start_payments_recalc_task(job_id)
+    return job_ids
+
+
+@app.post("/api/internal/recalculate-all-payments", status_code=202)
+async def recalculate_all_payments(
+    dry_run: bool = Query(default=False),
+    chunk_size: int = Query(default=PAYMENTS_RECALC_CHUNK_SIZE, ge=1, le=5000),
+    workers: int = Query(default=PAYMENTS_RECALC_WORKERS, ge=1, le=32),
+):
+    """
+    建立背景重算 job 後立即回應；以 GET .../{job_id} 查詢進度。
+    dry_run=true 只計算並與現有 payments 比對，不替換。
+    """
+    try:
+        with get_conn() as _c:
+            job = payments_recalc.create_job(
+                _c,
+                mode="dry_run" if dry_run else "apply",
+                chunk_size=chunk_size,
+                workers=workers,
             )
-            pricing_segments = cursor.fetchall()
-            if not pricing_segments:
-                skipped += 1
-                continue
+    except RecalcJobError as e:
+        raise HTTPException(status_code=409, detail=str(e))
 
-            price = None
-            for seg_start, seg_end, seg_price in pricing_segments:
-                if seg_start < seg_end:
-                    if seg_start <= t_start < seg_end:
-                        price = seg_price
-                        break
-                else:
-                    if t_start >= seg_start or t_start < seg_end:
-                        price = seg_price
-                        break
-            if price is None:
-                skipped += 1
-                continue
+    start_payments_recalc_task(job["job_id"])
+    return job
 
-            # 成本計算
-            kWh = (meter_stop - meter_start) / 1000
-            base_fee = 20.0
-            energy_fee = round(kWh * price, 2)
-            overuse_fee = round(kWh * 2 if kWh > 5 else 0, 2)
-            total_amount = round(base_fee + energy_fee + overuse_fee, 2)
 
-            # 寫入 payments 表
-            cursor.execute(
-                """
-                INSERT INTO payments (transaction_id, base_fee, energy_fee, overuse_fee, total_amount)
-                VALUES (?, ?, ?, ?, ?)
-            """,
-                (txn_id, base_fee, energy_fee, overuse_fee, total_amount),
-            )
-            created += 1
-
-            # 這裡重點修正：直接用 id_tag 對應卡片卡號
-            card_id = id_tag
-            cursor.execute(SHARED_BALANCE_BY_CARD_SQL, (card_id,))
-            balance_row = cursor.fetchone()
-            if balance_row:
-                old_balance = balance_row[0]
-                if old_balance >= total_amount:
-                    new_balance = round(old_balance - total_amount, 2)
-                    cursor.execute(
-                        """
-                        UPDATE household_accounts SET balance = ?, updated_at = ?
-                        WHERE account_id = (SELECT account_id FROM account_cards WHERE card_id = ?)
-                        """,
-                        (
-                            new_balance,
-                            datetime.utcnow().replace(tzinfo=timezone.utc).isoformat(),
-                            card_id,
-                        ),
-                    )
-                    print(
-                        f"💳 扣款成功：{card_id} | {old_balance} → {new_balance} 元 | txn={txn_id}"
-                    )
-                else:
-                    print(
-                        f"⚠️ 餘額不足：{card_id} | 餘額={old_balance}，費用={total_amount}"
-                    )
-            else:
-                print(f"⚠️ 找不到卡片餘額：card_id={card_id}")
+@app.get("/api/internal/recalculate-all-payments")
+def list_payments_recalc_jobs(limit: int = Query(default=20, ge=1, le=200)):
+    with get_conn() as _c:
+        return payments_recalc.list_jobs(_c, limit)
 
-        except Exception as e:
-            print(f"❌ 錯誤 txn {txn_id} | idTag={id_tag} | {e}")
-            skipped += 1
 
-    conn.commit()
-    return {
-        "message": "✅ 已重新計算所有交易成本（daily_pricing_rules 分段並自動扣款）",
-        "created": created,
-        "skipped": skipped,
-    }
+@app.get("/api/internal/recalculate-all-payments/{job_id}")
+def get_payments_recalc_job(job_id: int):
+    with get_conn() as _c:
+        job = payments_recalc.load_job(_c, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    job["active"] = job_id in payments_recalc_tasks
+    return job
+
+
+@app.post("/api/internal/recalculate-all-payments/{job_id}/resume", status_code=202)
+async def resume_payments_recalc_job(job_id: int):
+    with get_conn() as _c:
+        job = payments_recalc.load_job(_c, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    if job["status"] not in (payments_recalc.STATUS_RUNNING, payments_recalc.STATUS_FAILED):
+        raise HTTPException(status_code=409, detail=f"job is {job['status']}")
+    start_payments_recalc_task(job_id)
+    return job
 
 
 @app.get("/api/diagnostic/daily-pricing")
@@ -15029,11 +15664,184 @@ async def monitor_balance_and_auto_stop():
             await asyncio.sleep(10)
 
 
+# ===============================
+# OCPP Local Authorization List（SendLocalList）
+# ===============================
+async def _send_local_list(cp_id: str, update) -> str:
+    from ocpp.v16.enums import UpdateType
+
+    cp = connected_charge_points.get(cp_id)
+    if cp is None:
+        raise RuntimeError("cp_disconnected")
+    resp = await asyncio.wait_for(
+        cp.call(
+            call.SendLocalListPayload(
+                list_version=update.list_version,
+                update_type=UpdateType(update.update_type),
+                local_authorization_list=update.authorization_list(),
+            )
+        ),
+        timeout=60.0,
+    )
+    status = getattr(resp, "status", None)
+    return str(getattr(status, "value", status))
+
+
+async def _get_local_list_version(cp_id: str):
+    cp = connected_charge_points.get(cp_id)
+    if cp is None:
+        raise RuntimeError("cp_disconnected")
+    resp = await asyncio.wait_for(
+        cp.call(call.GetLocalListVersionPayload()), timeout=60.0
+    )
+    return getattr(resp, "list_version", None)
+
+
+local_list_sync = LocalListSync(
+    connect=lambda: get_conn(),
+    send=_send_local_list,
+    get_version=_get_local_list_version,
+    max_length=LOCAL_AUTH_LIST_MAX_LENGTH,
+    concurrency=LOCAL_AUTH_LIST_CONCURRENCY,
+    min_interval_s=LOCAL_AUTH_LIST_MIN_INTERVAL_SECONDS,
+)
+
+
+def schedule_local_list_sync(cp_id: str, delay_s: float = 5.0):
+    """BootNotification 回覆送出後再同步，避免在開機流程中插入 CALL。"""
+    if not LOCAL_AUTH_LIST_ENABLED:
+        return None
+
+    async def _run():
+        await asyncio.sleep(delay_s)
+        if is_cp_connection_alive(cp_id):
+            await local_list_sync.sync_charge_point(cp_id)
+
+    return asyncio.create_task(_run())
+
+
+async def local_auth_list_sync_loop():
+    """定期比對每支在線樁的本地授權清單，只推送有變動的樁。"""
+    while True:
+        await asyncio.sleep(LOCAL_AUTH_LIST_SYNC_SECONDS)
+        try:
+            await local_list_sync.sync_all(list(connected_charge_points))
+        except Exception as e:
+            logger.exception(f"[LOCAL_LIST][LOOP][ERR] err={e}")
+
+
+@app.get("/api/local-auth-list")
+def get_local_auth_list_status():
+    with get_conn() as _c:
+        states = local_auth_list.list_states(_c)
+    return {
+        "enabled": LOCAL_AUTH_LIST_ENABLED,
+        "sync": local_list_sync.snapshot(),
+        "charge_points": states,
+    }
+
+
+@app.get("/api/charge-points/{charge_point_id:path}/local-list")
+def get_charge_point_local_list(charge_point_id: str):
+    cp_id = _normalize_cp_id(charge_point_id)
+    with get_conn() as _c:
+        state = local_auth_list.load_state(_c, cp_id)
+        entries = local_auth_list.compute_local_list(_c, cp_id)
+    return {
+        "charge_point_id": cp_id,
+        "list_version": state.list_version if state else 0,
+        "last_status": state.last_status if state else None,
+        "in_sync": bool(state and state.entries == entries),
+        "entries": entries,
+    }
+
+
+@app.post("/api/charge-points/{charge_point_id:path}/local-list/sync")
+async def sync_charge_point_local_list(
+    charge_point_id: str, full: bool = Query(default=False)
+):
+    cp_id = _normalize_cp_id(charge_point_id)
+    if not is_cp_connection_alive(cp_id):
+        raise HTTPException(status_code=409, detail="charge point not connected")
+    return await local_list_sync.sync_charge_point(cp_id, force_full=full)
+
+
 # 啟動背景任務
+def run_balance_ledger_rollup() -> dict:
+    with household_connect(DB_FILE) as account_conn:
+        report = balance_ledger.rollup(account_conn)
+    if not report["ok"]:
+        logger.error(
+            f"[LEDGER][ROLLUP][DRIFT] accounts={report['accounts']} "
+            f"| drifted={report['drifted']} | unledgered={report['unledgered']}"
+        )
+    return report
+
+
+async def balance_ledger_rollup_loop():
+    """定期以帳本重算每戶餘額，與 household_accounts.balance 快取比對（只告警不修正）。"""
+    while True:
+        await asyncio.sleep(BALANCE_LEDGER_ROLLUP_SECONDS)
+        try:
+            await asyncio.to_thread(run_balance_ledger_rollup)
+        except Exception as e:
+            logger.exception(f"[LEDGER][ROLLUP][ERR] err={e}")
+
+
 @app.on_event("startup")
 async def startup_event():
     logger.warning("[STARTUP] SQLite database path: %s", DB_FILE)
+    schema = require_current_schema(conn)
+    logger.warning("[STARTUP] schema version: %s", schema.current_version)
+    previously_connected = restore_charger_state()
+    # 白名單於接受第一個連線前載入，accept 路徑之後只讀快取
+    try:
+        refresh_charge_point_whitelist_cache(reason="startup")
+    except sqlite3.Error as e:
+        # DB 暫時無法讀取時沿用快照中的白名單
+        if not charge_point_whitelist.loaded:
+            raise
+        logger.error(f"[STARTUP][WHITELIST_ERR] using snapshot whitelist | err={e}")
+    asyncio.create_task(warm_restart_task(previously_connected))
+    if CHARGER_STATE_SNAPSHOT_SECONDS > 0:
+        asyncio.create_task(charger_state_snapshot_loop())
+    resume_payments_recalc_jobs()
+    connection_log_batcher.start()
+    status_log_batcher.start()
+    if PRESENCE_FLUSH_SECONDS > 0:
+        asyncio.create_task(presence_flush_loop())
     asyncio.create_task(monitor_balance_and_auto_stop())
+    if BALANCE_LEDGER_ROLLUP_SECONDS > 0:
+        asyncio.create_task(balance_ledger_rollup_loop())
+    if LOCAL_AUTH_LIST_ENABLED and LOCAL_AUTH_LIST_SYNC_SECONDS > 0:
+        asyncio.create_task(local_auth_list_sync_loop())
+    if DB_MAINTENANCE_ENABLED and DB_MAINTENANCE_TICK_SECONDS > 0:
+        asyncio.create_task(database_maintenance_loop())
+    if DB_BACKUP_INTERVAL_SECONDS > 0:
+        asyncio.create_task(database_backup_loop())
+    try:
+        await asyncio.to_thread(sync_report_tracking)
+    except Exception as e:
+        logger.error(f"[STARTUP][REPORTING_TRACKING_ERR] err={e}")
+    if REPORTING_REPLICA_ENABLED and REPORTING_REFRESH_SECONDS > 0:
+        # 首次 refresh 會整份建立複本；完成前報表端點仍讀主資料庫
+        asyncio.create_task(reporting_replica_loop())
+    line_outbox_pool.start()
+    if not LINE_CHANNEL_SECRET:
+        logger.error("[STARTUP][LINE] LINE_CHANNEL_SECRET is not set; /webhook will reject every request")
+    line_webhook_queue.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await line_webhook_queue.stop()
+    await line_outbox_pool.stop()
+    await connection_log_batcher.stop()
+    await status_log_batcher.stop()
+    await asyncio.to_thread(flush_charge_point_presence)
+    if CHARGER_STATE_SNAPSHOT_SECONDS > 0:
+        await asyncio.to_thread(charger_state_snapshotter.save, _collect_charger_state())
+    database_maintenance.close()
 
 
 if __name__ == "__main__":
@@ -7,6 +7,7 @@ from datetime import datetime
 from pathlib import Path
 
 from db_config import get_database_path
+import balance_ledger
 from household_account_service import connect, ensure_schema, utc_iso
 
 
@@ -87,6 +88,7 @@ def migrate(db_file: str | None = None, create_backup: bool = True) -> dict[str,
                     """,
                     (card_id, cur.lastrowid, row["owner_name"], now, now),
                 )
+                balance_ledger.record_opening(conn, cur.lastrowid, now)
                 report["accounts_created"] = int(report["accounts_created"]) + 1
                 report["cards_linked"] = int(report["cards_linked"]) + 1
             conn.commit()
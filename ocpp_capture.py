@@ -0,0 +1,166 @@
+"""Append-only OCPP frame capture per charge point.
+
+When ``OCPP_CAPTURE_DIR`` is set, every raw OCPP-J frame that passes through
+``FastAPIWebSocketAdapter`` is appended to ``<dir>/<charge point>.ocpplog``.
+Each line is a compact JSON array::
+
+    [epoch_seconds, "open", {"charge_point_id": "TW*MSI*E000100", "connection_seq": 3}]
+    [epoch_seconds, "in",  "<raw frame received from the charger>"]
+    [epoch_seconds, "out", "<raw frame sent to the charger>"]
+    [epoch_seconds, "close", {}]
+
+Raw frames are stored verbatim (not re-encoded) so ``ocpp_replay.py`` can feed
+exactly the same bytes back into a server.  This module intentionally has no
+FastAPI or OCPP dependency.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Iterator
+
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_SUFFIX = ".ocpplog"
+DIRECTION_IN = "in"
+DIRECTION_OUT = "out"
+DIRECTION_OPEN = "open"
+DIRECTION_CLOSE = "close"
+
+_UNSAFE_FILENAME_CHARS = re.compile(r"[^A-Za-z0-9._-]")
+
+
+def capture_filename(charge_point_id: str) -> str:
+    """``TW*MSI*E000100`` → ``TW_MSI_E000100.ocpplog``."""
+    safe = _UNSAFE_FILENAME_CHARS.sub("_", str(charge_point_id or "").strip()) or "unknown"
+    return f"{safe}{CAPTURE_SUFFIX}"
+
+
+@dataclass(frozen=True)
+class CapturedFrame:
+    timestamp: float
+    direction: str
+    payload: Any
+
+    @property
+    def message(self) -> list | None:
+        """Decoded OCPP-J array for in/out frames, None for markers or bad JSON."""
+        if self.direction not in (DIRECTION_IN, DIRECTION_OUT):
+            return None
+        try:
+            decoded = json.loads(self.payload)
+        except (TypeError, ValueError):
+            return None
+        return decoded if isinstance(decoded, list) else None
+
+
+class ChargePointCapture:
+    """One charger's append-only capture file."""
+
+    def __init__(self, recorder: "OcppFrameRecorder", charge_point_id: str):
+        self.recorder = recorder
+        self.charge_point_id = charge_point_id
+        self.path = recorder.directory / capture_filename(charge_point_id)
+
+    def record(self, direction: str, payload: Any) -> None:
+        self.recorder.append(self.path, direction, payload)
+
+    def record_in(self, frame: str) -> None:
+        self.record(DIRECTION_IN, frame)
+
+    def record_out(self, frame: str) -> None:
+        self.record(DIRECTION_OUT, frame)
+
+    def open(self, **info: Any) -> None:
+        self.record(DIRECTION_OPEN, {"charge_point_id": self.charge_point_id, **info})
+
+    def close(self, **info: Any) -> None:
+        self.record(DIRECTION_CLOSE, info)
+
+
+class OcppFrameRecorder:
+    """
+    Appends frames with ``O_APPEND`` writes, one line per frame.
+
+    Files are opened per write so log rotation/cleanup never fights a held
+    handle, and a crashed process leaves complete lines only.  Capture errors
+    are logged and swallowed: capture must never break OCPP handling.
+    """
+
+    def __init__(self, directory: str | os.PathLike[str], charge_point_ids=None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.charge_point_ids = (
+            {str(cp_id).strip() for cp_id in charge_point_ids if str(cp_id).strip()}
+            if charge_point_ids
+            else None
+        )
+        self._lock = threading.Lock()
+
+    def enabled_for(self, charge_point_id: str) -> bool:
+        return self.charge_point_ids is None or charge_point_id in self.charge_point_ids
+
+    def for_charge_point(self, charge_point_id: str) -> ChargePointCapture | None:
+        if not self.enabled_for(charge_point_id):
+            return None
+        return ChargePointCapture(self, charge_point_id)
+
+    def append(self, path: Path, direction: str, payload: Any) -> None:
+        line = json.dumps(
+            [round(time.time(), 6), direction, payload],
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        try:
+            with self._lock:
+                with open(path, "a", encoding="utf-8") as handle:
+                    handle.write(line + "\n")
+        except Exception as exc:
+            logger.warning(f"[OCPP_CAPTURE][WRITE_ERR] path={path} | err={exc}")
+
+
+def recorder_from_env(environ=None) -> OcppFrameRecorder | None:
+    """OCPP_CAPTURE_DIR enables capture; OCPP_CAPTURE_CP_IDS limits it (comma list)."""
+    environ = os.environ if environ is None else environ
+    directory = str(environ.get("OCPP_CAPTURE_DIR", "") or "").strip()
+    if not directory:
+        return None
+    cp_ids = [
+        item.strip()
+        for item in str(environ.get("OCPP_CAPTURE_CP_IDS", "") or "").split(",")
+        if item.strip()
+    ]
+    return OcppFrameRecorder(directory, cp_ids or None)
+
+
+def read_capture(path: str | os.PathLike[str]) -> Iterator[CapturedFrame]:
+    """Yield frames in file order; a truncated trailing line is skipped."""
+    with open(path, "r", encoding="utf-8") as handle:
+        for line in handle:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                timestamp, direction, payload = json.loads(line)
+            except (TypeError, ValueError):
+                continue
+            yield CapturedFrame(float(timestamp), str(direction), payload)
+
+
+def charge_point_id_from_capture(path: str | os.PathLike[str]) -> str:
+    """The id stored in the first ``open`` marker, else the file stem."""
+    for frame in read_capture(path):
+        if frame.direction == DIRECTION_OPEN and isinstance(frame.payload, dict):
+            cp_id = str(frame.payload.get("charge_point_id") or "").strip()
+            if cp_id:
+                return cp_id
+    name = Path(path).name
+    return name[: -len(CAPTURE_SUFFIX)] if name.endswith(CAPTURE_SUFFIX) else name
@@ -0,0 +1,425 @@
+# ocpp_replay.py
+# ============================================================
+# Replay OCPP captures (ocpp_capture.py / OCPP_CAPTURE_DIR) into a server
+#
+#   # replay against a running server at real speed
+#   python ocpp_replay.py captures/TW_MSI_E000100.ocpplog --ws ws://127.0.0.1:8000
+#
+#   # start a throw-away local server, seed chargers/cards, replay 20x faster
+#   python ocpp_replay.py captures/*.ocpplog --local --speed 20 --output replay.json
+#
+#   # as fast as possible (throughput benchmark from real traffic)
+#   python ocpp_replay.py captures/*.ocpplog --local --speed 0
+#
+# Charger → server CALLs are sent with their original unique ids and payloads
+# (transactionId is remapped to the id the replay server assigned). Server →
+# charger CALLs are answered with the captured charger response for the same
+# action, in order. Assertions compare normalized CALLRESULT payloads per
+# captured CALL, so they do not depend on timing: volatile fields
+# (currentTime, timestamps, transactionId values) are masked.
+# ============================================================
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional
+
+import websockets
+
+from ocpp_capture import (
+    DIRECTION_IN,
+    DIRECTION_OPEN,
+    DIRECTION_OUT,
+    CapturedFrame,
+    charge_point_id_from_capture,
+    read_capture,
+)
+
+
+log = logging.getLogger("ocpp_replay")
+
+CALL = 2
+CALLRESULT = 3
+CALLERROR = 4
+
+VOLATILE_KEYS = {"currentTime", "timestamp", "expiryDate"}
+DEFAULT_SERVER_CALL_RESPONSE = {"status": "Accepted"}
+
+
+def normalize_payload(value: Any) -> Any:
+    """遮蔽與時間/DB 序號相關欄位，讓比對不受重播時間影響。"""
+    if isinstance(value, dict):
+        normalized = {}
+        for key, item in value.items():
+            if key in VOLATILE_KEYS:
+                normalized[key] = "<volatile>"
+            elif key == "transactionId":
+                normalized[key] = "<assigned>" if item else item
+            else:
+                normalized[key] = normalize_payload(item)
+        return normalized
+    if isinstance(value, list):
+        return [normalize_payload(item) for item in value]
+    return value
+
+
+@dataclass
+class ReplaySegment:
+    """One WebSocket connection worth of frames (between two ``open`` markers)."""
+
+    frames: List[CapturedFrame] = field(default_factory=list)
+
+
+@dataclass
+class ReplayPlan:
+    charge_point_id: str
+    segments: List[ReplaySegment]
+    expected_responses: Dict[str, list]
+    server_call_actions: Dict[str, str]
+    charger_responses_by_action: Dict[str, List[Any]]
+
+    @property
+    def charger_call_count(self) -> int:
+        return sum(
+            1
+            for segment in self.segments
+            for frame in segment.frames
+            if frame.direction == DIRECTION_IN
+            and (frame.message or [None])[0] == CALL
+        )
+
+
+def load_plan(path, charge_point_id: Optional[str] = None) -> ReplayPlan:
+    frames = list(read_capture(path))
+    cp_id = charge_point_id or charge_point_id_from_capture(path)
+
+    segments: List[ReplaySegment] = []
+    current = ReplaySegment()
+    expected: Dict[str, list] = {}
+    server_calls: Dict[str, str] = {}
+    responses_by_action: Dict[str, List[Any]] = {}
+
+    for frame in frames:
+        if frame.direction == DIRECTION_OPEN:
+            if current.frames:
+                segments.append(current)
+            current = ReplaySegment()
+            continue
+        message = frame.message
+        if not message:
+            continue
+        current.frames.append(frame)
+        kind, unique_id = message[0], str(message[1])
+        if frame.direction == DIRECTION_OUT and kind == CALL:
+            server_calls[unique_id] = str(message[2])
+        elif frame.direction == DIRECTION_OUT and kind in (CALLRESULT, CALLERROR):
+            expected[unique_id] = message
+        elif frame.direction == DIRECTION_IN and kind == CALLRESULT and unique_id in server_calls:
+            responses_by_action.setdefault(server_calls[unique_id], []).append(message[2])
+    if current.frames:
+        segments.append(current)
+
+    return ReplayPlan(
+        charge_point_id=cp_id,
+        segments=segments,
+        expected_responses=expected,
+        server_call_actions=server_calls,
+        charger_responses_by_action=responses_by_action,
+    )
+
+
+def collect_id_tags(plan: ReplayPlan) -> List[str]:
+    id_tags: List[str] = []
+    for segment in plan.segments:
+        for frame in segment.frames:
+            message = frame.message
+            if frame.direction == DIRECTION_IN and message and message[0] == CALL:
+                payload = message[3] if len(message) > 3 else {}
+                id_tag = payload.get("idTag") if isinstance(payload, dict) else None
+                if id_tag and id_tag not in id_tags:
+                    id_tags.append(str(id_tag))
+    return id_tags
+
+
+class ChargePointReplayer:
+    def __init__(
+        self,
+        plan: ReplayPlan,
+        ws_base: str,
+        speed: float = 1.0,
+        response_timeout: float = 30.0,
+        recorder=None,
+    ):
+        self.plan = plan
+        self.ws_base = ws_base.rstrip("/")
+        self.speed = float(speed)
+        self.response_timeout = float(response_timeout)
+        self.recorder = recorder
+        self.transaction_id_map: Dict[int, int] = {}
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.charger_responses: Dict[str, Deque[Any]] = {
+            action: deque(items) for action, items in plan.charger_responses_by_action.items()
+        }
+        self.live_server_calls: List[str] = []
+        self.mismatches: List[Dict[str, Any]] = []
+        self.calls_sent = 0
+        self.frames_sent = 0
+
+    def _remap_transaction_ids(self, value: Any) -> Any:
+        if isinstance(value, dict):
+            remapped = {}
+            for key, item in value.items():
+                if key == "transactionId" and isinstance(item, int):
+                    remapped[key] = self.transaction_id_map.get(item, item)
+                else:
+                    remapped[key] = self._remap_transaction_ids(item)
+            return remapped
+        if isinstance(value, list):
+            return [self._remap_transaction_ids(item) for item in value]
+        return value
+
+    async def _reader(self, ws):
+        async for raw in ws:
+            try:
+                message = json.loads(raw)
+            except ValueError:
+                continue
+            kind, unique_id = message[0], str(message[1])
+            if kind == CALL:
+                action = str(message[2])
+                self.live_server_calls.append(action)
+                queue = self.charger_responses.get(action)
+                payload = queue.popleft() if queue else DEFAULT_SERVER_CALL_RESPONSE
+                await ws.send(json.dumps([CALLRESULT, unique_id, payload]))
+                self.frames_sent += 1
+            else:
+                future = self.pending.pop(unique_id, None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+
+    async def _replay_segment(self, segment: ReplaySegment, clock: Dict[str, float]):
+        async with websockets.connect(
+            f"{self.ws_base}/{self.plan.charge_point_id}",
+            subprotocols=["ocpp1.6"],
+            ping_interval=None,
+            close_timeout=2,
+            max_queue=None,
+        ) as ws:
+            reader = asyncio.create_task(self._reader(ws))
+            try:
+                for frame in segment.frames:
+                    message = frame.message
+                    if frame.direction != DIRECTION_IN or message[0] != CALL:
+                        continue
+                    await self._wait_until(frame.timestamp, clock)
+                    await self._send_call(ws, message)
+            finally:
+                reader.cancel()
+                await asyncio.gather(reader, return_exceptions=True)
+
+    async def _wait_until(self, captured_ts: float, clock: Dict[str, float]):
+        if "capture_t0" not in clock:
+            clock["capture_t0"] = captured_ts
+            clock["replay_t0"] = time.monotonic()
+            return
+        if self.speed <= 0:
+            return
+        target = clock["replay_t0"] + (captured_ts - clock["capture_t0"]) / self.speed
+        delay = target - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _send_call(self, ws, message: list):
+        unique_id, action = str(message[1]), str(message[2])
+        payload = self._remap_transaction_ids(message[3] if len(message) > 3 else {})
+        future = asyncio.get_running_loop().create_future()
+        self.pending[unique_id] = future
+
+        t0 = time.perf_counter()
+        await ws.send(json.dumps([CALL, unique_id, action, payload], ensure_ascii=False))
+        self.calls_sent += 1
+        self.frames_sent += 1
+        try:
+            response = await asyncio.wait_for(future, timeout=self.response_timeout)
+            ok = response[0] == CALLRESULT
+        except asyncio.TimeoutError:
+            self.pending.pop(unique_id, None)
+            response, ok = None, False
+        if self.recorder is not None:
+            self.recorder.record(action, time.perf_counter() - t0, ok=ok)
+
+        expected = self.plan.expected_responses.get(unique_id)
+        if action == "StartTransaction" and expected and response and response[0] == CALLRESULT:
+            captured_tx = (expected[2] or {}).get("transactionId")
+            live_tx = (response[2] or {}).get("transactionId")
+            if captured_tx and live_tx:
+                self.transaction_id_map[int(captured_tx)] = int(live_tx)
+
+        if expected is None:
+            return
+        if response is None:
+            self.mismatches.append({"unique_id": unique_id, "action": action, "error": "timeout"})
+            return
+        expected_norm = [expected[0], normalize_payload(expected[2])]
+        actual_norm = [response[0], normalize_payload(response[2])]
+        if expected_norm != actual_norm:
+            self.mismatches.append(
+                {
+                    "unique_id": unique_id,
+                    "action": action,
+                    "expected": expected_norm,
+                    "actual": actual_norm,
+                }
+            )
+
+    async def run(self) -> Dict[str, Any]:
+        t0 = time.perf_counter()
+        clock: Dict[str, float] = {}
+        for segment in self.plan.segments:
+            await self._replay_segment(segment, clock)
+        elapsed_s = time.perf_counter() - t0
+        captured_server_calls = [
+            self.plan.server_call_actions[str(frame.message[1])]
+            for segment in self.plan.segments
+            for frame in segment.frames
+            if frame.direction == DIRECTION_OUT and frame.message[0] == CALL
+        ]
+        return {
+            "charge_point_id": self.plan.charge_point_id,
+            "connections": len(self.plan.segments),
+            "calls_sent": self.calls_sent,
+            "frames_sent": self.frames_sent,
+            "elapsed_s": round(elapsed_s, 3),
+            "calls_per_s": round(self.calls_sent / elapsed_s, 2) if elapsed_s > 0 else None,
+            "mismatches": self.mismatches,
+            # 伺服器主動呼叫（SetChargingProfile / RemoteStop…）受 debounce/時間影響，只列出不判定
+            "server_calls": {
+                "captured": captured_server_calls,
+                "live": list(self.live_server_calls),
+            },
+        }
+
+
+async def replay_captures(
+    paths: List[str],
+    ws_base: str,
+    speed: float = 1.0,
+    response_timeout: float = 30.0,
+    charge_point_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    from load_test import LatencyRecorder
+
+    recorder = LatencyRecorder()
+    plans = [load_plan(path, charge_point_id) for path in paths]
+    replayers = [
+        ChargePointReplayer(plan, ws_base, speed, response_timeout, recorder) for plan in plans
+    ]
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*(replayer.run() for replayer in replayers))
+    elapsed_s = time.perf_counter() - t0
+    return {
+        "speed": speed,
+        "charge_points": results,
+        "mismatch_count": sum(len(result["mismatches"]) for result in results),
+        "latency": recorder.summary(elapsed_s),
+    }
+
+
+def seed_for_replay(database_path, plans: List[ReplayPlan], balance: float = 1_000_000.0):
+    """白名單所有 charger，並為每個 idTag 建住戶帳戶 + 綁卡 + 允許所有 charger。"""
+    from household_account_service import (
+        bind_card_to_account,
+        connect,
+        create_household_account,
+    )
+
+    cp_ids = [plan.charge_point_id for plan in plans]
+    id_tags: List[str] = []
+    for plan in plans:
+        for id_tag in collect_id_tags(plan):
+            if id_tag not in id_tags:
+                id_tags.append(id_tag)
+
+    conn = connect(str(database_path))
+    try:
+        conn.executemany(
+            "INSERT OR IGNORE INTO charge_points (charge_point_id, name, status) VALUES (?, ?, 'enabled')",
+            [(cp_id, f"replay {cp_id}") for cp_id in cp_ids],
+        )
+        conn.commit()
+        for index, id_tag in enumerate(id_tags, start=1):
+            account = create_household_account(conn, "REPLAY", f"R{index:05d}", balance=balance)
+            bind_card_to_account(conn, int(account["account_id"]), id_tag)
+        conn.executemany(
+            "INSERT INTO card_whitelist (card_id, charge_point_id) VALUES (?, ?)",
+            [(id_tag, cp_id) for id_tag in id_tags for cp_id in cp_ids],
+        )
+        conn.execute(
+            "UPDATE community_settings SET enabled = 1, contract_kw = ? WHERE id = 1",
+            (7.0 * max(1, len(cp_ids)),),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def _run_local(args) -> Dict[str, Any]:
+    import tempfile
+
+    from load_test import LoadTestConfig, LocalServer
+
+    plans = [load_plan(path, args.cp_id) for path in args.captures]
+    with tempfile.TemporaryDirectory(prefix="ocpp_replay_") as directory:
+        server = LocalServer(LoadTestConfig(port=args.port), Path(directory))
+        server.start()
+        try:
+            await asyncio.to_thread(seed_for_replay, server.database_path, plans)
+            return await replay_captures(
+                args.captures, server.ws_base, args.speed, args.timeout, args.cp_id
+            )
+        finally:
+            server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay OCPP captures into a server")
+    parser.add_argument("captures", nargs="+", help=".ocpplog files (one per charger)")
+    parser.add_argument("--ws", dest="ws_base", default="ws://127.0.0.1:8000")
+    parser.add_argument("--local", action="store_true",
+                        help="Start a throw-away local server and seed chargers/cards")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="1 = real time, 10 = 10x faster, 0 = no delays")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Per-CALL response timeout")
+    parser.add_argument("--cp-id", default=None, help="Override charge point id (single capture)")
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--strict", action="store_true", help="Exit 1 when any response differs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
+
+    if args.local:
+        report = asyncio.run(_run_local(args))
+    else:
+        report = asyncio.run(
+            replay_captures(args.captures, args.ws_base, args.speed, args.timeout, args.cp_id)
+        )
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    print(text)
+    if args.strict and report["mismatch_count"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,484 @@
+"""Background, resumable recalculation of the ``payments`` table.
+
+``/api/internal/recalculate-all-payments`` used to ``DELETE FROM payments``
+and rebuild it on the shared global cursor inside the request, with its own
+single-price rule that skipped sessions crossing midnight.  A job here:
+
+- prices every finished transaction with ``billing.settlement_amount`` (the
+  same multi-period engine StopTransaction uses), with the pricing rules
+  loaded once per job;
+- walks ``transactions`` by primary key in chunks; a wave of chunks is
+  computed by a thread pool (read-only, one connection per chunk) and each
+  chunk's rows are written to ``payments_recalc_shadow`` in one short
+  ``BEGIN IMMEDIATE`` transaction together with the job's cursor
+  (``last_transaction_id``), so a crashed job resumes after the last
+  committed chunk;
+- ``dry_run`` jobs stop there and store ``diff`` against current payments in
+  the job summary; ``apply`` jobs swap the shadow rows in with a single
+  transaction (delete + insert for exactly the recalculated transactions).
+
+Recalculation never touches balances: debits are owned by the settlement
+ledger (``balance_ledger``) and re-debiting on every recalculation would
+charge households twice.  Transactions that cannot be priced (no meter
+start/stop or stop time) keep their existing payment rows.
+
+This module intentionally has no FastAPI or OCPP dependency.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable
+
+import billing
+import tariff_engine
+
+
+logger = logging.getLogger(__name__)
+
+MODES = ("apply", "dry_run")
+STATUS_RUNNING = "running"
+STATUS_COMPLETED = "completed"
+STATUS_FAILED = "failed"
+# 失敗後又建立了新 job：shadow 資料已清除，不可再續跑
+STATUS_SUPERSEDED = "superseded"
+# REAL 金額比對容許的誤差（小於 1 分）
+AMOUNT_TOLERANCE = 0.005
+
+JOB_COLUMNS = (
+    "job_id",
+    "mode",
+    "status",
+    "max_transaction_id",
+    "total",
+    "processed",
+    "computed",
+    "skipped",
+    "last_transaction_id",
+    "chunk_size",
+    "workers",
+    "summary",
+    "error",
+    "created_at",
+    "updated_at",
+    "finished_at",
+)
+
+
+class RecalcJobError(RuntimeError):
+    """A job cannot be created or resumed in its current state."""
+
+
+def _utc_iso() -> str:
+    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+
+
+def _placeholders(values) -> str:
+    return ",".join("?" for _ in values)
+
+
+@dataclass(frozen=True)
+class RecalcResult:
+    transaction_id: int
+    total_amount: float | None
+    paid_at: str | None
+
+    @property
+    def skipped(self) -> bool:
+        return self.total_amount is None
+
+
+def _job_dict(row) -> dict[str, Any]:
+    job = dict(zip(JOB_COLUMNS, tuple(row)))
+    job["summary"] = json.loads(job["summary"]) if job["summary"] else None
+    job["progress"] = round(job["processed"] / job["total"], 4) if job["total"] else 1.0
+    return job
+
+
+def load_job(conn: sqlite3.Connection, job_id: int) -> dict[str, Any] | None:
+    row = conn.execute(
+        f"SELECT {', '.join(JOB_COLUMNS)} FROM payment_recalc_jobs WHERE job_id = ?",
+        (int(job_id),),
+    ).fetchone()
+    return _job_dict(row) if row else None
+
+
+def list_jobs(conn: sqlite3.Connection, limit: int = 20) -> list[dict[str, Any]]:
+    rows = conn.execute(
+        f"""
+        SELECT {', '.join(JOB_COLUMNS)} FROM payment_recalc_jobs
+        ORDER BY job_id DESC LIMIT ?
+        """,
+        (int(limit),),
+    ).fetchall()
+    return [_job_dict(row) for row in rows]
+
+
+def running_job_ids(conn: sqlite3.Connection) -> list[int]:
+    rows = conn.execute(
+        "SELECT job_id FROM payment_recalc_jobs WHERE status = ? ORDER BY job_id",
+        (STATUS_RUNNING,),
+    ).fetchall()
+    return [int(row[0]) for row in rows]
+
+
+def create_job(
+    conn: sqlite3.Connection, *, mode: str = "apply", chunk_size: int = 200, workers: int = 4
+) -> dict[str, Any]:
+    """Snapshot the scope (finished transactions up to the current max id) and queue a job."""
+    if mode not in MODES:
+        raise ValueError(f"unknown mode: {mode}")
+    now = _utc_iso()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if running_job_ids(conn):
+            raise RecalcJobError("a payments recalculation job is already running")
+        max_tx, total = conn.execute(
+            """
+            SELECT COALESCE(MAX(transaction_id), 0), COUNT(*)
+            FROM transactions
+            WHERE meter_stop IS NOT NULL
+            """
+        ).fetchone()
+        # 舊 job 的 shadow 資料已無用（dry-run 的差異已存在 summary）
+        conn.execute("DELETE FROM payments_recalc_shadow")
+        conn.execute(
+            "UPDATE payment_recalc_jobs SET status = ?, updated_at = ? WHERE status = ?",
+            (STATUS_SUPERSEDED, now, STATUS_FAILED),
+        )
+        cur = conn.execute(
+            """
+            INSERT INTO payment_recalc_jobs (
+                mode, status, max_transaction_id, total, chunk_size, workers,
+                created_at, updated_at
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                mode,
+                STATUS_RUNNING,
+                int(max_tx),
+                int(total),
+                max(1, int(chunk_size)),
+                max(1, int(workers)),
+                now,
+                now,
+            ),
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return load_job(conn, cur.lastrowid)
+
+
+def compute_chunk(
+    conn: sqlite3.Connection,
+    transaction_ids: list[int],
+    rules_by_date: billing.RulesByDate,
+    surcharge_per_kwh: Any = 0,
+) -> list[RecalcResult]:
+    """Price one chunk: two range reads (transactions, meter_values), no writes."""
+    marks = _placeholders(transaction_ids)
+    transactions = conn.execute(
+        f"""
+        SELECT transaction_id, meter_start, meter_stop, stop_timestamp
+        FROM transactions
+        WHERE transaction_id IN ({marks})
+        ORDER BY transaction_id
+        """,
+        transaction_ids,
+    ).fetchall()
+    readings: dict[int, list[tuple]] = {}
+    for tx_id, ts, value in conn.execute(
+        f"""
+        SELECT transaction_id, timestamp, value
+        FROM meter_values
+        WHERE transaction_id IN ({marks})
+          AND measurand LIKE 'Energy.Active.Import%'
+        ORDER BY transaction_id, timestamp ASC
+        """,
+        transaction_ids,
+    ):
+        readings.setdefault(int(tx_id), []).append((ts, value))
+
+    results = []
+    for tx_id, meter_start, meter_stop, stop_ts in transactions:
+        if meter_start is None or meter_stop is None or not stop_ts:
+            results.append(RecalcResult(int(tx_id), None, stop_ts))
+            continue
+        total, _ = billing.settlement_amount(
+            meter_start,
+            meter_stop,
+            stop_ts,
+            readings.get(int(tx_id), []),
+            rules_by_date,
+            surcharge_per_kwh,
+        )
+        results.append(RecalcResult(int(tx_id), total, stop_ts))
+    return results
+
+
+def write_chunk(conn: sqlite3.Connection, job_id: int, results: list[RecalcResult]) -> None:
+    """One short write transaction: shadow rows + job cursor advance together."""
+    rows = [
+        (job_id, r.transaction_id, 0.0, r.total_amount, 0.0, r.total_amount, r.paid_at)
+        for r in results
+        if not r.skipped
+    ]
+    skipped = len(results) - len(rows)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO payments_recalc_shadow (
+                job_id, transaction_id, base_fee, energy_fee,
+                overuse_fee, total_amount, paid_at
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
+        conn.execute(
+            """
+            UPDATE payment_recalc_jobs
+            SET processed = processed + ?,
+                computed = computed + ?,
+                skipped = skipped + ?,
+                last_transaction_id = MAX(last_transaction_id, ?),
+                updated_at = ?
+            WHERE job_id = ?
+            """,
+            (
+                len(results),
+                len(rows),
+                skipped,
+                max((r.transaction_id for r in results), default=0),
+                _utc_iso(),
+                job_id,
+            ),
+        )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def diff(conn: sqlite3.Connection, job_id: int, limit: int = 50) -> dict[str, Any]:
+    """Compare the job's shadow rows with the latest current payment of each transaction."""
+    summary = {
+        "compared": 0,
+        "unchanged": 0,
+        "changed": 0,
+        "added": 0,
+        "duplicates_collapsed": 0,
+        "old_total": 0.0,
+        "new_total": 0.0,
+        "changes": [],
+    }
+    changes = []
+    for tx_id, new_total, old_total, old_rows in conn.execute(
+        """
+        SELECT s.transaction_id, s.total_amount,
+               (
+                   SELECT p.total_amount FROM payments p
+                   WHERE p.transaction_id = s.transaction_id
+                   ORDER BY p.id DESC LIMIT 1
+               ),
+               (
+                   SELECT COUNT(*) FROM payments p
+                   WHERE p.transaction_id = s.transaction_id
+               )
+        FROM payments_recalc_shadow s
+        WHERE s.job_id = ?
+        ORDER BY s.transaction_id
+        """,
+        (int(job_id),),
+    ):
+        summary["compared"] += 1
+        summary["new_total"] += float(new_total or 0)
+        if old_rows > 1:
+            summary["duplicates_collapsed"] += old_rows - 1
+        if old_total is None:
+            summary["added"] += 1
+            changes.append((tx_id, None, new_total, float(new_total or 0)))
+            continue
+        summary["old_total"] += float(old_total)
+        delta = float(new_total or 0) - float(old_total)
+        if abs(delta) < AMOUNT_TOLERANCE:
+            summary["unchanged"] += 1
+        else:
+            summary["changed"] += 1
+            changes.append((tx_id, old_total, new_total, delta))
+
+    changes.sort(key=lambda c: abs(c[3]), reverse=True)
+    summary["changes"] = [
+        {"transaction_id": tx_id, "old": old, "new": new, "delta": round(delta, 2)}
+        for tx_id, old, new, delta in changes[: max(0, int(limit))]
+    ]
+    summary["old_total"] = round(summary["old_total"], 2)
+    summary["new_total"] = round(summary["new_total"], 2)
+    summary["delta_total"] = round(summary["new_total"] - summary["old_total"], 2)
+    return summary
+
+
+def swap_in(conn: sqlite3.Connection, job_id: int) -> int:
+    """Atomically replace the payments of every recalculated transaction with the shadow rows."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            """
+            DELETE FROM payments
+            WHERE transaction_id IN (
+                SELECT transaction_id FROM payments_recalc_shadow WHERE job_id = ?
+            )
+            """,
+            (job_id,),
+        )
+        cur = conn.execute(
+            """
+            INSERT INTO payments (
+                transaction_id, base_fee, energy_fee, overuse_fee, total_amount, paid_at
+            )
+            SELECT transaction_id, base_fee, energy_fee, overuse_fee, total_amount, paid_at
+            FROM payments_recalc_shadow
+            WHERE job_id = ?
+            ORDER BY transaction_id
+            """,
+            (job_id,),
+        )
+        swapped = cur.rowcount
+        conn.execute("DELETE FROM payments_recalc_shadow WHERE job_id = ?", (job_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return swapped
+
+
+def _finish(conn: sqlite3.Connection, job_id: int, status: str, *, summary=None, error=None) -> None:
+    now = _utc_iso()
+    conn.execute(
+        """
+        UPDATE payment_recalc_jobs
+        SET status = ?, summary = COALESCE(?, summary), error = ?,
+            updated_at = ?, finished_at = ?
+        WHERE job_id = ?
+        """,
+        (
+            status,
+            json.dumps(summary, ensure_ascii=False) if summary is not None else None,
+            error,
+            now,
+            now,
+            job_id,
+        ),
+    )
+    conn.commit()
+
+
+class PaymentRecalculator:
+    """
+    Runs (or resumes) a job.  ``run`` is blocking: call it via
+    ``asyncio.to_thread`` so the event loop never waits on the recalculation.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], sqlite3.Connection],
+        *,
+        surcharge_per_kwh: Any = 0,
+        on_swapped: Callable[[int], None] | None = None,
+    ):
+        self.connect = connect
+        self.surcharge_per_kwh = surcharge_per_kwh
+        self.on_swapped = on_swapped
+
+    def _compute(self, transaction_ids, rules_by_date) -> list[RecalcResult]:
+        conn = self.connect()
+        try:
+            return compute_chunk(conn, transaction_ids, rules_by_date, self.surcharge_per_kwh)
+        finally:
+            conn.close()
+
+    def run(self, job_id: int) -> dict[str, Any]:
+        conn = self.connect()
+        try:
+            job = load_job(conn, job_id)
+            if job is None:
+                raise RecalcJobError(f"job not found: {job_id}")
+            if job["status"] == STATUS_COMPLETED:
+                return job
+            if job["status"] == STATUS_SUPERSEDED:
+                raise RecalcJobError(f"job {job_id} was superseded by a newer job")
+            if job["status"] == STATUS_FAILED:
+                conn.execute(
+                    "UPDATE payment_recalc_jobs SET status = ?, error = NULL WHERE job_id = ?",
+                    (STATUS_RUNNING, job_id),
+                )
+                conn.commit()
+            logger.warning(
+                f"[PAYMENTS][RECALC][START] job_id={job_id} | mode={job['mode']} "
+                f"| resume_after={job['last_transaction_id']} | total={job['total']}"
+            )
+            try:
+                self._run_chunks(conn, job)
+                summary = diff(conn, job_id)
+                if job["mode"] == "apply":
+                    summary["swapped"] = swap_in(conn, job_id)
+                _finish(conn, job_id, STATUS_COMPLETED, summary=summary)
+            except Exception as e:
+                logger.exception(f"[PAYMENTS][RECALC][ERR] job_id={job_id} | err={e}")
+                try:
+                    conn.rollback()
+                    _finish(conn, job_id, STATUS_FAILED, error=str(e))
+                except sqlite3.Error:
+                    pass
+                raise
+            if job["mode"] == "apply" and self.on_swapped is not None:
+                self.on_swapped(job_id)
+            job = load_job(conn, job_id)
+            logger.warning(
+                f"[PAYMENTS][RECALC][DONE] job_id={job_id} | mode={job['mode']} "
+                f"| computed={job['computed']} | skipped={job['skipped']} "
+                f"| changed={job['summary']['changed']}"
+            )
+            return job
+        finally:
+            conn.close()
+
+    def _run_chunks(self, conn: sqlite3.Connection, job: dict[str, Any]) -> None:
+        job_id = job["job_id"]
+        chunk_size = job["chunk_size"]
+        workers = job["workers"]
+        cursor = job["last_transaction_id"]
+        # 電價規則每個 job 只載入一次，所有 worker 共用
+        rules_by_date = tariff_engine.load_rules_by_date(conn)
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="payments-recalc") as pool:
+            while True:
+                ids = [
+                    int(row[0])
+                    for row in conn.execute(
+                        """
+                        SELECT transaction_id FROM transactions
+                        WHERE transaction_id > ? AND transaction_id <= ?
+                          AND meter_stop IS NOT NULL
+                        ORDER BY transaction_id
+                        LIMIT ?
+                        """,
+                        (cursor, job["max_transaction_id"], chunk_size * workers),
+                    )
+                ]
+                if not ids:
+                    return
+                chunks = [ids[i : i + chunk_size] for i in range(0, len(ids), chunk_size)]
+                # 平行計算、依序寫入：游標永遠是連續的已提交範圍
+                for results in pool.map(lambda c: self._compute(c, rules_by_date), chunks):
+                    write_chunk(conn, job_id, results)
+                cursor = ids[-1]
@@ -0,0 +1,399 @@
+"""Incremental calendar pricing import and the tariff version.
+
+``import_daily_pricing_calendar`` / ``apply_special_days_pricing`` used to
+walk every day in Python, delete the whole range and reinsert it in one
+transaction, holding the write lock (and blocking meter ingestion) for the
+whole multi-year import.  The pipeline here:
+
+- ``target_rules`` computes each day's rule set from the templates and the
+  holiday calendar, purely in memory;
+- ``load_existing`` reads the current rows for the range in one query and
+  ``plan_changes`` keeps only the days whose rule set differs (or, in
+  ``fill_missing`` mode, that have no rules at all);
+- ``apply_changes`` writes the changed days in small ``BEGIN IMMEDIATE``
+  batches, pausing between batches so other writers get the lock.
+
+The calendar import itself now stores one definition per year and lets
+``tariff_engine`` compile the days; ``apply_changes`` is what writes (or,
+with empty rules, deletes) the per-date override rows.
+
+Every write to ``daily_pricing_rules`` bumps ``tariff_state.version``
+(migration 13 triggers, so legacy endpoints and scripts are covered too).
+``TariffRulesCache`` keeps per-date rules in memory and drops them when the
+version moves.
+
+This module intentionally has no FastAPI or OCPP dependency.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+from typing import Any, Callable, Iterable
+
+
+Rule = tuple[str, str, float, str]
+DayRules = tuple[Rule, ...]
+
+MODES = ("fill_missing", "overwrite")
+
+# (season, "MM-DD", "MM-DD")；不在任何區間內為 non_summer
+SeasonRanges = tuple[tuple[str, str, str], ...]
+DEFAULT_SEASON_RANGES: SeasonRanges = (("summer", "06-01", "09-30"),)
+
+
+def season_for_date(target_date: date, season_ranges: SeasonRanges | None = None) -> str:
+    """台電季節：預設 6/1 ～ 9/30 為 summer，其餘 non_summer。"""
+    month_day = target_date.strftime("%m-%d")
+    for season, first, last in season_ranges or DEFAULT_SEASON_RANGES:
+        if first <= month_day <= last:
+            return season
+    return "non_summer"
+
+
+def day_type_for_date(target_date: date, holiday_map: dict[str, str]) -> str:
+    """holidays JSON 的 workday / holiday 優先，其次星期日 / 星期六，其他為 weekday。"""
+    override = holiday_map.get(target_date.strftime("%Y-%m-%d"))
+    if override == "workday":
+        return "weekday"
+    if override == "holiday":
+        return "holiday"
+    wd = target_date.weekday()
+    if wd == 6:
+        return "sunday"
+    if wd == 5:
+        return "saturday"
+    return "weekday"
+
+
+def _normalize_rule(start, end, price, label) -> Rule:
+    return (str(start), str(end), float(price), str(label or ""))
+
+
+def normalize_rules(rules: Iterable[tuple]) -> DayRules:
+    """``(start, end, price, label)`` rows → sorted, comparable day rules."""
+    return tuple(sorted(_normalize_rule(*rule) for rule in rules))
+
+
+def template_rules(
+    templates: dict[str, Any],
+    target_date: date,
+    day_type: str,
+    season_ranges: SeasonRanges | None = None,
+) -> DayRules:
+    """例假日沿用星期日模板並標記 label=holiday（與原匯入規則相同）。"""
+    return season_template_rules(
+        templates, season_for_date(target_date, season_ranges), day_type
+    )
+
+
+def season_template_rules(templates: dict[str, Any], season: str, day_type: str) -> DayRules:
+    season_templates = templates.get(season) or {}
+    template_key = "sunday" if day_type == "holiday" else day_type
+    label_override = "holiday" if day_type == "holiday" else None
+    return tuple(
+        sorted(
+            _normalize_rule(
+                rule.get("startTime"),
+                rule.get("endTime"),
+                rule.get("price"),
+                label_override or rule.get("label", ""),
+            )
+            for rule in season_templates.get(template_key) or []
+        )
+    )
+
+
+def target_rules(
+    templates: dict[str, Any],
+    holiday_maps: dict[int, dict[str, str]],
+    start_date: date,
+    end_date: date,
+) -> dict[str, tuple[str, DayRules]]:
+    """``{date: (day_type, rules)}`` for every day in the range."""
+    targets = {}
+    current = start_date
+    while current <= end_date:
+        day_type = day_type_for_date(current, holiday_maps.get(current.year, {}))
+        targets[current.strftime("%Y-%m-%d")] = (
+            day_type,
+            template_rules(templates, current, day_type),
+        )
+        current += timedelta(days=1)
+    return targets
+
+
+def load_existing(
+    conn: sqlite3.Connection, dates: Iterable[str] | None = None, *, first: str | None = None, last: str | None = None
+) -> dict[str, DayRules]:
+    """目前資料：給 first/last 讀一段範圍，或給 dates 讀指定日期（皆為單次查詢）。"""
+    if dates is not None:
+        dates = sorted(set(dates))
+        if not dates:
+            return {}
+        rows = conn.execute(
+            f"""
+            SELECT date, start_time, end_time, price, label
+            FROM daily_pricing_rules
+            WHERE date IN ({",".join("?" for _ in dates)})
+            """,
+            dates,
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            """
+            SELECT date, start_time, end_time, price, label
+            FROM daily_pricing_rules
+            WHERE date BETWEEN ? AND ?
+            """,
+            (first, last),
+        ).fetchall()
+    grouped: dict[str, list[tuple]] = {}
+    for r_date, *rule in rows:
+        grouped.setdefault(r_date, []).append(rule)
+    return {r_date: normalize_rules(rules) for r_date, rules in grouped.items()}
+
+
+def plan_changes(
+    existing: dict[str, DayRules], targets: dict[str, DayRules], mode: str = "overwrite"
+) -> dict[str, DayRules]:
+    """只留下需要寫入的日期。"""
+    if mode not in MODES:
+        raise ValueError(f"unknown mode: {mode}")
+    if mode == "fill_missing":
+        return {d: rules for d, rules in targets.items() if d not in existing}
+    return {d: rules for d, rules in targets.items() if existing.get(d) != rules}
+
+
+@dataclass
+class ApplyReport:
+    days_written: int = 0
+    rules_inserted: int = 0
+    deleted_rows: int = 0
+    batches: int = 0
+    lock_ms: float = 0.0
+    max_batch_lock_ms: float = 0.0
+    tariff_version: int | None = None
+    dates: list[str] = field(default_factory=list)
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "daysWritten": self.days_written,
+            "rulesInserted": self.rules_inserted,
+            "deletedRows": self.deleted_rows,
+            "batches": self.batches,
+            "lockMs": round(self.lock_ms, 2),
+            "maxBatchLockMs": round(self.max_batch_lock_ms, 2),
+            "tariffVersion": self.tariff_version,
+        }
+
+
+def apply_changes(
+    conn: sqlite3.Connection,
+    changes: dict[str, DayRules],
+    *,
+    batch_days: int = 62,
+    pause_s: float = 0.005,
+    clock: Callable[[], float] = time.perf_counter,
+) -> ApplyReport:
+    """Replace the changed days in short committed batches (delete + insert per batch)."""
+    report = ApplyReport()
+    dates = sorted(changes)
+    batch_days = max(1, int(batch_days))
+    for i in range(0, len(dates), batch_days):
+        batch = dates[i : i + batch_days]
+        rows = [(d, *rule) for d in batch for rule in changes[d]]
+        if i and pause_s > 0:
+            # 讓出寫入鎖給即時電表寫入等其他 writer
+            time.sleep(pause_s)
+        started = clock()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cur = conn.execute(
+                f"DELETE FROM daily_pricing_rules WHERE date IN ({','.join('?' for _ in batch)})",
+                batch,
+            )
+            report.deleted_rows += max(0, cur.rowcount or 0)
+            conn.executemany(
+                """
+                INSERT INTO daily_pricing_rules (date, start_time, end_time, price, label)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                rows,
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        elapsed_ms = (clock() - started) * 1000
+        report.lock_ms += elapsed_ms
+        report.max_batch_lock_ms = max(report.max_batch_lock_ms, elapsed_ms)
+        report.batches += 1
+        report.days_written += len(batch)
+        report.rules_inserted += len(rows)
+        report.dates.extend(batch)
+    report.tariff_version = tariff_version(conn)
+    return report
+
+
+def tariff_version(conn: sqlite3.Connection) -> int | None:
+    """None when the database predates migration 13."""
+    try:
+        row = conn.execute("SELECT version FROM tariff_state WHERE id = 1").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return int(row[0]) if row else None
+
+
+_json_cache: dict[str, tuple[float, Any]] = {}
+_json_cache_lock = threading.Lock()
+
+
+def read_json_cached(path: str) -> Any:
+    """holidays/YYYY.json：檔案 mtime 未變就不重新解析。"""
+    mtime = os.path.getmtime(path)
+    with _json_cache_lock:
+        cached = _json_cache.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    with _json_cache_lock:
+        _json_cache[path] = (mtime, data)
+    return data
+
+
+@dataclass
+class TariffRulesCacheStats:
+    hits: int = 0
+    misses: int = 0
+    version_checks: int = 0
+    invalidations: int = 0
+
+
+def load_rule_rows(
+    conn: sqlite3.Connection, dates: list[str]
+) -> dict[str, list[tuple[str, str, float]]]:
+    """daily_pricing_rules 原始列（rowid 順序）；沒有規則的日期回空 list。"""
+    loaded: dict[str, list[tuple[str, str, float]]] = {d: [] for d in dates}
+    if not dates:
+        return loaded
+    for r_date, start, end, price in conn.execute(
+        f"""
+        SELECT date, start_time, end_time, price
+        FROM daily_pricing_rules
+        WHERE date IN ({",".join("?" for _ in dates)})
+        ORDER BY rowid
+        """,
+        dates,
+    ):
+        loaded[r_date].append((start, end, price))
+    return loaded
+
+
+class TariffRulesCache:
+    """
+    Per-date ``(start, end, price)`` rules keyed by the tariff version.
+
+    The version is re-read at most every ``check_interval_s``; in-process
+    writers call ``invalidate`` after commit so their changes apply at once.
+    Without a version (pre-13 database) nothing is cached.  ``loader`` reads
+    the rules for missing dates (default: the raw ``daily_pricing_rules``
+    rows; main passes the tariff engine).
+    """
+
+    def __init__(
+        self,
+        check_interval_s: float = 1.0,
+        max_dates: int = 800,
+        clock: Callable[[], float] = time.monotonic,
+        loader: Callable[[sqlite3.Connection, list[str]], dict[str, list]] = load_rule_rows,
+    ):
+        self.check_interval_s = max(0.0, float(check_interval_s))
+        self.max_dates = max(1, int(max_dates))
+        self.clock = clock
+        self.loader = loader
+        self.stats = TariffRulesCacheStats()
+        self._rules: dict[str, list[tuple[str, str, float]]] = {}
+        self._version: int | None = None
+        self._checked_at = float("-inf")
+        self._scope: str | None = None
+        self._lock = threading.Lock()
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self.stats.invalidations += 1
+            self._rules.clear()
+            self._checked_at = float("-inf")
+
+    def _version_check_due(self, scope: str) -> bool:
+        with self._lock:
+            if scope != self._scope:
+                self._rules.clear()
+                self._scope = scope
+                self._checked_at = float("-inf")
+            return self.clock() - self._checked_at >= self.check_interval_s
+
+    def _apply_version(self, version: int | None) -> None:
+        with self._lock:
+            self.stats.version_checks += 1
+            if version != self._version:
+                self._rules.clear()
+                self._version = version
+            self._checked_at = self.clock()
+
+    def rules_for_dates(
+        self,
+        connect: Callable[[], sqlite3.Connection],
+        dates: Iterable[str],
+        scope: str = "",
+    ) -> dict[str, list[tuple[str, str, float]]]:
+        """
+        ``{date: [(start, end, price), ...]}`` in row order.  A warm lookup
+        opens no connection; ``connect`` is only called for a due version
+        check or for missing dates.
+        """
+        dates = sorted(set(dates))
+        conn = None
+        try:
+            if self._version_check_due(scope):
+                conn = connect()
+                self._apply_version(tariff_version(conn))
+            with self._lock:
+                cacheable = self._version is not None
+                found = {d: self._rules[d] for d in dates if cacheable and d in self._rules}
+                self.stats.hits += len(found)
+            missing = [d for d in dates if d not in found]
+            if not missing:
+                return found
+            if conn is None:
+                conn = connect()
+            loaded = self.loader(conn, missing)
+        finally:
+            if conn is not None:
+                conn.close()
+        with self._lock:
+            self.stats.misses += len(missing)
+            if cacheable:
+                if len(self._rules) + len(loaded) > self.max_dates:
+                    self._rules.clear()
+                self._rules.update(loaded)
+        found.update(loaded)
+        return found
+
+    def snapshot(self) -> dict[str, Any]:
+        stats = self.stats
+        return {
+            "version": self._version,
+            "dates": len(self._rules),
+            "check_interval_s": self.check_interval_s,
+            "hits": stats.hits,
+            "misses": stats.misses,
+            "version_checks": stats.version_checks,
+            "invalidations": stats.invalidations,
+        }
@@ -0,0 +1,468 @@
+"""Read-only reporting copy of the SQLite database.
+
+Transaction lists, CSV exports, summaries, the monthly PDF and the LINE
+message log search used to run on the primary file, so a slow admin query
+held a read snapshot (blocking checkpoints) and competed with OCPP writes
+for the same connection timeouts.  With ``REPORTING_REPLICA_ENABLED=1``
+main.py routes those endpoints to a separate file kept by
+``ReportingReplica``:
+
+- change tracking: triggers installed by schema migration 17 append
+  ``(table_name, rowid)`` to ``report_change_log`` for every write to the
+  tracked tables, but only while ``report_tracking.enabled = 1``
+  (``set_tracking``), so a deployment without a replica pays one
+  single-row lookup per write and keeps no log;
+- ``rebuild`` enables tracking, notes the log high-water mark and copies
+  the whole primary with the online backup API
+  (``db_backup.copy_database``, small page steps);
+- ``refresh`` reads up to ``batch_changes`` log entries and the current
+  version of every changed row from the primary in one deferred read
+  transaction (a WAL snapshot, so OCPP writers are never blocked), then
+  applies them in a write transaction on the replica file only
+  (``INSERT OR REPLACE`` per table), and trims the applied part of the
+  log on the primary;
+- a different ``PRAGMA schema_version`` on the primary (migration,
+  ``VACUUM``) triggers a rebuild, since rowids and columns may have changed.
+
+``freshness`` is what endpoints report (``X-Report-*`` headers in main.py);
+``usable`` is False until the first build and whenever the last
+successful refresh is older than ``max_staleness_s``, in which case
+main.py falls back to the primary.
+
+This module intentionally has no FastAPI or OCPP dependency.
+"""
+
+from __future__ import annotations
+
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable
+
+from db_backup import copy_database
+
+
+CHANGE_LOG_TABLE = "report_change_log"
+TRACKING_TABLE = "report_tracking"
+META_TABLE = "report_replica_meta"
+
+
+def _iso(epoch: float | None) -> str | None:
+    if epoch is None:
+        return None
+    return datetime.fromtimestamp(epoch, timezone.utc).replace(microsecond=0).isoformat()
+
+
+def change_tracking_statements(tables: tuple[str, ...]) -> tuple[str, ...]:
+    """DDL for the change log and the per-table triggers (used by schema_migrations)."""
+    statements = [
+        f"""
+        CREATE TABLE IF NOT EXISTS {CHANGE_LOG_TABLE} (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL
+        )
+        """,
+        f"""
+        CREATE TABLE IF NOT EXISTS {TRACKING_TABLE} (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            enabled INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT
+        )
+        """,
+        f"INSERT OR IGNORE INTO {TRACKING_TABLE} (id, enabled, updated_at) VALUES (1, 0, NULL)",
+    ]
+    enabled = f"(SELECT enabled FROM {TRACKING_TABLE} WHERE id = 1) = 1"
+    for table in tables:
+        statements.append(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_report_insert
+            AFTER INSERT ON {table} WHEN {enabled}
+            BEGIN
+                INSERT INTO {CHANGE_LOG_TABLE} (table_name, row_id) VALUES ('{table}', NEW.rowid);
+            END
+            """
+        )
+        statements.append(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_report_update
+            AFTER UPDATE ON {table} WHEN {enabled}
+            BEGIN
+                INSERT INTO {CHANGE_LOG_TABLE} (table_name, row_id) VALUES ('{table}', NEW.rowid);
+                INSERT INTO {CHANGE_LOG_TABLE} (table_name, row_id)
+                SELECT '{table}', OLD.rowid WHERE OLD.rowid <> NEW.rowid;
+            END
+            """
+        )
+        statements.append(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_report_delete
+            AFTER DELETE ON {table} WHEN {enabled}
+            BEGIN
+                INSERT INTO {CHANGE_LOG_TABLE} (table_name, row_id) VALUES ('{table}', OLD.rowid);
+            END
+            """
+        )
+    return tuple(statements)
+
+
+def set_tracking(conn: sqlite3.Connection, enabled: bool) -> None:
+    """Turn change logging on / off on the primary; turning it off also drops the log."""
+    with conn:
+        conn.execute(
+            f"UPDATE {TRACKING_TABLE} SET enabled = ?, updated_at = ? WHERE id = 1",
+            (1 if enabled else 0, _iso(time.time())),
+        )
+        if not enabled:
+            conn.execute(f"DELETE FROM {CHANGE_LOG_TABLE}")
+
+
+def _max_seq(conn: sqlite3.Connection, schema: str = "main") -> int:
+    return conn.execute(f"SELECT COALESCE(MAX(seq), 0) FROM {schema}.{CHANGE_LOG_TABLE}").fetchone()[0]
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> list[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA main.table_info({table})").fetchall()]
+
+
+@dataclass
+class ReplicaStats:
+    builds: int = 0
+    last_build_ms: float = 0.0
+    refreshes: int = 0
+    changes_applied: int = 0
+    rows_copied: int = 0
+    last_refresh_ms: float = 0.0
+    max_refresh_ms: float = 0.0
+    last_refresh_at: float | None = None
+    errors: int = 0
+    last_error: str | None = None
+
+
+class ReportingReplica:
+    """
+    Builder / refresher of one replica file.  ``refresh`` and ``rebuild``
+    are synchronous and serialized by a lock (main.py calls them from one
+    loop via ``asyncio.to_thread``); ``connect`` may be called from any
+    thread.
+    """
+
+    def __init__(
+        self,
+        primary_file: str,
+        replica_file: str,
+        *,
+        batch_changes: int = 5000,
+        max_staleness_s: float = 300.0,
+        busy_timeout_ms: int = 2000,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.primary_file = primary_file
+        self.replica_file = replica_file
+        self.batch_changes = max(1, int(batch_changes))
+        self.max_staleness_s = float(max_staleness_s)
+        self.busy_timeout_ms = int(busy_timeout_ms)
+        self.clock = clock
+        self.stats = ReplicaStats()
+        self.applied_seq = 0
+        self.primary_schema_version: int | None = None
+        self.built_at: float | None = None
+        self.lag_changes = 0
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------
+    # readers
+    # ------------------------------------------------------------
+    def connect(self, timeout_s: float = 15.0) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.replica_file, check_same_thread=False, timeout=timeout_s)
+        conn.execute(f"PRAGMA busy_timeout={int(timeout_s * 1000)}")
+        conn.execute("PRAGMA query_only=1")
+        return conn
+
+    def staleness_s(self) -> float | None:
+        if self.stats.last_refresh_at is None:
+            return None
+        return max(0.0, round(self.clock() - self.stats.last_refresh_at, 1))
+
+    @property
+    def usable(self) -> bool:
+        staleness = self.staleness_s()
+        return staleness is not None and staleness <= self.max_staleness_s
+
+    def freshness(self) -> dict[str, Any]:
+        return {
+            "source": "replica" if self.usable else "primary",
+            "refreshedAt": _iso(self.stats.last_refresh_at),
+            "stalenessSeconds": self.staleness_s(),
+            "lagChanges": self.lag_changes,
+        }
+
+    # ------------------------------------------------------------
+    # build / refresh
+    # ------------------------------------------------------------
+    def _primary(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.primary_file, timeout=self.busy_timeout_ms / 1000.0)
+        conn.execute(f"PRAGMA busy_timeout={self.busy_timeout_ms}")
+        return conn
+
+    def _replica_writer(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.replica_file, isolation_level=None, timeout=15.0)
+        conn.execute("PRAGMA busy_timeout=15000")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        return conn
+
+    def rebuild(self) -> dict[str, Any]:
+        with self._lock:
+            return self._rebuild()
+
+    def _rebuild(self) -> dict[str, Any]:
+        started = time.perf_counter()
+        primary = self._primary()
+        try:
+            # 先開追蹤再記高水位：之後的異動一定在 log 內，copy 已含的部分重放也無妨
+            set_tracking(primary, True)
+            high_water = _max_seq(primary)
+            # backup API 會把目的端的 schema cookie 加一，所以版本從 primary 讀；
+            # 複製期間若有 migration，下次 refresh 會看到版本不同而再建一次
+            schema_version = primary.execute("PRAGMA schema_version").fetchone()[0]
+        finally:
+            primary.close()
+
+        progress = copy_database(self.primary_file, self.replica_file, standalone=False)
+
+        conn = self._replica_writer()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # 複本只供查詢：移除觸發器（含 transaction_settlements 的禁止刪改），
+            # 重放時才能直接覆寫列，也不會在複本裡再寫一份 change log
+            for (name,) in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+            ).fetchall():
+                conn.execute(f'DROP TRIGGER IF EXISTS "{name}"')
+            conn.execute(f"DELETE FROM {CHANGE_LOG_TABLE}")
+            conn.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {META_TABLE} (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    applied_seq INTEGER NOT NULL,
+                    primary_schema_version INTEGER NOT NULL,
+                    built_at TEXT NOT NULL,
+                    refreshed_at TEXT
+                )
+                """
+            )
+            now = self.clock()
+            conn.execute(
+                f"""
+                INSERT OR REPLACE INTO {META_TABLE}
+                    (id, applied_seq, primary_schema_version, built_at, refreshed_at)
+                VALUES (1, ?, ?, ?, ?)
+                """,
+                (high_water, schema_version, _iso(now), _iso(now)),
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+        self.applied_seq = high_water
+        self.primary_schema_version = schema_version
+        self.built_at = now
+        self.stats.builds += 1
+        self.stats.last_build_ms = round((time.perf_counter() - started) * 1000.0, 2)
+        self.stats.last_refresh_at = now
+        return {"rebuilt": True, "applied_seq": high_water, "copy": progress}
+
+    def _load_meta(self, conn: sqlite3.Connection) -> bool:
+        try:
+            row = conn.execute(
+                f"SELECT applied_seq, primary_schema_version FROM {META_TABLE} WHERE id = 1"
+            ).fetchone()
+        except sqlite3.OperationalError:
+            return False
+        if row is None:
+            return False
+        self.applied_seq, self.primary_schema_version = int(row[0]), int(row[1])
+        return True
+
+    def refresh(self) -> dict[str, Any]:
+        """Apply pending changes (rebuilding first when needed); returns a report."""
+        with self._lock:
+            try:
+                report = self._refresh()
+                return self._rebuild() if report is None else report
+            except sqlite3.Error as e:
+                self.stats.errors += 1
+                self.stats.last_error = str(e)
+                raise
+
+    def _read_changes(self) -> tuple[int | None, int, list[tuple], int] | None:
+        """
+        Read a batch of changes from the primary in one deferred read
+        transaction (a WAL snapshot, so OCPP writers are never blocked).
+        Returns ``(high, changes, [(table, columns, row_ids, rows)], max_seq)``
+        or None
+        when the primary schema changed.
+        """
+        primary = self._primary()
+        try:
+            primary.execute("BEGIN")
+            if primary.execute("PRAGMA schema_version").fetchone()[0] != self.primary_schema_version:
+                return None
+            high = primary.execute(
+                f"""
+                SELECT MAX(seq) FROM (
+                    SELECT seq FROM {CHANGE_LOG_TABLE}
+                    WHERE seq > ? ORDER BY seq LIMIT ?
+                )
+                """,
+                (self.applied_seq, self.batch_changes),
+            ).fetchone()[0]
+            changes = 0
+            tables: list[tuple] = []
+            if high is not None:
+                changed = primary.execute(
+                    f"""
+                    SELECT DISTINCT table_name, row_id FROM {CHANGE_LOG_TABLE}
+                    WHERE seq > ? AND seq <= ?
+                    """,
+                    (self.applied_seq, high),
+                ).fetchall()
+                changes = len(changed)
+                by_table: dict[str, list[int]] = {}
+                for table, row_id in changed:
+                    by_table.setdefault(table, []).append(row_id)
+                for table, row_ids in by_table.items():
+                    columns = _columns(primary, table)
+                    if not columns:
+                        continue
+                    column_sql = ", ".join(f'"{c}"' for c in columns)
+                    # 刪除的列在 primary 已不存在：只送 rowid，重放時 DELETE 掉
+                    rows = primary.execute(
+                        f"""
+                        SELECT rowid, {column_sql} FROM {table}
+                        WHERE rowid IN (
+                            SELECT row_id FROM {CHANGE_LOG_TABLE}
+                            WHERE table_name = ? AND seq > ? AND seq <= ?
+                        )
+                        """,
+                        (table, self.applied_seq, high),
+                    ).fetchall()
+                    tables.append((table, columns, [(row_id,) for row_id in row_ids], rows))
+            return high, changes, tables, _max_seq(primary)
+        finally:
+            primary.rollback()
+            primary.close()
+
+    def _refresh(self) -> dict[str, Any] | None:
+        """None when the replica must be rebuilt first."""
+        started = time.perf_counter()
+        conn = self._replica_writer()
+        try:
+            if not self._load_meta(conn):
+                return None
+            read = self._read_changes()
+            if read is None:
+                return None
+            high, changes, tables, max_seq = read
+
+            # 只鎖複本檔：primary 不 ATTACH，套用期間 OCPP 寫入照常進行
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows_copied = 0
+                for table, columns, row_ids, rows in tables:
+                    rows_copied += self._apply_table(conn, table, columns, row_ids, rows)
+                now = self.clock()
+                if high is not None:
+                    conn.execute(
+                        f"UPDATE {META_TABLE} SET applied_seq = ? WHERE id = 1", (high,)
+                    )
+                conn.execute(
+                    f"UPDATE {META_TABLE} SET refreshed_at = ? WHERE id = 1", (_iso(now),)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+        self.lag_changes = max(0, max_seq - (high or self.applied_seq))
+        if high is not None:
+            self.applied_seq = high
+            self._trim(high)
+        stats = self.stats
+        elapsed_ms = round((time.perf_counter() - started) * 1000.0, 2)
+        stats.refreshes += 1
+        stats.changes_applied += changes
+        stats.rows_copied += rows_copied
+        stats.last_refresh_ms = elapsed_ms
+        stats.max_refresh_ms = max(stats.max_refresh_ms, elapsed_ms)
+        stats.last_refresh_at = now
+        return {
+            "rebuilt": False,
+            "applied_seq": self.applied_seq,
+            "changes": changes,
+            "rows_copied": rows_copied,
+            "lag_changes": self.lag_changes,
+            "elapsed_ms": elapsed_ms,
+        }
+
+    def _apply_table(
+        self,
+        conn: sqlite3.Connection,
+        table: str,
+        columns: list[str],
+        row_ids: list[tuple[int]],
+        rows: list[tuple],
+    ) -> int:
+        column_sql = ", ".join(f'"{c}"' for c in columns)
+        conn.executemany(f"DELETE FROM main.{table} WHERE rowid = ?", row_ids)
+        if not rows:
+            return 0
+        # OR REPLACE：批次只涵蓋部分 log 時，目前版本可能與尚未重放的舊列撞 UNIQUE
+        conn.executemany(
+            f"""
+            INSERT OR REPLACE INTO main.{table} (rowid, {column_sql})
+            VALUES ({", ".join("?" for _ in range(len(columns) + 1))})
+            """,
+            rows,
+        )
+        return len(rows)
+
+    def _trim(self, applied_seq: int) -> None:
+        try:
+            primary = self._primary()
+            try:
+                with primary:
+                    primary.execute(f"DELETE FROM {CHANGE_LOG_TABLE} WHERE seq <= ?", (applied_seq,))
+            finally:
+                primary.close()
+        except sqlite3.Error as e:
+            # 清不掉下次再清；只影響 log 大小
+            self.stats.last_error = f"trim: {e}"
+
+    def snapshot(self) -> dict[str, Any]:
+        stats = self.stats
+        return {
+            "primary_file": self.primary_file,
+            "replica_file": self.replica_file,
+            "usable": self.usable,
+            **self.freshness(),
+            "max_staleness_s": self.max_staleness_s,
+            "applied_seq": self.applied_seq,
+            "primary_schema_version": self.primary_schema_version,
+            "built_at": _iso(self.built_at),
+            "builds": stats.builds,
+            "last_build_ms": stats.last_build_ms,
+            "refreshes": stats.refreshes,
+            "changes_applied": stats.changes_applied,
+            "rows_copied": stats.rows_copied,
+            "last_refresh_ms": stats.last_refresh_ms,
+            "max_refresh_ms": stats.max_refresh_ms,
+            "errors": stats.errors,
+            "last_error": stats.last_error,
+        }
@@ -73,7 +73,15 @@ def run() -> dict[str, object]:
         print(f"[STARTUP][MIGRATION_LOCK] acquired={lock_path}")
         from migrate_payments_schema import migrate as migrate_payments
         from migrate_household_accounts import migrate as migrate_households
+        from schema_migrations import migrate as migrate_schema
 
+        schema_report = migrate_schema(database_path)
+        print(
+            "[STARTUP][SCHEMA_MIGRATION] "
+            f"from_version={schema_report['from_version']} "
+            f"to_version={schema_report['to_version']} "
+            f"applied={schema_report['applied']}"
+        )
         migrate_payments()
         report = migrate_households(database_path, create_backup=True)
         print(
@@ -82,6 +90,12 @@ def run() -> dict[str, object]:
             f"accounts_created={report['accounts_created']} "
             f"cards_linked={report['cards_linked']}"
         )
+        if os.getenv("DB_ENABLE_INCREMENTAL_VACUUM", "0") == "1":
+            # 一次性：整檔 VACUUM 轉為 auto_vacuum=INCREMENTAL（在 app 啟動前、持有鎖時執行）
+            from db_maintenance import enable_incremental_vacuum
+
+            converted = enable_incremental_vacuum(database_path)
+            print(f"[STARTUP][INCREMENTAL_VACUUM] converted={converted}")
         return report
 
 
@@ -0,0 +1,855 @@
+"""Versioned SQLite schema migrations.
+
+Schema creation used to run as module-level ``CREATE TABLE IF NOT EXISTS`` /
+``PRAGMA table_info`` / ``ALTER TABLE`` statements on every ``import main``.
+It now lives here as an ordered registry of steps that only
+``run_startup_migrations.py`` applies (under its cross-process file lock).
+Each applied step is recorded in ``schema_version`` together with a checksum
+of its definition; the app itself performs a single version check at startup.
+
+Rules for adding a step:
+
+- append a new ``Migration`` with the next version number; never edit or
+  renumber an applied step (the checksum check refuses that);
+- steps must be idempotent, because a database created before this registry
+  existed replays every step once against tables that may already exist.
+
+This module intentionally has no FastAPI or OCPP dependency.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import sqlite3
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Callable
+
+from balance_ledger import ensure_schema as ensure_balance_ledger_schema
+from household_account_service import ensure_schema as ensure_household_schema
+from reporting_replica import change_tracking_statements
+
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION_TABLE = "schema_version"
+
+
+class SchemaMigrationError(RuntimeError):
+    """The database schema does not match the migration registry."""
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    statements: tuple[str, ...] = ()
+    # (table, "column TYPE ...") pairs added only when the column is missing.
+    add_columns: tuple[tuple[str, str], ...] = ()
+    # Steps owned by another module (which manage their own transaction).
+    apply: Callable[[sqlite3.Connection], Any] | None = field(default=None, compare=False)
+
+    @property
+    def checksum(self) -> str:
+        definition = {
+            "version": self.version,
+            "name": self.name,
+            "statements": [" ".join(sql.split()) for sql in self.statements],
+            "add_columns": [list(item) for item in self.add_columns],
+            "apply": (
+                f"{self.apply.__module__}.{self.apply.__qualname__}"
+                if self.apply is not None
+                else None
+            ),
+        }
+        encoded = json.dumps(definition, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+@dataclass(frozen=True)
+class SchemaStatus:
+    current_version: int
+    latest_version: int
+    pending: tuple[int, ...]
+    checksum_mismatches: tuple[int, ...]
+
+    @property
+    def is_current(self) -> bool:
+        return not self.pending and not self.checksum_mismatches
+
+
+# ------------------------------------------------------------
+# Table definitions shared with main.py helpers
+# ------------------------------------------------------------
+LINE_BINDINGS_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS line_bindings (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        id_tag TEXT NOT NULL UNIQUE,
+        line_user_id TEXT NOT NULL UNIQUE,
+        display_name TEXT,
+        enabled INTEGER DEFAULT 1,
+        created_at TEXT,
+        updated_at TEXT
+    )
+    """,
+)
+
+LINE_MESSAGE_LOGS_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS line_message_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_type TEXT NOT NULL,
+        transaction_id INTEGER,
+        id_tag TEXT,
+        line_user_id TEXT,
+        status TEXT,
+        reason TEXT,
+        message TEXT,
+        line_status_code INTEGER,
+        line_response TEXT,
+        created_at TEXT
+    )
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_line_message_logs_transaction_id
+    ON line_message_logs (transaction_id)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_line_message_logs_id_tag
+    ON line_message_logs (id_tag)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_line_message_logs_created_at
+    ON line_message_logs (created_at)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS line_notification_claims (
+        event_type TEXT NOT NULL,
+        transaction_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        claimed_at TEXT NOT NULL,
+        completed_at TEXT,
+        PRIMARY KEY (event_type, transaction_id)
+    )
+    """,
+    # Recipient-level claims are separate from the legacy transaction-level
+    # table so existing claims and logs remain untouched.
+    """
+    CREATE TABLE IF NOT EXISTS line_recipient_notification_claims (
+        event_type TEXT NOT NULL,
+        transaction_id INTEGER NOT NULL,
+        line_user_id TEXT NOT NULL,
+        source_card_id TEXT,
+        status TEXT NOT NULL,
+        claimed_at TEXT NOT NULL,
+        completed_at TEXT,
+        error TEXT,
+        PRIMARY KEY (event_type, transaction_id, line_user_id)
+    )
+    """,
+)
+
+
+# ------------------------------------------------------------
+# Registry（只能往後追加，不可修改已套用的步驟）
+# ------------------------------------------------------------
+MIGRATIONS: tuple[Migration, ...] = (
+    Migration(
+        version=1,
+        name="core_tables",
+        statements=(
+            """
+            CREATE TABLE IF NOT EXISTS charge_points (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                charge_point_id TEXT UNIQUE NOT NULL,
+                name TEXT,
+                status TEXT,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+                max_current_a REAL DEFAULT 16
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS community_settings (
+                id INTEGER PRIMARY KEY,
+                enabled INTEGER DEFAULT 1,
+                contract_kw REAL DEFAULT 0,
+                voltage_v REAL DEFAULT 220,
+                phases INTEGER DEFAULT 1,
+                min_current_a REAL DEFAULT 16,
+                max_current_a REAL DEFAULT 32,
+                surcharge_per_kwh REAL DEFAULT 0
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS default_pricing_rules (
+                id INTEGER PRIMARY KEY,
+                weekday_rules TEXT,
+                saturday_rules TEXT,
+                sunday_rules TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS card_whitelist (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                card_id TEXT NOT NULL,
+                charge_point_id TEXT NOT NULL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS card_owners (
+                card_id TEXT PRIMARY KEY,
+                name TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS connection_logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                charge_point_id TEXT,
+                ip TEXT,
+                time TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS reservations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                charge_point_id TEXT NOT NULL,
+                id_tag TEXT NOT NULL,
+                start_time TEXT NOT NULL,
+                end_time   TEXT NOT NULL,
+                status     TEXT NOT NULL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS cards (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                card_id TEXT UNIQUE,
+                balance REAL DEFAULT 0
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS daily_pricing (
+                date TEXT PRIMARY KEY,
+                price_per_kwh REAL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS daily_pricing_rules (
+                date TEXT,
+                start_time TEXT,
+                end_time TEXT,
+                price REAL,
+                label TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS stop_transactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                transaction_id TEXT,
+                meter_stop INTEGER,
+                timestamp TEXT,
+                reason TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS payments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                transaction_id INTEGER,
+                base_fee REAL,
+                energy_fee REAL,
+                overuse_fee REAL,
+                total_amount REAL,
+                paid_at TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS transactions (
+                transaction_id INTEGER PRIMARY KEY,
+                charge_point_id TEXT,
+                connector_id INTEGER,
+                id_tag TEXT,
+                meter_start INTEGER,
+                start_timestamp TEXT,
+                meter_stop INTEGER,
+                stop_timestamp TEXT,
+                reason TEXT,
+                balance_before REAL,
+                balance_after REAL,
+                auto_stop_reason TEXT,
+                auto_stop_triggered_at TEXT,
+                auto_stop_balance REAL,
+                auto_stop_estimated_amount REAL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS id_tags (
+                id_tag TEXT PRIMARY KEY,
+                status TEXT,
+                valid_until TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS users (
+                id_tag TEXT PRIMARY KEY,
+                name TEXT,
+                department TEXT,
+                card_number TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS weekly_pricing (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                season TEXT,
+                weekday TEXT,
+                type TEXT,
+                start_time TEXT,
+                end_time TEXT,
+                price REAL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS pricing_rules (
+                season TEXT,
+                day_type TEXT,
+                start_time TEXT,
+                end_time TEXT,
+                price REAL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS meter_values (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                transaction_id INTEGER,
+                charge_point_id TEXT,
+                connector_id INTEGER,
+                timestamp TEXT,
+                value REAL,
+                measurand TEXT,
+                unit TEXT,
+                context TEXT,
+                format TEXT,
+                phase TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS status_logs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                charge_point_id TEXT,
+                connector_id INTEGER,
+                status TEXT,
+                timestamp TEXT
+            )
+            """,
+        ),
+    ),
+    Migration(
+        version=2,
+        name="legacy_additive_columns",
+        add_columns=(
+            ("charge_points", "max_current_a REAL DEFAULT 16"),
+            ("community_settings", "enabled INTEGER DEFAULT 1"),
+            ("community_settings", "contract_kw REAL DEFAULT 0"),
+            ("community_settings", "voltage_v REAL DEFAULT 220"),
+            ("community_settings", "phases INTEGER DEFAULT 1"),
+            ("community_settings", "min_current_a REAL DEFAULT 16"),
+            ("community_settings", "max_current_a REAL DEFAULT 32"),
+            ("community_settings", "surcharge_per_kwh REAL DEFAULT 0"),
+            ("transactions", "balance_before REAL"),
+            ("transactions", "balance_after REAL"),
+            ("transactions", "auto_stop_reason TEXT"),
+            ("transactions", "auto_stop_triggered_at TEXT"),
+            ("transactions", "auto_stop_balance REAL"),
+            ("transactions", "auto_stop_estimated_amount REAL"),
+            ("transactions", "surplus_amount REAL DEFAULT 0"),
+            ("meter_values", "phase TEXT"),
+            ("status_logs", "error_code TEXT"),
+        ),
+    ),
+    Migration(
+        version=3,
+        name="community_settings_default_row",
+        statements=(
+            """
+            INSERT OR IGNORE INTO community_settings
+            (id, enabled, contract_kw, voltage_v, phases, min_current_a, max_current_a, surcharge_per_kwh)
+            VALUES (1, 1, 0, 220, 1, 16, 32, 0)
+            """,
+        ),
+    ),
+    Migration(
+        version=4,
+        name="meter_values_and_transactions_indexes",
+        statements=(
+            "CREATE INDEX IF NOT EXISTS idx_meter_values_tx_id ON meter_values(transaction_id)",
+            "CREATE INDEX IF NOT EXISTS idx_meter_values_cp_ts ON meter_values(charge_point_id, timestamp)",
+            "CREATE INDEX IF NOT EXISTS idx_transactions_cp_stop ON transactions(charge_point_id, stop_timestamp)",
+        ),
+    ),
+    Migration(
+        version=5,
+        name="line_tables",
+        statements=LINE_BINDINGS_SCHEMA + LINE_MESSAGE_LOGS_SCHEMA,
+    ),
+    Migration(
+        version=6,
+        name="household_accounts",
+        apply=ensure_household_schema,
+    ),
+    Migration(
+        version=7,
+        name="line_outbox",
+        statements=(
+            """
+            CREATE TABLE IF NOT EXISTS line_outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                event_type TEXT NOT NULL,
+                transaction_id INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                claimed_at REAL,
+                claim_token TEXT,
+                last_error TEXT,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                UNIQUE (event_type, transaction_id)
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_line_outbox_status_due
+            ON line_outbox (status, next_attempt_at)
+            """,
+        ),
+    ),
+    Migration(
+        version=8,
+        name="transaction_settlements",
+        statements=(
+            """
+            CREATE TABLE IF NOT EXISTS transaction_settlements (
+                transaction_id INTEGER PRIMARY KEY,
+                snapshot_version INTEGER NOT NULL,
+                snapshot TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            )
+            """,
+            # 結算快照寫入後不可修改：LINE 訊息必須與當次扣款一致
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_transaction_settlements_no_update
+            BEFORE UPDATE ON transaction_settlements
+            BEGIN
+                SELECT RAISE(ABORT, 'transaction_settlements is immutable');
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_transaction_settlements_no_delete
+            BEFORE DELETE ON transaction_settlements
+            BEGIN
+                SELECT RAISE(ABORT, 'transaction_settlements is immutable');
+            END
+            """,
+        ),
+    ),
+    Migration(
+        version=9,
+        name="household_balance_ledger",
+        apply=ensure_balance_ledger_schema,
+    ),
+    Migration(
+        version=10,
+        name="local_auth_list_state",
+        statements=(
+            # 每支樁最後一次被接受的 SendLocalList 版本與內容（見 local_auth_list.py）
+            """
+            CREATE TABLE IF NOT EXISTS local_auth_list_state (
+                charge_point_id TEXT PRIMARY KEY,
+                list_version INTEGER NOT NULL DEFAULT 0,
+                entries TEXT,
+                content_hash TEXT,
+                entry_count INTEGER NOT NULL DEFAULT 0,
+                last_status TEXT,
+                last_error TEXT,
+                synced_at TEXT,
+                updated_at TEXT NOT NULL
+            )
+            """,
+        ),
+    ),
+    Migration(
+        version=11,
+        name="charge_point_presence",
+        statements=(
+            # Heartbeat / StatusNotification 最後出現時間；記憶體累積後定期批次寫入（見 status_tracker.py）
+            """
+            CREATE TABLE IF NOT EXISTS charge_point_presence (
+                charge_point_id TEXT PRIMARY KEY,
+                last_seen_at TEXT NOT NULL,
+                last_heartbeat_at TEXT,
+                updated_at TEXT NOT NULL
+            )
+            """,
+        ),
+    ),
+    Migration(
+        version=12,
+        name="payment_recalc_jobs",
+        statements=(
+            # 背景 payments 重算：進度以 last_transaction_id 為游標，可於重啟後續跑（見 payments_recalc.py）
+            """
+            CREATE TABLE IF NOT EXISTS payment_recalc_jobs (
+                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                mode TEXT NOT NULL CHECK (mode IN ('apply', 'dry_run')),
+                status TEXT NOT NULL,
+                max_transaction_id INTEGER NOT NULL,
+                total INTEGER NOT NULL DEFAULT 0,
+                processed INTEGER NOT NULL DEFAULT 0,
+                computed INTEGER NOT NULL DEFAULT 0,
+                skipped INTEGER NOT NULL DEFAULT 0,
+                last_transaction_id INTEGER NOT NULL DEFAULT 0,
+                chunk_size INTEGER NOT NULL,
+                workers INTEGER NOT NULL,
+                summary TEXT,
+                error TEXT,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                finished_at TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS payments_recalc_shadow (
+                job_id INTEGER NOT NULL,
+                transaction_id INTEGER NOT NULL,
+                base_fee REAL,
+                energy_fee REAL,
+                overuse_fee REAL,
+                total_amount REAL,
+                paid_at TEXT,
+                PRIMARY KEY (job_id, transaction_id)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_payments_transaction_id ON payments(transaction_id)",
+        ),
+    ),
+    Migration(
+        version=13,
+        name="tariff_version",
+        statements=(
+            # 電價版本：daily_pricing_rules 任何寫入都遞增，供程序內電價快取判斷是否需重讀（見 pricing_calendar.py）
+            """
+            CREATE TABLE IF NOT EXISTS tariff_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT
+            )
+            """,
+            "INSERT OR IGNORE INTO tariff_state (id, version, updated_at) VALUES (1, 0, NULL)",
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_daily_pricing_rules_version_insert
+            AFTER INSERT ON daily_pricing_rules
+            BEGIN
+                UPDATE tariff_state SET version = version + 1, updated_at = datetime('now') WHERE id = 1;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_daily_pricing_rules_version_update
+            AFTER UPDATE ON daily_pricing_rules
+            BEGIN
+                UPDATE tariff_state SET version = version + 1, updated_at = datetime('now') WHERE id = 1;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_daily_pricing_rules_version_delete
+            AFTER DELETE ON daily_pricing_rules
+            BEGIN
+                UPDATE tariff_state SET version = version + 1, updated_at = datetime('now') WHERE id = 1;
+            END
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_daily_pricing_rules_date ON daily_pricing_rules(date)",
+        ),
+    ),
+    Migration(
+        version=14,
+        name="tariff_calendars",
+        statements=(
+            # 規則式電價：每年一筆模板快照 + 例假日表，daily_pricing_rules 只存逐日覆寫（見 tariff_engine.py）
+            """
+            CREATE TABLE IF NOT EXISTS tariff_calendars (
+                year INTEGER PRIMARY KEY,
+                definition TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS tariff_holidays (
+                date TEXT PRIMARY KEY,
+                day_type TEXT NOT NULL CHECK (day_type IN ('holiday', 'workday'))
+            )
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_tariff_calendars_version_insert
+            AFTER INSERT ON tariff_calendars
+            BEGIN
+                UPDATE tariff_state SET version = version + 1, updated_at = datetime('now') WHERE id = 1;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_tariff_calendars_version_update
+            AFTER UPDATE ON tariff_calendars
+            BEGIN
+                UPDATE tariff_state SET version = version + 1, updated_at = datetime('now') WHERE id = 1;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_tariff_calendars_version_delete
+            AFTER DELETE ON tariff_calendars
+            BEGIN
+                UPDATE tariff_state SET version = version + 1, updated_at = datetime('now') WHERE id = 1;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_tariff_holidays_version_insert
+            AFTER INSERT ON tariff_holidays
+            BEGIN
+                UPDATE tariff_state SET version = version + 1, updated_at = datetime('now') WHERE id = 1;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_tariff_holidays_version_update
+            AFTER UPDATE ON tariff_holidays
+            BEGIN
+                UPDATE tariff_state SET version = version + 1, updated_at = datetime('now') WHERE id = 1;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS trg_tariff_holidays_version_delete
+            AFTER DELETE ON tariff_holidays
+            BEGIN
+                UPDATE tariff_state SET version = version + 1, updated_at = datetime('now') WHERE id = 1;
+            END
+            """,
+        ),
+    ),
+    Migration(
+        version=15,
+        name="transaction_timelines",
+        statements=(
+            # 交易明細頁的降採樣功率 / 度數曲線：StopTransaction 結算時寫入一次（見 transaction_detail.py）
+            """
+            CREATE TABLE IF NOT EXISTS transaction_timelines (
+                transaction_id INTEGER PRIMARY KEY,
+                timeline_version INTEGER NOT NULL,
+                points TEXT NOT NULL,
+                sample_count INTEGER NOT NULL,
+                bucket_seconds REAL NOT NULL,
+                created_at TEXT NOT NULL
+            )
+            """,
+        ),
+    ),
+    Migration(
+        version=16,
+        name="identity_key_indexes",
+        statements=(
+            # 卡號 / 住戶比對沿用 UPPER(TRIM()) 容錯規則；以表達式索引讓比對與排序走索引，
+            # 索引由 SQLite 隨寫入維護，舊資料於建立索引時即回填。
+            # 查詢端的運算式必須與索引逐字相同才會被採用（見 tests/test_identity_indexes.py）。
+            "CREATE INDEX IF NOT EXISTS idx_users_id_tag_key ON users(UPPER(TRIM(id_tag)))",
+            "CREATE INDEX IF NOT EXISTS idx_users_card_number_key ON users(UPPER(TRIM(card_number)))",
+            "CREATE INDEX IF NOT EXISTS idx_card_owners_card_key ON card_owners(UPPER(TRIM(card_id)))",
+            "CREATE INDEX IF NOT EXISTS idx_transactions_id_tag ON transactions(id_tag)",
+            """
+            CREATE INDEX IF NOT EXISTS idx_household_accounts_sort_key ON household_accounts(
+                CASE WHEN NULLIF(TRIM(floor_no), '') IS NULL THEN 1 ELSE 0 END,
+                UPPER(TRIM(floor_no)),
+                CASE WHEN NULLIF(TRIM(parking_space_no), '') IS NULL THEN 1 ELSE 0 END,
+                UPPER(TRIM(parking_space_no))
+            )
+            """,
+        ),
+    ),
+    Migration(
+        version=17,
+        name="reporting_change_log",
+        # 報表複本的異動追蹤：report_tracking.enabled=1 時才寫 log（見 reporting_replica.py）。
+        # 表清單寫死在此：改清單須新增一版 migration，不能改這一版。
+        statements=change_tracking_statements(
+            (
+                "transactions",
+                "payments",
+                "transaction_settlements",
+                "transaction_timelines",
+                "line_message_logs",
+                "users",
+                "card_owners",
+                "household_accounts",
+                "account_cards",
+            )
+        ),
+    ),
+)
+
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def _utc_iso() -> str:
+    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> set[str]:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})").fetchall()}
+
+
+def _table_exists(conn: sqlite3.Connection, table: str) -> bool:
+    return (
+        conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)
+        ).fetchone()
+        is not None
+    )
+
+
+def connect(db_file: str, timeout: float = 30.0) -> sqlite3.Connection:
+    """Autocommit connection: each step opens its own BEGIN IMMEDIATE."""
+    conn = sqlite3.connect(db_file, timeout=timeout, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(timeout * 1000)}")
+    return conn
+
+
+def ensure_version_table(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            checksum TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+        """
+    )
+
+
+def apply_statements(conn: sqlite3.Connection, statements, add_columns=()) -> list[str]:
+    """Run idempotent DDL/DML and add missing columns; returns added columns."""
+    added: list[str] = []
+    for sql in statements:
+        conn.execute(sql)
+    columns_by_table: dict[str, set[str]] = {}
+    for table, definition in add_columns:
+        if not _table_exists(conn, table):
+            continue
+        columns = columns_by_table.setdefault(table, _columns(conn, table))
+        name = definition.split()[0]
+        if name in columns:
+            continue
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {definition}")
+        columns.add(name)
+        added.append(f"{table}.{name}")
+    return added
+
+
+def applied_versions(conn: sqlite3.Connection) -> dict[int, str]:
+    """version → checksum; one query, empty when the table does not exist yet."""
+    try:
+        rows = conn.execute(
+            f"SELECT version, checksum FROM {SCHEMA_VERSION_TABLE}"
+        ).fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    return {int(row[0]): str(row[1]) for row in rows}
+
+
+def schema_status(conn: sqlite3.Connection, migrations=MIGRATIONS) -> SchemaStatus:
+    applied = applied_versions(conn)
+    pending = tuple(m.version for m in migrations if m.version not in applied)
+    mismatches = tuple(
+        m.version
+        for m in migrations
+        if m.version in applied and applied[m.version] != m.checksum
+    )
+    return SchemaStatus(
+        current_version=max(applied) if applied else 0,
+        latest_version=migrations[-1].version if migrations else 0,
+        pending=pending,
+        checksum_mismatches=mismatches,
+    )
+
+
+def _apply_one(conn: sqlite3.Connection, migration: Migration) -> list[str]:
+    if migration.apply is not None:
+        # ensure_household_schema 等既有函式自行管理交易
+        changes = migration.apply(conn) or []
+        conn.execute("BEGIN IMMEDIATE")
+    else:
+        conn.execute("BEGIN IMMEDIATE")
+        changes = apply_statements(conn, migration.statements, migration.add_columns)
+    try:
+        conn.execute(
+            f"""
+            INSERT INTO {SCHEMA_VERSION_TABLE} (version, name, checksum, applied_at)
+            VALUES (?, ?, ?, ?)
+            """,
+            (migration.version, migration.name, migration.checksum, _utc_iso()),
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return list(changes)
+
+
+def migrate(db_file: str, migrations=MIGRATIONS) -> dict[str, object]:
+    """
+    Apply every pending step in version order.
+
+    Callers must hold ``run_startup_migrations.migration_file_lock``; an
+    applied step whose checksum changed aborts before anything is applied.
+    """
+    conn = connect(db_file)
+    try:
+        ensure_version_table(conn)
+        status = schema_status(conn, migrations)
+        if status.checksum_mismatches:
+            raise SchemaMigrationError(
+                "applied migrations were modified: "
+                f"versions={list(status.checksum_mismatches)}"
+            )
+        applied: list[int] = []
+        changes: list[str] = []
+        for migration in migrations:
+            if migration.version not in status.pending:
+                continue
+            changes.extend(_apply_one(conn, migration))
+            applied.append(migration.version)
+            logger.warning(
+                f"[MIGRATION][SCHEMA] applied version={migration.version} "
+                f"name={migration.name}"
+            )
+        return {
+            "database": db_file,
+            "from_version": status.current_version,
+            "to_version": schema_status(conn, migrations).current_version,
+            "applied": applied,
+            "changes": changes,
+        }
+    finally:
+        conn.close()
+
+
+def require_current_schema(conn: sqlite3.Connection, migrations=MIGRATIONS) -> SchemaStatus:
+    """App-side startup check: raise unless every registered step is applied."""
+    status = schema_status(conn, migrations)
+    if not status.is_current:
+        raise SchemaMigrationError(
+            "database schema is not up to date "
+            f"(current={status.current_version}, latest={status.latest_version}, "
+            f"pending={list(status.pending)}, "
+            f"modified={list(status.checksum_mismatches)}); "
+            "run `python run_startup_migrations.py` first"
+        )
+    return status
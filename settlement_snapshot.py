@@ -0,0 +1,85 @@
+"""Immutable per-transaction settlement snapshots.
+
+StopTransaction settlement already computes everything a LINE notification
+shows: the per-period cost segments, the debited total, the household balance
+before/after and the floor / parking space the transaction was billed to.
+``save`` stores that result as one JSON row in ``transaction_settlements``
+inside the settlement transaction, so the snapshot commits (or rolls back)
+together with the debit.  Message builders call ``load`` instead of re-reading
+the transaction and rescanning ``meter_values``.
+
+Rows are write-once: ``INSERT OR IGNORE`` keeps the first snapshot and the
+table's triggers reject UPDATE / DELETE.
+"""
+
+from __future__ import annotations
+
+import json
+import sqlite3
+from datetime import datetime, timezone
+from typing import Any
+
+
+SNAPSHOT_VERSION = 1
+
+
+def _utc_iso() -> str:
+    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+
+
+def billing_details(segments) -> list[dict]:
+    """
+    ``_calculate_multi_period_cost_detailed`` segments → LINE/API detail 格式
+    （與 compute_transaction_cost 的 details 相同）。
+    """
+    return [
+        {
+            "from": seg.get("start"),
+            "to": seg.get("end"),
+            "kWh": round(float(seg.get("kwh") or 0.0), 6),
+            "price": float(seg.get("price") or 0.0),
+            "cost": round(float(seg.get("subtotal") or 0.0), 2),
+        }
+        for seg in segments or []
+    ]
+
+
+def save(conn, transaction_id: int, snapshot: dict[str, Any]) -> bool:
+    """Insert the snapshot (caller commits).  Returns False if one already exists."""
+    cur = conn.execute(
+        """
+        INSERT OR IGNORE INTO transaction_settlements (
+            transaction_id, snapshot_version, snapshot, created_at
+        )
+        VALUES (?, ?, ?, ?)
+        """,
+        (
+            int(transaction_id),
+            SNAPSHOT_VERSION,
+            json.dumps(snapshot, ensure_ascii=False, sort_keys=True),
+            _utc_iso(),
+        ),
+    )
+    return cur.rowcount == 1
+
+
+def load(conn, transaction_id: int) -> dict[str, Any] | None:
+    """
+    Return the stored snapshot, or None when the transaction was settled
+    before snapshots existed (or the table is missing in an old database).
+    """
+    try:
+        row = conn.execute(
+            """
+            SELECT snapshot_version, snapshot
+            FROM transaction_settlements
+            WHERE transaction_id = ?
+            """,
+            (int(transaction_id),),
+        ).fetchone()
+    except sqlite3.OperationalError:
+        return None
+
+    if not row or int(row[0]) != SNAPSHOT_VERSION:
+        return None
+    return json.loads(row[1])
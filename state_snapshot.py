@@ -0,0 +1,193 @@
+"""Charger state snapshots for warm restarts.
+
+``live_status_cache``, ``charging_point_status``, ``current_limit_state``,
+``cp_connection_seq`` and the WebSocket whitelist only live in memory, so
+after a deploy the dashboards showed zeros until every charger had sent
+fresh MeterValues, and the first rebalance saw only the chargers that had
+already reconnected.  ``StateSnapshotter`` writes a compact JSON copy of
+those dicts to a local file every few seconds (``write_snapshot`` replaces
+the file atomically) and main.py restores it at startup:
+
+- restored entries keep their original ``updated_at`` and get
+  ``restored: True`` / ``restored_from``, so ``LIVE_TTL`` reports them as
+  stale until the charger sends fresh data;
+- a snapshot older than ``max_age_s``, from another version or unreadable
+  is ignored (``StateSnapshotStats.restore_skipped`` says why);
+- values already present in memory always win over the file, and fresh
+  OCPP data clears the markers (``clear_restored``).
+
+This module intentionally has no FastAPI or OCPP dependency.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Callable
+
+
+SNAPSHOT_VERSION = 1
+
+
+def _iso(epoch: float) -> str:
+    return datetime.fromtimestamp(epoch, timezone.utc).replace(microsecond=0).isoformat()
+
+
+def write_snapshot(path: str, sections: dict[str, Any], *, now: float | None = None) -> int:
+    """Write ``sections`` atomically (temp file + ``os.replace``); returns the file size."""
+    payload = {
+        "version": SNAPSHOT_VERSION,
+        "saved_at": time.time() if now is None else now,
+        "sections": sections,
+    }
+    # default=str：cache 內偶有 datetime 等非 JSON 型別，寧可轉字串也不要整份寫失敗
+    data = json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(data.encode("utf-8"))
+
+
+def read_snapshot(
+    path: str, *, max_age_s: float, now: float | None = None
+) -> tuple[dict[str, Any] | None, str | None]:
+    """``(payload, None)`` or ``(None, reason)`` when the file must not be restored."""
+    try:
+        with open(path, encoding="utf-8") as f:
+            payload = json.load(f)
+    except FileNotFoundError:
+        return None, "missing"
+    except (OSError, ValueError) as e:
+        return None, f"unreadable: {e}"
+    if not isinstance(payload, dict) or payload.get("version") != SNAPSHOT_VERSION:
+        return None, "version_mismatch"
+    try:
+        age = (time.time() if now is None else now) - float(payload["saved_at"])
+    except (KeyError, TypeError, ValueError):
+        return None, "no_saved_at"
+    if age > max_age_s:
+        return None, f"too_old: {int(age)}s"
+    if not isinstance(payload.get("sections"), dict):
+        return None, "no_sections"
+    return payload, None
+
+
+def mark_restored(entries: Any, saved_at: float) -> dict[str, dict[str, Any]]:
+    """Per-charger dict entries tagged with ``restored`` / ``restored_from``; others dropped."""
+    if not isinstance(entries, dict):
+        return {}
+    restored_from = _iso(saved_at)
+    return {
+        str(key): {**value, "restored": True, "restored_from": restored_from}
+        for key, value in entries.items()
+        if isinstance(value, dict)
+    }
+
+
+def clear_restored(entry: dict[str, Any]) -> dict[str, Any]:
+    """收到樁端新資料時移除還原標記（原地修改並回傳同一個 dict）。"""
+    entry.pop("restored", None)
+    entry.pop("restored_from", None)
+    return entry
+
+
+def merge_missing(target: dict, restored: dict) -> int:
+    """只補記憶體內還沒有的 key（啟動後已收到的新資料優先）；回傳補入筆數。"""
+    added = 0
+    for key, value in restored.items():
+        if key not in target:
+            target[key] = value
+            added += 1
+    return added
+
+
+@dataclass
+class StateSnapshotStats:
+    writes: int = 0
+    write_errors: int = 0
+    last_error: str | None = None
+    last_write_at: float | None = None
+    last_bytes: int = 0
+    last_write_ms: float = 0.0
+    restored_at: float | None = None
+    restored_age_s: float | None = None
+    restored_entries: int = 0
+    restore_skipped: str | None = None
+
+
+class StateSnapshotter:
+    """
+    Periodic writer / startup reader of one snapshot file.
+
+    ``collect`` runs on the caller's thread (the event loop in main.py, so
+    the dicts are not mutated while being copied); ``save`` then only
+    serializes the copy and may run in a worker thread.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        collect: Callable[[], dict[str, Any]],
+        *,
+        interval_s: float = 15.0,
+        max_age_s: float = 900.0,
+    ):
+        self.path = path
+        self.collect = collect
+        self.interval_s = float(interval_s)
+        self.max_age_s = float(max_age_s)
+        self.stats = StateSnapshotStats()
+        self._lock = threading.Lock()
+
+    def save(self, sections: dict[str, Any] | None = None) -> bool:
+        if sections is None:
+            sections = self.collect()
+        started = time.perf_counter()
+        with self._lock:
+            try:
+                size = write_snapshot(self.path, sections)
+            except (OSError, TypeError, ValueError) as e:
+                self.stats.write_errors += 1
+                self.stats.last_error = str(e)
+                return False
+            self.stats.writes += 1
+            self.stats.last_bytes = size
+            self.stats.last_write_at = time.time()
+            self.stats.last_write_ms = round((time.perf_counter() - started) * 1000.0, 2)
+            return True
+
+    def load(self, now: float | None = None) -> dict[str, Any] | None:
+        payload, reason = read_snapshot(self.path, max_age_s=self.max_age_s, now=now)
+        if payload is None:
+            self.stats.restore_skipped = reason
+            return None
+        current = time.time() if now is None else now
+        self.stats.restored_at = current
+        self.stats.restored_age_s = round(current - float(payload["saved_at"]), 1)
+        self.stats.restore_skipped = None
+        return payload
+
+    def snapshot(self) -> dict[str, Any]:
+        stats = self.stats
+        return {
+            "path": self.path,
+            "interval_s": self.interval_s,
+            "max_age_s": self.max_age_s,
+            "writes": stats.writes,
+            "write_errors": stats.write_errors,
+            "last_error": stats.last_error,
+            "last_write_at": _iso(stats.last_write_at) if stats.last_write_at else None,
+            "last_bytes": stats.last_bytes,
+            "last_write_ms": stats.last_write_ms,
+            "restored_at": _iso(stats.restored_at) if stats.restored_at else None,
+            "restored_age_s": stats.restored_age_s,
+            "restored_entries": stats.restored_entries,
+            "restore_skipped": stats.restore_skipped,
+        }
@@ -0,0 +1,226 @@
+"""In-memory connector status and presence tracking for StatusNotification / Heartbeat.
+
+Chargers resend an unchanged StatusNotification as a keepalive (``cp_sim5``
+models this with ``status_keepalive_s``) and every one of them used to
+insert a ``status_logs`` row.  ``StatusTracker`` keeps the current status
+per (charge point, connector) and classifies each notification:
+
+- ``transition``: status or error code changed (or first seen since the
+  connection opened), persisted;
+- ``keepalive``: unchanged, but the last persisted row is older than
+  ``keepalive_touch_s``, persisted so ``status_logs`` timestamps stay fresh;
+- ``duplicate``: unchanged, nothing written.
+
+Persisted rows go through ``StatusLogBatcher`` (one ``executemany`` per
+flush).  Heartbeats and status notifications only update an in-memory
+last-seen map; ``flush_presence`` upserts the changed entries into
+``charge_point_presence`` periodically.
+
+This module intentionally has no FastAPI or OCPP dependency.
+"""
+
+from __future__ import annotations
+
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from ws_admission import RowBatcher
+
+
+TRANSITION = "transition"
+KEEPALIVE = "keepalive"
+DUPLICATE = "duplicate"
+
+PRESENCE_UPSERT_SQL = """
+    INSERT INTO charge_point_presence
+    (charge_point_id, last_seen_at, last_heartbeat_at, updated_at)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(charge_point_id) DO UPDATE SET
+        last_seen_at = excluded.last_seen_at,
+        last_heartbeat_at = COALESCE(excluded.last_heartbeat_at, last_heartbeat_at),
+        updated_at = excluded.updated_at
+"""
+
+
+@dataclass(frozen=True)
+class ConnectorStatus:
+    status: str
+    error_code: str
+    timestamp: str | None
+    persisted_at: float
+
+
+@dataclass
+class Presence:
+    last_seen_at: str
+    last_heartbeat_at: str | None = None
+
+
+@dataclass
+class StatusTrackerStats:
+    transitions: int = 0
+    keepalives: int = 0
+    duplicates: int = 0
+    heartbeats: int = 0
+    presence_flushes: int = 0
+    presence_written: int = 0
+    presence_errors: int = 0
+
+
+class StatusTracker:
+    def __init__(self, keepalive_touch_s: float = 900.0, clock: Callable[[], float] = time.monotonic):
+        self.keepalive_touch_s = max(0.0, float(keepalive_touch_s))
+        self.clock = clock
+        self.stats = StatusTrackerStats()
+        self._connectors: dict[tuple[str, int], ConnectorStatus] = {}
+        self._presence: dict[str, Presence] = {}
+        self._dirty: set[str] = set()
+        self._lock = threading.Lock()
+
+    def observe(
+        self,
+        charge_point_id: str,
+        connector_id: int,
+        status: str,
+        error_code: str,
+        timestamp: str | None,
+        seen_at: str | None = None,
+    ) -> str:
+        """
+        Record one StatusNotification; returns ``transition`` / ``keepalive`` / ``duplicate``.
+
+        ``seen_at`` is the server receive time used for presence (the
+        charger's own ``timestamp`` may come from an unsynchronised clock).
+        """
+        key = (charge_point_id, int(connector_id))
+        now = self.clock()
+        with self._lock:
+            previous = self._connectors.get(key)
+            if previous is None or (previous.status, previous.error_code) != (status, error_code):
+                kind = TRANSITION
+            elif now - previous.persisted_at >= self.keepalive_touch_s:
+                kind = KEEPALIVE
+            else:
+                kind = DUPLICATE
+
+            if kind == DUPLICATE:
+                self.stats.duplicates += 1
+                self._connectors[key] = ConnectorStatus(
+                    status, error_code, timestamp, previous.persisted_at
+                )
+            else:
+                if kind == TRANSITION:
+                    self.stats.transitions += 1
+                else:
+                    self.stats.keepalives += 1
+                self._connectors[key] = ConnectorStatus(status, error_code, timestamp, now)
+            if seen_at:
+                self._touch_locked(charge_point_id, seen_at, heartbeat=False)
+        return kind
+
+    def current(self, charge_point_id: str, connector_id: int) -> ConnectorStatus | None:
+        return self._connectors.get((charge_point_id, int(connector_id)))
+
+    def forget(self, charge_point_id: str) -> None:
+        """斷線後清除：重連後第一筆 StatusNotification 一定落地。"""
+        with self._lock:
+            for key in [key for key in self._connectors if key[0] == charge_point_id]:
+                self._connectors.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._connectors.clear()
+            self._presence.clear()
+            self._dirty.clear()
+
+    def heartbeat(self, charge_point_id: str, at: str) -> None:
+        with self._lock:
+            self.stats.heartbeats += 1
+            self._touch_locked(charge_point_id, at, heartbeat=True)
+
+    def _touch_locked(self, charge_point_id: str, at: str, *, heartbeat: bool) -> None:
+        presence = self._presence.get(charge_point_id)
+        if presence is None:
+            presence = self._presence[charge_point_id] = Presence(last_seen_at=at)
+        else:
+            presence.last_seen_at = max(presence.last_seen_at, at)
+        if heartbeat:
+            presence.last_heartbeat_at = max(presence.last_heartbeat_at or at, at)
+        self._dirty.add(charge_point_id)
+
+    def presence(self, charge_point_id: str) -> Presence | None:
+        return self._presence.get(charge_point_id)
+
+    def flush_presence(self, conn: sqlite3.Connection, updated_at: str) -> int:
+        """Upsert every charge point seen since the last flush (one ``executemany``)."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            rows = [
+                (
+                    cp_id,
+                    self._presence[cp_id].last_seen_at,
+                    self._presence[cp_id].last_heartbeat_at,
+                    updated_at,
+                )
+                for cp_id in sorted(dirty)
+                if cp_id in self._presence
+            ]
+        if not rows:
+            return 0
+        try:
+            conn.executemany(PRESENCE_UPSERT_SQL, rows)
+            conn.commit()
+        except Exception:
+            with self._lock:
+                self.stats.presence_errors += 1
+                self._dirty |= dirty
+            raise
+        self.stats.presence_flushes += 1
+        self.stats.presence_written += len(rows)
+        return len(rows)
+
+    def snapshot(self) -> dict[str, Any]:
+        stats = self.stats
+        notifications = stats.transitions + stats.keepalives + stats.duplicates
+        return {
+            "connectors": len(self._connectors),
+            "charge_points_seen": len(self._presence),
+            "presence_pending": len(self._dirty),
+            "keepalive_touch_s": self.keepalive_touch_s,
+            "transitions": stats.transitions,
+            "keepalives": stats.keepalives,
+            "duplicates": stats.duplicates,
+            "write_ratio": (
+                round((stats.transitions + stats.keepalives) / notifications, 4)
+                if notifications
+                else None
+            ),
+            "heartbeats": stats.heartbeats,
+            "presence_flushes": stats.presence_flushes,
+            "presence_written": stats.presence_written,
+            "presence_errors": stats.presence_errors,
+        }
+
+
+class StatusLogBatcher(RowBatcher):
+    """``status_logs`` rows for transitions / keepalive touches, written in batches."""
+
+    INSERT_SQL = """
+        INSERT INTO status_logs
+        (charge_point_id, connector_id, status, timestamp, error_code)
+        VALUES (?, ?, ?, ?, ?)
+    """
+    TASK_NAME = "status-log-batcher"
+
+    def add(
+        self,
+        charge_point_id: str,
+        connector_id: int,
+        status: str,
+        timestamp: str | None,
+        error_code: str,
+    ) -> None:
+        self.add_row((charge_point_id, connector_id, status, timestamp, error_code))
@@ -0,0 +1,314 @@
+"""Rule-based tariff engine.
+
+``daily_pricing_rules`` used to hold every day of every imported year
+(~1,000 rows a year, read on every price lookup).  A date's schedule is now
+resolved from compact definitions:
+
+1. explicit per-date overrides: the ``daily_pricing_rules`` rows that are
+   left (manual edits, ``duplicate-daily-pricing``, special days whose
+   template differs from the calendar's);
+2. otherwise the year's calendar (``tariff_calendars``): season ranges plus
+   the weekday / saturday / sunday templates, snapshotted when the year is
+   imported so later template edits never reprice past days, with the day
+   type taken from ``tariff_holidays``;
+3. otherwise nothing, and callers fall back to the default price.
+
+Compiled schedules are memoized per (definition, season, day type), so ten
+years of dates share about a dozen schedule tuples.  ``plan_compaction``
+finds overrides that equal the compiled schedule, so re-importing a year
+that was materialized by the old import shrinks it to its real overrides.
+
+This module intentionally has no FastAPI or OCPP dependency.
+"""
+
+from __future__ import annotations
+
+import functools
+import json
+import sqlite3
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Iterable
+
+import pricing_calendar
+from pricing_calendar import DayRules, SeasonRanges
+
+
+def make_definition(
+    templates: dict[str, Any], season_ranges: SeasonRanges | None = None
+) -> str:
+    """Canonical JSON, so identical definitions compare (and memoize) equal."""
+    return json.dumps(
+        {
+            "seasons": [list(r) for r in season_ranges or pricing_calendar.DEFAULT_SEASON_RANGES],
+            "templates": templates,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_definition(definition: str) -> tuple[SeasonRanges, dict[str, Any]]:
+    parsed = json.loads(definition)
+    seasons = tuple(tuple(r) for r in parsed.get("seasons") or ())
+    return seasons or pricing_calendar.DEFAULT_SEASON_RANGES, parsed.get("templates") or {}
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_schedule(definition: str, season: str, day_type: str) -> DayRules:
+    _, templates = _parse_definition(definition)
+    return pricing_calendar.season_template_rules(templates, season, day_type)
+
+
+def compiled_day(definition: str, target_date: date, holiday_map: dict[str, str]) -> tuple[str, DayRules]:
+    """``(day_type, rules)`` of one date under a calendar definition."""
+    seasons, _ = _parse_definition(definition)
+    day_type = pricing_calendar.day_type_for_date(target_date, holiday_map)
+    season = pricing_calendar.season_for_date(target_date, seasons)
+    return day_type, compile_schedule(definition, season, day_type)
+
+
+def _in_clause(values: list) -> str:
+    return ",".join("?" for _ in values)
+
+
+def load_calendars(conn: sqlite3.Connection, years: Iterable[int] | None = None) -> dict[int, str]:
+    if years is None:
+        rows = conn.execute("SELECT year, definition FROM tariff_calendars").fetchall()
+    else:
+        years = sorted(set(years))
+        if not years:
+            return {}
+        rows = conn.execute(
+            f"SELECT year, definition FROM tariff_calendars WHERE year IN ({_in_clause(years)})",
+            years,
+        ).fetchall()
+    return {int(year): definition for year, definition in rows}
+
+
+def load_holidays(conn: sqlite3.Connection, first: str, last: str) -> dict[str, str]:
+    return dict(
+        conn.execute(
+            "SELECT date, day_type FROM tariff_holidays WHERE date BETWEEN ? AND ?",
+            (first, last),
+        ).fetchall()
+    )
+
+
+def load_overrides(conn: sqlite3.Connection, dates: list[str]) -> dict[str, list[tuple]]:
+    """``{date: [(start, end, price, label), ...]}`` in row order, only for dates that have rows."""
+    overrides: dict[str, list[tuple]] = {}
+    # SQLite 參數上限：分段查詢
+    for i in range(0, len(dates), 900):
+        part = dates[i : i + 900]
+        for r_date, start, end, price, label in conn.execute(
+            f"""
+            SELECT date, start_time, end_time, price, COALESCE(label, '')
+            FROM daily_pricing_rules
+            WHERE date IN ({_in_clause(part)})
+            ORDER BY rowid
+            """,
+            part,
+        ):
+            overrides.setdefault(r_date, []).append((start, end, price, label))
+    return overrides
+
+
+def base_schedules(conn: sqlite3.Connection, dates: list[str]) -> dict[str, tuple[str, DayRules]]:
+    """Calendar schedules (ignoring overrides) for the dates whose year has a calendar."""
+    if not dates:
+        return {}
+    parsed = {d: datetime.strptime(d, "%Y-%m-%d").date() for d in dates}
+    calendars = load_calendars(conn, (day.year for day in parsed.values()))
+    if not calendars:
+        return {}
+    holidays = load_holidays(conn, min(dates), max(dates))
+    return {
+        d: compiled_day(calendars[day.year], day, holidays)
+        for d, day in parsed.items()
+        if day.year in calendars
+    }
+
+
+def resolve(conn: sqlite3.Connection, dates: Iterable[str]) -> dict[str, list[tuple]]:
+    """
+    Effective ``[(start, end, price, label), ...]`` per date: overrides
+    first, then the calendar; ``[]`` when neither applies.
+    """
+    dates = sorted(set(dates))
+    overrides = load_overrides(conn, dates)
+    base = base_schedules(conn, [d for d in dates if d not in overrides])
+    return {
+        d: overrides[d] if d in overrides else list(base[d][1]) if d in base else []
+        for d in dates
+    }
+
+
+def rules_for_dates(conn: sqlite3.Connection, dates: list[str]) -> dict[str, list[tuple[str, str, float]]]:
+    """``TariffRulesCache`` loader: ``(start, end, price)`` without labels."""
+    return {
+        d: [(start, end, price) for start, end, price, _ in rules]
+        for d, rules in resolve(conn, dates).items()
+    }
+
+
+def effective_rules(conn: sqlite3.Connection, dates: Iterable[str]) -> dict[str, DayRules]:
+    """``resolve`` normalized for comparison (before/after diffs of the import endpoints)."""
+    return {
+        d: pricing_calendar.normalize_rules(rules) for d, rules in resolve(conn, dates).items()
+    }
+
+
+def _date_range(first: date, last: date) -> list[str]:
+    return [
+        (first + timedelta(days=n)).strftime("%Y-%m-%d") for n in range((last - first).days + 1)
+    ]
+
+
+def date_range(first: str, last: str) -> list[str]:
+    return _date_range(
+        datetime.strptime(first, "%Y-%m-%d").date(), datetime.strptime(last, "%Y-%m-%d").date()
+    )
+
+
+def load_rules_by_date(
+    conn: sqlite3.Connection, first_date: str | None = None, last_date: str | None = None
+) -> dict[str, list[tuple[str, str, float]]]:
+    """
+    ``billing.RulesByDate`` for a date range, starting the day before
+    ``first_date`` (periods that cross midnight).  With no range, every
+    override date plus every day of every calendar year.
+    """
+    if first_date is not None and last_date is not None:
+        first = datetime.strptime(first_date, "%Y-%m-%d").date() - timedelta(days=1)
+        dates = _date_range(first, datetime.strptime(last_date, "%Y-%m-%d").date())
+    else:
+        dates = [row[0] for row in conn.execute("SELECT DISTINCT date FROM daily_pricing_rules")]
+        for year in load_calendars(conn):
+            dates.extend(_date_range(date(year, 1, 1), date(year, 12, 31)))
+    return {d: rules for d, rules in rules_for_dates(conn, dates).items() if rules}
+
+
+def _utc_now() -> str:
+    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+
+
+def register_calendars(
+    conn: sqlite3.Connection,
+    years: Iterable[int],
+    definition: str,
+    holiday_maps: dict[int, dict[str, str]],
+    *,
+    replace: bool,
+) -> list[int]:
+    """
+    Store the year's definition and holiday calendar (one short transaction).
+    ``replace=False`` leaves years that already have a calendar untouched.
+    Returns the years written.
+    """
+    years = sorted(set(years))
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        existing = load_calendars(conn, years)
+        written = []
+        for year in years:
+            if year in existing and not replace:
+                continue
+            # 定義相同時不更新（不觸發版本遞增）
+            conn.execute(
+                """
+                INSERT INTO tariff_calendars (year, definition, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(year) DO UPDATE SET definition = excluded.definition,
+                    updated_at = excluded.updated_at
+                WHERE tariff_calendars.definition <> excluded.definition
+                """,
+                (year, definition, _utc_now()),
+            )
+            holidays = {
+                d: t for d, t in (holiday_maps.get(year) or {}).items() if t in ("holiday", "workday")
+            }
+            current = load_holidays(conn, f"{year}-01-01", f"{year}-12-31")
+            if current != holidays:
+                conn.execute(
+                    "DELETE FROM tariff_holidays WHERE date BETWEEN ? AND ?",
+                    (f"{year}-01-01", f"{year}-12-31"),
+                )
+                conn.executemany(
+                    "INSERT INTO tariff_holidays (date, day_type) VALUES (?, ?)",
+                    sorted(holidays.items()),
+                )
+            written.append(year)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return written
+
+
+def set_holidays(conn: sqlite3.Connection, dates: Iterable[str], day_type: str = "holiday") -> int:
+    """標記特殊節日（只寫有變動的日期）；caller commits."""
+    dates = sorted(set(dates))
+    if not dates:
+        return 0
+    current = load_holidays(conn, dates[0], dates[-1])
+    changed = [(d, day_type) for d in dates if current.get(d) != day_type]
+    conn.executemany(
+        """
+        INSERT INTO tariff_holidays (date, day_type) VALUES (?, ?)
+        ON CONFLICT(date) DO UPDATE SET day_type = excluded.day_type
+        """,
+        changed,
+    )
+    return len(changed)
+
+
+def plan_compaction(
+    conn: sqlite3.Connection, first: str, last: str, *, drop_all: bool = False
+) -> dict[str, DayRules]:
+    """
+    Override dates in the range to delete (``pricing_calendar.apply_changes``
+    with empty rules): those equal to the calendar schedule, or every
+    override of a calendar year when ``drop_all``.
+    """
+    overrides = pricing_calendar.load_existing(conn, first=first, last=last)
+    base = base_schedules(conn, sorted(overrides))
+    return {
+        d: ()
+        for d, rules in overrides.items()
+        if d in base and (drop_all or rules == base[d][1])
+    }
+
+
+def materialize(conn: sqlite3.Connection, date_str: str) -> int:
+    """
+    Copy-on-write for the legacy per-row endpoints: a date without overrides
+    gets its calendar schedule written as rows first, so appending or
+    editing one row keeps the rest of the day.  Caller commits.
+    """
+    if conn.execute(
+        "SELECT 1 FROM daily_pricing_rules WHERE date = ? LIMIT 1", (date_str,)
+    ).fetchone():
+        return 0
+    base = base_schedules(conn, [date_str]).get(date_str)
+    if not base:
+        return 0
+    conn.executemany(
+        """
+        INSERT INTO daily_pricing_rules (date, start_time, end_time, price, label)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        [(date_str, *rule) for rule in base[1]],
+    )
+    return len(base[1])
+
+
+def storage_stats(conn: sqlite3.Connection) -> dict[str, Any]:
+    return {
+        "calendarYears": sorted(load_calendars(conn)),
+        "holidayRows": conn.execute("SELECT COUNT(*) FROM tariff_holidays").fetchone()[0],
+        "overrideRows": conn.execute("SELECT COUNT(*) FROM daily_pricing_rules").fetchone()[0],
+        "overrideDates": conn.execute(
+            "SELECT COUNT(DISTINCT date) FROM daily_pricing_rules"
+        ).fetchone()[0],
+        "compiledSchedules": compile_schedule.cache_info().currsize,
+    }
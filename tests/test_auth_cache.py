@@ -0,0 +1,109 @@
+import asyncio
+import gc
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from db_config import get_database_path
+from schema_migrations import migrate as migrate_schema
+
+# main.py no longer creates tables on import (run_startup_migrations.py does).
+migrate_schema(get_database_path())
+
+import main  # noqa: E402
+from auth_cache import AuthorizationCache, authorization_cache, load_authorization  # noqa: E402
+from household_account_service import (  # noqa: E402
+    bind_card_to_account,
+    connect,
+    create_household_account,
+    debit_household_account_atomic,
+    topup_household_account,
+    update_household_account,
+)
+from tests.test_household_accounts import make_db  # noqa: E402
+
+
+class AuthorizationCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = make_db(Path(self.tempdir.name))
+        conn = connect(self.db_file)
+        self.account_id = create_household_account(conn, "2F", "AUTH-01", 100)["account_id"]
+        bind_card_to_account(conn, self.account_id, "AUTH-CARD")
+        conn.execute(
+            "INSERT INTO card_whitelist(card_id,charge_point_id) VALUES ('AUTH-CARD','CP-1')"
+        )
+        conn.commit()
+        conn.close()
+        authorization_cache.clear()
+
+    def tearDown(self):
+        authorization_cache.clear()
+        gc.collect()
+        self.tempdir.cleanup()
+
+    def authorize(self, id_tag="AUTH-CARD"):
+        return asyncio.run(
+            main.ChargePoint.on_authorize(SimpleNamespace(id="CP-1"), id_tag)
+        ).id_tag_info["status"]
+
+    def test_cold_miss_is_one_joined_row(self):
+        conn = connect(self.db_file)
+        entry = load_authorization(conn, "AUTH-CARD")
+        self.assertIsNone(load_authorization(conn, "NOPE"))
+        conn.close()
+
+        self.assertEqual(entry.account_id, self.account_id)
+        self.assertEqual(entry.balance_class, "positive")
+        self.assertEqual(entry.authorize_status(), "Accepted")
+        self.assertTrue(entry.allows_charge_point("CP-1"))
+        self.assertFalse(entry.allows_charge_point("CP-2"))
+        self.assertFalse(entry.has_active_reservation)
+
+    def test_warm_tap_skips_the_database_until_a_writer_invalidates(self):
+        with patch.object(main, "DB_FILE", self.db_file):
+            self.assertEqual(self.authorize(), "Accepted")
+            with patch.object(
+                main, "_load_authorization_from_db", side_effect=AssertionError("db hit")
+            ):
+                self.assertEqual(self.authorize(), "Accepted")
+
+            conn = connect(self.db_file)
+            update_household_account(conn, self.account_id, status="disabled")
+            conn.close()
+            self.assertEqual(self.authorize(), "Blocked")
+
+        self.assertEqual(authorization_cache.stats.hits, 1)
+
+    def test_balance_class_follows_debit_and_topup(self):
+        with patch.object(main, "DB_FILE", self.db_file):
+            self.assertEqual(main.get_authorization("AUTH-CARD").balance_class, "positive")
+            conn = connect(self.db_file)
+            debit_household_account_atomic(conn, self.account_id, 100)
+            self.assertEqual(main.get_authorization("AUTH-CARD").balance_class, "empty")
+            topup_household_account(conn, self.account_id, 5)
+            conn.close()
+            self.assertEqual(main.get_authorization("AUTH-CARD").balance_class, "positive")
+
+    def test_load_racing_an_invalidation_is_not_stored(self):
+        cache = AuthorizationCache(ttl_s=60)
+        conn = connect(self.db_file)
+
+        def racing_loader(id_tag):
+            entry = load_authorization(conn, id_tag)
+            cache.invalidate_card(id_tag)
+            return entry
+
+        self.assertIsNotNone(cache.get(self.db_file, "AUTH-CARD", racing_loader))
+        self.assertEqual((len(cache), cache.stats.stale_loads), (0, 1))
+        cache.get(self.db_file, "AUTH-CARD", lambda tag: load_authorization(conn, tag))
+        self.assertEqual(len(cache), 1)
+        cache.get("other.sqlite3", "AUTH-CARD", lambda tag: None)
+        self.assertEqual(len(cache), 0)
+        conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
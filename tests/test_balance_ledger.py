@@ -0,0 +1,103 @@
+import gc
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+
+import balance_ledger
+from balance_ledger import LedgerError, post_entry, rollup
+from household_account_service import (
+    HouseholdAccountError,
+    connect,
+    create_household_account,
+    debit_household_account_atomic,
+    get_account_by_id,
+    topup_household_account,
+)
+from tests.test_household_accounts import make_db
+
+
+class BalanceLedgerTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = make_db(Path(self.tempdir.name))
+        self.conn = connect(self.db_file)
+        self.account_id = create_household_account(self.conn, "3F", "L-01", 100)["account_id"]
+
+    def tearDown(self):
+        self.conn.close()
+        gc.collect()
+        self.tempdir.cleanup()
+
+    def history(self):
+        return [
+            (entry["entry_type"], entry["amount"], entry["balance_after"])
+            for entry in reversed(balance_ledger.account_history(self.conn, self.account_id))
+        ]
+
+    def test_every_balance_change_is_an_entry_and_updates_the_cache(self):
+        topup_household_account(self.conn, self.account_id, 50)
+        self.assertEqual(
+            debit_household_account_atomic(self.conn, self.account_id, 200),
+            (150.0, 0.0),
+        )
+
+        self.assertEqual(
+            self.history(),
+            [("opening", 100.0, 100.0), ("topup", 50.0, 150.0), ("debit", -150.0, 0.0)],
+        )
+        self.assertEqual(get_account_by_id(self.conn, self.account_id)["balance"], 0)
+        self.assertTrue(rollup(self.conn)["ok"])
+
+    def test_settlement_and_topup_keys_apply_once(self):
+        first = debit_household_account_atomic(self.conn, self.account_id, 30, transaction_id=9)
+        replay = debit_household_account_atomic(self.conn, self.account_id, 30, transaction_id=9)
+        topup_household_account(self.conn, self.account_id, 10, idempotency_key="req-1")
+        topup_household_account(self.conn, self.account_id, 10, idempotency_key="req-1")
+
+        self.assertEqual(first, (100.0, 70.0))
+        self.assertEqual(replay, first)
+        self.assertEqual(get_account_by_id(self.conn, self.account_id)["balance"], 80)
+
+    def test_entries_are_append_only_and_cannot_go_negative(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        with self.assertRaises(LedgerError):
+            post_entry(self.conn, self.account_id, "adjustment", -101)
+        with self.assertRaises(LedgerError):
+            post_entry(self.conn, 999, "topup", 1)
+        self.conn.rollback()
+        with self.assertRaises(HouseholdAccountError):
+            topup_household_account(self.conn, 999, 1)
+
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.conn.execute(f"UPDATE {balance_ledger.LEDGER_TABLE} SET amount = 0")
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.conn.execute(f"DELETE FROM {balance_ledger.LEDGER_TABLE}")
+
+    def test_rollup_reports_and_repairs_cache_drift(self):
+        self.conn.execute(
+            "UPDATE household_accounts SET balance = 120 WHERE account_id = ?",
+            (self.account_id,),
+        )
+        self.conn.execute(
+            """
+            INSERT INTO household_accounts
+                (account_code, account_name, balance, status, created_at, updated_at)
+            VALUES ('RAW', 'raw', 5, 'active', 'now', 'now')
+            """
+        )
+        self.conn.commit()
+
+        report = rollup(self.conn)
+        self.assertFalse(report["ok"])
+        self.assertEqual(report["drifted"][0]["drift"], 20.0)
+        self.assertEqual(len(report["unledgered"]), 1)
+
+        self.assertEqual(rollup(self.conn, repair=True)["repaired"], 2)
+        self.assertTrue(rollup(self.conn)["ok"])
+        self.assertEqual(self.history()[-1], ("adjustment", 20.0, 120.0))
+        self.assertEqual(get_account_by_id(self.conn, self.account_id)["balance"], 120)
+
+
+if __name__ == "__main__":
+    unittest.main()
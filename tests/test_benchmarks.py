@@ -0,0 +1,76 @@
+import json
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import benchmarks
+
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+class BenchmarkHelpersTests(unittest.TestCase):
+    def test_pricing_rows_cover_every_day_with_holiday_templates(self):
+        rows = benchmarks.build_pricing_rows(2026, 2026)
+
+        days = {row[0] for row in rows}
+        self.assertEqual(len(days), 365)
+        # 2026-01-01 is a Thursday but listed as a holiday in holidays/2026.json
+        new_year = [row for row in rows if row[0] == "2026-01-01"]
+        self.assertEqual([(r[1], r[2]) for r in new_year], [("00:00", "24:00")])
+        self.assertEqual(new_year[0][4], "non_summer:sunday")
+        july_weekday = [row for row in rows if row[0] == "2026-07-15"]
+        self.assertEqual(len(july_weekday), 4)
+        self.assertTrue(all(r[4] == "summer:weekday" for r in july_weekday))
+
+    def test_compare_to_baseline_flags_regressions_by_median(self):
+        baseline = {"results": {"a": {"median_ms": 10.0}, "b": {"median_ms": 10.0}}}
+        report = {
+            "results": {
+                "a": {"median_ms": 13.0},
+                "b": {"median_ms": 5.0},
+                "c": {"median_ms": 1.0},
+            }
+        }
+
+        comparison = benchmarks.compare_to_baseline(report, baseline, max_regression=0.25)
+
+        self.assertEqual(comparison["regressions"], ["a"])
+        self.assertEqual(comparison["cases"]["a"]["ratio"], 1.3)
+        self.assertEqual(comparison["cases"]["b"]["status"], "improved")
+        self.assertEqual(comparison["cases"]["c"]["status"], "new")
+
+
+class BenchmarkSuiteTests(unittest.TestCase):
+    def test_quick_suite_emits_machine_readable_report(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = Path(directory) / "bench.json"
+            process = subprocess.run(
+                [
+                    sys.executable,
+                    "benchmarks.py",
+                    "--quick",
+                    "--filter", "calculate_multi_period_cost_detailed",
+                    "--filter", "debit_household_account_atomic",
+                    "--baseline", str(Path(directory) / "missing.json"),
+                    "--output", str(output),
+                ],
+                cwd=ROOT,
+                capture_output=True,
+                text=True,
+                timeout=300,
+            )
+            self.assertEqual(process.returncode, 0, process.stderr[-2000:])
+
+            report = json.loads(output.read_text(encoding="utf-8"))
+            self.assertEqual(json.loads(process.stdout), report)
+
+        names = set(report["results"])
+        self.assertIn("calculate_multi_period_cost_detailed[samples=1000]", names)
+        self.assertIn("debit_household_account_atomic[households=50]", names)
+        self.assertNotIn("price_for_timestamp[200_lookups]", names)
+        for result in report["results"].values():
+            self.assertGreater(result["median_ms"], 0)
+        self.assertTrue(report["meta"]["quick"])
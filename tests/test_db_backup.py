@@ -0,0 +1,96 @@
+import gzip
+import sqlite3
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+import db_backup
+from db_backup import BackupError, DatabaseBackup, copy_database, restore_backup, verify_backup
+
+
+class DatabaseBackupTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = str(Path(self.tempdir.name) / "ocpp.sqlite3")
+        self.backup_dir = str(Path(self.tempdir.name) / "backups")
+        self.writer = sqlite3.connect(self.db_file, isolation_level=None, check_same_thread=False)
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.writer.execute("CREATE TABLE meter_values (id INTEGER PRIMARY KEY, value TEXT)")
+        self.writer.executemany(
+            "INSERT INTO meter_values (value) VALUES (?)", [("x" * 200,) for _ in range(3000)]
+        )
+
+    def tearDown(self):
+        self.writer.close()
+        self.tempdir.cleanup()
+
+    def count_rows(self, db_file):
+        conn = sqlite3.connect(db_file)
+        try:
+            return conn.execute("SELECT COUNT(*) FROM meter_values").fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_compressed_snapshots_are_verified_and_rotated(self):
+        backup = DatabaseBackup(self.db_file, self.backup_dir, keep=2, step_pages=16, step_sleep_s=0)
+        reports = [backup.run() for _ in range(3)]
+
+        snapshots = db_backup.list_backups(self.backup_dir, self.db_file)
+        self.assertEqual([p.name for p in snapshots], [Path(r["snapshot"]).name for r in reports[1:]])
+        self.assertEqual(reports[2]["rotated"], [Path(reports[0]["snapshot"]).name])
+        self.assertGreater(reports[2]["steps"], 1)
+        self.assertLess(reports[2]["compressed_bytes"], reports[2]["raw_bytes"])
+        self.assertEqual(verify_backup(reports[2]["snapshot"]), ["ok"])
+        # 暫存的未壓縮複本不留在備份目錄
+        self.assertEqual(sorted(p.name for p in Path(self.backup_dir).iterdir()), [p.name for p in snapshots])
+
+        status = backup.snapshot()
+        self.assertEqual((status["runs"], status["failures"], len(status["snapshots"])), (3, 0, 2))
+        self.assertEqual(status["last_raw_bytes"], reports[2]["raw_bytes"])
+
+    def test_copy_falls_back_to_single_step_under_concurrent_writes(self):
+        stop = threading.Event()
+
+        def keep_writing():
+            while not stop.is_set():
+                self.writer.execute("INSERT INTO meter_values (value) VALUES ('y')")
+
+        thread = threading.Thread(target=keep_writing)
+        thread.start()
+        try:
+            target = str(Path(self.tempdir.name) / "copy.sqlite3")
+            progress = copy_database(
+                self.db_file, target, step_pages=1, step_sleep_s=0.002, max_restarts=2
+            )
+        finally:
+            stop.set()
+            thread.join()
+
+        self.assertTrue(progress["single_step_fallback"])
+        self.assertEqual(progress["restarts"], 3)
+        self.assertGreaterEqual(self.count_rows(target), 3000)
+        self.assertEqual(db_backup.integrity_check(target), ["ok"])
+        self.assertFalse(Path(f"{target}-wal").exists())
+
+    def test_restore_rejects_corrupt_snapshot_and_keeps_previous_database(self):
+        report = DatabaseBackup(self.db_file, self.backup_dir).run()
+        self.writer.execute("DELETE FROM meter_values WHERE id > 10")
+
+        corrupt = Path(self.backup_dir) / "ocpp.sqlite3.corrupt.sqlite3.gz"
+        with gzip.open(corrupt, "wb") as f:
+            f.write(b"SQLite format 3\0" + b"\xff" * 4096)
+        self.assertNotEqual(verify_backup(str(corrupt)), ["ok"])
+        with self.assertRaises(BackupError):
+            restore_backup(str(corrupt), self.db_file)
+        self.assertEqual(self.count_rows(self.db_file), 10)
+
+        self.writer.close()
+        result = restore_backup(report["snapshot"], self.db_file)
+        self.assertEqual(self.count_rows(self.db_file), 3000)
+        self.assertEqual(self.count_rows(result["previous"]), 10)
+        self.writer = sqlite3.connect(self.db_file)
+
+
+if __name__ == "__main__":
+    unittest.main()
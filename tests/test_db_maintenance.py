@@ -0,0 +1,113 @@
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+
+import db_maintenance
+from db_maintenance import DatabaseMaintenance, connection_pragmas
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class DatabaseMaintenanceTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = str(Path(self.tempdir.name) / "maint.sqlite3")
+        self.writer = sqlite3.connect(self.db_file, isolation_level=None)
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        # 測試自行控制 checkpoint 時機
+        self.writer.execute("PRAGMA wal_autocheckpoint=0")
+        self.writer.execute("CREATE TABLE meter_values (id INTEGER PRIMARY KEY, value TEXT)")
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        self.writer.close()
+        self.tempdir.cleanup()
+
+    def write_rows(self, n=200):
+        self.writer.executemany(
+            "INSERT INTO meter_values (value) VALUES (?)", [("x" * 200,) for _ in range(n)]
+        )
+
+    def test_passive_checkpoint_keeps_wal_bounded_under_continuous_writes(self):
+        maint = DatabaseMaintenance(self.db_file, quiet_s=5, passive_interval_s=10, clock=self.clock)
+        wal_sizes = []
+        # 每 5 秒都有寫入：永遠沒有 quiet 時段
+        for _ in range(40):
+            self.write_rows()
+            wal_sizes.append(db_maintenance.wal_size(self.db_file))
+            maint.tick()
+            self.clock.now += 5
+
+        self.assertEqual(maint.stats.quiet_ticks, 0)
+        self.assertEqual(maint.stats.passive_checkpoints, 20)
+        self.assertEqual(maint.stats.last_checkpointed_frames, maint.stats.last_wal_frames)
+        # checkpoint 後 WAL 從頭重用：大小停在約兩輪寫入量，不隨總寫入量成長
+        self.assertLessEqual(max(wal_sizes), 3 * wal_sizes[0])
+        self.assertLessEqual(wal_sizes[-1], 3 * wal_sizes[0])
+
+        # 間隔內不重複
+        self.write_rows()
+        self.assertEqual(maint.tick(), ["passive_checkpoint"])
+        self.clock.now += 3
+        self.write_rows()
+        self.assertEqual(maint.tick(), [])
+        maint.close()
+
+    def test_truncate_on_budget_and_incremental_vacuum_after_delete(self):
+        self.writer.close()
+        Path(self.db_file).unlink()
+        for suffix in ("-wal", "-shm"):
+            Path(self.db_file + suffix).unlink(missing_ok=True)
+        self.writer = sqlite3.connect(self.db_file, isolation_level=None)
+        self.writer.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.writer.execute("PRAGMA wal_autocheckpoint=0")
+        self.writer.execute("CREATE TABLE meter_values (id INTEGER PRIMARY KEY, value TEXT)")
+
+        maint = DatabaseMaintenance(
+            self.db_file, quiet_s=5, truncate_wal_bytes=64 * 1024, vacuum_max_pages=10_000, clock=self.clock
+        )
+        self.write_rows(2000)
+        self.assertGreater(db_maintenance.wal_size(self.db_file), 64 * 1024)
+        self.assertEqual(maint.tick(), ["truncate_checkpoint"])
+        self.assertEqual(db_maintenance.wal_size(self.db_file), 0)
+
+        self.writer.execute("DELETE FROM meter_values")
+        maint.request_vacuum()
+        self.assertGreater(maint.metrics()["freelist_pages"], 0)
+        self.clock.now += 10
+        maint.tick()
+        self.clock.now += 10
+        self.assertIn("incremental_vacuum", maint.tick())
+        snapshot = maint.snapshot()
+        self.assertEqual((snapshot["freelist_pages"], snapshot["auto_vacuum"]), (0, "incremental"))
+        self.assertFalse(snapshot["vacuum_requested"])
+        maint.close()
+
+    def test_optimize_interval_and_connection_pragmas(self):
+        maint = DatabaseMaintenance(self.db_file, quiet_s=1, optimize_interval_s=60, clock=self.clock)
+        maint.tick()
+        maint.request_analyze()
+        self.clock.now += 2
+        self.assertIn("analyze", maint.tick())
+        self.clock.now += 61
+        self.assertIn("optimize", maint.tick())
+        self.assertEqual((maint.stats.analyze_runs, maint.stats.optimize_runs), (1, 1))
+        maint.close()
+
+        self.assertEqual(connection_pragmas(), ())
+        self.assertEqual(
+            connection_pragmas(cache_size_kib=8192, mmap_size=1 << 26, wal_autocheckpoint=10000),
+            ("PRAGMA cache_size=-8192", "PRAGMA mmap_size=67108864", "PRAGMA wal_autocheckpoint=10000"),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
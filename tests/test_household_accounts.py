@@ -9,7 +9,13 @@ from pathlib import Path
 from types import SimpleNamespace
 from unittest.mock import patch
 
-import main
+from db_config import get_database_path
+from schema_migrations import migrate as migrate_schema
+
+# main.py no longer creates tables on import (run_startup_migrations.py does).
+migrate_schema(get_database_path())
+
+import main  # noqa: E402
 from household_account_service import (
     HouseholdAccountError,
     bind_card_to_account,
@@ -45,6 +51,10 @@ def make_db(directory: Path) -> str:
             id_tag TEXT PRIMARY KEY, name TEXT, department TEXT, card_number TEXT
         );
         CREATE TABLE card_whitelist (id INTEGER PRIMARY KEY, card_id TEXT, charge_point_id TEXT);
+        CREATE TABLE reservations (
+            id INTEGER PRIMARY KEY, charge_point_id TEXT, id_tag TEXT,
+            start_time TEXT, end_time TEXT, status TEXT
+        );
         CREATE TABLE charge_points (
             id INTEGER PRIMARY KEY, charge_point_id TEXT UNIQUE, name TEXT,
             status TEXT DEFAULT 'enabled', created_at TEXT, max_current_a REAL
@@ -676,13 +686,9 @@ class HouseholdAccountTests(unittest.TestCase):
             items = json.loads(transaction_response.body)
         self.assertEqual((items[0]["floorNo"], items[0]["parkingSpaceNo"]), ("9F", "STOP-01"))
 
-        detail_conn = sqlite3.connect(self.db_file)
-        try:
-            with patch.object(main, "cursor", detail_conn.cursor()):
-                detail_response = asyncio.run(main.get_transaction_detail(901))
-            detail = json.loads(detail_response.body)
-        finally:
-            detail_conn.close()
+        with patch.object(main, "DB_FILE", self.db_file):
+            detail_response = asyncio.run(main.get_transaction_detail(901))
+        detail = json.loads(detail_response.body)
         self.assertEqual((detail["floorNo"], detail["parkingSpaceNo"]), ("9F", "STOP-01"))
 
         with (
@@ -0,0 +1,176 @@
+import asyncio
+import json
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import auth_cache
+import household_bulk
+import main
+from household_account_service import connect, create_household_account
+from schema_migrations import migrate
+
+
+class FakeRequest(SimpleNamespace):
+    async def body(self):
+        return self.payload
+
+
+class HouseholdBulkTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = str(Path(self.tempdir.name) / "bulk.sqlite3")
+        migrate(self.db_file)
+        self.conn = connect(self.db_file)
+        self.existing = create_household_account(self.conn, "B1", "P-01", 100)
+        self.conn.execute(
+            "INSERT INTO account_cards (card_id, account_id, status, created_at, updated_at) "
+            "VALUES ('CARD-OLD', ?, 'active', '2026-01-01T00:00:00+00:00', '2026-01-01T00:00:00+00:00')",
+            (self.existing["account_id"],),
+        )
+        self.conn.commit()
+        auth_cache.clear()
+
+    def tearDown(self):
+        self.conn.close()
+        self.tempdir.cleanup()
+
+    def count(self, table):
+        return self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+    def test_csv_batch_with_conflicts_reports_every_row_and_writes_nothing(self):
+        body = (
+            "﻿floor_no,parking_space_no,balance,card_ids\n"
+            "b1,p-01,0,\n"  # 與既有戶號衝突（大小寫不同）
+            "B2,P-02,50,CARD-1;CARD-2\n"
+            "B3,P-03,-1,\n"
+            "ｂ２,P-02,0,CARD-OLD\n"  # 批次內衝突 + 卡號已綁定
+            "B4,P-04,0,CARD-2\n"
+        ).encode("utf-8")
+        rows = household_bulk.parse_rows(body, "text/csv; charset=utf-8")
+        report = household_bulk.bulk_create_accounts(self.conn, rows)
+
+        statuses = [(r.row, r.status) for r in report.results]
+        self.assertEqual(statuses, [(1, "error"), (2, "error"), (3, "error"), (4, "error"), (5, "error")])
+        errors = {r.row: r.error for r in report.results}
+        self.assertIn(f"account_ids=[{self.existing['account_id']}]", errors[1])
+        self.assertIn("rows=[2, 4]", errors[2])
+        self.assertEqual(errors[3], "balance cannot be negative")
+        self.assertIn("repeated in batch (row 2)", errors[5])
+        self.assertFalse(report.applied)
+        self.assertEqual(self.count("household_accounts"), 1)
+        self.assertEqual(self.count("account_cards"), 1)
+
+        with self.assertRaises(household_bulk.HouseholdAccountError):
+            household_bulk.parse_rows(b'{"rows": "nope"}', "application/json")
+
+    def test_json_batch_applies_in_one_transaction_with_single_invalidation(self):
+        rows = [
+            {"floorNo": "C1", "parkingSpaceNo": "P-11", "balance": 30, "cardIds": ["CARD-A"]},
+            {"floor_no": "C2", "parking_space_no": "P-12", "card_ids": ["CARD-B", "CARD-C"]},
+        ]
+        dry = household_bulk.bulk_create_accounts(self.conn, rows, dry_run=True)
+        self.assertEqual((dry.errors, dry.applied), (0, False))
+        self.assertEqual(self.count("household_accounts"), 1)
+
+        before = auth_cache.authorization_cache.snapshot()["invalidations"]
+        report = household_bulk.bulk_create_accounts(self.conn, rows)
+        self.assertTrue(report.applied)
+        self.assertEqual(auth_cache.authorization_cache.snapshot()["invalidations"], before + 1)
+
+        account_id = report.results[0].data["accountId"]
+        self.assertEqual(
+            tuple(
+                self.conn.execute(
+                    "SELECT entry_type, amount FROM household_balance_ledger WHERE account_id = ?", (account_id,)
+                ).fetchone()
+            ),
+            ("opening", 30.0),
+        )
+        self.assertEqual(
+            [
+                row[0]
+                for row in self.conn.execute(
+                    "SELECT card_id FROM account_cards WHERE account_id = ? ORDER BY card_id",
+                    (report.results[1].data["accountId"],),
+                )
+            ],
+            ["CARD-B", "CARD-C"],
+        )
+        self.assertEqual(
+            self.conn.execute("SELECT status FROM id_tags WHERE id_tag = 'CARD-A'").fetchone()[0], "Accepted"
+        )
+
+        bind = household_bulk.bulk_bind_cards(
+            self.conn,
+            [
+                {"floorNo": "c1", "parkingSpaceNo": "p-11", "cardId": "CARD-D", "chargePointIds": "CP-1;CP-2"},
+                {"accountId": 9999, "cardId": "CARD-E"},
+            ],
+        )
+        self.assertEqual([r.error for r in bind.results], [None, "account not found"])
+        bind = household_bulk.bulk_bind_cards(
+            self.conn, [{"floorNo": "c1", "parkingSpaceNo": "p-11", "cardId": "CARD-D", "chargePointIds": "CP-1;CP-2"}]
+        )
+        self.assertTrue(bind.applied)
+        self.assertEqual(self.count("card_whitelist"), 2)
+
+    def test_topups_skip_applied_keys_and_routes_return_422_on_errors(self):
+        account_id = self.existing["account_id"]
+        first = household_bulk.bulk_topup(
+            self.conn, [{"accountId": account_id, "amount": 10, "idempotencyKey": "pay-1"}]
+        )
+        self.assertEqual(first.results[0].data["balance"], 110.0)
+
+        report = household_bulk.bulk_topup(
+            self.conn,
+            [
+                {"accountId": account_id, "amount": 10, "idempotencyKey": "pay-1"},
+                {"floorNo": "B1", "parkingSpaceNo": "P-01", "amount": "5.5", "idempotencyKey": "pay-2"},
+                {"accountId": account_id, "amount": 1},
+            ],
+        )
+        self.assertEqual([r.status for r in report.results], ["skipped", "ok", "ok"])
+        self.assertEqual(
+            self.conn.execute("SELECT balance FROM household_accounts WHERE account_id = ?", (account_id,)).fetchone()[0],
+            116.5,
+        )
+        duplicate = household_bulk.bulk_topup(
+            self.conn,
+            [
+                {"accountId": account_id, "amount": 1, "idempotencyKey": "pay-3"},
+                {"accountId": account_id, "amount": 1, "idempotencyKey": "pay-3"},
+            ],
+        )
+        self.assertEqual(duplicate.errors, 1)
+
+        with patch.object(main, "DB_FILE", self.db_file):
+            def post(route, payload, content_type="application/json", dry_run=False):
+                request = FakeRequest(payload=payload, headers={"content-type": content_type})
+                response = asyncio.run(route(request, dry_run))
+                return response.status_code, json.loads(response.body)
+
+            status, body = post(
+                main.api_bulk_add_id_tags,
+                b"idTag,validUntil\nTAG-1,2030-01-01T00:00:00Z\nTAG-2,not-a-date\n",
+                "text/csv",
+            )
+            self.assertEqual((status, body["errors"], body["applied"]), (422, 1, False))
+            self.assertEqual(body["rows"][1]["error"], "Invalid validUntil format")
+
+            status, body = post(main.api_bulk_add_id_tags, b'[{"idTag": "TAG-1"}, {"idTag": "CARD-OLD"}]')
+            self.assertEqual((status, body["ok"], body["applied"]), (200, 2, True))
+            self.assertEqual(self.count("id_tags"), 2)
+
+            status, body = post(main.api_bulk_add_id_tags, b'[{"idTag": "TAG-1"}]')
+            self.assertEqual((status, body["rows"][0]["error"]), (422, "idTag already exists"))
+
+            with self.assertRaises(main.HTTPException) as ctx:
+                post(main.api_bulk_create_household_accounts, b"")
+            self.assertEqual(ctx.exception.status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
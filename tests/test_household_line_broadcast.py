@@ -7,7 +7,13 @@ from pathlib import Path
 from types import SimpleNamespace
 from unittest.mock import MagicMock, patch
 
-import main
+from db_config import get_database_path
+from schema_migrations import migrate as migrate_schema
+
+# main.py no longer creates tables on import (run_startup_migrations.py does).
+migrate_schema(get_database_path())
+
+import main  # noqa: E402
 from household_account_service import (
     bind_card_to_account,
     connect,
@@ -15,6 +21,7 @@ from household_account_service import (
     get_account_by_id,
     update_account_card,
 )
+from line_emulator import LineApiEmulator
 from tests.test_household_accounts import make_db
 
 
@@ -305,7 +312,7 @@ class HouseholdLineBroadcastTests(unittest.TestCase):
         )
         self._create_transaction(1007, account, "CARD-A")
 
-        def send(*, line_user_id, message):
+        def send(*, line_user_id, message, retry_key=None):
             if line_user_id == "USER-B":
                 return {"ok": False, "error": "timeout"}
             return {"ok": True}
@@ -351,6 +358,151 @@ class HouseholdLineBroadcastTests(unittest.TestCase):
         self.assertEqual(statuses, {"USER-A": "sent", "USER-B": "failed"})
         self.assertEqual(logs, {"USER-A": "sent", "USER-B": "failed"})
 
+    def _line_api(self):
+        line_api = LineApiEmulator().start()
+        self.addCleanup(line_api.stop)
+        return line_api, patch.multiple(
+            main,
+            DB_FILE=self.db_file,
+            LINE_DELIVERY_MODE="multicast",
+            build_charge_completed_line_message=MagicMock(
+                return_value=self._completed_message("CARD-A")
+            ),
+            **line_api.main_overrides(),
+        )
+
+    def _statuses(self, table, tx_id):
+        conn = connect(self.db_file)
+        try:
+            return dict(
+                conn.execute(
+                    f"SELECT line_user_id,status FROM {table} "
+                    "WHERE event_type='charge_completed' AND transaction_id=?",
+                    (tx_id,),
+                ).fetchall()
+            )
+        finally:
+            conn.close()
+
+    def test_multicast_mode_sends_household_once_and_records_group(self):
+        account = self._create_account(
+            "15F",
+            "B22",
+            [
+                ("CARD-A", "active", "USER-A", True),
+                ("CARD-B", "active", "USER-B", True),
+                ("CARD-C", "active", "USER-C", True),
+            ],
+        )
+        self._create_transaction(1015, account, "CARD-A")
+        emulator, line_api = self._line_api()
+
+        with line_api:
+            result = main.send_charge_completed_line_notification(1015)
+            duplicate = main.send_charge_completed_line_notification(1015)
+
+        self.assertEqual(result["summary"], {"recipients": 3, "sent": 3, "failed": 0, "skipped": 0})
+        self.assertEqual(duplicate["summary"]["skipped"], 3)
+        self.assertEqual([r.path for r in emulator.requests], ["/v2/bot/message/multicast"])
+        self.assertEqual(sorted(emulator.requests[0].recipients), ["USER-A", "USER-B", "USER-C"])
+        expected = {"USER-A": "sent", "USER-B": "sent", "USER-C": "sent"}
+        self.assertEqual(self._statuses("line_recipient_notification_claims", 1015), expected)
+        self.assertEqual(self._statuses("line_message_logs", 1015), expected)
+
+    def test_outbox_retry_after_lost_push_response_is_not_delivered_twice(self):
+        account = self._create_account(
+            "17F", "B24", [("CARD-A", "active", "USER-A", True)]
+        )
+        self._create_transaction(1017, account, "CARD-A")
+
+        emulator, line_api = self._line_api()
+        emulator.lose_responses(1)
+        with line_api:
+            first = main.send_charge_completed_line_notification(1017)
+            retry = main.send_charge_completed_line_notification(
+                1017, delivery=main.LineDeliveryOptions(reclaim_failed=True)
+            )
+
+        self.assertTrue(main.line_outbox.is_retryable_line_result(first))
+        self.assertEqual(retry["status"], "sent")
+        self.assertEqual(
+            [(r.status, r.retry_key) for r in emulator.requests],
+            [
+                (504, main.line_outbox.retry_key("charge_completed", 1017, ["USER-A"])),
+                (409, main.line_outbox.retry_key("charge_completed", 1017, ["USER-A"])),
+            ],
+        )
+        self.assertEqual(emulator.delivered["USER-A"], ["completed transaction card=CARD-A"])
+        self.assertEqual(
+            self._statuses("line_recipient_notification_claims", 1017), {"USER-A": "sent"}
+        )
+
+    def test_multicast_failure_falls_back_to_per_recipient_push(self):
+        account = self._create_account(
+            "16F",
+            "B23",
+            [
+                ("CARD-A", "active", "USER-A", True),
+                ("CARD-B", "active", "USER-B", True),
+            ],
+        )
+        self._create_transaction(1016, account, "CARD-A")
+
+        emulator, line_api = self._line_api()
+        emulator.fail_users.add("USER-B")
+        with line_api:
+            result = main.send_charge_completed_line_notification(1016)
+
+        self.assertEqual(result["status"], "partial")
+        self.assertEqual(
+            [(r.path, r.status) for r in emulator.requests],
+            [
+                ("/v2/bot/message/multicast", 400),
+                ("/v2/bot/message/push", 200),
+                ("/v2/bot/message/push", 400),
+            ],
+        )
+        expected = {"USER-A": "sent", "USER-B": "failed"}
+        self.assertEqual(self._statuses("line_recipient_notification_claims", 1016), expected)
+        self.assertEqual(self._statuses("line_message_logs", 1016), expected)
+
+    def test_transient_multicast_failure_is_retried_as_multicast_with_same_key(self):
+        account = self._create_account(
+            "18F",
+            "B25",
+            [
+                ("CARD-A", "active", "USER-A", True),
+                ("CARD-B", "active", "USER-B", True),
+            ],
+        )
+        self._create_transaction(1018, account, "CARD-A")
+
+        emulator, line_api = self._line_api()
+        emulator.lose_responses(1)
+        with line_api:
+            first = main.send_charge_completed_line_notification(1018)
+            retry = main.send_charge_completed_line_notification(
+                1018, delivery=main.LineDeliveryOptions(reclaim_failed=True)
+            )
+
+        self.assertTrue(main.line_outbox.is_retryable_line_result(first))
+        self.assertEqual(retry["summary"]["sent"], 2)
+        key = main.line_outbox.retry_key("charge_completed", 1018, ["USER-A", "USER-B"])
+        self.assertEqual(
+            [(r.path, r.status, r.retry_key) for r in emulator.requests],
+            [
+                ("/v2/bot/message/multicast", 504, key),
+                ("/v2/bot/message/multicast", 409, key),
+            ],
+        )
+        self.assertEqual(
+            {user: len(texts) for user, texts in emulator.delivered.items()},
+            {"USER-A": 1, "USER-B": 1},
+        )
+        expected = {"USER-A": "sent", "USER-B": "sent"}
+        self.assertEqual(self._statuses("line_recipient_notification_claims", 1018), expected)
+
+
     def test_no_recipients_skips_without_affecting_stop_settlement(self):
         account = self._create_account(
             "11F", "B18", [("CARD-A", "active", None, False)]
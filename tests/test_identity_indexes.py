@@ -0,0 +1,90 @@
+import asyncio
+import json
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import main
+from household_account_service import list_household_accounts
+from schema_migrations import migrate
+
+
+def plan(conn, sql, params=()):
+    return [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+
+
+class IdentityIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = str(Path(self.tempdir.name) / "identity.sqlite3")
+        migrate(self.db_file)
+        with sqlite3.connect(self.db_file) as conn:
+            conn.execute(
+                "INSERT INTO users (id_tag, name, card_number) VALUES (' card-a ', '王小明', 'no-1')"
+            )
+            conn.execute("INSERT INTO card_owners (card_id, name) VALUES ('card-b', '李大華')")
+            conn.executemany(
+                "INSERT INTO transactions (transaction_id, charge_point_id, id_tag, meter_start, start_timestamp) "
+                "VALUES (?, 'CP-1', ?, 0, '2026-03-01T00:00:00+00:00')",
+                [(1, "CARD-A"), (2, "NO-1"), (3, " Card-B")],
+            )
+        self.statements = []
+        original = main.get_conn
+
+        def traced_conn():
+            conn = original()
+            conn.set_trace_callback(self.statements.append)
+            return conn
+
+        self.patches = [
+            patch.object(main, "DB_FILE", self.db_file),
+            patch.object(main, "get_conn", traced_conn),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+        self.tempdir.cleanup()
+
+    def test_transaction_list_resolves_residents_with_index_seeks(self):
+        response = asyncio.run(
+            main.get_transactions(None, None, None, None, None, None, False)
+        )
+        rows = json.loads(response.body)
+        names = {row["transactionId"]: row["residentName"] for row in rows}
+
+        self.assertEqual(names, {1: "王小明", 2: "王小明", 3: "李大華"})
+        query = next(sql for sql in self.statements if "LEFT JOIN users u" in sql)
+        with sqlite3.connect(self.db_file) as conn:
+            steps = plan(conn, query)
+        self.assertIn("SEARCH u USING INDEX idx_users_id_tag_key (<expr>=?) LEFT-JOIN", steps)
+        self.assertIn("SEARCH u USING INDEX idx_users_card_number_key (<expr>=?) LEFT-JOIN", steps)
+        self.assertIn("SEARCH co USING INDEX idx_card_owners_card_key (<expr>=?) LEFT-JOIN", steps)
+        self.assertFalse([s for s in steps if s.startswith("SCAN u") or s.startswith("SCAN co")])
+
+    def test_identity_fallback_and_household_listing_use_indexes(self):
+        with sqlite3.connect(self.db_file) as conn:
+            conn.set_trace_callback(self.statements.append)
+            self.assertEqual(main._transaction_identity(conn, "Card-A")[0], "王小明")
+            self.assertEqual(main._transaction_identity(conn, "CARD-B ")[0], "李大華")
+            conn.row_factory = sqlite3.Row
+            list_household_accounts(conn)
+            conn.set_trace_callback(None)
+
+            fallbacks = [sql for sql in self.statements if "UPPER(TRIM(" in sql and "LIMIT 1" in sql]
+            listing = next(sql for sql in self.statements if "FROM household_accounts ha" in sql)
+            steps = [step for sql in fallbacks for step in plan(conn, sql)]
+            listing_steps = plan(conn, listing)
+
+        self.assertEqual(len(fallbacks), 3)
+        self.assertTrue(all(step.startswith(("SEARCH", "MULTI-INDEX", "INDEX")) for step in steps))
+        self.assertIn("SCAN ha USING INDEX idx_household_accounts_sort_key", listing_steps)
+        self.assertFalse([s for s in listing_steps if "TEMP B-TREE" in s])
+
+
+if __name__ == "__main__":
+    unittest.main()
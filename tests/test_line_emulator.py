@@ -0,0 +1,142 @@
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from db_config import get_database_path
+from schema_migrations import migrate as migrate_schema
+
+# main.py no longer creates tables on import (run_startup_migrations.py does).
+migrate_schema(get_database_path())
+
+import line_outbox  # noqa: E402
+import main  # noqa: E402
+from line_emulator import (  # noqa: E402
+    FaultConfig,
+    LineApiEmulator,
+    sign_webhook_body,
+    text_message_event,
+    verify_webhook_signature,
+)
+
+
+class LineEmulatorTests(unittest.TestCase):
+    def setUp(self):
+        self.emulator = LineApiEmulator().start()
+        self.addCleanup(self.emulator.stop)
+
+    def test_push_is_recorded_and_delivered(self):
+        with patch.multiple(main, **self.emulator.main_overrides()):
+            result = main.send_line_message(line_user_id="U1", message="hello")
+
+        self.assertTrue(result["ok"])
+        self.assertEqual(self.emulator.delivered["U1"], ["hello"])
+        self.assertEqual(self.emulator.stats()["by_status"], {"200": 1})
+
+    def test_wrong_token_is_rejected_and_not_retryable(self):
+        overrides = self.emulator.main_overrides()
+        overrides["LINE_CHANNEL_ACCESS_TOKEN"] = "wrong"
+        with patch.multiple(main, **overrides):
+            result = main.send_line_message(line_user_id="U1", message="hello")
+
+        self.assertEqual(result["status_code"], 401)
+        self.assertFalse(result["retryable"])
+        self.assertFalse(self.emulator.requests[0].authorized)
+
+    def test_scripted_faults_are_classified_retryable(self):
+        self.emulator.queue_statuses(429, 503)
+        with patch.multiple(main, **self.emulator.main_overrides()):
+            results = [main.send_line_message(line_user_id="U1", message="m") for _ in range(3)]
+
+        self.assertEqual([r["status_code"] for r in results], [429, 503, 200])
+        self.assertEqual([r.get("retryable") for r in results[:2]], [True, True])
+        self.assertEqual(self.emulator.delivered["U1"], ["m"])
+
+    def test_reused_retry_key_after_lost_response_is_not_delivered_twice(self):
+        key = line_outbox.retry_key("charge_completed", 1, ["U1"])
+        self.emulator.lose_responses(1)
+        with patch.multiple(main, **self.emulator.main_overrides()):
+            lost = main.send_line_message(line_user_id="U1", message="m", retry_key=key)
+            again = main.send_line_message(line_user_id="U1", message="m", retry_key=key)
+
+        self.assertEqual((lost["status_code"], lost["retryable"]), (504, True))
+        self.assertEqual((again["ok"], again["status_code"], again["duplicate"]), (True, 409, True))
+        self.assertEqual(self.emulator.delivered["U1"], ["m"])
+        self.assertEqual([r.retry_key for r in self.emulator.requests], [key, key])
+        self.assertEqual(key, line_outbox.retry_key("charge_completed", 1, ["U1"]))
+        self.assertNotEqual(key, line_outbox.retry_key("charge_completed", 2, ["U1"]))
+
+    def test_multicast_limits_are_enforced(self):
+        with patch.multiple(main, **self.emulator.main_overrides()):
+            ok = main.send_line_multicast(line_user_ids=["U1", "U2"], message="m")
+        status, _, _ = self.emulator.handle(
+            "/v2/bot/message/multicast",
+            {"Authorization": "Bearer emulator-token"},
+            b'{"to": [], "messages": [{"type": "text", "text": "m"}]}',
+        )
+
+        self.assertTrue(ok["ok"])
+        self.assertEqual(status, 400)
+
+    def test_random_faults_are_seeded(self):
+        def statuses(seed):
+            emulator = LineApiEmulator(faults=FaultConfig(rate_429=0.3, rate_5xx=0.3, seed=seed))
+            try:
+                body = b'{"to": "U1", "messages": [{"type": "text", "text": "m"}]}'
+                headers = {"Authorization": "Bearer emulator-token"}
+                return [emulator.handle("/v2/bot/message/push", headers, body)[0] for _ in range(20)]
+            finally:
+                emulator.stop()
+
+        self.assertEqual(statuses(3), statuses(3))
+        self.assertTrue({429, 500} <= set(statuses(3)))
+
+    def test_webhook_signature_round_trip(self):
+        body = b'{"events": []}'
+        signature = sign_webhook_body(body, "secret")
+
+        self.assertTrue(verify_webhook_signature(body, signature, "secret"))
+        self.assertFalse(verify_webhook_signature(body + b" ", signature, "secret"))
+        self.assertFalse(verify_webhook_signature(body, signature, "other"))
+        self.assertEqual(text_message_event("U1", "hi")["source"]["userId"], "U1")
+
+
+class LineOutboxAgainstEmulatorTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = str(Path(self.tempdir.name) / "emulator.sqlite3")
+        migrate_schema(self.db_file)
+        self.emulator = LineApiEmulator().start()
+        self.addCleanup(self.emulator.stop)
+        self.addCleanup(self.tempdir.cleanup)
+
+    def test_rate_limited_push_is_retried_until_delivered(self):
+        conn = sqlite3.connect(self.db_file)
+        line_outbox.enqueue(conn, "manual_push", 1, now=0)
+        conn.commit()
+        conn.close()
+
+        def handler(job, delivery):
+            line_result = main.send_line_message(line_user_id="U1", message="notice")
+            return {
+                "status": "sent" if line_result["ok"] else "failed",
+                "recipientResults": [
+                    {"status": "sent" if line_result["ok"] else "failed", "lineResult": line_result}
+                ],
+            }
+
+        pool = line_outbox.LineOutboxWorkerPool(
+            lambda: sqlite3.connect(self.db_file), handler, backoff_base_s=0
+        )
+        self.emulator.queue_statuses(429, 500)
+        with patch.multiple(main, **self.emulator.main_overrides()):
+            outcomes = pool.drain_once() + pool.drain_once() + pool.drain_once()
+
+        self.assertEqual(outcomes, ["retry", "retry", "done"])
+        self.assertEqual(self.emulator.delivered["U1"], ["notice"])
+        self.assertEqual(self.emulator.stats()["by_status"], {"429": 1, "500": 1, "200": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
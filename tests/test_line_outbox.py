@@ -0,0 +1,247 @@
+import asyncio
+import sqlite3
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from db_config import get_database_path
+from schema_migrations import migrate as migrate_schema
+
+# main.py no longer creates tables on import (run_startup_migrations.py does).
+migrate_schema(get_database_path())
+
+import line_outbox  # noqa: E402
+import main  # noqa: E402
+from line_outbox import (  # noqa: E402
+    LineDeliveryOptions,
+    LineOutboxWorkerPool,
+    RecipientRateLimiter,
+    backoff_delay,
+    claim_due,
+    enqueue,
+    is_retryable_line_result,
+)
+
+
+class LineOutboxTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = str(Path(self.tempdir.name) / "outbox.sqlite3")
+        migrate_schema(self.db_file)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def connect(self):
+        return sqlite3.connect(self.db_file, timeout=15)
+
+    def rows(self):
+        conn = self.connect()
+        try:
+            return conn.execute(
+                "SELECT event_type, transaction_id, status, attempts FROM line_outbox ORDER BY id"
+            ).fetchall()
+        finally:
+            conn.close()
+
+    def make_pool(self, handler, **kwargs):
+        kwargs.setdefault("backoff_base_s", 0)
+        return LineOutboxWorkerPool(self.connect, handler, **kwargs)
+
+
+class LineOutboxStorageTests(LineOutboxTestCase):
+    def test_enqueue_is_idempotent_per_event_and_transaction(self):
+        conn = self.connect()
+        self.assertTrue(enqueue(conn, "charge_completed", 7))
+        self.assertFalse(enqueue(conn, "charge_completed", 7))
+        self.assertTrue(enqueue(conn, "low_balance_after_transaction", 7))
+        conn.commit()
+        conn.close()
+
+        self.assertEqual(
+            self.rows(),
+            [
+                ("charge_completed", 7, "pending", 0),
+                ("low_balance_after_transaction", 7, "pending", 0),
+            ],
+        )
+
+    def test_expired_sending_lease_is_recovered_and_reclaimed(self):
+        conn = self.connect()
+        enqueue(conn, "charge_completed", 7, now=100)
+        conn.commit()
+
+        jobs, recovered = claim_due(conn, limit=5, lease_s=60, now=100)
+        self.assertEqual((len(jobs), recovered), (1, 0))
+        self.assertEqual(claim_due(conn, limit=5, lease_s=60, now=150), ([], 0))
+
+        # worker 當機：lease 到期後同一筆工作被重新領取，舊 token 失效
+        again, recovered = claim_due(conn, limit=5, lease_s=60, now=200)
+        self.assertEqual(recovered, 1)
+        self.assertEqual([job.attempts for job in again], [2])
+        self.assertFalse(line_outbox.complete(conn, jobs[0], "done"))
+        self.assertTrue(line_outbox.complete(conn, again[0], "done"))
+        conn.close()
+
+    def test_retryable_failures_back_off_then_dead_letter(self):
+        conn = self.connect()
+        enqueue(conn, "charge_completed", 7, now=0)
+        conn.commit()
+        conn.close()
+        pool = self.make_pool(
+            lambda job, delivery: {"status": "failed", "reason": "line_api_failed"},
+            max_attempts=2,
+        )
+
+        self.assertEqual(pool.drain_once(), ["retry"])
+        self.assertEqual(pool.drain_once(), ["dead"])
+        self.assertEqual(pool.drain_once(), [])
+        self.assertEqual(self.rows(), [("charge_completed", 7, "dead", 2)])
+        self.assertEqual((pool.stats.retried, pool.stats.dead), (1, 1))
+
+    def test_handler_exception_is_retried(self):
+        conn = self.connect()
+        enqueue(conn, "charge_completed", 7, now=0)
+        conn.commit()
+        conn.close()
+        calls = []
+
+        def handler(job, delivery):
+            calls.append(delivery.reclaim_failed)
+            if len(calls) == 1:
+                raise sqlite3.OperationalError("database is locked")
+            return {"status": "sent"}
+
+        pool = self.make_pool(handler)
+        self.assertEqual(pool.drain_once() + pool.drain_once(), ["retry", "done"])
+        self.assertEqual(calls, [False, True])
+
+
+class LineOutboxPolicyTests(unittest.TestCase):
+    def test_retry_classification(self):
+        failed = lambda line_result: {
+            "status": "failed",
+            "recipientResults": [{"status": "failed", "lineResult": line_result}],
+        }
+
+        self.assertFalse(is_retryable_line_result({"status": "sent"}))
+        self.assertFalse(is_retryable_line_result({"status": "skipped"}))
+        self.assertTrue(is_retryable_line_result({"status": "failed", "reason": "unexpected_error"}))
+        self.assertTrue(is_retryable_line_result(failed({"ok": False, "status_code": 429})))
+        self.assertTrue(is_retryable_line_result(failed({"ok": False, "status_code": 503})))
+        self.assertTrue(is_retryable_line_result(failed({"ok": False, "status_code": None})))
+        self.assertFalse(is_retryable_line_result(failed({"ok": False, "status_code": 400})))
+        self.assertFalse(is_retryable_line_result(failed({"ok": False, "retryable": False})))
+
+    def test_backoff_is_exponential_and_capped(self):
+        delays = [backoff_delay(n, base_s=5, cap_s=60, jitter=0) for n in range(1, 6)]
+        self.assertEqual(delays, [5, 10, 20, 40, 60])
+
+    def test_rate_limiter_spaces_pushes_per_recipient(self):
+        now = [100.0]
+        limiter = RecipientRateLimiter(1.0, clock=lambda: now[0])
+
+        self.assertEqual(limiter.reserve("U1"), 0)
+        self.assertEqual(limiter.reserve("U1"), 1.0)
+        self.assertEqual(limiter.reserve("U2"), 0)
+        now[0] = 105.0
+        self.assertEqual(limiter.reserve("U1"), 0)
+
+
+class LineOutboxPoolTests(LineOutboxTestCase):
+    def test_pool_drains_jobs_on_wake(self):
+        handled = []
+
+        def handler(job, delivery):
+            handled.append((job.event_type, job.transaction_id))
+            return {"status": "sent"}
+
+        async def scenario():
+            pool = self.make_pool(handler, workers=2, poll_interval_s=30)
+            pool.start()
+            try:
+                conn = self.connect()
+                for tx_id in (1, 2, 3):
+                    enqueue(conn, "charge_completed", tx_id)
+                conn.commit()
+                conn.close()
+                pool.wake()
+                deadline = time.monotonic() + 10
+                while pool.stats.done < 3 and time.monotonic() < deadline:
+                    await asyncio.sleep(0.02)
+            finally:
+                await pool.stop()
+            return pool
+
+        pool = asyncio.run(scenario())
+
+        self.assertEqual(sorted(handled), [("charge_completed", n) for n in (1, 2, 3)])
+        self.assertEqual(pool.stats.done, 3)
+        self.assertEqual({row[2] for row in self.rows()}, {"done"})
+
+
+class LineRecipientReclaimTests(LineOutboxTestCase):
+    def test_only_outbox_retries_reopen_failed_or_stale_claims(self):
+        with patch.object(main, "DB_FILE", self.db_file):
+            claim = main.claim_line_recipient_notification
+            self.assertTrue(claim("charge_completed", 1, "U1"))
+            self.assertFalse(claim("charge_completed", 1, "U1", reclaim_failed=True))
+            main.complete_line_recipient_notification_claim("charge_completed", 1, "U1", "failed")
+
+            self.assertFalse(claim("charge_completed", 1, "U1"))
+            self.assertTrue(claim("charge_completed", 1, "U1", reclaim_failed=True))
+            self.assertFalse(
+                claim("charge_completed", 1, "U1", stale_sending_before="2000-01-01T00:00:00+00:00")
+            )
+            self.assertTrue(
+                claim("charge_completed", 1, "U1", stale_sending_before="2999-01-01T00:00:00+00:00")
+            )
+            main.complete_line_recipient_notification_claim("charge_completed", 1, "U1", "sent")
+            self.assertFalse(
+                claim(
+                    "charge_completed",
+                    1,
+                    "U1",
+                    reclaim_failed=True,
+                    stale_sending_before="2999-01-01T00:00:00+00:00",
+                )
+            )
+
+    def test_settlement_enqueues_events_in_callers_transaction(self):
+        conn = self.connect()
+        conn.execute(
+            "INSERT INTO transactions (transaction_id, auto_stop_reason) VALUES (5, ?)",
+            (main.AUTO_STOP_REASON_BALANCE_INSUFFICIENT,),
+        )
+        conn.commit()
+
+        # 與 StopTransaction 結算相同：在呼叫端的 BEGIN IMMEDIATE 之內
+        conn.execute("BEGIN IMMEDIATE")
+        events = main.enqueue_stop_transaction_line_events(conn.cursor(), 5, balance_after=500)
+        conn.rollback()
+        self.assertEqual(len(events), 3)
+        self.assertEqual(self.rows(), [])
+
+        conn.execute("BEGIN IMMEDIATE")
+        main.enqueue_stop_transaction_line_events(conn.cursor(), 5, balance_after=5000)
+        conn.commit()
+        conn.close()
+        self.assertEqual(
+            [row[0] for row in self.rows()],
+            ["charge_completed", "auto_stop_balance_insufficient"],
+        )
+
+    def test_outbox_job_dispatches_with_delivery_options(self):
+        job = line_outbox.OutboxJob(1, "low_balance_after_transaction", 9, 2, "token")
+        options = LineDeliveryOptions(reclaim_failed=True)
+        with patch.object(
+            main, "send_low_balance_line_notification", return_value={"status": "sent"}
+        ) as sender:
+            self.assertEqual(main.run_line_outbox_job(job, options), {"status": "sent"})
+        sender.assert_called_once_with(9, delivery=options)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+import asyncio
+import json
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from fastapi import HTTPException
+
+from db_config import get_database_path
+from schema_migrations import migrate as migrate_schema
+
+# main.py no longer creates tables on import (run_startup_migrations.py does).
+migrate_schema(get_database_path())
+
+import main  # noqa: E402
+from line_emulator import LineApiEmulator, sign_webhook_body, text_message_event  # noqa: E402
+from line_webhook import EventDeduplicator, WebhookEventQueue, verify_signature  # noqa: E402
+
+
+class FakeRequest:
+    def __init__(self, body: bytes, headers: dict):
+        self._body = body
+        self.headers = headers
+
+    async def body(self):
+        return self._body
+
+
+class EventDeduplicatorTests(unittest.TestCase):
+    def test_window_is_bounded_by_ttl_and_size(self):
+        now = [0.0]
+        dedup = EventDeduplicator(ttl_s=10, max_entries=2, clock=lambda: now[0])
+
+        self.assertTrue(dedup.add("a"))
+        self.assertFalse(dedup.add("a"))
+        self.assertTrue(dedup.add("b"))
+        self.assertTrue(dedup.add("c"))
+        self.assertEqual(len(dedup), 2)
+        self.assertTrue(dedup.add("a"))
+
+        now[0] = 11.0
+        self.assertTrue(dedup.add("c"))
+        self.assertEqual(len(dedup), 1)
+
+
+class WebhookEventQueueTests(unittest.TestCase):
+    def test_duplicates_are_skipped_and_concurrency_is_bounded(self):
+        lock = threading.Lock()
+        state = {"active": 0, "peak": 0, "handled": []}
+
+        def handler(event):
+            with lock:
+                state["active"] += 1
+                state["peak"] = max(state["peak"], state["active"])
+            time.sleep(0.02)
+            with lock:
+                state["active"] -= 1
+                state["handled"].append(event["webhookEventId"])
+
+        async def scenario():
+            queue = WebhookEventQueue(handler, workers=2)
+            events = [{"webhookEventId": f"E{n}"} for n in range(6)]
+            first = queue.submit(events)
+            again = queue.submit(events[:2])
+            await queue.join()
+            await queue.stop()
+            return first, again
+
+        first, again = asyncio.run(scenario())
+
+        self.assertEqual((first.accepted, first.duplicates), (6, 0))
+        self.assertEqual((again.accepted, again.duplicates), (0, 2))
+        self.assertEqual(sorted(state["handled"]), [f"E{n}" for n in range(6)])
+        self.assertLessEqual(state["peak"], 2)
+
+    def test_full_queue_drops_without_marking_event_seen(self):
+        async def scenario():
+            queue = WebhookEventQueue(lambda event: None, workers=1, maxsize=1)
+            dropped = queue.submit([{"webhookEventId": "A"}, {"webhookEventId": "B"}])
+            await queue.join()
+            retried = queue.submit([{"webhookEventId": "B"}])
+            await queue.join()
+            await queue.stop()
+            return dropped, retried, queue.stats.processed
+
+        dropped, retried, processed = asyncio.run(scenario())
+
+        self.assertEqual((dropped.accepted, dropped.dropped), (1, 1))
+        self.assertEqual(retried.accepted, 1)
+        self.assertEqual(processed, 2)
+
+
+class WebhookEndpointTests(unittest.TestCase):
+    def setUp(self):
+        self.emulator = LineApiEmulator().start()
+        self.addCleanup(self.emulator.stop)
+
+    async def _post(self, events, signature=None):
+        body = json.dumps({"destination": "U0", "events": events}).encode("utf-8")
+        headers = {
+            "X-Line-Signature": signature
+            or sign_webhook_body(body, self.emulator.channel_secret)
+        }
+        try:
+            return await main.webhook(FakeRequest(body, headers))
+        finally:
+            await main.line_webhook_queue.join()
+
+    def test_signed_events_are_acknowledged_then_replied_once(self):
+        queue = WebhookEventQueue(main.process_line_webhook_event, workers=2)
+        event = text_message_event("U1", "綁定 CARD-1", reply_token="R1")
+
+        with (
+            patch.multiple(main, **self.emulator.main_overrides()),
+            patch.object(main, "line_webhook_queue", queue),
+            patch.object(
+                main, "bind_line_user_to_id_tag", return_value={"ok": True}
+            ) as bind,
+        ):
+            async def scenario():
+                first = await self._post([event])
+                redelivered = await self._post(
+                    [dict(event, deliveryContext={"isRedelivery": True})]
+                )
+                await queue.stop()
+                return first, redelivered
+
+            first, redelivered = asyncio.run(scenario())
+
+        self.assertEqual((first["accepted"], first["found_user_ids"]), (1, ["U1"]))
+        self.assertEqual((redelivered["accepted"], redelivered["duplicates"]), (0, 1))
+        bind.assert_called_once_with(id_tag="CARD-1", line_user_id="U1", display_name=None)
+        self.assertEqual(len(self.emulator.delivered["reply:R1"]), 1)
+
+    def test_bad_signature_is_rejected_before_queueing(self):
+        queue = WebhookEventQueue(main.process_line_webhook_event)
+        with (
+            patch.multiple(main, **self.emulator.main_overrides()),
+            patch.object(main, "line_webhook_queue", queue),
+        ):
+            with self.assertRaises(HTTPException) as ctx:
+                asyncio.run(
+                    self._post([text_message_event("U1", "help")], signature="forged")
+                )
+
+        self.assertEqual(ctx.exception.status_code, 401)
+        self.assertEqual(queue.stats.received, 0)
+        self.assertFalse(verify_signature(b"{}", "forged", "secret"))
+
+    def test_missing_channel_secret_rejects_instead_of_accepting_unsigned(self):
+        queue = WebhookEventQueue(main.process_line_webhook_event)
+        with (
+            patch.multiple(main, **self.emulator.main_overrides()),
+            patch.object(main, "LINE_CHANNEL_SECRET", ""),
+            patch.object(main, "line_webhook_queue", queue),
+        ):
+            with self.assertRaises(HTTPException) as ctx:
+                asyncio.run(self._post([text_message_event("U1", "help")], signature="unsigned"))
+
+        self.assertEqual(ctx.exception.status_code, 503)
+        self.assertEqual(queue.stats.received, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import asyncio
+import unittest
+
+import load_test
+
+
+class LoadTestPlanTests(unittest.TestCase):
+    def test_same_seed_produces_same_scenario(self):
+        config = load_test.LoadTestConfig(
+            chargers=20, duration_s=120, remote_stops_per_min=30, seed=7
+        )
+
+        self.assertEqual(load_test.build_plans(config), load_test.build_plans(config))
+        self.assertEqual(
+            load_test.build_remote_stop_schedule(config),
+            load_test.build_remote_stop_schedule(config),
+        )
+
+        other = load_test.LoadTestConfig(
+            chargers=20, duration_s=120, remote_stops_per_min=30, seed=8
+        )
+        self.assertNotEqual(load_test.build_plans(config), load_test.build_plans(other))
+
+    def test_non_charging_chargers_have_no_sessions(self):
+        config = load_test.LoadTestConfig(chargers=10, charging_ratio=0.0)
+
+        plans = load_test.build_plans(config)
+
+        self.assertEqual(len(plans), 10)
+        self.assertTrue(all(not plan.charges and not plan.sessions for plan in plans))
+        self.assertEqual(len({plan.cp_id for plan in plans}), 10)
+
+    def test_latency_summary_percentiles(self):
+        recorder = load_test.LatencyRecorder()
+        for ms in range(1, 101):
+            recorder.record("MeterValues", ms / 1000.0)
+        recorder.record("Authorize", 0.002, ok=False)
+
+        summary = recorder.summary(elapsed_s=10.0)
+
+        meter = summary["actions"]["MeterValues"]
+        self.assertEqual(meter["count"], 100)
+        self.assertEqual(meter["throughput_per_s"], 10.0)
+        self.assertEqual(meter["p50_ms"], 50.5)
+        self.assertEqual(meter["p99_ms"], 99.01)
+        self.assertEqual(meter["max_ms"], 100.0)
+        self.assertEqual(summary["actions"]["Authorize"]["errors"], 1)
+        self.assertEqual(summary["total_calls"], 101)
+
+
+class LoadTestSmokeTests(unittest.TestCase):
+    def test_short_run_against_local_server(self):
+        config = load_test.LoadTestConfig(
+            chargers=2,
+            duration_s=6,
+            ramp_s=0.5,
+            meter_interval_s=1,
+            charging_ratio=1.0,
+            session_min_s=2,
+            session_max_s=3,
+            idle_min_s=0.1,
+            idle_max_s=0.2,
+            seed=11,
+        )
+
+        report = asyncio.run(load_test.run_load_test(config))
+
+        actions = report["latency"]["actions"]
+        for action in ("BootNotification", "StartTransaction", "MeterValues"):
+            self.assertIn(action, actions)
+            self.assertEqual(actions[action]["errors"], 0)
+        self.assertGreaterEqual(report["counters"]["sessions_started"], 2)
+        self.assertEqual(report["counters"]["sessions_rejected"], 0)
@@ -0,0 +1,132 @@
+import asyncio
+import gc
+import tempfile
+import unittest
+from pathlib import Path
+
+from household_account_service import (
+    bind_card_to_account,
+    connect,
+    create_household_account,
+    disable_account_card,
+)
+from local_auth_list import LocalListSync, load_state, plan_updates
+from schema_migrations import migrate
+
+
+class PlanUpdatesTests(unittest.TestCase):
+    def test_unknown_previous_sends_full_and_small_change_is_differential(self):
+        current = {"A": "Accepted", "B": "Blocked", "D": "Accepted"}
+
+        full = plan_updates(None, current, list_version=3)
+        self.assertEqual([(u.list_version, u.update_type) for u in full], [(4, "Full")])
+        self.assertEqual(plan_updates(current, current, list_version=4), [])
+
+        diff = plan_updates(
+            dict.fromkeys("ABCD", "Accepted"), current, list_version=4
+        )
+        self.assertEqual([(u.list_version, u.update_type) for u in diff], [(5, "Differential")])
+        self.assertEqual(
+            diff[0].authorization_list(),
+            [{"id_tag": "B", "id_tag_info": {"status": "Blocked"}}, {"id_tag": "C"}],
+        )
+
+    def test_large_full_list_is_chunked_with_consecutive_versions(self):
+        current = {f"T{n:02d}": "Accepted" for n in range(5)}
+
+        updates = plan_updates(None, current, list_version=0, max_length=2)
+
+        self.assertEqual(
+            [(u.list_version, u.update_type, len(u.entries)) for u in updates],
+            [(1, "Full", 2), (2, "Differential", 2), (3, "Differential", 1)],
+        )
+
+
+class LocalListSyncTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = str(Path(self.tempdir.name) / "local-list.sqlite3")
+        migrate(self.db_file)
+        conn = connect(self.db_file)
+        conn.execute("INSERT INTO charge_points(charge_point_id,name) VALUES ('CP-1','One')")
+        conn.commit()
+        account = create_household_account(conn, "1F", "LL-01", 100)
+        for card in ("LL-A", "LL-B"):
+            bind_card_to_account(conn, account["account_id"], card)
+            conn.execute(
+                "INSERT INTO card_whitelist(card_id,charge_point_id) VALUES (?, 'CP-1')",
+                (card,),
+            )
+            conn.commit()
+        conn.close()
+        self.sent = []
+        self.responses = []
+        self.charger_version = None
+
+    def tearDown(self):
+        gc.collect()
+        self.tempdir.cleanup()
+
+    def make_sync(self):
+        async def send(cp_id, update):
+            self.sent.append((cp_id, update.list_version, update.update_type, update.entries))
+            return self.responses.pop(0) if self.responses else "Accepted"
+
+        async def get_version(cp_id):
+            return self.charger_version
+
+        return LocalListSync(
+            lambda: connect(self.db_file),
+            send,
+            get_version=get_version,
+            min_interval_s=0,
+        )
+
+    def state(self):
+        conn = connect(self.db_file)
+        try:
+            return load_state(conn, "CP-1")
+        finally:
+            conn.close()
+
+    def test_full_then_differential_then_full_after_charger_lost_list(self):
+        sync = self.make_sync()
+
+        first = asyncio.run(sync.sync_all(["CP-1"]))[0]
+        unchanged = asyncio.run(sync.sync_charge_point("CP-1"))
+        conn = connect(self.db_file)
+        disable_account_card(conn, "LL-B")
+        conn.close()
+        self.charger_version = 1
+        differential = asyncio.run(sync.sync_charge_point("CP-1"))
+        conn = connect(self.db_file)
+        conn.execute("DELETE FROM card_whitelist WHERE card_id='LL-A'")
+        conn.commit()
+        conn.close()
+        self.charger_version = 0
+        resent = asyncio.run(sync.sync_charge_point("CP-1"))
+
+        self.assertEqual((first["result"], first["update_types"]), ("synced", ["Full"]))
+        self.assertEqual(unchanged["result"], "unchanged")
+        self.assertEqual(differential["update_types"], ["Differential"])
+        self.assertEqual(self.sent[1][3], (("LL-B", "Blocked"),))
+        self.assertEqual(resent["update_types"], ["Full"])
+        self.assertEqual(self.state().list_version, 3)
+        self.assertEqual(self.state().entries, {"LL-B": "Blocked"})
+
+    def test_rejected_update_keeps_previous_state_and_not_supported_is_skipped(self):
+        sync = self.make_sync()
+        self.responses = ["Failed"]
+        failed = asyncio.run(sync.sync_charge_point("CP-1"))
+        self.assertEqual((failed["result"], self.state().list_version), ("failed", 0))
+        self.assertIsNone(self.state().entries)
+
+        self.responses = ["NotSupported"]
+        asyncio.run(sync.sync_charge_point("CP-1"))
+        skipped = asyncio.run(sync.sync_charge_point("CP-1"))
+        self.assertEqual(skipped["result"], "not_supported")
+        self.assertEqual(len(self.sent), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,7 +9,14 @@ from types import SimpleNamespace
 if not os.environ.get("DATABASE_PATH"):
     raise RuntimeError("DATABASE_PATH must point to a temporary test database")
 
-import main
+from db_config import get_database_path
+from schema_migrations import migrate as migrate_schema
+
+# main.py no longer creates tables on import (run_startup_migrations.py does).
+migrate_schema(get_database_path())
+
+import main  # noqa: E402
+from household_account_service import debit_household_account_atomic  # noqa: E402
 
 
 CP_ID = "TW*TEST*STOP0001"
@@ -49,6 +56,7 @@ class MainStopIntegrationTests(unittest.IsolatedAsyncioTestCase):
         main.charging_point_status.clear()
         with main.get_conn() as conn:
             for table in (
+                "line_outbox",
                 "line_message_logs",
                 "payments",
                 "stop_transactions",
@@ -255,12 +263,13 @@ class MainStopIntegrationTests(unittest.IsolatedAsyncioTestCase):
             )
             conn.commit()
 
-        counters = {"completed": 0, "low": 0, "auto": 0, "rebalance": 0}
+        counters = {"completed": 0, "low": 0, "auto": 0, "rebalance": 0, "wake": 0}
         originals = (
             main.schedule_charge_completed_line_notification,
             main.schedule_low_balance_line_notification,
             main.schedule_auto_stop_balance_insufficient_line_notification,
             main.request_rebalance,
+            main.wake_line_outbox,
         )
         main.schedule_charge_completed_line_notification = lambda tx: counters.__setitem__(
             "completed", counters["completed"] + 1
@@ -274,6 +283,9 @@ class MainStopIntegrationTests(unittest.IsolatedAsyncioTestCase):
         main.request_rebalance = lambda reason: counters.__setitem__(
             "rebalance", counters["rebalance"] + 1
         )
+        main.wake_line_outbox = lambda label: counters.__setitem__(
+            "wake", counters["wake"] + 1
+        )
         try:
             fake_self = SimpleNamespace(id=CP_ID)
             payload = {
@@ -304,17 +316,176 @@ class MainStopIntegrationTests(unittest.IsolatedAsyncioTestCase):
             self.assertEqual(balance_after_first, balance_after_second)
             self.assertEqual(payment_count, 1)
             self.assertEqual(stop_count, 1)
-            self.assertEqual(counters["completed"], 1)
-            self.assertEqual(counters["low"], 1)
-            self.assertEqual(counters["auto"], 1)
+            # outbox 已在結算 transaction 內寫入：commit 後只喚醒一次，不再逐一 schedule_*
+            with main.get_conn() as conn:
+                events = conn.execute(
+                    "SELECT event_type FROM line_outbox WHERE transaction_id = ? ORDER BY event_type",
+                    (tx_id,),
+                ).fetchall()
+            self.assertEqual(
+                [row[0] for row in events],
+                ["auto_stop_balance_insufficient", "charge_completed", "low_balance_after_transaction"],
+            )
+            self.assertEqual(counters["wake"], 1)
+            self.assertEqual((counters["completed"], counters["low"], counters["auto"]), (0, 0, 0))
+
+            # in-transaction 寫入失敗時才退回各別 schedule_*
+            fallback_tx_id = 208
+            with main.get_conn() as conn:
+                conn.execute(
+                    """
+                    INSERT INTO transactions (
+                        transaction_id, charge_point_id, connector_id, id_tag,
+                        meter_start, start_timestamp, auto_stop_reason
+                    ) VALUES (?, ?, 1, ?, 0, ?, ?)
+                    """,
+                    (
+                        fallback_tx_id,
+                        CP_ID,
+                        CARD_ID,
+                        "2026-07-18T01:00:00+00:00",
+                        main.AUTO_STOP_REASON_BALANCE_INSUFFICIENT,
+                    ),
+                )
+                conn.commit()
+            original_enqueue = main.enqueue_stop_transaction_line_events
+            main.enqueue_stop_transaction_line_events = lambda *args: []
+            try:
+                await main.ChargePoint.on_stop_transaction(
+                    fake_self, **dict(payload, transaction_id=fallback_tx_id)
+                )
+            finally:
+                main.enqueue_stop_transaction_line_events = original_enqueue
+            self.assertEqual(counters["wake"], 1)
+            self.assertEqual((counters["completed"], counters["low"], counters["auto"]), (1, 1, 1))
         finally:
             (
                 main.schedule_charge_completed_line_notification,
                 main.schedule_low_balance_line_notification,
                 main.schedule_auto_stop_balance_insufficient_line_notification,
                 main.request_rebalance,
+                main.wake_line_outbox,
             ) = originals
 
+    async def test_stop_persists_timeline_ending_at_last_energy_reading(self):
+        tx_id = 207
+        self._insert_transaction(tx_id)
+        main.live_transaction_timelines.discard(tx_id)
+        with main.get_conn() as conn:
+            conn.execute("DELETE FROM transaction_timelines")
+            conn.executemany(
+                """
+                INSERT INTO meter_values (
+                    transaction_id, charge_point_id, connector_id,
+                    timestamp, value, measurand, unit
+                ) VALUES (?, ?, 1, ?, ?, 'Energy.Active.Import.Register', 'Wh')
+                """,
+                [
+                    (tx_id, CP_ID, "2026-07-18T00:00:00+00:00", 0),
+                    (tx_id, CP_ID, "2026-07-18T01:00:00+00:00", 8000),
+                ],
+            )
+            conn.commit()
+
+        fake_self = SimpleNamespace(id=CP_ID)
+        await main.ChargePoint.on_stop_transaction(
+            fake_self,
+            transaction_id=tx_id,
+            meter_stop=8000,
+            timestamp="2026-07-18T01:05:00+00:00",
+            reason="Local",
+        )
+        # 曲線在 commit 後由 worker thread 寫入
+        await asyncio.gather(*main.transaction_timeline_tasks)
+
+        with main.get_conn() as conn:
+            # StopTransaction 仍會補一筆 0 kWh 的結尾紀錄，曲線不可被它歸零
+            self.assertEqual(
+                conn.execute(
+                    "SELECT COUNT(*) FROM meter_values WHERE transaction_id = ? AND connector_id = 0",
+                    (tx_id,),
+                ).fetchone()[0],
+                1,
+            )
+            timeline = main.transaction_detail.load_timeline(conn, tx_id)
+        self.assertEqual(timeline["points"][-1]["kwh"], 8.0)
+        view = main.transaction_detail.meter_values_view(timeline["points"], 0)
+        self.assertEqual(view[-1]["sampledValue"][0]["value"], 8000.0)
+
+    async def test_stop_saves_live_timeline_after_commit_without_rescanning(self):
+        tx_id = 206
+        self._insert_transaction(tx_id)
+        with main.get_conn() as conn:
+            conn.execute("DELETE FROM transaction_timelines")
+            conn.commit()
+        main.live_transaction_timelines.add(tx_id, "2026-07-18T00:00:00+00:00", kwh=0.0, kw=7.0)
+        main.live_transaction_timelines.add(tx_id, "2026-07-18T00:30:00+00:00", kwh=3.5, kw=7.0)
+
+        def no_rescan(*args, **kwargs):
+            raise AssertionError("meter_values rescanned")
+
+        original = main.transaction_detail.read_timeline
+        main.transaction_detail.read_timeline = no_rescan
+        try:
+            await main.ChargePoint.on_stop_transaction(
+                SimpleNamespace(id=CP_ID),
+                transaction_id=tx_id,
+                meter_stop=3500,
+                timestamp="2026-07-18T00:31:00+00:00",
+                reason="Local",
+            )
+            await asyncio.gather(*main.transaction_timeline_tasks)
+        finally:
+            main.transaction_detail.read_timeline = original
+
+        with main.get_conn() as conn:
+            timeline = main.transaction_detail.load_timeline(conn, tx_id)
+        self.assertEqual([p["kwh"] for p in timeline["points"]], [0.0, 3.5])
+        self.assertIsNone(main.live_transaction_timelines.points(tx_id))
+
+    async def test_helper_and_stop_transaction_share_one_settlement_key(self):
+        tx_id = 205
+        self._insert_transaction(tx_id)
+        with main.get_conn() as conn:
+            conn.execute(
+                """
+                INSERT INTO meter_values (
+                    transaction_id, charge_point_id, connector_id,
+                    timestamp, value, measurand, unit
+                ) VALUES (?, ?, 1, ?, 1000, 'Energy.Active.Import.Register', 'Wh')
+                """,
+                (tx_id, CP_ID, "2026-07-18T00:10:00+00:00"),
+            )
+            conn.commit()
+        account_conn = main.household_connect(main.DB_FILE)
+        try:
+            account_id = main.ensure_legacy_account_for_card(account_conn, CARD_ID)["account_id"]
+            account_conn.execute(
+                "UPDATE transactions SET account_id = ? WHERE transaction_id = ?", (account_id, tx_id)
+            )
+            account_conn.commit()
+            debit_household_account_atomic(account_conn, account_id, 5, transaction_id=tx_id)
+        finally:
+            account_conn.close()
+
+        await main.ChargePoint.on_stop_transaction(
+            SimpleNamespace(id=CP_ID),
+            transaction_id=tx_id,
+            meter_stop=1000,
+            timestamp="2026-07-18T00:20:00+00:00",
+            reason="Local",
+        )
+
+        with main.get_conn() as conn:
+            keys = conn.execute(
+                "SELECT idempotency_key FROM household_balance_ledger "
+                "WHERE transaction_id = ? AND account_id = ? AND entry_type = 'debit'",
+                (tx_id, account_id),
+            ).fetchall()
+        self.assertEqual(
+            keys, [(f"settlement:{tx_id}:{account_id}:2026-07-18T00:00:00+00:00",)]
+        )
+
     async def test_settlement_failure_completes_context_as_failed(self):
         tx_id = 9999
         context, _ = await main.stop_registry.get_or_create(tx_id, CP_ID, "manual")
@@ -395,6 +566,34 @@ class MainStopIntegrationTests(unittest.IsolatedAsyncioTestCase):
         finally:
             main._schedule_balance_estimate_stop = original_schedule
 
+    async def test_stale_socket_finally_keeps_status_of_new_connection(self):
+        new_cp = FakeChargePoint(instance_id="B", seq=2)
+
+        class StaleChargePoint:
+            def __init__(self, cp_id, connection):
+                self.id = cp_id
+
+            async def start(self):
+                # 充電樁已重連並回報狀態，舊 socket 的 finally 才執行
+                main.connected_charge_points[CP_ID] = new_cp
+                main.status_tracker.observe(CP_ID, 1, "Charging", "NoError", None)
+                raise main.WebSocketDisconnect()
+
+        async def accept(websocket, raw_cp_id):
+            return CP_ID
+
+        originals = (main._accept_or_reject_ws, main.ChargePoint)
+        main._accept_or_reject_ws = accept
+        main.ChargePoint = StaleChargePoint
+        try:
+            await main.websocket_endpoint(SimpleNamespace(headers={}), CP_ID)
+        finally:
+            main._accept_or_reject_ws, main.ChargePoint = originals
+            main.connected_charge_points.clear()
+
+        self.assertEqual(main.status_tracker.current(CP_ID, 1).status, "Charging")
+        main.status_tracker.forget(CP_ID)
+
 
 if __name__ == "__main__":
     unittest.main()
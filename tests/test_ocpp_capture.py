@@ -0,0 +1,174 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+import ocpp_capture
+import ocpp_replay
+
+
+if not os.environ.get("DATABASE_PATH"):
+    raise RuntimeError("DATABASE_PATH must point to a temporary test database")
+
+from db_config import get_database_path
+from schema_migrations import migrate as migrate_schema
+
+# main.py no longer creates tables on import (run_startup_migrations.py does).
+migrate_schema(get_database_path())
+
+import main  # noqa: E402
+
+
+CP_ID = "TW*CAP*0001"
+
+
+class FakeWebSocket:
+    def __init__(self, inbound):
+        self.inbound = list(inbound)
+        self.sent = []
+        self.headers = {}
+
+    async def receive_text(self):
+        return self.inbound.pop(0)
+
+    async def send_text(self, data):
+        self.sent.append(data)
+
+
+def _write_capture(path, frames):
+    with open(path, "w", encoding="utf-8") as handle:
+        for frame in frames:
+            handle.write(json.dumps(frame) + "\n")
+
+
+class OcppCaptureTests(unittest.TestCase):
+    def test_recorder_appends_one_line_per_frame(self):
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = ocpp_capture.OcppFrameRecorder(directory)
+            capture = recorder.for_charge_point(CP_ID)
+            capture.open(connection_seq=1)
+            capture.record_in('[2,"1","Heartbeat",{}]')
+            capture.record_out('[3,"1",{"currentTime":"x"}]')
+            capture.close()
+
+            path = Path(directory) / "TW_CAP_0001.ocpplog"
+            frames = list(ocpp_capture.read_capture(path))
+
+            self.assertEqual(
+                [frame.direction for frame in frames], ["open", "in", "out", "close"]
+            )
+            self.assertEqual(frames[1].message, [2, "1", "Heartbeat", {}])
+            self.assertIsNone(frames[0].message)
+            self.assertEqual(ocpp_capture.charge_point_id_from_capture(path), CP_ID)
+
+    def test_truncated_trailing_line_is_ignored(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "x.ocpplog"
+            path.write_text('[1.0,"in","[2,\\"1\\",\\"Heartbeat\\",{}]"]\n[2.0,"in","[2', encoding="utf-8")
+
+            self.assertEqual(len(list(ocpp_capture.read_capture(path))), 1)
+
+    def test_env_enables_capture_for_selected_charge_points(self):
+        self.assertIsNone(ocpp_capture.recorder_from_env({}))
+        with tempfile.TemporaryDirectory() as directory:
+            recorder = ocpp_capture.recorder_from_env(
+                {"OCPP_CAPTURE_DIR": directory, "OCPP_CAPTURE_CP_IDS": f"{CP_ID}, OTHER"}
+            )
+
+            self.assertIsNotNone(recorder.for_charge_point(CP_ID))
+            self.assertIsNone(recorder.for_charge_point("NOT-SELECTED"))
+
+
+class WebSocketAdapterCaptureTests(unittest.IsolatedAsyncioTestCase):
+    async def test_adapter_records_inbound_and_outbound_frames(self):
+        with tempfile.TemporaryDirectory() as directory:
+            capture = ocpp_capture.OcppFrameRecorder(directory).for_charge_point(CP_ID)
+            websocket = FakeWebSocket(['[2,"9","Heartbeat",{}]'])
+            adapter = main.FastAPIWebSocketAdapter(websocket, capture=capture)
+
+            self.assertEqual(await adapter.recv(), '[2,"9","Heartbeat",{}]')
+            await adapter.send('[3,"9",{}]')
+
+            frames = list(ocpp_capture.read_capture(capture.path))
+            self.assertEqual(
+                [(frame.direction, frame.payload) for frame in frames],
+                [("in", '[2,"9","Heartbeat",{}]'), ("out", '[3,"9",{}]')],
+            )
+            self.assertEqual(websocket.sent, ['[3,"9",{}]'])
+
+    async def test_adapter_without_capture_is_unchanged(self):
+        websocket = FakeWebSocket(['[2,"1","Heartbeat",{}]'])
+        adapter = main.FastAPIWebSocketAdapter(websocket)
+
+        self.assertEqual(await adapter.recv(), '[2,"1","Heartbeat",{}]')
+        await adapter.send("x")
+        self.assertEqual(websocket.sent, ["x"])
+
+
+class OcppReplayTests(unittest.TestCase):
+    def _capture(self, directory):
+        path = Path(directory) / "TW_CAP_0001.ocpplog"
+        _write_capture(
+            path,
+            [
+                [100.0, "open", {"charge_point_id": CP_ID, "connection_seq": 1}],
+                [100.1, "in", '[2,"b1","BootNotification",{"chargePointModel":"M","chargePointVendor":"V"}]'],
+                [100.2, "out", '[3,"b1",{"currentTime":"2026-01-01T00:00:00+00:00","interval":60,"status":"Accepted"}]'],
+                [100.3, "in", '[2,"h1","Heartbeat",{}]'],
+                [100.4, "out", '[3,"h1",{"currentTime":"2026-01-01T00:00:01+00:00"}]'],
+                [100.5, "out", '[2,"s1","SetChargingProfile",{"connectorId":1}]'],
+                [100.6, "in", '[3,"s1",{"status":"Rejected"}]'],
+                [100.7, "close", {}],
+                [200.0, "open", {"charge_point_id": CP_ID, "connection_seq": 2}],
+                [200.1, "in", '[2,"a1","Authorize",{"idTag":"CARD-1"}]'],
+                [200.2, "out", '[3,"a1",{"idTagInfo":{"status":"Accepted"}}]'],
+            ],
+        )
+        return path
+
+    def test_plan_splits_connections_and_indexes_responses(self):
+        with tempfile.TemporaryDirectory() as directory:
+            plan = ocpp_replay.load_plan(self._capture(directory))
+
+        self.assertEqual(plan.charge_point_id, CP_ID)
+        self.assertEqual(len(plan.segments), 2)
+        self.assertEqual(plan.charger_call_count, 3)
+        self.assertEqual(plan.server_call_actions, {"s1": "SetChargingProfile"})
+        self.assertEqual(
+            plan.charger_responses_by_action, {"SetChargingProfile": [{"status": "Rejected"}]}
+        )
+        self.assertEqual(ocpp_replay.collect_id_tags(plan), ["CARD-1"])
+
+    def test_normalize_masks_volatile_fields(self):
+        self.assertEqual(
+            ocpp_replay.normalize_payload(
+                {"currentTime": "x", "transactionId": 42, "idTagInfo": {"status": "Accepted"}}
+            ),
+            {"currentTime": "<volatile>", "transactionId": "<assigned>", "idTagInfo": {"status": "Accepted"}},
+        )
+        self.assertEqual(ocpp_replay.normalize_payload({"transactionId": 0}), {"transactionId": 0})
+
+    def test_replay_against_local_server_matches_capture(self):
+        from load_test import LoadTestConfig, LocalServer
+
+        async def _run(directory, path):
+            plan = ocpp_replay.load_plan(path)
+            server = LocalServer(LoadTestConfig(), Path(directory) / "server")
+            (Path(directory) / "server").mkdir()
+            server.start()
+            try:
+                await asyncio.to_thread(ocpp_replay.seed_for_replay, server.database_path, [plan])
+                return await ocpp_replay.replay_captures([str(path)], server.ws_base, speed=0)
+            finally:
+                server.stop()
+
+        with tempfile.TemporaryDirectory() as directory:
+            report = asyncio.run(_run(directory, self._capture(directory)))
+
+        result = report["charge_points"][0]
+        self.assertEqual(result["connections"], 2)
+        self.assertEqual(result["calls_sent"], 3)
+        self.assertEqual(report["mismatch_count"], 0, result["mismatches"])
+        self.assertIn("Authorize", report["latency"]["actions"])
@@ -0,0 +1,144 @@
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import payments_recalc
+import tariff_engine
+from payments_recalc import PaymentRecalculator, RecalcJobError, create_job, load_job
+from schema_migrations import migrate
+
+
+class PaymentRecalcTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = str(Path(self.tempdir.name) / "recalc.sqlite3")
+        migrate(self.db_file)
+        conn = self.connect()
+        # 2026-03-01 台北時間：00:00-12:00 每度 5 元，12:00-23:59 每度 8 元
+        conn.executemany(
+            "INSERT INTO daily_pricing_rules(date,start_time,end_time,price) VALUES (?,?,?,?)",
+            [
+                ("2026-03-01", "00:00", "12:00", 5),
+                ("2026-03-01", "12:00", "23:59", 8),
+                ("2026-03-02", "00:00", "23:59", 4),
+            ],
+        )
+        for tx_id in range(1, 8):
+            conn.execute(
+                """
+                INSERT INTO transactions(transaction_id, charge_point_id, id_tag,
+                    meter_start, meter_stop, start_timestamp, stop_timestamp)
+                VALUES (?, 'CP-1', 'CARD', 0, 2000, '2026-03-01T02:00:00+00:00',
+                        '2026-03-01T05:00:00+00:00')
+                """,
+                (tx_id,),
+            )
+            # 10:30 → 13:00 台北時間：1 度 @5 + 1 度 @8 = 13 元
+            conn.executemany(
+                """
+                INSERT INTO meter_values(transaction_id, charge_point_id, timestamp, value, measurand)
+                VALUES (?, 'CP-1', ?, ?, 'Energy.Active.Import.Register')
+                """,
+                [
+                    (tx_id, "2026-03-01T02:00:00+00:00", 0),
+                    (tx_id, "2026-03-01T03:00:00+00:00", 1000),
+                    (tx_id, "2026-03-01T05:00:00+00:00", 2000),
+                ],
+            )
+        # 跨午夜（舊版直接略過）：沒有 meter_values → used kWh × 結束時電價 = 2 × 4
+        conn.execute(
+            """
+            INSERT INTO transactions(transaction_id, charge_point_id, id_tag,
+                meter_start, meter_stop, start_timestamp, stop_timestamp)
+            VALUES (8, 'CP-1', 'CARD', 0, 2000, '2026-03-01T15:00:00+00:00',
+                    '2026-03-01T17:00:00+00:00')
+            """
+        )
+        # 進行中：不在重算範圍
+        conn.execute(
+            "INSERT INTO transactions(transaction_id, charge_point_id, meter_start) VALUES (9, 'CP-1', 0)"
+        )
+        conn.executemany(
+            "INSERT INTO payments(transaction_id, base_fee, energy_fee, overuse_fee, total_amount) "
+            "VALUES (?, 0, ?, 0, ?)",
+            [(1, 13, 13), (2, 20, 20), (2, 13, 13), (3, 99, 99)],
+        )
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def connect(self):
+        return sqlite3.connect(self.db_file)
+
+    def payments(self):
+        with self.connect() as conn:
+            return conn.execute(
+                "SELECT transaction_id, total_amount FROM payments ORDER BY transaction_id, id"
+            ).fetchall()
+
+    def test_engine_matches_live_settlement_rule(self):
+        with self.connect() as conn:
+            rules = tariff_engine.load_rules_by_date(conn)
+            results = payments_recalc.compute_chunk(conn, [1, 8], rules)
+        self.assertEqual([(r.transaction_id, r.total_amount) for r in results], [(1, 13.0), (8, 8.0)])
+
+    def test_dry_run_reports_diff_without_touching_payments(self):
+        before = self.payments()
+        with self.connect() as conn:
+            job = create_job(conn, mode="dry_run", chunk_size=2, workers=2)
+            with self.assertRaises(RecalcJobError):
+                create_job(conn)
+
+        job = PaymentRecalculator(self.connect).run(job["job_id"])
+
+        self.assertEqual(self.payments(), before)
+        self.assertEqual((job["status"], job["processed"], job["total"]), ("completed", 8, 8))
+        summary = job["summary"]
+        self.assertEqual(
+            (summary["unchanged"], summary["changed"], summary["added"]), (2, 1, 5)
+        )
+        self.assertEqual(summary["duplicates_collapsed"], 1)
+        self.assertEqual(summary["changes"][0], {"transaction_id": 3, "old": 99, "new": 13.0, "delta": -86.0})
+
+    def test_apply_resumes_after_a_crash_and_swaps_once(self):
+        with self.connect() as conn:
+            job_id = create_job(conn, chunk_size=2, workers=2)["job_id"]
+
+        real_write = payments_recalc.write_chunk
+        calls = []
+
+        def crashing_write(conn, job_id, results):
+            calls.append([r.transaction_id for r in results])
+            if len(calls) == 3:
+                raise sqlite3.OperationalError("disk I/O error")
+            real_write(conn, job_id, results)
+
+        with patch.object(payments_recalc, "write_chunk", side_effect=crashing_write):
+            with self.assertRaises(sqlite3.OperationalError):
+                PaymentRecalculator(self.connect).run(job_id)
+
+        with self.connect() as conn:
+            failed = load_job(conn, job_id)
+        self.assertEqual((failed["status"], failed["last_transaction_id"]), ("failed", 4))
+        self.assertEqual(self.payments()[0:4], [(1, 13.0), (2, 20.0), (2, 13.0), (3, 99.0)])
+
+        swapped = []
+        job = PaymentRecalculator(self.connect, on_swapped=swapped.append).run(job_id)
+
+        self.assertEqual((job["status"], job["processed"], job["summary"]["swapped"]), ("completed", 8, 8))
+        self.assertEqual(swapped, [job_id])
+        self.assertEqual(
+            self.payments(), [(tx_id, 13.0) for tx_id in range(1, 8)] + [(8, 8.0)]
+        )
+        with self.connect() as conn:
+            self.assertEqual(
+                conn.execute("SELECT COUNT(*) FROM payments_recalc_shadow").fetchone()[0], 0
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
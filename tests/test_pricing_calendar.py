@@ -0,0 +1,144 @@
+import sqlite3
+import tempfile
+import time
+import unittest
+from datetime import date
+from pathlib import Path
+
+import pricing_calendar
+from pricing_calendar import TariffRulesCache, apply_changes, load_existing, plan_changes, target_rules
+from schema_migrations import migrate
+
+
+TEMPLATES = {
+    "summer": {
+        "weekday": [
+            {"startTime": "00:00", "endTime": "16:00", "price": 2.5, "label": "off"},
+            {"startTime": "16:00", "endTime": "22:00", "price": 8.0, "label": "peak"},
+            {"startTime": "22:00", "endTime": "24:00", "price": 2.5, "label": "off"},
+        ],
+        "saturday": [{"startTime": "00:00", "endTime": "24:00", "price": 3.0, "label": "sat"}],
+        "sunday": [{"startTime": "00:00", "endTime": "24:00", "price": 2.0, "label": "sun"}],
+    },
+    "non_summer": {
+        "weekday": [
+            {"startTime": "00:00", "endTime": "15:00", "price": 2.4, "label": "off"},
+            {"startTime": "15:00", "endTime": "21:00", "price": 7.0, "label": "peak"},
+            {"startTime": "21:00", "endTime": "24:00", "price": 2.4, "label": "off"},
+        ],
+        "saturday": [{"startTime": "00:00", "endTime": "24:00", "price": 2.8, "label": "sat"}],
+        "sunday": [{"startTime": "00:00", "endTime": "24:00", "price": 1.9, "label": "sun"}],
+    },
+}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class PricingCalendarTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = str(Path(self.tempdir.name) / "pricing.sqlite3")
+        migrate(self.db_file)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def connect(self):
+        return sqlite3.connect(self.db_file)
+
+    def import_range(self, conn, start, end, holidays=None, mode="overwrite"):
+        targets = target_rules(TEMPLATES, holidays or {}, start, end)
+        wanted = {d: rules for d, (_, rules) in targets.items()}
+        existing = load_existing(conn, first=min(wanted), last=max(wanted))
+        return apply_changes(conn, plan_changes(existing, wanted, mode), batch_days=7, pause_s=0)
+
+    def test_reimport_writes_only_changed_days(self):
+        with self.connect() as conn:
+            first = self.import_range(conn, date(2026, 5, 25), date(2026, 6, 7))
+            self.assertEqual((first.days_written, first.batches), (14, 2))
+
+            again = self.import_range(conn, date(2026, 5, 25), date(2026, 6, 7))
+            self.assertEqual((again.days_written, again.batches), (0, 0))
+
+            # 6/3（週三）改為國定假日：只重寫這一天，沿用星期日模板並標記 holiday
+            holidays = {2026: {"2026-06-03": "holiday"}}
+            changed = self.import_range(conn, date(2026, 5, 25), date(2026, 6, 7), holidays)
+            self.assertEqual(changed.dates, ["2026-06-03"])
+            self.assertEqual(
+                load_existing(conn, ["2026-06-03"]),
+                {"2026-06-03": (("00:00", "24:00", 2.0, "holiday"),)},
+            )
+
+    def test_fill_missing_keeps_existing_days(self):
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT INTO daily_pricing_rules(date,start_time,end_time,price,label) "
+                "VALUES ('2026-01-05','00:00','24:00',9.9,'manual')"
+            )
+            conn.commit()
+            report = self.import_range(
+                conn, date(2026, 1, 4), date(2026, 1, 6), mode="fill_missing"
+            )
+            self.assertEqual(report.dates, ["2026-01-04", "2026-01-06"])
+            self.assertEqual(
+                load_existing(conn, ["2026-01-05"])["2026-01-05"],
+                (("00:00", "24:00", 9.9, "manual"),),
+            )
+            with self.assertRaises(ValueError):
+                plan_changes({}, {}, "replace_all")
+
+    def test_any_rule_write_bumps_version_and_refreshes_cache(self):
+        clock = FakeClock()
+        cache = TariffRulesCache(check_interval_s=1.0, clock=clock)
+        opened = []
+
+        def connect():
+            opened.append(1)
+            return self.connect()
+
+        with self.connect() as conn:
+            self.import_range(conn, date(2026, 3, 2), date(2026, 3, 2))
+            v1 = pricing_calendar.tariff_version(conn)
+
+        rules = cache.rules_for_dates(connect, ["2026-03-02"], self.db_file)
+        self.assertEqual(rules["2026-03-02"][1], ("15:00", "21:00", 7.0))
+        cache.rules_for_dates(connect, ["2026-03-02"], self.db_file)
+        self.assertEqual(len(opened), 1)
+
+        # 舊端點 / 手動 SQL 直接寫表：trigger 仍會遞增版本
+        with self.connect() as conn:
+            conn.execute("UPDATE daily_pricing_rules SET price = 9 WHERE label = 'peak'")
+            conn.commit()
+            self.assertGreater(pricing_calendar.tariff_version(conn), v1)
+
+        self.assertEqual(
+            cache.rules_for_dates(connect, ["2026-03-02"], self.db_file)["2026-03-02"][1][2], 7.0
+        )
+        clock.now += 1.0
+        self.assertEqual(
+            cache.rules_for_dates(connect, ["2026-03-02"], self.db_file)["2026-03-02"][1][2], 9
+        )
+        self.assertEqual(cache.snapshot()["misses"], 2)
+
+    def test_ten_year_import_holds_the_lock_briefly(self):
+        with self.connect() as conn:
+            started = time.perf_counter()
+            targets = target_rules(TEMPLATES, {}, date(2026, 1, 1), date(2035, 12, 31))
+            wanted = {d: rules for d, (_, rules) in targets.items()}
+            existing = load_existing(conn, first=min(wanted), last=max(wanted))
+            report = apply_changes(conn, plan_changes(existing, wanted), pause_s=0)
+            elapsed = time.perf_counter() - started
+
+        self.assertEqual(report.days_written, 3652)
+        self.assertLess(report.max_batch_lock_ms, 500)
+        self.assertLess(elapsed, 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
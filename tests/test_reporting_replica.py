@@ -0,0 +1,195 @@
+import asyncio
+import json
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import main
+from reporting_replica import ReportingReplica, set_tracking
+from schema_migrations import migrate
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_780_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ReportingReplicaTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = str(Path(self.tempdir.name) / "primary.sqlite3")
+        self.replica_file = str(Path(self.tempdir.name) / "primary.sqlite3.reporting")
+        migrate(self.db_file)
+        with sqlite3.connect(self.db_file) as conn:
+            conn.executemany(
+                "INSERT INTO transactions (transaction_id, charge_point_id, connector_id, id_tag, meter_start, "
+                "start_timestamp, meter_stop, stop_timestamp) VALUES (?, 'CP-1', 1, ?, 0, ?, 2000, ?)",
+                [
+                    (1, "CARD-A", "2026-03-01T02:00:00+00:00", "2026-03-01T03:00:00+00:00"),
+                    (2, "CARD-B", "2026-03-02T02:00:00+00:00", "2026-03-02T03:00:00+00:00"),
+                ],
+            )
+            conn.execute("INSERT INTO users (id_tag, name) VALUES ('CARD-A', 'Resident A')")
+        self.clock = FakeClock()
+        self.replica = ReportingReplica(self.db_file, self.replica_file, max_staleness_s=60, clock=self.clock)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def primary(self):
+        return sqlite3.connect(self.db_file)
+
+    def replica_rows(self, sql, params=()):
+        conn = self.replica.connect()
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def test_incremental_refresh_copies_changed_rows_and_trims_log(self):
+        with self.primary() as conn:
+            self.assertEqual(conn.execute("INSERT INTO transactions (transaction_id) VALUES (90)").rowcount, 1)
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM report_change_log").fetchone()[0], 0)
+
+        self.assertTrue(self.replica.refresh()["rebuilt"])
+        self.assertEqual(self.replica_rows("SELECT COUNT(*) FROM transactions")[0][0], 3)
+
+        with self.primary() as conn:
+            conn.execute("UPDATE transactions SET meter_stop = 5000 WHERE transaction_id = 1")
+            conn.execute("DELETE FROM transactions WHERE transaction_id = 90")
+            conn.execute("INSERT INTO payments (transaction_id, total_amount) VALUES (1, 30.0)")
+            # 主資料庫禁止改刪的結算快照在複本也要能寫入
+            conn.execute(
+                "INSERT INTO transaction_settlements (transaction_id, snapshot_version, snapshot, created_at) "
+                "VALUES (1, 1, '{}', '2026-03-01T03:00:00+00:00')"
+            )
+            conn.execute("DELETE FROM users WHERE id_tag = 'CARD-A'")
+            conn.execute("INSERT INTO users (id_tag, name) VALUES ('CARD-A', 'Resident A2')")
+            conn.execute("INSERT INTO meter_values (transaction_id, value) VALUES (1, 5000)")
+
+        self.clock.now += 5
+        report = self.replica.refresh()
+        self.assertEqual((report["rebuilt"], report["lag_changes"]), (False, 0))
+        self.assertEqual(
+            self.replica_rows("SELECT transaction_id, meter_stop FROM transactions ORDER BY transaction_id"),
+            [(1, 5000), (2, 2000)],
+        )
+        self.assertEqual(self.replica_rows("SELECT transaction_id, total_amount FROM payments"), [(1, 30.0)])
+        self.assertEqual(self.replica_rows("SELECT COUNT(*) FROM transaction_settlements")[0][0], 1)
+        self.assertEqual(self.replica_rows("SELECT id_tag, name FROM users"), [("CARD-A", "Resident A2")])
+        # meter_values 不在追蹤清單：複本只保留建立當下的內容
+        self.assertEqual(self.replica_rows("SELECT COUNT(*) FROM meter_values")[0][0], 0)
+        with self.primary() as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM report_change_log").fetchone()[0], 0)
+        self.assertEqual(self.replica.freshness()["stalenessSeconds"], 0.0)
+
+        with self.assertRaises(sqlite3.OperationalError):
+            self.replica_rows("DELETE FROM transactions")
+
+        with self.primary() as conn:
+            set_tracking(conn, False)
+            conn.execute("UPDATE transactions SET meter_stop = 6000 WHERE transaction_id = 2")
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM report_change_log").fetchone()[0], 0)
+
+    def test_batches_staleness_and_rebuild_on_schema_change(self):
+        self.replica.batch_changes = 2
+        self.replica.refresh()
+        with self.primary() as conn:
+            conn.executemany(
+                "UPDATE transactions SET reason = ? WHERE transaction_id = ?",
+                [("Local", 1), ("Remote", 2), ("EVDisconnected", 1)],
+            )
+        self.assertEqual(self.replica.refresh()["lag_changes"], 1)
+        self.assertEqual(self.replica.refresh()["rows_copied"], 1)
+        self.assertEqual(
+            self.replica_rows("SELECT reason FROM transactions ORDER BY transaction_id"),
+            [("EVDisconnected",), ("Remote",)],
+        )
+
+        self.clock.now += 61
+        self.assertFalse(self.replica.usable)
+        self.assertEqual(self.replica.freshness()["source"], "primary")
+
+        with self.primary() as conn:
+            conn.execute("CREATE TABLE report_probe (id INTEGER PRIMARY KEY)")
+        self.assertTrue(self.replica.refresh()["rebuilt"])
+        self.assertTrue(self.replica.usable)
+        self.assertEqual(self.replica_rows("SELECT COUNT(*) FROM report_probe")[0][0], 0)
+        self.assertEqual(self.replica.stats.builds, 2)
+
+    def test_primary_stays_writable_while_refresh_applies(self):
+        self.replica.refresh()
+        with self.primary() as conn:
+            conn.execute("UPDATE transactions SET meter_stop = 3000 WHERE transaction_id = 1")
+
+        apply_table = self.replica._apply_table
+        written = []
+
+        def apply_while_writing(*args):
+            # 複本寫入交易進行中：primary 不可被鎖住（timeout=0 立即失敗）
+            writer = sqlite3.connect(self.db_file, timeout=0)
+            try:
+                with writer:
+                    writer.execute(
+                        "INSERT INTO transactions (transaction_id, charge_point_id) VALUES (?, 'CP-2')",
+                        (10 + len(written),),
+                    )
+                written.append(True)
+            finally:
+                writer.close()
+            return apply_table(*args)
+
+        with patch.object(self.replica, "_apply_table", apply_while_writing):
+            self.assertFalse(self.replica.refresh()["rebuilt"])
+        self.assertEqual(written, [True])
+        self.assertEqual(self.replica_rows("SELECT meter_stop FROM transactions WHERE transaction_id = 1"), [(3000,)])
+
+        self.replica.refresh()
+        self.assertEqual(self.replica_rows("SELECT COUNT(*) FROM transactions WHERE transaction_id = 10")[0][0], 1)
+
+    def test_report_endpoints_read_replica_with_freshness_headers(self):
+        self.replica.refresh()
+        with self.primary() as conn:
+            conn.execute("INSERT INTO transactions (transaction_id, charge_point_id, id_tag) VALUES (3, 'CP-1', 'CARD-C')")
+
+        patches = [
+            patch.object(main, "DB_FILE", self.db_file),
+            patch.object(main, "REPORTING_REPLICA_ENABLED", True),
+            patch.object(main, "report_replica", self.replica),
+        ]
+        for p in patches:
+            p.start()
+        try:
+            def transaction_ids():
+                response = asyncio.run(main.get_transactions(None, None, None, None, None, None, False))
+                return sorted(row["transactionId"] for row in json.loads(response.body))
+
+            self.assertEqual(transaction_ids(), [1, 2])
+            self.replica.refresh()
+            self.assertEqual(transaction_ids(), [1, 2, 3])
+
+            async def call_next(request):
+                return main.JSONResponse(content=[])
+
+            request = SimpleNamespace(method="GET", url=SimpleNamespace(path="/api/transactions"))
+            response = asyncio.run(main.report_freshness_headers(request, call_next))
+            self.assertEqual(response.headers["X-Report-Source"], "replica")
+            self.assertEqual(response.headers["X-Report-Staleness-Seconds"], "0.0")
+
+            self.clock.now += 61
+            self.assertEqual(transaction_ids(), [1, 2, 3])
+            response = asyncio.run(main.report_freshness_headers(request, call_next))
+            self.assertEqual(response.headers["X-Report-Source"], "primary")
+        finally:
+            for p in reversed(patches):
+                p.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+from dataclasses import replace
+from pathlib import Path
+
+import schema_migrations
+from schema_migrations import SchemaMigrationError, migrate, require_current_schema
+
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def _columns(db_file, table):
+    conn = sqlite3.connect(db_file)
+    try:
+        return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    finally:
+        conn.close()
+
+
+class SchemaMigrationTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = str(Path(self.tempdir.name) / "schema.sqlite3")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_fresh_database_applies_every_step_once(self):
+        first = migrate(self.db_file)
+        second = migrate(self.db_file)
+
+        versions = [m.version for m in schema_migrations.MIGRATIONS]
+        self.assertEqual(versions, sorted(set(versions)))
+        self.assertEqual(first["applied"], versions)
+        self.assertEqual(first["to_version"], schema_migrations.LATEST_VERSION)
+        self.assertEqual(second["applied"], [])
+
+        conn = sqlite3.connect(self.db_file)
+        try:
+            self.assertTrue(require_current_schema(conn).is_current)
+            self.assertEqual(
+                conn.execute("SELECT contract_kw, surcharge_per_kwh FROM community_settings WHERE id=1").fetchone(),
+                (0, 0),
+            )
+        finally:
+            conn.close()
+        self.assertIn("surplus_amount", _columns(self.db_file, "transactions"))
+        self.assertIn("account_id", _columns(self.db_file, "transactions"))
+
+    def test_pre_registry_database_is_upgraded_in_place(self):
+        conn = sqlite3.connect(self.db_file)
+        conn.executescript(
+            """
+            CREATE TABLE transactions (
+                transaction_id INTEGER PRIMARY KEY,
+                charge_point_id TEXT,
+                connector_id INTEGER,
+                id_tag TEXT,
+                meter_start INTEGER,
+                start_timestamp TEXT,
+                meter_stop INTEGER,
+                stop_timestamp TEXT,
+                reason TEXT
+            );
+            INSERT INTO transactions (transaction_id, charge_point_id, id_tag)
+            VALUES (7, 'CP-1', 'CARD-1');
+            CREATE TABLE community_settings (id INTEGER PRIMARY KEY, contract_kw REAL);
+            INSERT INTO community_settings VALUES (1, 55);
+            """
+        )
+        conn.commit()
+        conn.close()
+
+        migrate(self.db_file)
+
+        self.assertTrue({"balance_before", "surplus_amount"} <= _columns(self.db_file, "transactions"))
+        self.assertIn("surcharge_per_kwh", _columns(self.db_file, "community_settings"))
+        conn = sqlite3.connect(self.db_file)
+        try:
+            self.assertEqual(conn.execute("SELECT id_tag FROM transactions").fetchall(), [("CARD-1",)])
+            self.assertEqual(conn.execute("SELECT contract_kw FROM community_settings").fetchall(), [(55,)])
+        finally:
+            conn.close()
+
+    def test_modified_applied_step_is_refused(self):
+        migrate(self.db_file)
+        changed = list(schema_migrations.MIGRATIONS)
+        changed[0] = replace(changed[0], statements=changed[0].statements[:-1])
+
+        with self.assertRaises(SchemaMigrationError):
+            migrate(self.db_file, tuple(changed))
+
+    def test_app_check_reports_pending_steps(self):
+        conn = sqlite3.connect(self.db_file)
+        try:
+            with self.assertRaisesRegex(SchemaMigrationError, "run_startup_migrations"):
+                require_current_schema(conn)
+        finally:
+            conn.close()
+
+    def test_importing_main_does_not_touch_the_schema(self):
+        env = os.environ.copy()
+        env["DATABASE_PATH"] = self.db_file
+        process = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import main, sqlite3; "
+                "print(sqlite3.connect(main.DB_FILE).execute("
+                "\"SELECT COUNT(*) FROM sqlite_master WHERE type='table'\").fetchone()[0])",
+            ],
+            cwd=ROOT,
+            env=env,
+            capture_output=True,
+            text=True,
+            timeout=120,
+        )
+
+        self.assertEqual(process.returncode, 0, process.stderr[-2000:])
+        self.assertEqual(process.stdout.strip().splitlines()[-1], "0")
@@ -0,0 +1,165 @@
+import asyncio
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from db_config import get_database_path
+from schema_migrations import migrate as migrate_schema
+
+# main.py no longer creates tables on import (run_startup_migrations.py does).
+migrate_schema(get_database_path())
+
+import main  # noqa: E402
+import settlement_snapshot  # noqa: E402
+from household_account_service import (  # noqa: E402
+    bind_card_to_account,
+    connect,
+    create_household_account,
+)
+
+
+SEGMENTS = [
+    {
+        "start": "2026-07-22T00:00:00+00:00",
+        "end": "2026-07-22T00:30:00+00:00",
+        "kwh": 0.4,
+        "price": 100.0,
+        "subtotal": 40.0,
+    },
+    {
+        "start": "2026-07-22T00:30:00+00:00",
+        "end": "2026-07-22T01:00:00+00:00",
+        "kwh": 0.6,
+        "price": 50.0,
+        "subtotal": 30.0,
+    },
+]
+
+
+class SettlementSnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = str(Path(self.tempdir.name) / "snapshot.sqlite3")
+        migrate_schema(self.db_file)
+
+        conn = connect(self.db_file)
+        self.account = create_household_account(conn, "7F", "B21", 1000)
+        bind_card_to_account(conn, self.account["account_id"], "CARD-S")
+        conn.execute(
+            """
+            INSERT INTO transactions(
+                transaction_id,id_tag,charge_point_id,connector_id,
+                meter_start,start_timestamp,account_id,floor_no,parking_space_no
+            ) VALUES (2001,'CARD-S','CP-1',1,0,'2026-07-22T00:00:00+00:00',?,?,?)
+            """,
+            (
+                self.account["account_id"],
+                self.account["floor_no"],
+                self.account["parking_space_no"],
+            ),
+        )
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def _settle(self):
+        with (
+            patch.object(main, "DB_FILE", self.db_file),
+            patch.object(
+                main,
+                "_calculate_multi_period_cost_detailed",
+                return_value={"total": 70.0, "segments": SEGMENTS},
+            ),
+            patch.object(
+                main, "get_community_settings", return_value={"surcharge_per_kwh": 0}
+            ),
+            patch.object(main, "schedule_charge_completed_line_notification"),
+            patch.object(main, "schedule_low_balance_line_notification"),
+            patch.object(
+                main, "schedule_auto_stop_balance_insufficient_line_notification"
+            ),
+            patch.object(main, "request_rebalance"),
+        ):
+            asyncio.run(
+                main.ChargePoint.on_stop_transaction(
+                    SimpleNamespace(id="CP-1"),
+                    transaction_id=2001,
+                    meter_stop=1000,
+                    timestamp="2026-07-22T01:00:00+00:00",
+                    reason="Remote",
+                )
+            )
+
+    def test_settlement_persists_immutable_snapshot(self):
+        self._settle()
+
+        conn = sqlite3.connect(self.db_file)
+        snapshot = settlement_snapshot.load(conn, 2001)
+        self.assertEqual(snapshot["cost"], 70.0)
+        self.assertEqual((snapshot["balance_before"], snapshot["balance_after"]), (1000, 930))
+        self.assertEqual(snapshot["floor_no"], self.account["floor_no"])
+        self.assertEqual([d["cost"] for d in snapshot["cost_details"]], [40.0, 30.0])
+        self.assertEqual(snapshot["duration_text"], "1小時0分")
+
+        # 重送 StopTransaction 不得覆寫；表本身拒絕 UPDATE / DELETE
+        self.assertFalse(settlement_snapshot.save(conn, 2001, {"cost": 0}))
+        with self.assertRaises(sqlite3.IntegrityError):
+            conn.execute("UPDATE transaction_settlements SET snapshot='{}'")
+        with self.assertRaises(sqlite3.IntegrityError):
+            conn.execute("DELETE FROM transaction_settlements")
+        conn.close()
+
+    def test_message_builders_render_from_snapshot_without_recomputing(self):
+        self._settle()
+
+        # 結算後帳戶餘額變動（例如儲值）不影響已結算的通知內容
+        conn = connect(self.db_file)
+        conn.execute("UPDATE household_accounts SET balance = 5000")
+        conn.commit()
+        conn.close()
+
+        with (
+            patch.object(main, "DB_FILE", self.db_file),
+            patch.object(
+                main,
+                "_calculate_multi_period_cost_detailed",
+                side_effect=AssertionError("meter_values rescanned"),
+            ),
+        ):
+            completed = main.build_charge_completed_line_message(2001)
+            low = main.build_low_balance_line_message(2001)
+            auto = main.build_auto_stop_balance_insufficient_line_message(2001)
+
+        self.assertEqual(completed["data"]["source"], "settlement_snapshot")
+        self.assertEqual(completed["data"]["cost"], 70.0)
+        self.assertEqual(completed["data"]["balanceAfter"], 930)
+        self.assertEqual(len(completed["data"]["costDetails"]), 2)
+        self.assertIn("扣款後餘額：", completed["message"])
+        self.assertIsNone(completed["data"]["costError"])
+        self.assertEqual(low["data"]["balanceAfter"], 930)
+        self.assertEqual(low["data"]["source"], "settlement_snapshot")
+        self.assertEqual(auto["reason"], "not_auto_stop_balance_insufficient")
+
+    def test_transactions_without_snapshot_fall_back_to_live_query(self):
+        with (
+            patch.object(main, "DB_FILE", self.db_file),
+            patch.object(
+                main,
+                "_calculate_multi_period_cost_detailed",
+                return_value={"total": 0.0, "segments": []},
+            ) as breakdown,
+        ):
+            completed = main.build_charge_completed_line_message(2001)
+
+        breakdown.assert_called_once_with(2001)
+        self.assertEqual(completed["data"]["source"], "transaction")
+        self.assertFalse(completed["isCompleted"])
+
+
+if __name__ == "__main__":
+    unittest.main()
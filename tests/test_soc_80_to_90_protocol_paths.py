@@ -17,6 +17,12 @@ _TEST_DIR = tempfile.TemporaryDirectory(
 _TEST_DB = Path(_TEST_DIR.name) / "test_soc_80_to_90.sqlite3"
 os.environ["DATABASE_PATH"] = str(_TEST_DB)
 
+from db_config import get_database_path
+from schema_migrations import migrate as migrate_schema
+
+# main.py no longer creates tables on import (run_startup_migrations.py does).
+migrate_schema(get_database_path())
+
 import main  # noqa: E402
 
 
@@ -42,6 +48,7 @@ class Soc80To90ProtocolPathTests(unittest.IsolatedAsyncioTestCase):
         self.remote_stop_calls = []
         self.profile_calls = []
         self.balance_stop_candidates = []
+        self.outbox_wakes = []
 
         self.originals = {
             "schedule_charge_completed_line_notification": main.schedule_charge_completed_line_notification,
@@ -52,6 +59,7 @@ class Soc80To90ProtocolPathTests(unittest.IsolatedAsyncioTestCase):
             "request_transaction_stop": main.request_transaction_stop,
             "send_current_limit_profile": main.send_current_limit_profile,
             "_price_for_timestamp": main._price_for_timestamp,
+            "wake_line_outbox": main.wake_line_outbox,
         }
 
         main.schedule_charge_completed_line_notification = (
@@ -61,6 +69,7 @@ class Soc80To90ProtocolPathTests(unittest.IsolatedAsyncioTestCase):
         main.schedule_auto_stop_balance_insufficient_line_notification = (
             lambda _tx_id: None
         )
+        main.wake_line_outbox = lambda label: self.outbox_wakes.append(str(label))
         main.request_rebalance = (
             lambda reason: self.rebalance_calls.append(str(reason))
         )
@@ -91,9 +100,11 @@ class Soc80To90ProtocolPathTests(unittest.IsolatedAsyncioTestCase):
         main.charging_point_status.clear()
         main.current_limit_state.clear()
         main.ws_disconnect_grace.clear()
+        main.authorization_cache.clear()
 
         with main.get_conn() as conn:
             for table in (
+                "line_outbox",
                 "line_message_logs",
                 "line_bindings",
                 "payments",
@@ -270,6 +281,16 @@ class Soc80To90ProtocolPathTests(unittest.IsolatedAsyncioTestCase):
                     """
                 )
             ]
+            # StopTransaction 在結算交易內寫入 outbox；舊路徑則經由 schedule_*。
+            line_calls = [
+                int(row[0])
+                for row in conn.execute(
+                    """
+                    SELECT transaction_id FROM line_outbox
+                    WHERE event_type='charge_completed' ORDER BY id
+                    """
+                )
+            ] + list(self.line_calls)
             active_tx_ids = [
                 row[0]
                 for row in conn.execute(
@@ -288,7 +309,7 @@ class Soc80To90ProtocolPathTests(unittest.IsolatedAsyncioTestCase):
             "stop_transaction_rows": stop_count,
             "balance": balance,
             "meter_values": meter_rows,
-            "line_calls": list(self.line_calls),
+            "line_calls": line_calls,
             "active_transaction_ids": active_tx_ids,
             "smart_active_cp_ids": main.get_effective_active_cp_ids(),
             "charging_point_status": copy.deepcopy(
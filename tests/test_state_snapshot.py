@@ -0,0 +1,119 @@
+import asyncio
+import json
+import sqlite3
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import main
+from schema_migrations import migrate
+from state_snapshot import StateSnapshotter, read_snapshot, write_snapshot
+from ws_admission import VersionedWhitelist
+
+
+class SnapshotFileTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = str(Path(self.tempdir.name) / "state.json")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_round_trip_and_rejections(self):
+        snapshotter = StateSnapshotter(self.path, lambda: {"live_status": {"CP-1": {"power": 7.2}}}, max_age_s=60)
+        self.assertIsNone(snapshotter.load())
+        self.assertEqual(snapshotter.snapshot()["restore_skipped"], "missing")
+
+        self.assertTrue(snapshotter.save())
+        payload = snapshotter.load()
+        self.assertEqual(payload["sections"]["live_status"]["CP-1"]["power"], 7.2)
+        self.assertFalse(Path(f"{self.path}.tmp").exists())
+
+        self.assertIsNone(read_snapshot(self.path, max_age_s=60, now=time.time() + 120)[0])
+        Path(self.path).write_text('{"version": 1, "saved_at"', encoding="utf-8")
+        self.assertTrue(read_snapshot(self.path, max_age_s=60)[1].startswith("unreadable"))
+        write_snapshot(self.path, {})
+        data = json.loads(Path(self.path).read_text(encoding="utf-8"))
+        data["version"] = 0
+        Path(self.path).write_text(json.dumps(data), encoding="utf-8")
+        self.assertEqual(read_snapshot(self.path, max_age_s=60), (None, "version_mismatch"))
+
+
+class WarmRestartTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = str(Path(self.tempdir.name) / "state.sqlite3")
+        migrate(self.db_file)
+        with sqlite3.connect(self.db_file) as conn:
+            conn.execute(
+                "INSERT INTO transactions (transaction_id, charge_point_id, connector_id, id_tag, "
+                "meter_start, start_timestamp) VALUES (1, 'CP-1', 1, 'CARD-A', 1000, '2026-03-01T02:00:00+00:00')"
+            )
+            conn.executemany(
+                "INSERT INTO meter_values (transaction_id, charge_point_id, timestamp, value, measurand, unit) "
+                "VALUES (1, 'CP-1', ?, ?, 'Energy.Active.Import.Register', 'Wh')",
+                [("2026-03-01T02:00:00+00:00", 1000), ("2026-03-01T02:10:00+00:00", 2200)],
+            )
+        self.saved_at = time.time() - 30
+        write_snapshot(
+            str(Path(self.tempdir.name) / "state.json"),
+            {
+                "live_status": {"CP-1": {"power": 7.2, "energy_kwh": 1.2, "updated_at": self.saved_at}},
+                "charging_point_status": {"CP-1": {"status": "Charging"}},
+                "current_limit_state": {
+                    "CP-1": {"requested_limit_a": 16.0, "applied": True, "last_tx_id": 1},
+                    "CP-2": {"requested_limit_a": 16.0, "applied": True, "last_tx_id": 99},
+                },
+                "cp_connection_seq": {"CP-1": 7},
+                "connected": ["CP-1", "CP-2"],
+                "whitelist": ["CP-1", "CP-2"],
+            },
+            now=self.saved_at,
+        )
+        self.patches = [
+            patch.object(main, "DB_FILE", self.db_file),
+            patch.object(main, "charge_point_whitelist", VersionedWhitelist()),
+            patch.object(main.charger_state_snapshotter, "path", str(Path(self.tempdir.name) / "state.json")),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+        for state in (
+            main.live_status_cache,
+            main.charging_point_status,
+            main.current_limit_state,
+            main.cp_connection_seq,
+            main.ws_disconnect_grace,
+        ):
+            state.pop("CP-1", None)
+            state.pop("CP-2", None)
+        main.live_transaction_timelines.discard(1)
+        self.tempdir.cleanup()
+
+    def test_restore_marks_entries_and_hydration_keeps_allocation_share(self):
+        main.cp_connection_seq["CP-1"] = 9
+
+        connected = main.restore_charger_state()
+        report = asyncio.run(main.hydrate_active_transactions(connected))
+
+        live = main.live_status_cache["CP-1"]
+        self.assertEqual((live["power"], live["restored"], live["updated_at"]), (7.2, True, self.saved_at))
+        self.assertEqual(main.cp_connection_seq["CP-1"], 9)
+        self.assertEqual(main.charge_point_whitelist.snapshot().reason, "snapshot")
+        self.assertNotIn("CP-2", main.current_limit_state)
+        self.assertTrue(main.current_limit_state["CP-1"]["applied"])
+        self.assertEqual(report["warm_restart_grace"], ["CP-1"])
+        self.assertTrue(main.is_cp_effectively_available_for_allocation("CP-1"))
+        self.assertEqual(main.live_transaction_timelines.points(1)[-1]["kwh"], 1.2)
+
+        main._upsert_live("CP-1", power=6.8)
+        self.assertNotIn("restored", main.live_status_cache["CP-1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
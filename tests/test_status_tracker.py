@@ -0,0 +1,117 @@
+import asyncio
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+
+from schema_migrations import migrate
+from status_tracker import (
+    DUPLICATE,
+    KEEPALIVE,
+    TRANSITION,
+    StatusLogBatcher,
+    StatusTracker,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class StatusTrackerTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = str(Path(self.tempdir.name) / "status.sqlite3")
+        migrate(self.db_file)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def connect(self):
+        return sqlite3.connect(self.db_file)
+
+    def test_only_transitions_and_keepalive_touches_are_persisted(self):
+        clock = FakeClock()
+        tracker = StatusTracker(keepalive_touch_s=60, clock=clock)
+        batcher = StatusLogBatcher(self.connect)
+
+        kinds = []
+        for status, advance in (
+            ("Available", 0),
+            ("Available", 30),
+            ("Available", 29),
+            ("Available", 1),
+            ("Charging", 1),
+            ("Charging", 1),
+        ):
+            clock.now += advance
+            kind = tracker.observe("CP-1", 1, status, "NoError", f"t{len(kinds)}")
+            kinds.append(kind)
+            if kind != DUPLICATE:
+                batcher.add("CP-1", 1, status, f"t{len(kinds)}", "NoError")
+
+        tracker.forget("CP-1")
+        kinds.append(tracker.observe("CP-1", 1, "Charging", "NoError", "t6"))
+
+        self.assertEqual(
+            kinds,
+            [TRANSITION, DUPLICATE, DUPLICATE, KEEPALIVE, TRANSITION, DUPLICATE, TRANSITION],
+        )
+        self.assertEqual(batcher.flush(), 3)
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT status, error_code FROM status_logs ORDER BY id"
+            ).fetchall()
+        self.assertEqual(
+            rows, [("Available", "NoError"), ("Available", "NoError"), ("Charging", "NoError")]
+        )
+        self.assertEqual(tracker.snapshot()["write_ratio"], round(4 / 7, 4))
+
+    def test_presence_is_upserted_only_for_charge_points_seen_since_last_flush(self):
+        tracker = StatusTracker()
+        tracker.heartbeat("CP-1", "2026-01-01T00:00:00+00:00")
+        tracker.heartbeat("CP-1", "2026-01-01T00:01:00+00:00")
+        tracker.observe("CP-2", 1, "Available", "NoError", None, seen_at="2026-01-01T00:01:30+00:00")
+
+        with self.connect() as conn:
+            self.assertEqual(tracker.flush_presence(conn, "u1"), 2)
+            self.assertEqual(tracker.flush_presence(conn, "u2"), 0)
+            tracker.observe("CP-1", 1, "Available", "NoError", None, seen_at="2026-01-01T00:02:00+00:00")
+            self.assertEqual(tracker.flush_presence(conn, "u3"), 1)
+            rows = conn.execute(
+                """
+                SELECT charge_point_id, last_seen_at, last_heartbeat_at, updated_at
+                FROM charge_point_presence ORDER BY charge_point_id
+                """
+            ).fetchall()
+
+        self.assertEqual(
+            rows,
+            [
+                ("CP-1", "2026-01-01T00:02:00+00:00", "2026-01-01T00:01:00+00:00", "u3"),
+                ("CP-2", "2026-01-01T00:01:30+00:00", None, "u1"),
+            ],
+        )
+
+    def test_batcher_stop_flushes_pending_rows(self):
+        batcher = StatusLogBatcher(self.connect, flush_interval_s=60)
+
+        async def run():
+            batcher.start()
+            batcher.add("CP-1", 1, "Faulted", "t0", "GroundFailure")
+            await batcher.stop()
+
+        asyncio.run(run())
+        with self.connect() as conn:
+            self.assertEqual(
+                conn.execute("SELECT status, error_code FROM status_logs").fetchall(),
+                [("Faulted", "GroundFailure")],
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
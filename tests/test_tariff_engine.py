@@ -0,0 +1,129 @@
+import sqlite3
+import tempfile
+import unittest
+from datetime import date
+from pathlib import Path
+from unittest.mock import patch
+
+import main
+import pricing_calendar
+import tariff_engine
+from schema_migrations import migrate
+from tests.test_pricing_calendar import TEMPLATES
+
+
+HOLIDAYS = {2026: {"2026-06-03": "holiday", "2026-06-06": "workday"}}
+
+
+def daily_pricing_endpoint():
+    # main 內同一路徑有兩個同名函式，實際生效的是先註冊的那一個
+    return next(
+        route.endpoint
+        for route in main.app.routes
+        if getattr(route, "path", None) == "/api/daily-pricing"
+        and "GET" in (getattr(route, "methods", set()) or set())
+    )
+
+
+class TariffEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = str(Path(self.tempdir.name) / "tariff.sqlite3")
+        migrate(self.db_file)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def connect(self):
+        return sqlite3.connect(self.db_file)
+
+    def register(self, conn, years=(2026,), templates=TEMPLATES, replace=True):
+        return tariff_engine.register_calendars(
+            conn, years, tariff_engine.make_definition(templates), HOLIDAYS, replace=replace
+        )
+
+    def test_calendar_compiles_days_without_storing_rows(self):
+        with self.connect() as conn:
+            self.register(conn)
+            rules = tariff_engine.resolve(
+                conn, ["2026-06-02", "2026-06-03", "2026-06-06", "2026-01-03", "2027-01-04"]
+            )
+            stats = tariff_engine.storage_stats(conn)
+
+        self.assertEqual(rules["2026-06-02"][1], ("16:00", "22:00", 8.0, "peak"))
+        # 國定假日：夏月星期日模板 + holiday 標記；補班日（星期六）用工作日模板
+        self.assertEqual(rules["2026-06-03"], [("00:00", "24:00", 2.0, "holiday")])
+        self.assertEqual(rules["2026-06-06"][1][2], 8.0)
+        self.assertEqual(rules["2026-01-03"], [("00:00", "24:00", 2.8, "sat")])
+        self.assertEqual(rules["2027-01-04"], [])
+        self.assertEqual((stats["calendarYears"], stats["overrideRows"], stats["holidayRows"]), ([2026], 0, 2))
+
+    def test_overrides_win_and_compaction_keeps_only_real_edits(self):
+        with self.connect() as conn:
+            # 舊版匯入逐日展開的資料 + 一天人工修改
+            targets = pricing_calendar.target_rules(
+                TEMPLATES, HOLIDAYS, date(2026, 6, 1), date(2026, 6, 7)
+            )
+            changes = {d: rules for d, (_, rules) in targets.items()}
+            changes["2026-06-04"] = (("00:00", "24:00", 1.0, "promo"),)
+            pricing_calendar.apply_changes(conn, changes, pause_s=0)
+            self.register(conn)
+
+            self.assertEqual(
+                tariff_engine.resolve(conn, ["2026-06-04"])["2026-06-04"],
+                [("00:00", "24:00", 1.0, "promo")],
+            )
+            before = tariff_engine.effective_rules(conn, changes)
+            drop = tariff_engine.plan_compaction(conn, "2026-06-01", "2026-06-07")
+            pricing_calendar.apply_changes(conn, drop, pause_s=0)
+
+            self.assertEqual(sorted(drop), sorted(set(changes) - {"2026-06-04"}))
+            self.assertEqual(tariff_engine.effective_rules(conn, changes), before)
+            self.assertEqual(tariff_engine.storage_stats(conn)["overrideDates"], 1)
+
+    def test_calendar_snapshot_and_legacy_row_edits(self):
+        with self.connect() as conn:
+            self.register(conn)
+            # fill_missing：既有年度不因模板修改而改價
+            cheaper = {"summer": {}, "non_summer": {}}
+            self.assertEqual(self.register(conn, (2026, 2027), cheaper, replace=False), [2027])
+            self.assertEqual(tariff_engine.resolve(conn, ["2026-06-02"])["2026-06-02"][1][2], 8.0)
+
+            # 逐列新增：先展開萬年曆規則，再加上新時段
+            self.assertEqual(tariff_engine.materialize(conn, "2026-06-02"), 3)
+            self.assertEqual(tariff_engine.materialize(conn, "2026-06-02"), 0)
+            conn.commit()
+
+            rules = tariff_engine.load_rules_by_date(conn)
+        self.assertEqual(len(rules), 365)
+        self.assertEqual(rules["2026-06-02"][1], ("16:00", "22:00", 8.0))
+
+    def test_import_endpoint_compacts_materialized_years_without_repricing(self):
+        targets = pricing_calendar.target_rules(TEMPLATES, HOLIDAYS, date(2026, 1, 1), date(2026, 12, 31))
+        with self.connect() as conn:
+            pricing_calendar.apply_changes(
+                conn, {d: rules for d, (_, rules) in targets.items()}, pause_s=0
+            )
+
+        with (
+            patch.object(main, "DB_FILE", self.db_file),
+            patch.object(main, "_load_default_pricing_rules_for_import", return_value=TEMPLATES),
+            patch.object(main, "_load_holiday_calendar_for_year", side_effect=lambda y: HOLIDAYS.get(y, {})),
+            patch.object(main, "PRICING_IMPORT_PAUSE_SECONDS", 0),
+        ):
+            get_daily_pricing = daily_pricing_endpoint()
+            before = get_daily_pricing("2026-06-03")
+            result = main.import_daily_pricing_calendar(
+                {"startYear": 2026, "endYear": 2026, "mode": "fill_missing"}
+            )
+            after = get_daily_pricing("2026-06-03")
+            price = main._price_for_timestamp("2026-06-02T09:00:00+00:00")
+
+        self.assertEqual((result["daysCreated"], result["daysSkipped"]), (0, 365))
+        self.assertEqual(result["storage"]["overrideRows"], 0)
+        self.assertEqual(after, before)
+        self.assertEqual(price, 8.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
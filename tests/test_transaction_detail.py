@@ -0,0 +1,143 @@
+import asyncio
+import json
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest.mock import patch
+
+import main
+import payments_recalc
+from schema_migrations import migrate
+from transaction_detail import Series, TransactionDetailCache, build_timeline
+
+
+START = datetime(2026, 3, 1, 2, 0, tzinfo=timezone.utc)
+
+
+def iso(seconds):
+    return (START + timedelta(seconds=seconds)).isoformat()
+
+
+class SeriesTests(unittest.TestCase):
+    def test_long_session_stays_within_point_budget(self):
+        series = Series(max_points=50, min_bucket_s=60)
+        # 10 小時、每 10 秒一筆：7 kW 定速充電
+        for i in range(3600):
+            series.add(iso(i * 10), kwh=7 * i * 10 / 3600, kw=7.0)
+
+        points = series.points()
+        self.assertLessEqual(len(points), 50)
+        self.assertEqual(series.samples, 3600)
+        self.assertEqual(points[-1]["kwh"], round(7 * 35990 / 3600, 4))
+        self.assertTrue(all(p["kw"] == 7.0 for p in points))
+
+    def test_build_sums_phases_and_follows_billing_units(self):
+        rows = [
+            (iso(0), 10000, "Energy.Active.Import.Register", "Wh", None),
+            (iso(0), 2000, "Power.Active.Import", "W", "L1"),
+            (iso(0), 2500, "Power.Active.Import", "W", "L2"),
+            (iso(300), 12.5, "Energy.Active.Import.Register", "kWh", None),
+            (iso(300), 6.0, "Power.Active.Import", "kW", None),
+            (iso(300), 1.0, "Power.Active.Import", "kW", "L1"),
+        ]
+        points = build_timeline(rows, meter_start=10000).points()
+        self.assertEqual(
+            [(p["kwh"], p["kw"]) for p in points], [(0.0, 4.5), (2.5, 6.0)]
+        )
+
+
+class TransactionDetailCacheTests(unittest.TestCase):
+    def test_store_is_dropped_after_a_racing_invalidation(self):
+        cache = TransactionDetailCache(max_entries=2)
+        _, generation = cache.lookup("db", 1)
+        cache.invalidate()
+        self.assertFalse(cache.store("db", 1, {"id": 1}, generation))
+
+        for tx_id in (1, 2, 3):
+            _, generation = cache.lookup("db", tx_id)
+            cache.store("db", tx_id, {"id": tx_id}, generation)
+        self.assertEqual(cache.lookup("db", 1)[0], None)
+        self.assertEqual(cache.lookup("db", 3)[0], {"id": 3})
+        self.assertEqual(cache.lookup("other-db", 3)[0], None)
+        self.assertEqual(cache.snapshot()["evictions"], 1)
+
+
+class TransactionDetailEndpointTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = str(Path(self.tempdir.name) / "detail.sqlite3")
+        migrate(self.db_file)
+        with sqlite3.connect(self.db_file) as conn:
+            conn.execute(
+                "INSERT INTO users (id_tag, name, card_number) VALUES ('card-a', '王小明', 'CARD-A')"
+            )
+            conn.executemany(
+                """
+                INSERT INTO transactions (transaction_id, charge_point_id, connector_id, id_tag,
+                    meter_start, start_timestamp, meter_stop, stop_timestamp)
+                VALUES (?, 'CP-1', 1, 'CARD-A', 0, ?, ?, ?)
+                """,
+                [(1, iso(0), 2000, iso(600)), (2, iso(0), None, None)],
+            )
+            conn.executemany(
+                """
+                INSERT INTO meter_values (transaction_id, charge_point_id, timestamp, value, measurand, unit)
+                VALUES (1, 'CP-1', ?, ?, 'Energy.Active.Import.Register', 'Wh')
+                """,
+                [(iso(i * 60), i * 200) for i in range(11)],
+            )
+            conn.execute(
+                "INSERT INTO payments (transaction_id, total_amount) VALUES (1, 99)"
+            )
+        self.patch = patch.object(main, "DB_FILE", self.db_file)
+        self.patch.start()
+        main.transaction_detail_cache.invalidate()
+
+    def tearDown(self):
+        self.patch.stop()
+        main.live_status_cache.pop("CP-1", None)
+        main.live_transaction_timelines.discard(2)
+        self.tempdir.cleanup()
+
+    def detail(self, tx_id):
+        return json.loads(asyncio.run(main.get_transaction_detail(tx_id)).body)
+
+    def test_finished_session_is_cached_and_cleared_by_recalculation(self):
+        first = self.detail(1)
+        hits = main.transaction_detail_cache.snapshot()["hits"]
+        second = self.detail(1)
+
+        self.assertEqual(first, second)
+        self.assertEqual(main.transaction_detail_cache.snapshot()["hits"], hits + 1)
+        self.assertEqual((first["residentName"], first["energyKwh"], first["paidAmount"]), ("王小明", 2.0, 99.0))
+        self.assertEqual(len(first["timeline"]["points"]), 11)
+        self.assertEqual(first["meterValues"][-1]["sampledValue"][0]["value"], 2000.0)
+        with sqlite3.connect(self.db_file) as conn:
+            self.assertEqual(
+                conn.execute("SELECT sample_count FROM transaction_timelines WHERE transaction_id = 1").fetchone(),
+                (11,),
+            )
+            job_id = payments_recalc.create_job(conn)["job_id"]
+
+        with patch.object(main, "get_community_settings", return_value={"surcharge_per_kwh": 0}):
+            main._run_payments_recalc_job(job_id)
+        self.assertEqual(main.transaction_detail_cache.snapshot()["entries"], 0)
+        # 無電價規則：2 kWh × 預設 6 元
+        self.assertEqual(self.detail(1)["paidAmount"], 12.0)
+
+    def test_active_session_reads_live_state_and_is_not_cached(self):
+        main.live_status_cache["CP-1"] = {"power": 7.2, "energy_kwh": 1.5, "estimated_amount": 9.0}
+        main.live_transaction_timelines.add(2, iso(0), kwh=0.0, kw=7.0)
+        main.live_transaction_timelines.add(2, iso(120), kwh=1.5, kw=7.4)
+
+        detail = self.detail(2)
+
+        self.assertEqual((detail["active"], detail["source"], detail["energyKwh"]), (True, "live", 1.5))
+        self.assertEqual([p["kw"] for p in detail["timeline"]["points"]], [7.0, 7.4])
+        self.assertEqual(main.transaction_detail_cache.snapshot()["entries"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
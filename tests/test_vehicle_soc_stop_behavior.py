@@ -7,14 +7,20 @@ from pathlib import Path
 from types import SimpleNamespace
 
 
-# Importing main initializes its schema, so force that initialization onto a
-# dedicated temporary database before main is imported.
+# The schema is migrated onto a dedicated temporary database before main is
+# imported, so the test never touches a shared database.
 _TEST_DIR = tempfile.TemporaryDirectory(
     prefix="ocpp_soc_behavior_", ignore_cleanup_errors=True
 )
 _TEST_DB = Path(_TEST_DIR.name) / "test_soc_behavior.sqlite3"
 os.environ["DATABASE_PATH"] = str(_TEST_DB)
 
+from db_config import get_database_path
+from schema_migrations import migrate as migrate_schema
+
+# main.py no longer creates tables on import (run_startup_migrations.py does).
+migrate_schema(get_database_path())
+
 import main  # noqa: E402
 
 
@@ -37,6 +43,7 @@ class VehicleSocStopBehaviorTests(unittest.IsolatedAsyncioTestCase):
         self.line_completed_calls = []
         self.low_balance_calls = []
         self.auto_stop_line_calls = []
+        self.outbox_wakes = []
         self.rebalance_calls = []
         self.balance_stop_candidates = []
         self.profile_calls = []
@@ -51,6 +58,7 @@ class VehicleSocStopBehaviorTests(unittest.IsolatedAsyncioTestCase):
             "send_current_limit_profile": main.send_current_limit_profile,
             "_price_for_timestamp": main._price_for_timestamp,
             "request_transaction_stop": main.request_transaction_stop,
+            "wake_line_outbox": main.wake_line_outbox,
         }
 
         main.schedule_charge_completed_line_notification = (
@@ -62,6 +70,7 @@ class VehicleSocStopBehaviorTests(unittest.IsolatedAsyncioTestCase):
         main.schedule_auto_stop_balance_insufficient_line_notification = (
             lambda tx_id: self.auto_stop_line_calls.append(int(tx_id))
         )
+        main.wake_line_outbox = lambda label: self.outbox_wakes.append(str(label))
         main.request_rebalance = (
             lambda reason: self.rebalance_calls.append(str(reason))
         )
@@ -94,9 +103,11 @@ class VehicleSocStopBehaviorTests(unittest.IsolatedAsyncioTestCase):
         main.charging_point_status.clear()
         main.current_limit_state.clear()
         main.ws_disconnect_grace.clear()
+        main.authorization_cache.clear()
 
         with main.get_conn() as conn:
             for table in (
+                "line_outbox",
                 "line_message_logs",
                 "line_bindings",
                 "payments",
@@ -244,6 +255,16 @@ class VehicleSocStopBehaviorTests(unittest.IsolatedAsyncioTestCase):
             balance = conn.execute(
                 "SELECT balance FROM cards WHERE card_id=?", (CARD_ID,)
             ).fetchone()[0]
+            # StopTransaction 在結算交易內寫入 outbox；舊路徑則經由 schedule_*。
+            line_completed_calls = [
+                int(row[0])
+                for row in conn.execute(
+                    """
+                    SELECT transaction_id FROM line_outbox
+                    WHERE event_type='charge_completed' ORDER BY id
+                    """
+                )
+            ] + list(self.line_completed_calls)
             meter_counts = {
                 str(row[0]): row[1]
                 for row in conn.execute(
@@ -259,10 +280,10 @@ class VehicleSocStopBehaviorTests(unittest.IsolatedAsyncioTestCase):
             "history": main.get_card_history(CARD_ID)["history"],
             "balance": balance,
             "meter_value_counts": meter_counts,
-            "line_completed_calls": list(self.line_completed_calls),
+            "line_completed_calls": line_completed_calls,
             "line_completed_messages": [
                 main.build_charge_completed_line_message(tx_id).get("message")
-                for tx_id in self.line_completed_calls
+                for tx_id in line_completed_calls
             ],
             "charging_point_status": main.charging_point_status.get(CP_ID),
             "live_status_cache": main.live_status_cache.get(CP_ID),
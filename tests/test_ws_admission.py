@@ -0,0 +1,131 @@
+import asyncio
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+
+from ws_admission import (
+    AdmissionController,
+    AdmissionRejected,
+    ConnectionLogBatcher,
+    TokenBucket,
+    VersionedWhitelist,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTests(unittest.TestCase):
+    def test_burst_then_paced_and_over_budget_takes_nothing(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate_per_s=2, burst=2, clock=clock)
+
+        self.assertEqual([bucket.reserve(), bucket.reserve()], [0.0, 0.0])
+        self.assertAlmostEqual(bucket.reserve(), 0.5)
+        self.assertIsNone(bucket.reserve(max_wait_s=0.5))
+        self.assertAlmostEqual(bucket.reserve(max_wait_s=1.0), 1.0)
+
+        clock.now += 10
+        self.assertEqual(bucket.reserve(), 0.0)
+
+
+class AdmissionControllerTests(unittest.TestCase):
+    def test_storm_settles_after_quiet_period(self):
+        clock = FakeClock()
+        admission = AdmissionController(
+            rate_per_s=0, storm_window_s=10, storm_threshold=3, settle_s=5, clock=clock
+        )
+
+        async def admit(n):
+            for _ in range(n):
+                await admission.acquire("CP")
+                admission.release()
+
+        asyncio.run(admit(2))
+        self.assertFalse(admission.storm_active())
+        asyncio.run(admit(1))
+        self.assertEqual(admission.settle_remaining_s(), 5)
+
+        clock.now += 4
+        asyncio.run(admit(1))
+        self.assertEqual(admission.settle_remaining_s(), 5)
+        clock.now += 5
+        self.assertFalse(admission.storm_active())
+        self.assertEqual(admission.snapshot()["admitted"], 4)
+
+    def test_concurrency_limit_rejects_after_wait_budget(self):
+        admission = AdmissionController(rate_per_s=0, max_concurrent=1, wait_timeout_s=0.05)
+
+        async def run():
+            await admission.acquire("CP-1")
+            with self.assertRaises(AdmissionRejected):
+                await admission.acquire("CP-2")
+            admission.release()
+            await admission.acquire("CP-2")
+            admission.release()
+
+        asyncio.run(run())
+        snapshot = admission.snapshot()
+        self.assertEqual((snapshot["admitted"], snapshot["rejected_busy"]), (2, 1))
+        self.assertEqual((snapshot["in_flight"], snapshot["peak_in_flight"]), (0, 1))
+
+
+class VersionedWhitelistTests(unittest.TestCase):
+    def test_version_only_moves_when_the_set_changes(self):
+        whitelist = VersionedWhitelist()
+        self.assertFalse(whitelist.loaded)
+
+        first = whitelist.replace(["CP-1"], reason="startup")
+        same = whitelist.replace(["CP-1"], reason="api")
+        changed = whitelist.replace(["CP-1", "CP-2"], reason="api")
+
+        self.assertEqual((first.version, same.version, changed.version), (1, 1, 2))
+        self.assertTrue(whitelist.contains("CP-2"))
+        self.assertEqual(first.ids, frozenset({"CP-1"}))
+
+
+class ConnectionLogBatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_file = str(Path(self.tempdir.name) / "conn-log.sqlite3")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def connect(self):
+        return sqlite3.connect(self.db_file)
+
+    def count(self):
+        with self.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM connection_logs").fetchone()[0]
+
+    def test_failed_flush_requeues_and_stop_writes_everything_in_one_batch(self):
+        batcher = ConnectionLogBatcher(self.connect, flush_interval_s=60, max_pending=3)
+        for n in range(4):
+            batcher.add(f"CP-{n}", "127.0.0.1", f"2026-01-01T00:00:0{n}")
+
+        self.assertEqual(batcher.flush(), 0)
+        self.assertEqual((batcher.pending(), batcher.stats.dropped), (3, 1))
+
+        with self.connect() as conn:
+            conn.execute(
+                "CREATE TABLE connection_logs (charge_point_id TEXT, ip TEXT, time TEXT)"
+            )
+
+        async def run():
+            batcher.start()
+            await batcher.stop()
+
+        asyncio.run(run())
+        self.assertEqual(self.count(), 3)
+        self.assertEqual((batcher.stats.flushes, batcher.stats.errors), (1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
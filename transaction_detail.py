@@ -0,0 +1,434 @@
+"""Transaction detail: downsampled meter timelines and the detail cache.
+
+``GET /api/transactions/{id}`` used to join ``users`` / ``card_owners`` on
+``UPPER(TRIM(...))`` and return every raw ``meter_values`` row of the
+session on every page view.  Finished sessions are now served from data
+written once at stop time:
+
+- the settlement snapshot (``settlement_snapshot.py``) for the billed
+  numbers;
+- a downsampled power / energy timeline saved to ``transaction_timelines``
+  by a worker thread after the settlement commits: the live series of the
+  session (``TimelineAccumulator.pop``), or ``read_timeline`` when there is
+  none, then ``save_timeline``;
+- ``TransactionDetailCache``, an LRU of the rendered payload keyed by
+  transaction id, cleared when payments are recalculated.
+
+``Series`` is the downsampler: fixed-width time buckets (last energy
+reading, mean power) whose width doubles when the point budget is exceeded,
+so memory stays bounded however long the session runs.  Energy is
+cumulative, so a reading lower than one already seen is dropped.  The same class
+backs ``TimelineAccumulator``, the live series of active sessions fed by
+MeterValues.
+
+This module intentionally has no FastAPI or OCPP dependency.
+"""
+
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Iterable
+
+
+TIMELINE_VERSION = 1
+
+
+def _epoch(ts: Any) -> float | None:
+    try:
+        parsed = datetime.fromisoformat(str(ts).replace("Z", "+00:00"))
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+@dataclass
+class _Bucket:
+    index: int
+    t: str
+    kwh: float | None = None
+    kw_sum: float = 0.0
+    kw_n: int = 0
+
+    def merge(self, other: "_Bucket") -> None:
+        self.t = other.t
+        if other.kwh is not None:
+            self.kwh = other.kwh
+        self.kw_sum += other.kw_sum
+        self.kw_n += other.kw_n
+
+
+class Series:
+    """Online time-bucket downsampler; samples must arrive in time order."""
+
+    def __init__(self, max_points: int = 240, min_bucket_s: float = 60.0):
+        self.max_points = max(2, int(max_points))
+        self.width = max(1.0, float(min_bucket_s))
+        self.samples = 0
+        self._t0: float | None = None
+        self._kwh_high: float | None = None
+        self._buckets: list[_Bucket] = []
+
+    def add(self, ts: Any, *, kwh: float | None = None, kw: float | None = None) -> None:
+        # 累積電量只增不減：較低的讀值（StopTransaction 補的 0 kWh 佔位列、
+        # 電表重置）不得覆蓋已知的最高值
+        if kwh is not None:
+            if self._kwh_high is not None and kwh < self._kwh_high:
+                kwh = None
+            else:
+                self._kwh_high = kwh
+        epoch = _epoch(ts)
+        if epoch is None or (kwh is None and kw is None):
+            return
+        if self._t0 is None:
+            self._t0 = epoch
+        index = max(0, int((epoch - self._t0) // self.width))
+        sample = _Bucket(index, str(ts), kwh, kw or 0.0, 1 if kw is not None else 0)
+        self.samples += 1
+        # 時間倒退（重送的舊資料）併入最後一個 bucket
+        if self._buckets and index <= self._buckets[-1].index:
+            self._buckets[-1].merge(sample)
+            return
+        self._buckets.append(sample)
+        while len(self._buckets) > self.max_points:
+            self._coarsen()
+
+    def _coarsen(self) -> None:
+        self.width *= 2
+        merged: list[_Bucket] = []
+        for bucket in self._buckets:
+            bucket.index //= 2
+            if merged and merged[-1].index == bucket.index:
+                merged[-1].merge(bucket)
+            else:
+                merged.append(bucket)
+        self._buckets = merged
+
+    def points(self) -> list[dict[str, Any]]:
+        """``[{"t", "kwh", "kw"}]``；kwh 為本次充電累積度數（沿用前一點），kw 為區間平均功率。"""
+        points = []
+        kwh = None
+        for bucket in self._buckets:
+            if bucket.kwh is not None:
+                kwh = bucket.kwh
+            points.append(
+                {
+                    "t": bucket.t,
+                    "kwh": round(kwh, 4) if kwh is not None else None,
+                    "kw": round(bucket.kw_sum / bucket.kw_n, 3) if bucket.kw_n else None,
+                }
+            )
+        return points
+
+
+def session_kwh(value: Any, unit: Any, meter_start: Any) -> float | None:
+    """Energy.Active.Import.Register → 本次累積 kWh（未標單位視為 Wh，與計費相同）。"""
+    try:
+        wh = float(value)
+        if str(unit or "").strip().lower() == "kwh":
+            wh *= 1000.0
+        return max(0.0, (wh - float(meter_start or 0)) / 1000.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def power_kw(value: Any, unit: Any) -> float | None:
+    """未標單位視為 kW（同 main._to_kw）。"""
+    try:
+        v = float(value)
+    except (TypeError, ValueError):
+        return None
+    return v / 1000.0 if str(unit or "").strip().lower() in ("w", "watt", "watts") else v
+
+
+def build_timeline(
+    rows: Iterable[tuple],
+    meter_start: Any,
+    *,
+    max_points: int = 240,
+    min_bucket_s: float = 60.0,
+) -> Series:
+    """
+    ``rows``: ``(timestamp, value, measurand, unit, phase)`` in time order.
+    Total power uses the phase-less reading of a timestamp, otherwise the
+    sum of its per-phase readings.
+    """
+    series = Series(max_points, min_bucket_s)
+    current_ts = None
+    kwh = None
+    total_kw = None
+    phase_kw = None
+
+    def flush():
+        kw = total_kw if total_kw is not None else phase_kw
+        if current_ts is not None:
+            series.add(current_ts, kwh=kwh, kw=kw)
+
+    for ts, value, measurand, unit, phase in rows:
+        if ts != current_ts:
+            flush()
+            current_ts, kwh, total_kw, phase_kw = ts, None, None, None
+        measurand = str(measurand or "")
+        if "Energy.Active.Import" in measurand:
+            kwh = session_kwh(value, unit, meter_start)
+        elif measurand.startswith("Power.Active.Import"):
+            kw = power_kw(value, unit)
+            if kw is None:
+                continue
+            if phase:
+                phase_kw = (phase_kw or 0.0) + kw
+            else:
+                total_kw = kw
+    flush()
+    return series
+
+
+def read_timeline(
+    conn: sqlite3.Connection, transaction_id: int, meter_start: Any, **kwargs
+) -> Series:
+    rows = conn.execute(
+        """
+        SELECT timestamp, value, measurand, unit, phase
+        FROM meter_values
+        WHERE transaction_id = ?
+        ORDER BY timestamp, id
+        """,
+        (int(transaction_id),),
+    )
+    return build_timeline(rows, meter_start, **kwargs)
+
+
+def read_timelines(
+    conn: sqlite3.Connection, meter_starts: dict[int, Any], **kwargs
+) -> dict[int, Series]:
+    """``read_timeline`` for many transactions with one query (warm-restart hydration)."""
+    tx_ids = sorted(int(tx_id) for tx_id in meter_starts)
+    rows_by_tx: dict[int, list[tuple]] = {tx_id: [] for tx_id in tx_ids}
+    # SQLite 參數上限：分段查詢
+    for i in range(0, len(tx_ids), 900):
+        part = tx_ids[i : i + 900]
+        for tx_id, *row in conn.execute(
+            f"""
+            SELECT transaction_id, timestamp, value, measurand, unit, phase
+            FROM meter_values
+            WHERE transaction_id IN ({",".join("?" for _ in part)})
+            ORDER BY transaction_id, timestamp, id
+            """,
+            part,
+        ):
+            rows_by_tx[int(tx_id)].append(tuple(row))
+    return {
+        tx_id: build_timeline(rows, meter_starts.get(tx_id), **kwargs)
+        for tx_id, rows in rows_by_tx.items()
+    }
+
+
+def save_timeline(conn, transaction_id: int, series: Series) -> bool:
+    """Insert once (caller commits); returns False if the transaction already has one."""
+    cur = conn.execute(
+        """
+        INSERT OR IGNORE INTO transaction_timelines (
+            transaction_id, timeline_version, points, sample_count, bucket_seconds, created_at
+        )
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        (
+            int(transaction_id),
+            TIMELINE_VERSION,
+            json.dumps(series.points(), separators=(",", ":")),
+            series.samples,
+            series.width,
+            datetime.now(timezone.utc).replace(microsecond=0).isoformat(),
+        ),
+    )
+    return cur.rowcount == 1
+
+
+def load_timeline(conn, transaction_id: int) -> dict[str, Any] | None:
+    try:
+        row = conn.execute(
+            """
+            SELECT timeline_version, points, sample_count, bucket_seconds
+            FROM transaction_timelines
+            WHERE transaction_id = ?
+            """,
+            (int(transaction_id),),
+        ).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    if not row or int(row[0]) != TIMELINE_VERSION:
+        return None
+    return {"points": json.loads(row[1]), "samples": row[2], "bucketSeconds": row[3]}
+
+
+def meter_values_view(points: list[dict[str, Any]], meter_start: Any) -> list[dict[str, Any]]:
+    """舊前端的 meterValues 格式（OCPP sampledValue），由降採樣後的點產生。"""
+    try:
+        start_wh = float(meter_start or 0)
+    except (TypeError, ValueError):
+        start_wh = 0.0
+    view = []
+    for point in points:
+        sampled = []
+        if point.get("kwh") is not None:
+            sampled.append(
+                {
+                    "value": round(start_wh + point["kwh"] * 1000.0, 1),
+                    "measurand": "Energy.Active.Import.Register",
+                    "unit": "Wh",
+                    "context": "Sample.Periodic",
+                    "format": "Raw",
+                }
+            )
+        if point.get("kw") is not None:
+            sampled.append(
+                {
+                    "value": point["kw"],
+                    "measurand": "Power.Active.Import",
+                    "unit": "kW",
+                    "context": "Sample.Periodic",
+                    "format": "Raw",
+                }
+            )
+        view.append({"timestamp": point["t"], "sampledValue": sampled})
+    return view
+
+
+class TimelineAccumulator:
+    """Live series per active transaction (MeterValues → ``add``; StopTransaction → ``pop``)."""
+
+    def __init__(self, max_points: int = 240, min_bucket_s: float = 60.0, max_sessions: int = 2000):
+        self.max_points = max_points
+        self.min_bucket_s = min_bucket_s
+        self.max_sessions = max(1, int(max_sessions))
+        self._series: OrderedDict[int, Series] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, transaction_id: Any, ts: Any, *, kwh: float | None = None, kw: float | None = None) -> None:
+        try:
+            tx_id = int(transaction_id)
+        except (TypeError, ValueError):
+            return
+        with self._lock:
+            series = self._series.get(tx_id)
+            if series is None:
+                series = self._series[tx_id] = Series(self.max_points, self.min_bucket_s)
+                # 漏收 StopTransaction 的舊 session 不無限累積
+                while len(self._series) > self.max_sessions:
+                    self._series.popitem(last=False)
+            series.add(ts, kwh=kwh, kw=kw)
+
+    def seed(self, transaction_id: Any, series: Series) -> bool:
+        """重啟後由 DB 補建的曲線；已有即時資料的交易不覆蓋。"""
+        tx_id = int(transaction_id)
+        with self._lock:
+            if tx_id in self._series:
+                return False
+            self._series[tx_id] = series
+            while len(self._series) > self.max_sessions:
+                self._series.popitem(last=False)
+            return True
+
+    def points(self, transaction_id: int) -> list[dict[str, Any]] | None:
+        with self._lock:
+            series = self._series.get(int(transaction_id))
+            return series.points() if series is not None else None
+
+    def pop(self, transaction_id: Any) -> Series | None:
+        """StopTransaction：取出（並移除）本次充電的曲線，commit 後直接存檔。"""
+        try:
+            tx_id = int(transaction_id)
+        except (TypeError, ValueError):
+            return None
+        with self._lock:
+            return self._series.pop(tx_id, None)
+
+    def discard(self, transaction_id: Any) -> None:
+        self.pop(transaction_id)
+
+    def __len__(self) -> int:
+        return len(self._series)
+
+
+@dataclass
+class TransactionDetailCacheStats:
+    hits: int = 0
+    misses: int = 0
+    stale_loads: int = 0
+    invalidations: int = 0
+    evictions: int = 0
+
+
+class TransactionDetailCache:
+    """
+    Thread-safe LRU of finished-transaction detail payloads.
+
+    ``lookup`` returns the entry and the current generation; ``store`` drops
+    the value if an invalidation happened in between.  ``scope`` is the
+    database path, as in ``auth_cache.AuthorizationCache``.
+    """
+
+    def __init__(self, max_entries: int = 512):
+        self.max_entries = max(1, int(max_entries))
+        self.stats = TransactionDetailCacheStats()
+        self._entries: OrderedDict[int, dict[str, Any]] = OrderedDict()
+        self._scope: str | None = None
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, scope: str, transaction_id: int) -> tuple[dict[str, Any] | None, int]:
+        with self._lock:
+            if scope != self._scope:
+                self._entries.clear()
+                self._generation += 1
+                self._scope = scope
+            entry = self._entries.get(int(transaction_id))
+            if entry is not None:
+                self._entries.move_to_end(int(transaction_id))
+                self.stats.hits += 1
+            else:
+                self.stats.misses += 1
+            return entry, self._generation
+
+    def store(self, scope: str, transaction_id: int, payload: dict[str, Any], generation: int) -> bool:
+        with self._lock:
+            if generation != self._generation or scope != self._scope:
+                self.stats.stale_loads += 1
+                return False
+            self._entries[int(transaction_id)] = payload
+            self._entries.move_to_end(int(transaction_id))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+            return True
+
+    def invalidate(self, transaction_id: int | None = None) -> None:
+        """None 清空全部（payments 重算後）。"""
+        with self._lock:
+            self._generation += 1
+            self.stats.invalidations += 1
+            if transaction_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(int(transaction_id), None)
+
+    def snapshot(self) -> dict[str, Any]:
+        stats = self.stats
+        lookups = stats.hits + stats.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "generation": self._generation,
+            "hits": stats.hits,
+            "misses": stats.misses,
+            "hit_ratio": round(stats.hits / lookups, 4) if lookups else None,
+            "stale_loads": stats.stale_loads,
+            "invalidations": stats.invalidations,
+            "evictions": stats.evictions,
+        }
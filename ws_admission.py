@@ -0,0 +1,354 @@
+"""Reconnect-storm admission control for the OCPP WebSocket endpoint.
+
+After a deploy every charger reconnects at once.  Each handshake used to
+run a full ``charge_points`` scan on a whitelist miss, insert one
+``connection_logs`` row, and the BootNotification / StatusNotification that
+follow each requested a rebalance.  This module provides the pieces
+main.py wires into ``_accept_or_reject_ws``:
+
+- ``TokenBucket`` + ``AdmissionController``: handshakes are admitted at
+  ``rate_per_s`` (bursts up to ``burst``) with at most ``max_concurrent``
+  in flight; a charger that cannot be admitted within ``wait_timeout_s`` is
+  told to retry later instead of piling up;
+- ``VersionedWhitelist``: an immutable snapshot of allowed charge point ids
+  with a version that only changes when the set changes; a hit on the
+  accept path never touches SQLite, writers replace it after commit and a
+  miss shares one throttled reload;
+- ``ConnectionLogBatcher``: ``connection_logs`` rows are buffered and
+  written with one ``executemany`` per flush;
+- ``AdmissionController.settle_remaining_s`` lets the rebalance runner hold
+  its single post-storm recomputation until admissions have been quiet for
+  ``settle_s``.
+
+This module intentionally has no FastAPI or OCPP dependency.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Classic token bucket; ``reserve`` returns the wait before the token is usable."""
+
+    def __init__(self, rate_per_s: float, burst: int, clock: Callable[[], float] = time.monotonic):
+        self.rate_per_s = max(0.0, float(rate_per_s))
+        self.burst = max(1, int(burst))
+        self.clock = clock
+        self._tokens = float(self.burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        if self.rate_per_s > 0:
+            self._tokens = min(
+                float(self.burst), self._tokens + (now - self._updated) * self.rate_per_s
+            )
+        self._updated = now
+
+    def reserve(self, max_wait_s: float | None = None) -> float | None:
+        """
+        Take one token; returns seconds to wait (0 = now).
+
+        None when the token would not be available within ``max_wait_s``
+        (nothing is taken in that case).
+        """
+        if self.rate_per_s <= 0:
+            return 0.0
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate_per_s
+            if max_wait_s is not None and wait > max_wait_s:
+                return None
+            self._tokens -= 1
+            return wait
+
+
+@dataclass
+class AdmissionStats:
+    admitted: int = 0
+    rejected_busy: int = 0
+    rejected_whitelist: int = 0
+    in_flight: int = 0
+    peak_in_flight: int = 0
+    last_admitted_at: float | None = None
+
+
+class AdmissionRejected(Exception):
+    """The handshake could not be admitted within the wait budget."""
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        *,
+        rate_per_s: float = 20.0,
+        burst: int = 20,
+        max_concurrent: int = 10,
+        wait_timeout_s: float = 30.0,
+        storm_window_s: float = 10.0,
+        storm_threshold: int = 5,
+        settle_s: float = 10.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.bucket = TokenBucket(rate_per_s, burst, clock)
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.wait_timeout_s = max(0.0, float(wait_timeout_s))
+        self.storm_window_s = max(0.0, float(storm_window_s))
+        self.storm_threshold = max(1, int(storm_threshold))
+        self.settle_s = max(0.0, float(settle_s))
+        self.clock = clock
+        self.stats = AdmissionStats()
+        self._recent: deque[float] = deque()
+        self._storm_until = 0.0
+        self._semaphore: asyncio.Semaphore | None = None
+
+    def _note_admission(self, now: float) -> None:
+        self._recent.append(now)
+        while self._recent and now - self._recent[0] > self.storm_window_s:
+            self._recent.popleft()
+        if len(self._recent) >= self.storm_threshold:
+            if self._storm_until <= now:
+                logger.warning(
+                    f"[WS_ADMISSION][STORM] admissions={len(self._recent)} "
+                    f"| window={self.storm_window_s}s"
+                )
+            self._storm_until = now + self.settle_s
+        elif self._storm_until > now:
+            # 風暴中仍有新連線：延長靜默期
+            self._storm_until = now + self.settle_s
+
+    def storm_active(self) -> bool:
+        return self.settle_remaining_s() > 0
+
+    def settle_remaining_s(self) -> float:
+        """Seconds until the current reconnect storm counts as settled (0 = calm)."""
+        return max(0.0, self._storm_until - self.clock())
+
+    async def acquire(self, cp_id: str) -> None:
+        """Wait for a handshake slot; raises ``AdmissionRejected`` when over budget."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        started = self.clock()
+        wait = self.bucket.reserve(self.wait_timeout_s)
+        if wait is None:
+            self.stats.rejected_busy += 1
+            raise AdmissionRejected(f"rate limited: {cp_id}")
+        if wait > 0:
+            await asyncio.sleep(wait)
+        remaining = self.wait_timeout_s - (self.clock() - started)
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=max(0.0, remaining))
+        except asyncio.TimeoutError:
+            self.stats.rejected_busy += 1
+            raise AdmissionRejected(f"too many concurrent handshakes: {cp_id}")
+        now = self.clock()
+        self.stats.in_flight += 1
+        self.stats.peak_in_flight = max(self.stats.peak_in_flight, self.stats.in_flight)
+        self.stats.admitted += 1
+        self.stats.last_admitted_at = now
+        self._note_admission(now)
+
+    def release(self) -> None:
+        self.stats.in_flight = max(0, self.stats.in_flight - 1)
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    def snapshot(self) -> dict[str, Any]:
+        stats = self.stats
+        return {
+            "rate_per_s": self.bucket.rate_per_s,
+            "burst": self.bucket.burst,
+            "max_concurrent": self.max_concurrent,
+            "wait_timeout_s": self.wait_timeout_s,
+            "admitted": stats.admitted,
+            "rejected_busy": stats.rejected_busy,
+            "rejected_whitelist": stats.rejected_whitelist,
+            "in_flight": stats.in_flight,
+            "peak_in_flight": stats.peak_in_flight,
+            "storm_active": self.storm_active(),
+            "settle_remaining_s": round(self.settle_remaining_s(), 3),
+        }
+
+
+@dataclass(frozen=True)
+class WhitelistSnapshot:
+    version: int
+    ids: frozenset[str]
+    updated_at: float
+    reason: str
+
+
+class VersionedWhitelist:
+    """
+    Allowed charge point ids, replaced atomically.
+
+    Readers get an immutable ``WhitelistSnapshot``; the version only
+    increases when the set actually changes.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self._snapshot = WhitelistSnapshot(0, frozenset(), 0.0, "empty")
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def snapshot(self) -> WhitelistSnapshot:
+        return self._snapshot
+
+    def contains(self, cp_id: str) -> bool:
+        return cp_id in self._snapshot.ids
+
+    def replace(self, ids: Iterable[str], reason: str = "manual") -> WhitelistSnapshot:
+        new_ids = frozenset(ids)
+        with self._lock:
+            current = self._snapshot
+            version = current.version + 1 if new_ids != current.ids or not self._loaded else current.version
+            self._snapshot = WhitelistSnapshot(version, new_ids, self.clock(), reason)
+            self._loaded = True
+            return self._snapshot
+
+
+@dataclass
+class RowBatcherStats:
+    queued: int = 0
+    written: int = 0
+    dropped: int = 0
+    flushes: int = 0
+    errors: int = 0
+    last_error: str | None = None
+
+
+class RowBatcher:
+    """
+    Buffer rows for ``INSERT_SQL`` and write them in batches.
+
+    ``add_row`` is non-blocking; ``flush`` writes everything buffered with
+    one ``executemany`` inside one transaction.  The buffer is bounded by
+    ``max_pending`` (oldest rows are dropped and counted).
+    """
+
+    INSERT_SQL = ""
+    TASK_NAME = "row-batcher"
+
+    def __init__(
+        self,
+        connect: Callable[[], sqlite3.Connection],
+        *,
+        flush_interval_s: float = 1.0,
+        max_batch: int = 200,
+        max_pending: int = 10000,
+    ):
+        self.connect = connect
+        self.flush_interval_s = max(0.05, float(flush_interval_s))
+        self.max_batch = max(1, int(max_batch))
+        self.max_pending = max(1, int(max_pending))
+        self.stats = RowBatcherStats()
+        self._pending: deque[tuple] = deque()
+        self._lock = threading.Lock()
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    def add_row(self, row: tuple) -> None:
+        with self._lock:
+            self._pending.append(row)
+            self.stats.queued += 1
+            while len(self._pending) > self.max_pending:
+                self._pending.popleft()
+                self.stats.dropped += 1
+            full = len(self._pending) >= self.max_batch
+        if full and self._wakeup is not None:
+            self._wakeup.set()
+
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def flush(self) -> int:
+        """Write every buffered row (blocking; call via ``asyncio.to_thread``)."""
+        with self._lock:
+            rows = list(self._pending)
+            self._pending.clear()
+        if not rows:
+            return 0
+        conn = self.connect()
+        try:
+            conn.executemany(self.INSERT_SQL, rows)
+            conn.commit()
+        except Exception as e:
+            self.stats.errors += 1
+            self.stats.last_error = str(e)
+            with self._lock:
+                # 寫入失敗：放回佇列等下一輪（仍受 max_pending 限制）
+                self._pending.extendleft(reversed(rows))
+                while len(self._pending) > self.max_pending:
+                    self._pending.popleft()
+                    self.stats.dropped += 1
+            logger.error(f"[BATCH][{self.TASK_NAME}][FLUSH_ERR] rows={len(rows)} | err={e}")
+            return 0
+        finally:
+            conn.close()
+        self.stats.written += len(rows)
+        self.stats.flushes += 1
+        return len(rows)
+
+    def start(self) -> None:
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(
+            self._run(), name=self.TASK_NAME
+        )
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval_s)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._pending:
+                await asyncio.to_thread(self.flush)
+
+    async def stop(self) -> None:
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await asyncio.to_thread(self.flush)
+
+    def snapshot(self) -> dict[str, Any]:
+        stats = self.stats
+        return {
+            "pending": self.pending(),
+            "queued": stats.queued,
+            "written": stats.written,
+            "dropped": stats.dropped,
+            "flushes": stats.flushes,
+            "errors": stats.errors,
+            "last_error": stats.last_error,
+        }
+
+
+class ConnectionLogBatcher(RowBatcher):
+    """``connection_logs`` rows written in batches off the handshake path."""
+
+    INSERT_SQL = "INSERT INTO connection_logs (charge_point_id, ip, time) VALUES (?, ?, ?)"
+    TASK_NAME = "connection-log-batcher"
+
+    def add(self, charge_point_id: str, ip: str | None, at: str) -> None:
+        self.add_row((charge_point_id, ip, at))